@@ -0,0 +1,93 @@
+"""
+This module benchmarks `vmctl exec` (wrapper.agent.GuestAgentApi) on simulated guests, with a stub agent transport.
+
+StubAgentTransport answers guest-exec and guest-exec-status like qemu-guest-agent does, after a round trip delay,
+and every guest's command runs for a random time. The benchmark runs the same command on every guest one at a time
+and with a pool of workers, checks that every guest's output came back, and reports the wall time, the time until
+the first result arrived and the number of agent calls (status polls included).
+
+usage:
+    python benchmarks/bench_agent.py --guests 64 --parallelism 16 --round-trip-ms 5
+"""
+import argparse
+import base64
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from wrapper.agent import GuestAgentApi
+
+
+class StubAgentTransport:
+    """
+    Answers guest agent commands like an agent in every guest would, without a host.
+    """
+
+    def __init__(self, durations, round_trip: float):
+        self.durations = durations
+        self.round_trip = round_trip
+        self.calls = 0
+        self.processes = {}
+        self.pids = itertools.count(1000)
+        self.lock = threading.Lock()
+
+    def command(self, vm_name: str, execute: str, arguments=None, timeout: float = 5.0):
+        time.sleep(self.round_trip)
+        with self.lock:
+            self.calls += 1
+            if execute == "guest-exec":
+                pid = next(self.pids)
+                self.processes[pid] = (vm_name, time.monotonic(), arguments)
+                return {"pid": pid}
+        if execute != "guest-exec-status":
+            raise ValueError(f"The stub does not answer {execute}.")
+        name, started, arguments = self.processes[arguments["pid"]]
+        if time.monotonic() - started < self.durations[name]:
+            return {"exited": False}
+        output = f"{name}: {' '.join([arguments['path']] + arguments['arg'])}\n"
+        return {"exited": True, "exitcode": 0, "out-data": base64.b64encode(output.encode()).decode()}
+
+
+def run(guests, durations, round_trip: float, parallelism: int):
+    """
+    Runs `uname -a` on every guest.
+
+    Returns:
+        tuple: The results, the wall time, the time to the first result and the number of agent calls.
+    """
+    transport = StubAgentTransport(durations, round_trip)
+    api = GuestAgentApi(None, transport)
+    start = time.perf_counter()
+    first = []
+    results = api.exec(guests, ["uname", "-a"], parallelism=parallelism,
+                       on_result=lambda result: first.append(time.perf_counter() - start) if not first else None)
+    return results, time.perf_counter() - start, first[0], transport.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guests", type=int, default=64, help="number of guests")
+    parser.add_argument("--parallelism", type=int, default=16, help="size of the worker pool")
+    parser.add_argument("--round-trip-ms", type=float, default=5.0, help="delay of every agent call")
+    parser.add_argument("--max-duration-ms", type=float, default=300.0, help="longest time a guest's command runs")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    guests = [f"vm-{index:03d}" for index in range(args.guests)]
+    durations = {name: rng.uniform(0, args.max_duration_ms / 1000) for name in guests}
+
+    print(f"{'parallelism':<12} {'wall s':>8} {'first s':>8} {'agent calls':>12}")
+    for parallelism in (1, args.parallelism):
+        results, wall, first, calls = run(guests, durations, args.round_trip_ms / 1000, parallelism)
+        assert sorted(result["name"] for result in results) == guests, "a guest's result is missing"
+        assert all(result["stdout"].startswith(result["name"]) for result in results), "a guest's output is wrong"
+        print(f"{parallelism:<12} {wall:>8.2f} {first:>8.2f} {calls:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+This module benchmarks the asyncio API (wrapper.aio) on the in-memory `test:///default` hypervisor.
+
+It defines a number of domains, then reads the info of every one of them with AsyncLibVirtApi at several pool
+sizes, while a heartbeat task measures how late the event loop wakes it up. A loop that never blocks keeps
+the heartbeat's lag close to its interval, however many calls are in flight.
+
+usage:
+    python benchmarks/bench_aio.py --domains 2000 --parallelism 1 8 32
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from wrapper.aio import AsyncLibVirtApi
+
+DOMAIN_XML = """
+<domain type='test'>
+    <name>{name}</name>
+    <memory unit='MiB'>128</memory>
+    <vcpu>1</vcpu>
+    <os>
+        <type arch='x86_64'>hvm</type>
+    </os>
+</domain>
+"""
+
+HEARTBEAT_INTERVAL = 0.005
+
+
+async def heartbeat(lags):
+    """
+    Sleeps in a loop and records how late each wake up was.
+
+    Args:
+        lags (list): Receives the lag of every wake up in seconds.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lags.append(time.perf_counter() - start - HEARTBEAT_INTERVAL)
+
+
+async def bench(domains: int, parallelism: int):
+    """
+    Reads the info of every domain concurrently.
+
+    Args:
+        domains (int): The number of domains to define.
+        parallelism (int): The size of the connection's thread pool.
+
+    Returns:
+        tuple: The elapsed time in seconds and the worst heartbeat lag in seconds.
+    """
+    # the test driver keeps its state per connection, every round starts from scratch
+    api = await AsyncLibVirtApi.open("test:///default", parallelism, events=False)
+    names = [f"bench-{index:05d}" for index in range(domains)]
+    for name in names:
+        api.api.connection.defineXML(DOMAIN_XML.format(name=name))
+
+    lags = []
+    beat = asyncio.ensure_future(heartbeat(lags))
+    start = time.perf_counter()
+    infos = await asyncio.gather(*(api.get_vm_info(name) for name in names))
+    elapsed = time.perf_counter() - start
+    beat.cancel()
+    assert [info.name for info in infos] == names
+
+    await api.close()
+    return elapsed, max(lags, default=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--domains", type=int, default=2000, help="number of domains to define")
+    parser.add_argument("--parallelism", type=int, nargs="+", default=[1, 8, 32], help="thread pool sizes to measure")
+    args = parser.parse_args()
+
+    print(f"{'parallelism':>12} {'total ms':>10} {'calls/s':>10} {'max lag ms':>11}")
+    for parallelism in args.parallelism:
+        elapsed, lag = asyncio.run(bench(args.domains, parallelism))
+        print(f"{parallelism:>12} {elapsed * 1000:>10.2f} {args.domains / elapsed:>10.0f} {lag * 1000:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
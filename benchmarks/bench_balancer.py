@@ -0,0 +1,102 @@
+"""
+This module benchmarks the memory auto-balancer (utils.balancer) on synthetic guests, without a host.
+
+Every guest has a working set that follows its own pattern (idle, steady or bursty), and every tick its balloon
+stats are derived from the working set and the balloon size the balancer gave it, like the balloon driver would
+report them. The benchmark reports how much memory the balancer reclaimed, how often the guests were under pressure (less than `low_free` of their memory free),
+how many balloon changes it made and how many of those reversed the previous change of the same VM (oscillation),
+and how long a decision takes.
+
+usage:
+    python benchmarks/bench_balancer.py --vms 50 --ticks 500 --record trace.ndjson
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from utils.balancer import BalloonBalancer
+
+MIB = 1024
+
+
+def working_set(pattern: str, tick: int, phase: float, maximum: int):
+    """
+    Gets the memory a guest uses at a tick.
+
+    Returns:
+        int: The working set in KiB.
+    """
+    if pattern == "idle":
+        return int(maximum * 0.15)
+    if pattern == "steady":
+        return int(maximum * 0.55)
+    # bursty guests swing between 20% and 90% of their memory
+    return int(maximum * (0.55 + 0.35 * math.sin(tick / 20 + phase)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vms", type=int, default=50, help="number of guests")
+    parser.add_argument("--ticks", type=int, default=500, help="number of ticks")
+    parser.add_argument("--memory", type=int, default=4096, help="maximum memory of each guest in MiB")
+    parser.add_argument("--host-free", type=int, default=2048, help="free memory of the host in MiB")
+    parser.add_argument("--record", help="also write the stats as a trace for `vmctl mem balance --replay`")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    maximum = args.memory * MIB
+    guests = {f"vm-{index:03d}": {"pattern": rng.choice(["idle", "steady", "bursty"]), "phase": rng.uniform(0, 6.28),
+                                  "current": maximum, "swap_in": 0, "last": 0}
+              for index in range(args.vms)}
+
+    balancer = BalloonBalancer({})
+    record = open(args.record, "w") if args.record else None
+    changes = reversals = pressured = 0
+    decide_seconds = 0.0
+    for tick in range(args.ticks):
+        samples = {}
+        for name, guest in guests.items():
+            used = working_set(guest["pattern"], tick, guest["phase"], maximum)
+            available = guest["current"]
+            if used > available:
+                # what does not fit is swapped
+                guest["swap_in"] += used - available
+            if available - used < available * balancer.settings["low_free"]:
+                pressured += 1
+            samples[name] = {"current": guest["current"], "maximum": maximum, "available": available,
+                             "usable": max(0, available - used), "unused": max(0, available - used),
+                             "swap_in": guest["swap_in"], "major_fault": 0}
+        host_free = args.host_free * MIB
+        if record:
+            record.write(json.dumps({"time": tick, "host_free": host_free, "samples": samples}) + "\n")
+
+        start = time.perf_counter()
+        decisions = balancer.decide(samples, host_free)
+        decide_seconds += time.perf_counter() - start
+        for decision in decisions:
+            guest = guests[decision["name"]]
+            direction = 1 if decision["target"] > decision["current"] else -1
+            reversals += guest["last"] == -direction
+            guest["last"] = direction
+            guest["current"] = decision["target"]
+            changes += 1
+
+    if record:
+        record.close()
+    reclaimed = sum(maximum - guest["current"] for guest in guests.values()) // MIB
+    patterns = {pattern: sum(guest["pattern"] == pattern for guest in guests.values()) for pattern in ["idle", "steady", "bursty"]}
+    print(f"guests              {args.vms} ({', '.join(f'{pattern} {count}' for pattern, count in patterns.items())})")
+    print(f"reclaimed           {reclaimed} MiB of {args.vms * args.memory} MiB")
+    print(f"pressured samples   {pressured} of {args.vms * args.ticks}")
+    print(f"balloon changes     {changes} ({reversals} reversals)")
+    print(f"decision time       {decide_seconds / args.ticks * 1000:.3f} ms per tick")
+
+
+if __name__ == "__main__":
+    main()
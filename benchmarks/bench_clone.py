@@ -0,0 +1,130 @@
+"""
+This module benchmarks `vmctl clone` against full copies of a base image.
+
+It seeds the in-memory `test:///default` hypervisor with a base VM whose disk is a volume of the
+test driver's default pool, then times CloneApi creating a growing number of clones. Then, on local
+temporary files, it compares copying a base image with creating a qcow2 overlay of it (with qemu-img,
+when it is installed), which is the I/O a clone saves on a real host.
+
+usage:
+    python benchmarks/bench_clone.py --counts 1 10 50 --image-size 512
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvirt
+from wrapper.clone import CloneApi
+
+BASE_VOLUME_XML = """
+<volume>
+    <name>bench-base.qcow2</name>
+    <capacity unit='GiB'>10</capacity>
+    <target>
+        <format type='qcow2'/>
+    </target>
+</volume>
+"""
+
+BASE_DOMAIN_XML = """
+<domain type='test'>
+    <name>bench-base</name>
+    <memory unit='MiB'>128</memory>
+    <vcpu>1</vcpu>
+    <os>
+        <type arch='x86_64'>hvm</type>
+    </os>
+    <devices>
+        <disk type='file' device='disk'>
+            <driver name='qemu' type='qcow2'/>
+            <source file='{path}'/>
+            <target dev='vda' bus='virtio'/>
+        </disk>
+        <interface type='network'>
+            <mac address='52:54:00:00:00:01'/>
+            <source network='default'/>
+        </interface>
+    </devices>
+</domain>
+"""
+
+
+def seed_base(connection):
+    """
+    Creates the base volume and defines the base VM on the test driver.
+
+    Args:
+        connection (libvirt.virConnect): The connection to the test driver.
+    """
+    pool = connection.storagePoolLookupByName("default-pool")
+    volume = pool.createXML(BASE_VOLUME_XML, 0)
+    connection.defineXML(BASE_DOMAIN_XML.format(path=volume.path()))
+
+
+def bench_libvirt(counts):
+    """
+    Times cloning the base VM through the test driver.
+
+    Args:
+        counts (list): The numbers of clones to create.
+    """
+    print(f"{'clones':>8} {'total ms':>10} {'ms/clone':>10} {'failed':>7}")
+    for count in counts:
+        # the test driver keeps its state in memory, closing the
+        # last connection below resets it for the next round
+        connection = libvirt.open("test:///default")
+        seed_base(connection)
+        start = time.perf_counter()
+        results = CloneApi(connection).clone("bench-base", [f"bench-{index:05d}" for index in range(count)])
+        elapsed = (time.perf_counter() - start) * 1000
+        failed = sum(1 for result in results if result["status"] == "failed")
+        print(f"{count:>8} {elapsed:>10.2f} {elapsed / count:>10.2f} {failed:>7}")
+        connection.close()
+
+
+def bench_local(image_size: int):
+    """
+    Compares copying a base image with creating a qcow2 overlay of it, on local temporary files.
+
+    Args:
+        image_size (int): The amount of data in the base image in MiB.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        base = os.path.join(directory, "base.img")
+        with open(base, "wb") as base_file:
+            chunk = os.urandom(1024 * 1024)
+            for _ in range(image_size):
+                base_file.write(chunk)
+
+        start = time.perf_counter()
+        shutil.copyfile(base, os.path.join(directory, "copy.img"))
+        copy_ms = (time.perf_counter() - start) * 1000
+        print(f"full copy of {image_size} MiB: {copy_ms:.2f} ms")
+
+        if shutil.which("qemu-img") is None:
+            print("qemu-img is not installed, skipping the overlay measurement")
+            return
+        start = time.perf_counter()
+        subprocess.run(["qemu-img", "create", "-q", "-f", "qcow2", "-b", base, "-F", "raw", os.path.join(directory, "overlay.qcow2")], check=True)
+        overlay_ms = (time.perf_counter() - start) * 1000
+        print(f"qcow2 overlay:      {overlay_ms:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 10, 50], help="numbers of clones to create")
+    parser.add_argument("--image-size", type=int, default=512, help="size of the local base image in MiB")
+    args = parser.parse_args()
+
+    bench_libvirt(args.counts)
+    bench_local(args.image_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+This module benchmarks the latency of vmctl commands with and without the vmctl daemon.
+
+Every command is run as a fresh `python src/main.py ...` process, first connecting to libvirt
+directly (cold) and then through a daemon that keeps the connection open.
+
+usage:
+    python benchmarks/bench_daemon.py --uri test:///default --runs 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "main.py")
+
+COMMANDS = [
+    ["hostinfo"],
+    ["list"],
+    ["info", "test"],
+    ["start", "test"],
+]
+
+
+def time_command(command, env, runs):
+    """
+    Runs a vmctl command several times and measures its latency.
+
+    Args:
+        command (list): The vmctl arguments.
+        env (dict): The environment to run vmctl with.
+        runs (int): The number of runs.
+
+    Returns:
+        float: The median latency in milliseconds.
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, MAIN_PATH, *command], env=env, stdout=subprocess.DEVNULL, check=False)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def wait_for_socket(socket_path, timeout=10):
+    """
+    Waits until the daemon has created its socket.
+
+    Args:
+        socket_path (str): The path of the daemon's socket.
+        timeout (int, optional): The maximum time to wait in seconds. Defaults to 10.
+    """
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(socket_path):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"the daemon did not create {socket_path}")
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="test:///default", help="libvirt URI to benchmark against")
+    parser.add_argument("--runs", type=int, default=10, help="runs per command")
+    args = parser.parse_args()
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "vmctl.sock")
+    env = dict(os.environ, VMCTL_URI=args.uri, VMCTL_SOCKET=socket_path)
+    cold_env = dict(env, VMCTL_NO_DAEMON="1")
+
+    daemon = subprocess.Popen([sys.executable, MAIN_PATH, "daemon"], env=cold_env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_socket(socket_path)
+        print(f"{'command':<16} {'cold ms':>10} {'daemon ms':>10}")
+        for command in COMMANDS:
+            cold_ms = time_command(command, cold_env, args.runs)
+            daemon_ms = time_command(command, env, args.runs)
+            print(f"{' '.join(command):<16} {cold_ms:>10.1f} {daemon_ms:>10.1f}")
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+if __name__ == "__main__":
+    main()
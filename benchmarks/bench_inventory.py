@@ -0,0 +1,94 @@
+"""
+This module benchmarks the local inventory (`vmctl list --cached`, `vmctl find`) on the in-memory `test:///default`
+hypervisor.
+
+It defines a number of domains, then compares a name search done against libvirt (list every domain and read the
+XML of each, which is what finding a VM by tag takes without an index) with the first refresh of the inventory,
+an incremental refresh after a few state changes, and the same search answered from the inventory.
+
+usage:
+    python benchmarks/bench_inventory.py --domains 2000 --changes 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvirt
+from utils.inventory import Inventory
+from wrapper.inventory import InventoryApi
+
+DOMAIN_XML = """
+<domain type='test'>
+    <name>{name}</name>
+    <memory unit='MiB'>128</memory>
+    <vcpu>1</vcpu>
+    <os>
+        <type arch='x86_64'>hvm</type>
+    </os>
+    <metadata>
+        <bench:owner xmlns:bench="https://example.com/bench">{owner}</bench:owner>
+    </metadata>
+</domain>
+"""
+
+
+def timed(func):
+    """
+    Calls a function and measures it.
+
+    Returns:
+        tuple: The value returned and the time taken in milliseconds.
+    """
+    start = time.perf_counter()
+    value = func()
+    return value, (time.perf_counter() - start) * 1000
+
+
+def search_libvirt(connection, owner):
+    """
+    Finds the domains of an owner by reading the XML of every domain.
+
+    Returns:
+        list: The names of the domains.
+    """
+    return [domain.name() for domain in connection.listAllDomains() if f">{owner}<" in domain.XMLDesc(0)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--domains", type=int, default=2000, help="number of domains to define")
+    parser.add_argument("--changes", type=int, default=10, help="number of domains started between refreshes")
+    args = parser.parse_args()
+
+    connection = libvirt.open("test:///default")
+    names = [f"bench-{index:05d}" for index in range(args.domains)]
+    for index, name in enumerate(names):
+        connection.defineXML(DOMAIN_XML.format(name=name, owner=f"team-{index % 10}"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        inventory = Inventory(os.path.join(directory, "inventory.db"))
+        api = InventoryApi(connection, "test:///default", inventory=inventory)
+
+        expected, libvirt_ms = timed(lambda: search_libvirt(connection, "team-3"))
+        first, first_ms = timed(api.refresh)
+        for name in names[:args.changes]:
+            connection.lookupByName(name).create()
+        again, again_ms = timed(api.refresh)
+        found, cached_ms = timed(lambda: inventory.get_vms(tags={"owner": "team-3"}))
+
+        assert sorted(vm["name"] for vm in found) == sorted(expected), "the inventory and libvirt disagree"
+        print(f"{'operation':<28} {'ms':>9} {'XMLs read':>10}")
+        print(f"{'search libvirt (by tag)':<28} {libvirt_ms:>9.1f} {args.domains:>10}")
+        print(f"{'first refresh':<28} {first_ms:>9.1f} {first['read']:>10}")
+        print(f"{'refresh after changes':<28} {again_ms:>9.1f} {again['read']:>10}")
+        print(f"{'search inventory (by tag)':<28} {cached_ms:>9.1f} {0:>10}")
+        inventory.close()
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+This module benchmarks `vmctl list` against the libvirt test driver.
+
+It seeds the in-memory `test:///default` hypervisor with a growing number of domains and
+compares the number of libvirt RPCs (and the wall time) needed to build the VM listing with
+the old per-domain approach and with the bulk getAllDomainStats approach used by VMApi.
+
+usage:
+    python benchmarks/bench_list.py --counts 10 100 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvirt
+from wrapper.vm import VMApi
+
+# these methods only read fields cached on the python object,
+# they never result in a round trip to the libvirt daemon
+LOCAL_METHODS = {"name", "ID", "UUID", "UUIDString", "connect"}
+
+DOMAIN_XML = """
+<domain type='test'>
+    <name>{name}</name>
+    <memory unit='MiB'>128</memory>
+    <vcpu>1</vcpu>
+    <os>
+        <type arch='x86_64'>hvm</type>
+    </os>
+</domain>
+"""
+
+
+class CountingProxy:
+    """
+    A proxy that counts the libvirt RPCs made through a connection and the domains it returns.
+    """
+
+    def __init__(self, target, counter):
+        """
+        Initializes the CountingProxy class.
+
+        Args:
+            target (object): The libvirt object to proxy.
+            counter (dict): A shared dictionary holding the "rpcs" count.
+        """
+        self._target = target
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        def wrapper(*args, **kwargs):
+            if name not in LOCAL_METHODS:
+                self._counter["rpcs"] += 1
+            return self._wrap(attribute(*args, **kwargs))
+        return wrapper
+
+    def _wrap(self, value):
+        if isinstance(value, libvirt.virDomain):
+            return CountingProxy(value, self._counter)
+        if isinstance(value, list):
+            return [self._wrap(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple(self._wrap(item) for item in value)
+        return value
+
+
+def seed_domains(connection, count):
+    """
+    Defines `count` domains on the test driver and starts every other one.
+
+    Args:
+        connection (libvirt.virConnect): The connection to the test driver.
+        count (int): The number of domains to define.
+    """
+    for index in range(count):
+        domain = connection.defineXML(DOMAIN_XML.format(name=f"bench-{index:05d}"))
+        if index % 2 == 0:
+            domain.create()
+
+
+def legacy_list(connection):
+    """
+    Builds the VM listing the way vmctl used to, with several RPCs per domain.
+
+    Args:
+        connection (libvirt.virConnect): The connection object.
+
+    Returns:
+        list: A list of (id, name, state) tuples.
+    """
+    rows = []
+    for domain in connection.listAllDomains():
+        state, _ = domain.state()
+        rows.append((domain.ID(), domain.name(), state))
+    return rows
+
+
+def measure(func, connection):
+    """
+    Runs a listing function through a counting proxy.
+
+    Args:
+        func (callable): The listing function, called with the proxied connection.
+        connection (libvirt.virConnect): The connection object.
+
+    Returns:
+        tuple: The number of RPCs made and the wall time in milliseconds.
+    """
+    counter = {"rpcs": 0}
+    start = time.perf_counter()
+    func(CountingProxy(connection, counter))
+    elapsed = (time.perf_counter() - start) * 1000
+    return counter["rpcs"], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000], help="domain counts to benchmark")
+    args = parser.parse_args()
+
+    print(f"{'domains':>8} {'legacy rpcs':>12} {'legacy ms':>10} {'bulk rpcs':>10} {'bulk ms':>8}")
+    for count in args.counts:
+        # the test driver keeps its state in memory, closing the
+        # last connection below resets it for the next round
+        connection = libvirt.open("test:///default")
+        seed_domains(connection, count)
+
+        legacy_rpcs, legacy_ms = measure(legacy_list, connection)
+        bulk_rpcs, bulk_ms = measure(lambda conn: VMApi(conn).get_vms(), connection)
+        print(f"{count:>8} {legacy_rpcs:>12} {legacy_ms:>10.2f} {bulk_rpcs:>10} {bulk_ms:>8.2f}")
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
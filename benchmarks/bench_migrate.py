@@ -0,0 +1,149 @@
+"""
+This module benchmarks how the concurrency limit of `vmctl migrate` trades per-VM time for total time.
+
+The test driver cannot migrate, so the transfers are simulated: every migration of the running `test:///default`
+domains copies its memory over one shared link, re-sending what the guest dirties meanwhile, and completes once
+what remains can be sent within the downtime target. Everything else is MigrationApi's own code: the checks
+against a second test driver host (read from a temporary node file, so it does not share the state of
+`test:///default`), the limit on concurrent migrations and the progress read while they run.
+
+usage:
+    python benchmarks/bench_migrate.py --vms 8 --memory 1024 --link 1000 --limits 1 2 4 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvirt
+from wrapper.migrate import MigrationApi
+
+DOMAIN_XML = """
+<domain type='test'>
+    <name>{name}</name>
+    <memory unit='MiB'>{memory}</memory>
+    <vcpu>1</vcpu>
+    <os>
+        <type arch='x86_64'>hvm</type>
+    </os>
+</domain>
+"""
+
+# an empty destination host with room for every vm
+DESTINATION_XML = """
+<node>
+    <cpu>
+        <nodes>1</nodes>
+        <sockets>1</sockets>
+        <cores>32</cores>
+        <threads>2</threads>
+        <active>64</active>
+        <mhz>2000</mhz>
+        <model>x86_64</model>
+    </cpu>
+    <memory>268435456</memory>
+</node>
+"""
+
+TICK = 0.02
+
+
+class SimulatedMigrationApi(MigrationApi):
+    """
+    A MigrationApi whose transfers are simulated over a shared link.
+    """
+
+    def __init__(self, connection, link: float, dirty_rate: float, downtime: float):
+        """
+        Initializes the SimulatedMigrationApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection to the source host.
+            link (float): The bandwidth of the link shared by all migrations in MiB/s.
+            dirty_rate (float): The rate each guest dirties its memory at in MiB/s.
+            downtime (float): The downtime target in seconds.
+        """
+        super().__init__(connection)
+        self.link = link
+        self.dirty_rate = dirty_rate
+        self.downtime = downtime
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.max_active = 0
+
+    def _start_migration(self, domain, dest_uri, params, flags):
+        cap = params.get(libvirt.VIR_MIGRATE_PARAM_BANDWIDTH) or float("inf")
+        total = domain.info()[1] * 1024
+        job = {"memory_total": total, "memory_remaining": total, "memory_bps": 0, "memory_iteration": 1,
+               "memory_dirty_rate": int(self.dirty_rate * 1024 * 1024 / 4096), "memory_page_size": 4096}
+        with self.jobs_lock:
+            self.jobs[domain.name()] = job
+            self.max_active = max(self.max_active, len(self.jobs))
+        try:
+            sent = 0
+            while True:
+                time.sleep(TICK)
+                with self.jobs_lock:
+                    rate = min(cap, self.link / len(self.jobs)) * 1024 * 1024
+                    if job["memory_remaining"] <= rate * self.downtime:
+                        return
+                    step = rate * TICK
+                    job["memory_remaining"] = max(0, job["memory_remaining"] - step) + self.dirty_rate * 1024 * 1024 * TICK
+                    job["memory_bps"] = int(rate)
+                    sent += step
+                    job["memory_iteration"] = 1 + int(sent // total)
+        finally:
+            with self.jobs_lock:
+                del self.jobs[domain.name()]
+
+    def _read_job_stats(self, domain):
+        with self.jobs_lock:
+            job = self.jobs.get(domain.name())
+            if job is None:
+                raise libvirt.libvirtError("no migration job")
+            return dict(job)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vms", type=int, default=8, help="number of VMs to migrate")
+    parser.add_argument("--memory", type=int, default=1024, help="memory of each VM in MiB")
+    parser.add_argument("--link", type=float, default=1000, help="bandwidth of the link in MiB/s")
+    parser.add_argument("--dirty-rate", type=float, default=50, help="rate each guest dirties memory at in MiB/s")
+    parser.add_argument("--downtime", type=float, default=0.3, help="downtime target in seconds")
+    parser.add_argument("--limits", type=int, nargs="+", default=[1, 2, 4, 8], help="concurrency limits to measure")
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".xml") as destination:
+        destination.write(DESTINATION_XML)
+        destination.flush()
+        dest_uri = f"test://{destination.name}"
+
+        print(f"{'limit':>6} {'total s':>9} {'mean s/vm':>10} {'max active':>11} {'progress reads':>15} {'failed':>7}")
+        for limit in args.limits:
+            connection = libvirt.open("test:///default")
+            names = [f"bench-{index:03d}" for index in range(args.vms)]
+            for name in names:
+                connection.defineXML(DOMAIN_XML.format(name=name, memory=args.memory)).create()
+
+            api = SimulatedMigrationApi(connection, args.link, args.dirty_rate, args.downtime)
+            reads = []
+            start = time.perf_counter()
+            results = api.migrate(names, dest_uri, max_concurrent=limit, force=True, poll_interval=0.05, on_progress=reads.append)
+            elapsed = time.perf_counter() - start
+
+            assert api.max_active <= limit, f"{api.max_active} migrations ran at once with a limit of {limit}"
+            failed = [result for result in results if result["status"] == "failed"]
+            mean = sum(result["seconds"] for result in results) / len(results)
+            print(f"{limit:>6} {elapsed:>9.2f} {mean:>10.2f} {api.max_active:>11} {len(reads):>15} {len(failed):>7}")
+            for result in failed:
+                print(f"  {result['name']}: {result['message']}")
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+This module benchmarks the NUMA placement engine on a synthetic host.
+
+It builds capabilities XML for a host with several NUMA nodes (no multi-socket machine needed),
+places a batch of VMs with every strategy, checks that no node runs out of memory and that no CPU
+is shared while another one is still free, and reports how the VMs were spread and how long it took.
+
+usage:
+    python benchmarks/bench_placement.py --nodes 2 --cores 8 --threads 2 --vms 24 --vcpus 2 --memory 4096
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from utils.errors import VmctlError
+from wrapper.placement import PlacementEngine, format_cpuset, parse_capabilities
+
+
+def synthetic_capabilities(nodes: int, cores: int, threads: int, memory: int):
+    """
+    Creates the capabilities XML of a host with one socket per NUMA node.
+
+    Args:
+        nodes (int): The number of NUMA nodes.
+        cores (int): The number of cores per node.
+        threads (int): The number of threads per core.
+        memory (int): The memory of each node in MiB.
+
+    Returns:
+        str: The capabilities XML.
+    """
+    cells = []
+    for node in range(nodes):
+        cpus = []
+        for core in range(cores):
+            # linux numbers the second thread of every core after all the first threads
+            ids = [node * cores + core + thread * nodes * cores for thread in range(threads)]
+            siblings = ",".join(str(cpu) for cpu in ids)
+            cpus += [f"<cpu id='{cpu}' socket_id='{node}' core_id='{core}' siblings='{siblings}'/>" for cpu in ids]
+        cells.append(f"""
+        <cell id='{node}'>
+          <memory unit='KiB'>{memory * 1024}</memory>
+          <cpus num='{len(cpus)}'>{''.join(cpus)}</cpus>
+        </cell>""")
+    return f"<capabilities><host><topology><cells num='{nodes}'>{''.join(cells)}</cells></topology></host></capabilities>"
+
+
+def check_placements(nodes, placements, vm_memory: int):
+    """
+    Checks that the placements fit the host.
+
+    Args:
+        nodes (list): The NUMA nodes, as returned by parse_capabilities.
+        placements (list): The placements returned by PlacementEngine.place.
+        vm_memory (int): The memory of each VM in MiB.
+
+    Raises:
+        AssertionError: If a node ran out of memory, or a CPU was shared while another CPU of its node was free.
+    """
+    node_cpus = {node["id"]: {cpu["id"] for cpu in node["cpus"]} for node in nodes}
+    node_memory = {node["id"]: node["memory"] for node in nodes}
+    used_memory = Counter()
+    pins = Counter()
+    for placement in placements:
+        assert set(placement["cpus"]) <= node_cpus[placement["node"]], "a vcpu was pinned outside of its node"
+        used_memory[placement["node"]] += vm_memory * 1024
+        pins.update(placement["cpus"])
+    for node, cpus in node_cpus.items():
+        assert used_memory[node] <= node_memory[node], f"node {node} ran out of memory"
+        counts = [pins[cpu] for cpu in cpus]
+        assert max(counts) - min(counts) <= 1, f"cpus of node {node} are shared while others are free"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=2, help="number of NUMA nodes")
+    parser.add_argument("--cores", type=int, default=8, help="cores per node")
+    parser.add_argument("--threads", type=int, default=2, help="threads per core")
+    parser.add_argument("--node-memory", type=int, default=65536, help="memory of each node in MiB")
+    parser.add_argument("--vms", type=int, default=24, help="number of VMs to place")
+    parser.add_argument("--vcpus", type=int, default=2, help="vCPUs of each VM")
+    parser.add_argument("--memory", type=int, default=4096, help="memory of each VM in MiB")
+    args = parser.parse_args()
+
+    nodes = parse_capabilities(synthetic_capabilities(args.nodes, args.cores, args.threads, args.node_memory))
+    free_memory = {node["id"]: node["memory"] for node in nodes}
+
+    print(f"{'strategy':>8} {'placed':>7} {'ms':>8}  vms per node / first placement")
+    for strategy in ["auto", "pack", "spread"]:
+        engine = PlacementEngine(nodes, free_memory, [], strategy)
+        placements = []
+        start = time.perf_counter()
+        for _ in range(args.vms):
+            try:
+                placements.append(engine.place(args.vcpus, args.memory))
+            except VmctlError:
+                break
+        elapsed = (time.perf_counter() - start) * 1000
+        check_placements(nodes, placements, args.memory)
+
+        per_node = Counter(placement["node"] for placement in placements)
+        distribution = " ".join(f"{node['id']}:{per_node[node['id']]}" for node in nodes)
+        first = f"node {placements[0]['node']} cpus {format_cpuset(placements[0]['cpus'])}" if placements else "-"
+        print(f"{strategy:>8} {len(placements):>7} {elapsed:>8.2f}  {distribution} / {first}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+This module benchmarks the cost of vmctl's profiling (`--profile`) on the in-memory `test:///default` hypervisor.
+
+It defines a number of domains, then reads the state of every one of them through a plain connection, a
+connection with profiling off (which is the same plain connection, plus the None checks of phase()) and an
+instrumented connection, and reports the time per call of each.
+
+usage:
+    python benchmarks/bench_profiling.py --domains 500 --rounds 20
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvirt
+from utils import profiling
+from wrapper.instrument import instrument
+
+DOMAIN_XML = """
+<domain type='test'>
+    <name>{name}</name>
+    <memory unit='MiB'>128</memory>
+    <vcpu>1</vcpu>
+    <os>
+        <type arch='x86_64'>hvm</type>
+    </os>
+</domain>
+"""
+
+
+def read_states(connection, names):
+    """
+    Looks up every domain and reads its state.
+
+    Args:
+        connection (libvirt.virConnect): The connection, instrumented or not.
+        names (list): The names of the domains.
+
+    Returns:
+        int: The number of libvirt calls made.
+    """
+    for name in names:
+        connection.lookupByName(name).state()
+    return len(names) * 2
+
+
+def measure(connection, names, rounds, phased):
+    """
+    Reads the states a number of times.
+
+    Args:
+        connection (libvirt.virConnect): The connection, instrumented or not.
+        names (list): The names of the domains.
+        rounds (int): The number of times every domain is read.
+        phased (bool): Whether every round runs inside a phase, like the CLI's commands.
+
+    Returns:
+        float: The mean time per libvirt call in microseconds.
+    """
+    calls = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if phased:
+            with profiling.phase("command"):
+                calls += read_states(connection, names)
+        else:
+            calls += read_states(connection, names)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--domains", type=int, default=500, help="number of domains to define")
+    parser.add_argument("--rounds", type=int, default=20, help="number of times every domain is read")
+    args = parser.parse_args()
+
+    connection = libvirt.open("test:///default")
+    names = [f"bench-{index:04d}" for index in range(args.domains)]
+    for name in names:
+        connection.defineXML(DOMAIN_XML.format(name=name))
+
+    # without profiling.enable() phase() is a no-op and the connection is never wrapped
+    plain = measure(connection, names, args.rounds, phased=False)
+    disabled = measure(connection, names, args.rounds, phased=True)
+    profiler = profiling.enable()
+    enabled = measure(instrument(connection, profiler), names, args.rounds, phased=True)
+
+    print(f"{'mode':<10} {'us/call':>9} {'overhead':>9}")
+    for mode, per_call in [("plain", plain), ("disabled", disabled), ("enabled", enabled)]:
+        print(f"{mode:<10} {per_call:>9.2f} {per_call / plain - 1:>+9.1%}")
+    print(f"{len(profiler.events)} events recorded")
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+This module benchmarks wrapper.resilient.ResilientConnection by injecting faults into a connection to the libvirt
+test driver (`test:///default`).
+
+FlakyHost stands in for a libvirtd that restarts now and then: a call fails as if the daemon went away, every
+connection opened before that stays dead, and the next few attempts to connect are refused. Calls also fail, less
+often, as if the domain were busy with another job. The same workload (listing stats, looking up the domain and
+reading it, and pausing or resuming it) runs through a plain connection and through a ResilientConnection. The
+benchmark checks that the resilient one keeps working across restarts and never repeats a call that is not
+idempotent, and reports the failed calls, reconnects and wall time of both, and the overhead per call of the proxy
+on a healthy connection.
+
+usage:
+    python benchmarks/bench_reconnect.py --rounds 2000 --drop-rate 0.01 --busy-rate 0.02 --outage 2
+"""
+import argparse
+import collections
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvirt
+from wrapper.resilient import ResilientConnection, is_idempotent
+
+URI = "test:///default"
+
+# calls that never reach the daemon, so a dead connection does not fail them
+LOCAL_METHODS = {"close", "setKeepAlive", "registerCloseCallback", "name", "UUIDString"}
+
+SETTINGS = {"attempts": 4, "base_delay": 0.001, "max_delay": 0.01}
+
+
+class InjectedError(libvirt.libvirtError):
+    """
+    A libvirt error with a chosen error code, raised without a failed libvirt call behind it.
+    """
+
+    def __init__(self, code: int, message: str, domain: int = libvirt.VIR_FROM_RPC):
+        Exception.__init__(self, message)
+        self.err = (code, domain, message, libvirt.VIR_ERR_ERROR, None, None, None, -1, -1)
+
+    def get_error_code(self):
+        return self.err[0]
+
+    def get_error_domain(self):
+        return self.err[1]
+
+
+class FlakyHost:
+    """
+    Opens connections to the test driver that fail like those to a libvirtd that restarts now and then.
+    """
+
+    def __init__(self, rng, drop_rate: float, busy_rate: float, outage: int):
+        self.rng = rng
+        self.drop_rate = drop_rate
+        self.busy_rate = busy_rate
+        self.outage = outage
+        # bumped on every restart, connections opened before it are dead
+        self.epoch = 0
+        self.refusals = 0
+        self.restarts = 0
+        self.calls = collections.Counter()
+
+    def open(self, uri: str):
+        if self.refusals:
+            self.refusals -= 1
+            raise InjectedError(libvirt.VIR_ERR_SYSTEM_ERROR, "Failed to connect socket: Connection refused")
+        return FlakyConnection(libvirt.open(uri), self)
+
+    def check(self, epoch: int, method: str):
+        """
+        Fails a call the way the host would, before it is made.
+        """
+        self.calls[method] += 1
+        if epoch != self.epoch:
+            raise InjectedError(libvirt.VIR_ERR_INVALID_CONN, "internal error: client socket is closed")
+        roll = self.rng.random()
+        if roll < self.drop_rate:
+            self.epoch += 1
+            self.restarts += 1
+            self.refusals = self.outage
+            raise InjectedError(libvirt.VIR_ERR_SYSTEM_ERROR, "End of file while reading data: Input/output error")
+        if roll < self.drop_rate + self.busy_rate:
+            raise InjectedError(libvirt.VIR_ERR_OPERATION_TIMEOUT,
+                                "Timed out during operation: cannot acquire state change lock", libvirt.VIR_FROM_QEMU)
+
+
+class FlakyConnection:
+    """
+    A connection whose calls, and those of its domains, go through FlakyHost.check first.
+    """
+
+    def __init__(self, target, host: FlakyHost):
+        self._target = target
+        self._host = host
+        self._epoch = host.epoch
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute) or name in LOCAL_METHODS:
+            return attribute
+
+        def wrapper(*args, **kwargs):
+            self._host.check(self._epoch, name)
+            return self._wrap(attribute(*args, **kwargs))
+        return wrapper
+
+    def _wrap(self, value):
+        if isinstance(value, libvirt.virDomain):
+            return FlakyDomain(value, self)
+        if isinstance(value, list):
+            return [self._wrap(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple(self._wrap(item) for item in value)
+        return value
+
+
+class FlakyDomain(libvirt.virDomain):
+    """
+    A domain of a FlakyConnection. It is a virDomain, so ResilientConnection wraps it like any other domain.
+    """
+
+    def __init__(self, target, connection: FlakyConnection):
+        # virDomain.__init__ is not called, every attribute is read from the wrapped domain
+        object.__setattr__(self, "_flaky", (target, connection))
+
+    def __getattribute__(self, name):
+        target, connection = object.__getattribute__(self, "_flaky")
+        attribute = getattr(target, name)
+        if name.startswith("_") or not callable(attribute) or name in LOCAL_METHODS:
+            return attribute
+
+        def wrapper(*args, **kwargs):
+            connection._host.check(connection._epoch, name)
+            return attribute(*args, **kwargs)
+        return wrapper
+
+
+def workload(connection, domain_name: str, rounds: int):
+    """
+    Makes the calls of a monitoring loop that also pauses and resumes a domain, counting the calls that failed.
+
+    Returns:
+        tuple: The number of calls made, the number that failed and the number of pauses and resumes asked for.
+    """
+    calls = failures = toggles = 0
+    for _ in range(rounds):
+        steps = [
+            lambda: connection.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE),
+            lambda: connection.lookupByName(domain_name).XMLDesc(0),
+        ]
+        for step in steps:
+            calls += 1
+            try:
+                step()
+            except libvirt.libvirtError:
+                failures += 1
+        calls += 1
+        try:
+            domain = connection.lookupByName(domain_name)
+            paused = domain.info()[0] == libvirt.VIR_DOMAIN_PAUSED
+            toggles += 1
+            domain.resume() if paused else domain.suspend()
+        except libvirt.libvirtError:
+            failures += 1
+    return calls, failures, toggles
+
+
+def run(resilient: bool, args):
+    """
+    Runs the workload against a flaky host.
+
+    Returns:
+        tuple: The host, the number of calls, failures, toggles and reconnects, and the wall time.
+    """
+    host = FlakyHost(random.Random(args.seed), args.drop_rate, args.busy_rate, args.outage)
+    connection = ResilientConnection(URI, host.open, SETTINGS) if resilient else host.open(URI)
+    domain_name = connection.listAllDomains()[0].name()
+    start = time.perf_counter()
+    calls, failures, toggles = workload(connection, domain_name, args.rounds)
+    wall = time.perf_counter() - start
+    reconnects = connection.reconnects if resilient else 0
+    connection.close()
+    return host, calls, failures, toggles, reconnects, wall
+
+
+def overhead(rounds: int):
+    """
+    Measures the time per lookupByName and info call of a plain and a resilient connection to a healthy host.
+
+    Returns:
+        tuple: The microseconds per call of both.
+    """
+    results = []
+    for connection in (libvirt.open(URI), ResilientConnection(URI, libvirt.open, SETTINGS)):
+        name = connection.listAllDomains()[0].name()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            connection.lookupByName(name).info()
+        results.append((time.perf_counter() - start) / (rounds * 2) * 1e6)
+        connection.close()
+    return tuple(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=2000, help="rounds of the workload")
+    parser.add_argument("--drop-rate", type=float, default=0.01, help="chance that a call finds the daemon restarting")
+    parser.add_argument("--busy-rate", type=float, default=0.02, help="chance that a call times out on a busy domain")
+    parser.add_argument("--outage", type=int, default=2, help="connection attempts refused after a restart")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the fault injection")
+    args = parser.parse_args()
+
+    print(f"{'connection':<12} {'calls':>8} {'failed':>8} {'restarts':>9} {'reconnects':>11} {'wall s':>8}")
+    for resilient in (False, True):
+        host, calls, failures, toggles, reconnects, wall = run(resilient, args)
+        if resilient:
+            assert host.restarts == 0 or reconnects > 0, "the connection was never replaced"
+            assert failures < calls / 2, "most calls failed through the resilient connection"
+            # every pause and resume was asked for once, a repeated one would show up as an extra call
+            assert not is_idempotent("suspend") and not is_idempotent("resume")
+            assert host.calls["suspend"] + host.calls["resume"] <= toggles, "a pause or resume was repeated"
+        print(f"{'resilient' if resilient else 'plain':<12} {calls:>8} {failures:>8} {host.restarts:>9} "
+              f"{reconnects:>11} {wall:>8.2f}")
+
+    plain, resilient = overhead(args.rounds)
+    print(f"\noverhead on a healthy connection: {plain:.1f} us per call plain, {resilient:.1f} us resilient")
+
+
+if __name__ == "__main__":
+    main()
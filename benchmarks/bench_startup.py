@@ -0,0 +1,94 @@
+"""
+This module benchmarks how long vmctl takes to start for commands that need no connection (`about`, `--help`).
+
+Every command is run a number of times in a fresh interpreter and the median wall time is compared against a
+budget. One more run with `python -X importtime` lists the slowest imports and checks that none of the modules
+that are only needed to talk to libvirt (libvirt itself, LibVirtApi, rich tables) were loaded. The exit status is
+1 if a command is over budget or loads one of them, so the benchmark can guard against startup regressions.
+
+usage:
+    python benchmarks/bench_startup.py --runs 20 --budget-ms 400 --commands about --help
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "main.py")
+
+# modules a command that does not connect must never import
+FORBIDDEN_MODULES = ["libvirt", "wrapper.libvirt", "wrapper.vm", "rich.table"]
+
+
+def run(command, importtime=False):
+    """
+    Runs vmctl once in a fresh interpreter.
+
+    Args:
+        command (list): The arguments of vmctl, e.g. ["about"].
+        importtime (bool, optional): Whether to run with `-X importtime`. Defaults to False.
+
+    Returns:
+        tuple: The wall time in seconds and the captured stderr.
+    """
+    args = [sys.executable] + (["-X", "importtime"] if importtime else []) + [MAIN] + command
+    start = time.perf_counter()
+    result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                            env=dict(os.environ, COLUMNS="80"))
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"vmctl {' '.join(command)} failed: {result.stderr.strip()}")
+    return elapsed, result.stderr
+
+
+def parse_importtime(stderr):
+    """
+    Parses the output of `-X importtime`.
+
+    Args:
+        stderr (str): The stderr of the run.
+
+    Returns:
+        dict: The cumulative import time in microseconds of every imported module.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20, help="number of runs per command")
+    parser.add_argument("--budget-ms", type=float, default=400, help="maximum median startup time in milliseconds")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to show")
+    parser.add_argument("--commands", nargs="+", default=["about", "--help"], help="vmctl commands to run")
+    args = parser.parse_args()
+
+    over_budget = False
+    print(f"{'command':<10} {'median ms':>10} {'min ms':>8} {'max ms':>8} {'budget':>8}")
+    for command in args.commands:
+        times = [run([command])[0] * 1000 for _ in range(args.runs)]
+        median = statistics.median(times)
+        over_budget |= median > args.budget_ms
+        print(f"{command:<10} {median:>10.1f} {min(times):>8.1f} {max(times):>8.1f} {'over' if median > args.budget_ms else 'ok':>8}")
+
+    modules = parse_importtime(run([args.commands[0]], importtime=True)[1])
+    print(f"\nslowest packages imported by `vmctl {args.commands[0]}` ({len(modules)} modules):")
+    top_level = {name: cumulative for name, cumulative in modules.items() if "." not in name}
+    for name, cumulative in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {name:<30} {cumulative / 1000:>8.1f} ms")
+
+    loaded = [name for name in FORBIDDEN_MODULES if name in modules]
+    if loaded:
+        print(f"\nimported without connecting: {', '.join(loaded)}")
+    sys.exit(1 if over_budget or loaded else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+This module is the scale benchmark of vmctl's command paths, run against the libvirt test driver.
+
+For every domain count it generates a `test://` driver fixture (a node XML with that many domains, every other one
+running) and runs each case on a fresh connection to it, through LibVirtApi like the CLI does:
+
+    list       VMApi.list_vms, the `vmctl list` table
+    info       VMApi.vm_info for a sample of the domains
+    start      resolve the shut off domains and start them all (`vmctl start --state shutoff '*'`)
+    destroy    resolve the running domains and destroy them all
+    provision  VMApi.provision_vm for a few new VMs, capacity admission included
+    xml        utils.xml.create_xml_config for as many VMs as there are domains (no connection)
+
+Every case reports its wall time (the best of --repeat runs), the number of RPCs (counted in a separate run
+through an instrumented connection, see wrapper.instrument) and the peak memory allocated by Python (in
+another run under tracemalloc, memory libvirt allocates in C is not seen). The output of the commands goes to
+/dev/null. Results can be saved as JSON, and compared against a saved baseline: a case is flagged when it makes
+more RPCs than the baseline, or its wall time or peak memory grew by more than --threshold (and by more
+than a small absolute amount, so noise on fast cases is not flagged). The exit status is 1 when anything is flagged.
+
+usage:
+    python benchmarks/bench_suite.py --counts 10 100 1000 10000 --save baseline.json
+    python benchmarks/bench_suite.py --counts 10 100 1000 10000 --compare baseline.json --threshold 0.2
+    python benchmarks/bench_suite.py --results current.json --compare baseline.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvirt
+from utils.profiling import Profiler
+from utils.xml import create_xml_config
+from wrapper.instrument import instrument
+from wrapper.libvirt import LibVirtApi
+
+CASES = ["list", "info", "start", "destroy", "provision", "xml"]
+
+# these methods only read fields cached on the python object,
+# they never result in a round trip to the libvirt daemon
+LOCAL_METHODS = {"name", "ID", "UUID", "UUIDString", "connect"}
+
+# the test driver's own schema, runstate 5 defines a domain shut off
+# reference: https://libvirt.org/drvtest.html
+TEST_NAMESPACE = "http://libvirt.org/schemas/domain/test/1.0"
+
+NODE_XML = """<node>
+    <cpu>
+        <mhz>3000</mhz>
+        <model>x86_64</model>
+        <active>64</active>
+        <nodes>2</nodes>
+        <sockets>2</sockets>
+        <cores>16</cores>
+        <threads>2</threads>
+    </cpu>
+    <memory>{memory}</memory>
+    <network>
+        <name>default</name>
+        <bridge name='virbr0'/>
+        <forward/>
+        <ip address='192.168.122.1' netmask='255.255.255.0'/>
+    </network>
+{domains}
+</node>
+"""
+
+DOMAIN_XML = """    <domain type='test' xmlns:test='{namespace}'>
+        <name>{name}</name>
+        <memory unit='MiB'>128</memory>
+        <vcpu>1</vcpu>
+        <os>
+            <type arch='x86_64'>hvm</type>
+        </os>
+        <devices>
+            <disk type='file' device='disk'>
+                <source file='/var/lib/libvirt/images/{name}.qcow2'/>
+                <target dev='vda' bus='virtio'/>
+            </disk>
+            <interface type='network'>
+                <source network='default'/>
+            </interface>
+        </devices>{runstate}
+    </domain>"""
+
+# the absolute slack before a slower or bigger case is flagged
+MIN_WALL_MS = 2.0
+MIN_PEAK_KIB = 256
+
+
+def write_fixture(directory: str, count: int):
+    """
+    Writes a test driver node with `count` domains, every other one shut off, unless it exists already.
+
+    Args:
+        directory (str): The directory of the fixtures.
+        count (int): The number of domains.
+
+    Returns:
+        str: The URI that opens the node.
+    """
+    path = os.path.abspath(os.path.join(directory, f"node-{count}.xml"))
+    if not os.path.exists(path):
+        domains = [
+            DOMAIN_XML.format(namespace=TEST_NAMESPACE, name=escape(f"bench-{index:05d}"),
+                              runstate="\n        <test:runstate>5</test:runstate>" if index % 2 else "")
+            for index in range(count)
+        ]
+        # enough memory for every domain, so admission never refuses the new ones
+        memory = max(count * 256, 64 * 1024) * 1024
+        with open(path, "w") as fixture:
+            fixture.write(NODE_XML.format(memory=memory, domains="\n".join(domains)))
+    return f"test://{path}"
+
+
+def list_case(api, count: int, args):
+    """
+    Lists every VM in a table.
+
+    Returns:
+        int: The number of operations, 1.
+    """
+    api.vm_api.list_vms()
+    return 1
+
+
+def info_case(api, count: int, args):
+    """
+    Shows the info of a sample of the VMs, spread over all of them.
+
+    Returns:
+        int: The number of VMs read.
+    """
+    names = [f"bench-{index:05d}" for index in range(0, count, max(1, count // args.info_sample))][:args.info_sample]
+    for name in names:
+        api.vm_api.vm_info(name)
+    return len(names)
+
+
+def action_case(action: str, state: str):
+    """
+    Creates a case that applies a lifecycle action to every VM in a state, like `vmctl <action> --state <state> '*'`.
+
+    Returns:
+        callable: The case.
+    """
+    def case(api, count: int, args):
+        vm_names = api.vm_api.resolve_vms(["*"], states=[state])
+        api.vm_api.print_action_results(action, api.vm_api.run_action(action, vm_names, args.parallelism))
+        return len(vm_names)
+    return case
+
+
+def provision_case(api, count: int, args):
+    """
+    Provisions new VMs, one at a time.
+
+    Returns:
+        int: The number of VMs defined.
+    """
+    for index in range(args.provision):
+        name = f"new-{index:03d}"
+        api.vm_api.provision_vm(name, 512, 1, disk_path=f"/var/lib/libvirt/images/{name}.qcow2", force=True)
+    return args.provision
+
+
+def xml_case(api, count: int, args):
+    """
+    Renders the XML configuration of as many VMs as the host has domains.
+
+    Returns:
+        int: The number of configurations rendered.
+    """
+    for index in range(count):
+        name = f"bench-{index:05d}"
+        create_xml_config(name, 512, 1, disk_path=f"/var/lib/libvirt/images/{name}.qcow2")
+    return count
+
+
+RUNNERS = {
+    "list": list_case,
+    "info": info_case,
+    "start": action_case("start", "shutoff"),
+    "destroy": action_case("destroy", "running"),
+    "provision": provision_case,
+    "xml": xml_case,
+}
+
+
+def run_once(case: str, uri: str, count: int, args, profiler: Profiler = None, trace: bool = False):
+    """
+    Runs a case once, on a fresh connection (the test driver reads the fixture again on every connection).
+
+    Returns:
+        tuple: The number of operations, the wall time in milliseconds, the peak memory in KiB (0 without trace)
+               and the number of RPCs (0 without a profiler).
+    """
+    api = LibVirtApi(uri, retry={})
+    if profiler is not None:
+        api.connection.target = instrument(api.connection.target, profiler)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            if trace:
+                tracemalloc.start()
+            start = time.perf_counter()
+            ops = RUNNERS[case](api, count, args)
+            wall = (time.perf_counter() - start) * 1000
+            peak = 0
+            if trace:
+                peak = tracemalloc.get_traced_memory()[1] / 1024
+                tracemalloc.stop()
+        # counted before close(), which is not part of the case
+        rpcs = sum(1 for name, category, *_ in profiler.events
+                   if category == "rpc" and name.partition(".")[2] not in LOCAL_METHODS) if profiler else 0
+        return ops, wall, peak, rpcs
+    finally:
+        api.close()
+
+
+def measure(case: str, uri: str, count: int, args):
+    """
+    Measures a case: its best wall time, its RPCs and its peak memory, each in its own runs.
+
+    Returns:
+        dict: The result.
+    """
+    walls = []
+    for _ in range(args.repeat):
+        ops, wall, _, _ = run_once(case, uri, count, args)
+        walls.append(wall)
+    _, _, _, rpcs = run_once(case, uri, count, args, profiler=Profiler())
+    _, _, peak, _ = run_once(case, uri, count, args, trace=True)
+    return {"case": case, "domains": count, "ops": ops, "wall_ms": round(min(walls), 3), "rpcs": rpcs,
+            "peak_kib": round(peak, 1)}
+
+
+def run_suite(args):
+    """
+    Runs every case at every domain count.
+
+    Returns:
+        dict: The results, with what they were measured on.
+    """
+    major, rest = divmod(libvirt.getVersion(), 1000000)
+    results = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "libvirt": f"{major}.{rest // 1000}.{rest % 1000}",
+        "repeat": args.repeat,
+        "results": [],
+    }
+    fixtures = args.fixtures or tempfile.mkdtemp(prefix="vmctl-bench-")
+    os.makedirs(fixtures, exist_ok=True)
+
+    print(f"{'case':<10} {'domains':>8} {'ops':>6} {'wall ms':>10} {'rpcs':>7} {'peak KiB':>10}")
+    for count in args.counts:
+        uri = write_fixture(fixtures, count)
+        for case in args.cases:
+            result = measure(case, uri, count, args)
+            results["results"].append(result)
+            print(f"{case:<10} {count:>8} {result['ops']:>6} {result['wall_ms']:>10.2f} {result['rpcs']:>7} "
+                  f"{result['peak_kib']:>10.1f}")
+    return results
+
+
+def compare(results, baseline, threshold: float):
+    """
+    Compares results against a baseline and prints what changed.
+
+    Args:
+        results (dict): The results.
+        baseline (dict): The baseline results.
+        threshold (float): The relative growth of wall time and peak memory that is flagged, e.g. 0.2 for 20%.
+
+    Returns:
+        list: The "<case>@<domains>: <reason>" of every regression.
+    """
+    previous = {(result["case"], result["domains"]): result for result in baseline["results"]}
+    regressions = []
+    print(f"\n{'case':<10} {'domains':>8} {'wall ms':>21} {'rpcs':>14} {'peak KiB':>23}")
+    for result in results["results"]:
+        base = previous.get((result["case"], result["domains"]))
+        if base is None:
+            continue
+        reasons = []
+        if result["rpcs"] > base["rpcs"]:
+            reasons.append(f"RPCs {base['rpcs']} -> {result['rpcs']}")
+        if result["wall_ms"] > base["wall_ms"] * (1 + threshold) and result["wall_ms"] - base["wall_ms"] > MIN_WALL_MS:
+            reasons.append(f"wall time {result['wall_ms'] / base['wall_ms'] - 1:+.0%}")
+        if (result["peak_kib"] > base["peak_kib"] * (1 + threshold)
+                and result["peak_kib"] - base["peak_kib"] > MIN_PEAK_KIB):
+            reasons.append(f"peak memory {result['peak_kib'] / base['peak_kib'] - 1:+.0%}")
+        regressions += [f"{result['case']}@{result['domains']}: {reason}" for reason in reasons]
+        print(f"{result['case']:<10} {result['domains']:>8} {base['wall_ms']:>9.2f} -> {result['wall_ms']:<8.2f} "
+              f"{base['rpcs']:>5} -> {result['rpcs']:<5} {base['peak_kib']:>10.1f} -> {result['peak_kib']:<9.1f}"
+              f"{'  REGRESSION' if reasons else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000, 10000], help="domain counts to benchmark")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES, help="cases to run")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of every case, the best one counts")
+    parser.add_argument("--info-sample", type=int, default=100, help="domains the info case reads")
+    parser.add_argument("--provision", type=int, default=10, help="VMs the provision case defines")
+    parser.add_argument("--parallelism", type=int, default=8, help="size of the worker pool of the lifecycle cases")
+    parser.add_argument("--fixtures", help="directory to write (and reuse) the fixtures in, a temporary one by default")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--results", help="read the results from this JSON file instead of running the suite")
+    parser.add_argument("--compare", help="a JSON file of baseline results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative growth flagged as a regression")
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results) as results_file:
+            results = json.load(results_file)
+    else:
+        results = run_suite(args)
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+        print(f"\nresults written to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions against {args.compare}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nno regressions against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,27 @@ This module is the entry point for the vmctl command-line interface.
 It uses the Typer library to create a simple and user-friendly CLI.
 The CLI provides commands for managing virtual machines using the Libvirt API.
 """
+import time
+IMPORT_STARTED = time.perf_counter()
+import sys
+from utils import profiling
+# --profile and --trace-file are also read here, because the imports
+# and the connection they time happen before typer parses the options
+if "--profile" in sys.argv or any(arg.split("=")[0] == "--trace-file" for arg in sys.argv):
+    profiling.enable(IMPORT_STARTED)
 import typer
+from typing import List
 from rich import print
-import wrapper.libvirt as libvirt_api
-from utils.errors import handle_error
-import sys
+import wrapper.daemon as daemon_api
+from wrapper.pool import ConnectionPool
+from utils.config import load_config, resolve_hosts
+from utils.manifest import expand_name, load_manifest
+from utils.output import check_output_format, default_output_format, strip_markup, write_records
+from utils.errors import VmctlError, handle_error
+import os
+
+if profiling.get_profiler() is not None:
+    profiling.get_profiler().record("import", "phase", IMPORT_STARTED, time.perf_counter())
 
 VMCTL_BANNER = r"""
                       _   _
@@ -19,11 +35,102 @@ __   ___ __ ___   ___| |_| |
 
 """
 app = typer.Typer(no_args_is_help=True)
-try:
-    libvirt = libvirt_api.LibVirtApi()
-except Exception as e:
-    handle_error(e)
-    sys.exit(1)
+# commands are served by the vmctl daemon when one is running,
+# otherwise vmctl connects to libvirt directly
+LIBVIRT_URI = os.environ.get("VMCTL_URI", "qemu:///system")
+
+# connections are opened on first use and shared, so commands like `about`
+# and `--help` never connect (nor import libvirt) and work without libvirtd
+connection_pool = ConnectionPool(daemon_api.connect)
+
+def get_api():
+    """Returns the connection to LIBVIRT_URI, through the vmctl daemon when one is running."""
+    return connection_pool.get(LIBVIRT_URI)
+
+def get_direct_api(uri: str = LIBVIRT_URI):
+    """Returns a direct libvirt connection, for commands that stream output or use local state and cannot go through the daemon."""
+    api = connection_pool.get(uri)
+    if isinstance(api, daemon_api.DaemonClient):
+        import wrapper.libvirt as libvirt_api
+        return libvirt_api.LibVirtApi(uri)
+    return api
+
+# chosen when the command runs, from whether stdout is a terminal
+OUTPUT_OPTION = typer.Option(default_output_format, "--output", "-o", show_default="table on a terminal, ndjson otherwise",
+                             help="Output format: table, json, ndjson (one record per line, streamed) or csv.")
+
+FORCE_OPTION = typer.Option(False, "--force", help="Go ahead even if the VMs exceed the host's capacity limits, with a warning.")
+
+PLACEMENT_OPTION = typer.Option("none", "--placement", help="Pin VMs to a NUMA node and host CPUs: none, auto, pack (fill one node first) or spread (balance the nodes).")
+
+HOST_OPTION = typer.Option(None, "--host", help="Query this host (a name from the configuration file or a libvirt URI). Can be repeated.")
+ALL_HOSTS_OPTION = typer.Option(False, "--all-hosts", help="Query every host in the configuration file.")
+
+def get_fleet(hosts: List[str], all_hosts: bool):
+    """Returns a FleetApi for the selected hosts, or None if no hosts were selected."""
+    if not hosts and not all_hosts:
+        return None
+    from wrapper.fleet import FleetApi
+    return FleetApi(resolve_hosts(load_config(), hosts, all_hosts), connection_pool)
+
+MAX_AGE_OPTION = typer.Option(None, "--max-age", help="Refresh hosts whose inventory entry is older than this many seconds first (default 60, or \"inventory\": {\"max_age\": N} in the configuration file).")
+REFRESH_OPTION = typer.Option(False, "--refresh", help="Refresh the inventory first, reading every VM's disks and tags again.")
+
+def get_inventory(hosts, max_age: float, full: bool):
+    """
+    Opens the local inventory, after refreshing the hosts whose entry is missing or older than max_age.
+    Without hosts, the hosts already in the inventory and LIBVIRT_URI are refreshed.
+    """
+    from utils.inventory import Inventory, get_inventory_settings
+    from wrapper.fleet import FleetApi
+    path, default_max_age = get_inventory_settings()
+    max_age = default_max_age if max_age is None else max_age
+    inventory = Inventory(path)
+    if hosts is None:
+        hosts = {uri: uri for uri in inventory.get_hosts()}
+        hosts.setdefault(LIBVIRT_URI, LIBVIRT_URI)
+    stale = {}
+    for name, uri in hosts.items():
+        age = inventory.get_age(uri)
+        if full or age is None or age > max_age:
+            stale[name] = uri
+    if stale:
+        from wrapper.inventory import InventoryApi
+        # the refresh writes this inventory, not the daemon's, so it runs on direct connections.
+        # hosts that cannot be reached are answered from their last entry
+        fleet = FleetApi(stale, ConnectionPool(get_direct_api))
+        results, errors = fleet.fan_out(lambda api: InventoryApi(api.connection, api.uri, inventory).refresh(full))
+        fleet.print_errors(errors)
+        # VMs whose XML could not be read are listed without disks and tags until a refresh reads it
+        for name, summary in results.items():
+            for vm_name, error in summary["errors"].items():
+                fleet.print_errors({name: f"VM '{vm_name}': {error}"})
+    return inventory
+
+@app.callback()
+def main(ctx: typer.Context,
+         profile: bool = typer.Option(False, "--profile", help="Print the time spent in each phase and libvirt call to stderr."),
+         trace_file: str = typer.Option(None, "--trace-file", help="Write the phases and libvirt calls as Chrome trace JSON (chrome://tracing, Perfetto).")):
+    """
+    A simple CLI tool to manage VM's using the LibVirt API.
+    """
+    profiler = profiling.get_profiler()
+    if profiler is None:
+        return
+    started = time.perf_counter()
+
+    def report():
+        profiler.record("command", "phase", started, time.perf_counter())
+        if profile:
+            from rich.console import Console
+            profiler.print_summary(Console(stderr=True))
+        if trace_file:
+            # runs after the command, a bad path still ends it with an error rather than a traceback
+            try:
+                profiler.write_trace(trace_file)
+            except VmctlError as e:
+                handle_error(e)
+    ctx.call_on_close(report)
 
 @app.command()
 def about():
@@ -34,77 +141,627 @@ If you are new, type [green]help[/green] (or) [green]--help[/green] to learn mor
 """)
 
 @app.command()
-def hostinfo():
+def daemon(socket_path: str = typer.Option(None, "--socket", help="Path of the Unix socket to listen on."),
+           max_staleness: float = typer.Option(30.0, "--max-staleness", help="Maximum age in seconds of a cached VM state.")):
+    """
+    Run the vmctl daemon, which keeps libvirt connections open and serves other vmctl commands.
+    """
     try:
-        libvirt.host_api.get_info()
+        # the daemon opens its own connections, which receive lifecycle events
+        socket_path = socket_path or daemon_api.default_socket_path()
+        print(f"vmctl daemon listening on [bold bright_cyan]{socket_path}[/bold bright_cyan]")
+        daemon_api.VmctlDaemon(socket_path, max_staleness).serve_forever()
     except Exception as e:
         handle_error(e)
 
-# these are the commands to manage
-# the lifecycle of virtual machines
 @app.command()
-def list():
+def watch(vm_names: List[str] = typer.Argument(None, help="Only show these VMs (names or glob patterns).", show_default=False)):
+    """
+    Stream VM state transitions as they happen.
+    """
     try:
-        libvirt.vm_api.list_vms()
+        # watching needs a connection of its own that receives lifecycle events
+        import wrapper.libvirt as libvirt_api
+        api = libvirt_api.LibVirtApi(LIBVIRT_URI, events=True)
+        api.vm_api.watch(api.event_feed, vm_names)
+        api.close()
     except Exception as e:
         handle_error(e)
 
 @app.command()
-def provision(vm_name: str, vm_memory: int, vm_vcpus: int, iso_path: str = None, disk_path: str = None):
+def top(interval: float = typer.Option(2.0, "--interval", "-i", help="Seconds between refreshes."),
+        sort: str = typer.Option("cpu", "--sort", "-s", help="Column to sort by (name, state, cpu, memory, iops, disk_read, disk_write, net_rx or net_tx)."),
+        history: int = typer.Option(60, "--history", help="Number of samples kept per VM.")):
+    """
+    Show a live, refreshing table of the resource usage of every VM.
+    """
     try:
-        libvirt.vm_api.provision_vm(vm_name, vm_memory, vm_vcpus, iso_path, disk_path)
+        get_direct_api().metrics_api.top(interval, sort, history)
     except Exception as e:
         handle_error(e)
 
 @app.command()
-def info(vm_name: str):
+def stats(vm_names: List[str] = typer.Argument(None, help="Only show these VMs.", show_default=False),
+          interval: float = typer.Option(1.0, "--interval", "-i", help="Seconds each measurement covers."),
+          count: int = typer.Option(1, "--count", "-c", help="Number of measurements."),
+          sort: str = typer.Option("cpu", "--sort", "-s", help="Column to sort by (name, state, cpu, memory, iops, disk_read, disk_write, net_rx or net_tx).")):
+    """
+    Show the CPU, memory, disk and network usage of VMs over an interval.
+    """
     try:
-        libvirt.vm_api.vm_info(vm_name)
+        get_direct_api().metrics_api.stats(vm_names, interval, count, sort)
     except Exception as e:
         handle_error(e)
-    
+
 @app.command()
-def start(vm_name: str):
+def exporter(address: str = typer.Option("127.0.0.1", "--address", help="Address to listen on."),
+             port: int = typer.Option(9177, "--port", help="Port to listen on."),
+             cache_ttl: float = typer.Option(15.0, "--cache-ttl", help="Seconds a collection is reused for, usually the scrape interval."),
+             scrape_timeout: float = typer.Option(5.0, "--scrape-timeout", help="Maximum seconds a scrape waits for a collection.")):
+    """
+    Serve host and VM metrics in the Prometheus text format on /metrics.
+    """
     try:
-        libvirt.vm_api.start_vm(vm_name)
+        from wrapper.exporter import MetricsExporter
+        MetricsExporter(get_direct_api(), cache_ttl, scrape_timeout).serve_forever(address, port)
     except Exception as e:
         handle_error(e)
 
 @app.command()
-def shutdown(vm_name: str):
+def hostinfo(host: List[str] = HOST_OPTION, all_hosts: bool = ALL_HOSTS_OPTION, output: str = OUTPUT_OPTION):
     try:
-        libvirt.vm_api.shutdown_vm(vm_name)
+        check_output_format(output)
+        fleet = get_fleet(host, all_hosts)
+        if output != "table":
+            host_infos, errors = fleet.get_host_info() if fleet else ([get_api().host_api.get_host_info()], {})
+            write_records(host_infos, output)
+            if fleet:
+                fleet.print_errors(errors)
+        elif fleet:
+            fleet.get_info()
+        else:
+            get_api().host_api.get_info()
     except Exception as e:
         handle_error(e)
 
 @app.command()
-def destroy(vm_name: str):
+def capacity(host: List[str] = HOST_OPTION, all_hosts: bool = ALL_HOSTS_OPTION, output: str = OUTPUT_OPTION):
+    """
+    Show the memory and vCPUs committed to VMs against the capacity limits, and the headroom left, per host.
+    """
     try:
-        libvirt.vm_api.destroy_vm(vm_name)
+        check_output_format(output)
+        fleet = get_fleet(host, all_hosts)
+        if output != "table":
+            capacities, errors = fleet.get_capacity() if fleet else ([get_api().capacity_api.get_capacity()], {})
+            write_records(capacities, output)
+            if fleet:
+                fleet.print_errors(errors)
+        elif fleet:
+            fleet.capacity()
+        else:
+            get_api().capacity_api.capacity()
     except Exception as e:
         handle_error(e)
 
+# these are the commands to manage
+# the lifecycle of virtual machines
+@app.command()
+def list(state: List[str] = typer.Option(None, "--state", help="Only list VMs in this state (running, shutoff or paused). Can be repeated."),
+         host: List[str] = HOST_OPTION, all_hosts: bool = ALL_HOSTS_OPTION, output: str = OUTPUT_OPTION,
+         cached: bool = typer.Option(False, "--cached", help="Answer from the local inventory, refreshing it only if it is older than --max-age."),
+         max_age: float = MAX_AGE_OPTION, refresh: bool = REFRESH_OPTION):
+    try:
+        check_output_format(output)
+        if cached:
+            hosts = resolve_hosts(load_config(), host, all_hosts) or {LIBVIRT_URI: LIBVIRT_URI}
+            vms = get_inventory(hosts, max_age, refresh).get_vms(hosts.values(), state)
+            if output != "table":
+                write_records(vms, output)
+            else:
+                from wrapper.inventory import list_cached_vms
+                list_cached_vms(vms, "List of VMs (cached)")
+            return
+        fleet = get_fleet(host, all_hosts)
+        if output != "table":
+            write_records(fleet.iter_vms(state) if fleet else get_api().vm_api.get_vms(state), output)
+            if fleet:
+                fleet.print_errors(fleet.errors)
+        elif fleet:
+            fleet.list_vms(state)
+        else:
+            get_api().vm_api.list_vms(state)
+    except Exception as e:
+        handle_error(e)
 
 @app.command()
-def suspend(vm_name: str):
+def find(pattern: str = typer.Argument(None, help="A name, part of a name, glob pattern or UUID prefix."),
+         tag: List[str] = typer.Option(None, "--tag", help="Only find VMs with this metadata tag, as key=value. Can be repeated."),
+         state: List[str] = typer.Option(None, "--state", help="Only find VMs in this state. Can be repeated."),
+         host: List[str] = HOST_OPTION, all_hosts: bool = ALL_HOSTS_OPTION, output: str = OUTPUT_OPTION,
+         max_age: float = MAX_AGE_OPTION, refresh: bool = REFRESH_OPTION):
+    """
+    Find VMs by name, UUID or metadata tag in the local inventory of every host vmctl has seen.
+    """
     try:
-        libvirt.vm_api.suspend_vm(vm_name)
+        from utils.inventory import parse_tags
+        check_output_format(output)
+        tags = parse_tags(tag)
+        # without hosts, every host already in the inventory is searched, and this one
+        hosts = resolve_hosts(load_config(), host, all_hosts) or None
+        inventory = get_inventory(hosts, max_age, refresh)
+        uris = hosts.values() if hosts else None
+        vms = inventory.get_vms(uris, state, pattern, tags)
+        if output != "table":
+            write_records(vms, output)
+        else:
+            from wrapper.inventory import list_cached_vms
+            list_cached_vms(vms, f"VMs matching '{pattern or '*'}'")
     except Exception as e:
         handle_error(e)
 
 @app.command()
-def resume(vm_name: str):
+def provision(vm_name: str, vm_memory: int, vm_vcpus: int, iso_path: str = None, disk_path: str = None,
+              placement: str = PLACEMENT_OPTION, force: bool = FORCE_OPTION,
+              hugepages: bool = typer.Option(False, "--hugepages", help="Back the VM's memory with hugepages, which the host must have reserved."),
+              hugepage_size: int = typer.Option(None, "--hugepage-size", help="Size of the hugepages in KiB (e.g. 2048 or 1048576). Defaults to the host's default size."),
+              qos: str = typer.Option(None, "--qos", help="Limit the VM's disk and network I/O with this QoS profile (see `vmctl qos profiles`).")):
     try:
-        libvirt.vm_api.resume_vm(vm_name)
+        get_api().vm_api.provision_vm(vm_name, vm_memory, vm_vcpus, iso_path, disk_path, placement, force,
+                                      (hugepage_size or True) if hugepages or hugepage_size else False, qos)
     except Exception as e:
         handle_error(e)
 
 @app.command()
-def reboot(vm_name: str):
+def info(vm_name: str, host: List[str] = HOST_OPTION, all_hosts: bool = ALL_HOSTS_OPTION, output: str = OUTPUT_OPTION):
     try:
-        libvirt.vm_api.reboot_vm(vm_name)
+        check_output_format(output)
+        fleet = get_fleet(host, all_hosts)
+        if output != "table":
+            vms, errors = fleet.get_vm_info(vm_name) if fleet else ([get_api().vm_api.get_vm_info(vm_name)], {})
+            write_records(vms, output)
+            if fleet:
+                fleet.print_errors(errors)
+        elif fleet:
+            fleet.vm_info(vm_name)
+        else:
+            get_api().vm_api.vm_info(vm_name)
     except Exception as e:
         handle_error(e)
     
+# the lifecycle commands accept several names, glob patterns or --all,
+# and act on all the matching VMs through a bounded pool of workers
+VM_NAMES_ARGUMENT = typer.Argument(None, help="Names or glob patterns (e.g. 'web-*') of the VMs.", show_default=False)
+ALL_VMS_OPTION = typer.Option(False, "--all", help="Act on every VM.")
+STATE_OPTION = typer.Option(None, "--state", help="Only act on VMs in this state (running, shutoff or paused). Can be repeated.")
+PARALLELISM_OPTION = typer.Option(8, "--parallelism", "-p", help="Maximum number of VMs acted on at the same time.")
+WAIT_OPTION = typer.Option(False, "--wait", help="Wait until the VMs reached their target state.")
+TIMEOUT_OPTION = typer.Option(300.0, "--timeout", help="Maximum time to wait in seconds (with --wait).")
+
+def run_lifecycle_command(action: str, vm_names: List[str], all_vms: bool, state: List[str], parallelism: int,
+                          wait: bool = False, timeout: float = None, escalate: bool = False, output: str = "table", force: bool = False):
+    failed = False
+    vm_names = vm_names or []
+    try:
+        check_output_format(output)
+        # waiting needs lifecycle events, which are received on a
+        # direct connection of our own rather than through the daemon
+        if wait:
+            import wrapper.libvirt as libvirt_api
+            api = libvirt_api.LibVirtApi(LIBVIRT_URI, events=True)
+        else:
+            api = get_api()
+        names = api.vm_api.resolve_vms(vm_names, all_vms, state)
+        single = not all_vms and not state and len(vm_names) == 1 and names == vm_names
+        if single and not wait and output == "table":
+            if action == "start":
+                api.vm_api.start_vm(names[0], force)
+            else:
+                getattr(api.vm_api, f"{action}_vm")(names[0])
+        else:
+            results = api.vm_api.run_action(action, names, parallelism, wait, timeout, escalate, force)
+            if output != "table":
+                write_records([dict(result, message=strip_markup(result["message"])) for result in results], output)
+            elif single:
+                print(results[0]["message"])
+            else:
+                api.vm_api.print_action_results(action, results)
+            failed = any(result["status"] == "failed" for result in results)
+    except Exception as e:
+        handle_error(e)
+    if failed:
+        raise typer.Exit(code=1)
+
+@app.command()
+def start(vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION, parallelism: int = PARALLELISM_OPTION,
+          wait: bool = WAIT_OPTION, timeout: float = TIMEOUT_OPTION, output: str = OUTPUT_OPTION, force: bool = FORCE_OPTION):
+    run_lifecycle_command("start", vm_names, all_vms, state, parallelism, wait, timeout, output=output, force=force)
+
+@app.command()
+def shutdown(vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION, parallelism: int = PARALLELISM_OPTION,
+             wait: bool = WAIT_OPTION, timeout: float = TIMEOUT_OPTION,
+             destroy_on_timeout: bool = typer.Option(False, "--destroy-on-timeout", help="Destroy VMs that did not shut down before the timeout (with --wait)."),
+             output: str = OUTPUT_OPTION):
+    run_lifecycle_command("shutdown", vm_names, all_vms, state, parallelism, wait, timeout, destroy_on_timeout, output)
+
+@app.command()
+def destroy(vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION, parallelism: int = PARALLELISM_OPTION,
+            wait: bool = WAIT_OPTION, timeout: float = TIMEOUT_OPTION, output: str = OUTPUT_OPTION):
+    run_lifecycle_command("destroy", vm_names, all_vms, state, parallelism, wait, timeout, output=output)
+
+
+@app.command()
+def suspend(vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION, parallelism: int = PARALLELISM_OPTION,
+            wait: bool = WAIT_OPTION, timeout: float = TIMEOUT_OPTION, output: str = OUTPUT_OPTION):
+    run_lifecycle_command("suspend", vm_names, all_vms, state, parallelism, wait, timeout, output=output)
+
+@app.command()
+def resume(vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION, parallelism: int = PARALLELISM_OPTION,
+           wait: bool = WAIT_OPTION, timeout: float = TIMEOUT_OPTION, output: str = OUTPUT_OPTION):
+    run_lifecycle_command("resume", vm_names, all_vms, state, parallelism, wait, timeout, output=output)
+
+@app.command()
+def reboot(vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION, parallelism: int = PARALLELISM_OPTION,
+           wait: bool = WAIT_OPTION, timeout: float = TIMEOUT_OPTION, output: str = OUTPUT_OPTION):
+    run_lifecycle_command("reboot", vm_names, all_vms, state, parallelism, wait, timeout, output=output)
+
+@app.command()
+def apply(manifest: str = typer.Argument(..., help="Path of a YAML or JSON manifest declaring the VMs."),
+          dry_run: bool = typer.Option(False, "--dry-run", help="Only show what would change."),
+          parallelism: int = typer.Option(8, "--parallelism", "-p", help="Maximum number of VMs defined at the same time."),
+          placement: str = PLACEMENT_OPTION, output: str = OUTPUT_OPTION, force: bool = FORCE_OPTION):
+    """
+    Provision the VMs declared in a manifest, defining only the ones that are missing or changed.
+    """
+    failed = False
+    try:
+        check_output_format(output)
+        results = get_api().vm_api.apply(load_manifest(manifest), parallelism, dry_run, placement, force)
+        if output != "table":
+            write_records([dict(result, message=strip_markup(result["message"])) for result in results], output)
+        else:
+            get_api().vm_api.print_apply_results(results, dry_run)
+        failed = any(result["status"] == "failed" for result in results)
+    except Exception as e:
+        handle_error(e)
+    if failed:
+        raise typer.Exit(code=1)
+
+@app.command()
+def clone(base: str = typer.Argument(..., help="Name of the shut off VM to clone."),
+          vm_names: List[str] = typer.Argument(..., help="Names of the clones, ranges like 'web-{01..20}' are expanded."),
+          pool: str = typer.Option(None, "--pool", help="Storage pool for the overlay disks. Defaults to the pool of each base disk."),
+          parallelism: int = typer.Option(8, "--parallelism", "-p", help="Maximum number of clones created at the same time."),
+          output: str = OUTPUT_OPTION, force: bool = FORCE_OPTION):
+    """
+    Create thin clones of a VM, whose disks are qcow2 overlays backed by the base VM's disks.
+    """
+    failed = False
+    try:
+        check_output_format(output)
+        names = [name for template in vm_names for name in expand_name(template)]
+        results = get_api().clone_api.clone(base, names, parallelism, pool, force)
+        if output != "table":
+            write_records(results, output)
+        else:
+            get_api().clone_api.print_clone_results(base, results)
+        failed = any(result["status"] == "failed" for result in results)
+    except Exception as e:
+        handle_error(e)
+    if failed:
+        raise typer.Exit(code=1)
+
+@app.command()
+def migrate(vm_names: List[str] = VM_NAMES_ARGUMENT,
+            to: str = typer.Option(..., "--to", help="Destination host (a name from the configuration file or a libvirt URI)."),
+            all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION,
+            max_concurrent: int = typer.Option(None, "--max-concurrent", help="Maximum number of migrations at the same time. Defaults to 2."),
+            bandwidth: int = typer.Option(None, "--bandwidth", help="Bandwidth cap of each migration in MiB/s (0 for none)."),
+            auto_converge: bool = typer.Option(False, "--auto-converge", help="Throttle VMs that dirty memory faster than it is sent."),
+            postcopy: bool = typer.Option(False, "--postcopy", help="Switch to post-copy once the first pass over the memory is done."),
+            postcopy_after: float = typer.Option(None, "--postcopy-after", help="Switch to post-copy after this many seconds instead (with --postcopy)."),
+            force: bool = FORCE_OPTION, output: str = OUTPUT_OPTION):
+    """
+    Live migrate VMs to another host (peer-to-peer), showing their progress.
+    """
+    failed = False
+    try:
+        check_output_format(output)
+        dest_uri = resolve_hosts(load_config(), [to])[to]
+        # progress is streamed while the migrations run, which the daemon cannot do
+        api = get_direct_api()
+        names = api.vm_api.resolve_vms(vm_names, all_vms, state)
+        options = {"max_concurrent": max_concurrent, "bandwidth": bandwidth, "auto_converge": auto_converge,
+                   "postcopy": postcopy, "postcopy_after": postcopy_after, "force": force}
+        if output != "table":
+            results = api.migration_api.migrate(names, dest_uri, **options)
+            write_records([dict(result, message=strip_markup(result["message"])) for result in results], output)
+        else:
+            results = api.migration_api.migrate_live(names, dest_uri, **options)
+        failed = any(result["status"] == "failed" for result in results)
+    except Exception as e:
+        handle_error(e)
+    if failed:
+        raise typer.Exit(code=1)
+
+AGENT_STATE_OPTION = typer.Option(None, "--state", help="Only act on VMs in this state. Defaults to running, the only VMs with an agent to talk to.")
+AGENT_TIMEOUT_OPTION = typer.Option(30.0, "--timeout", "-t", help="Seconds each VM may take, after which it is reported as timed out.")
+
+def run_agent_command(vm_pattern: str, state: List[str], output: str, func, print_result):
+    failed = False
+    try:
+        check_output_format(output)
+        # results are streamed as each vm finishes, which the daemon cannot do
+        api = get_direct_api()
+        # only running vms have an agent to talk to
+        names = api.vm_api.resolve_vms([vm_pattern], False, state or ["running"])
+        if output == "ndjson":
+            results = func(api, names, lambda result: write_records([result], output))
+        elif output != "table":
+            results = func(api, names, None)
+            write_records(results, output)
+        else:
+            results = func(api, names, print_result)
+            done = sum(1 for result in results if result["status"] == "done")
+            print(f"[bold]{done} of {len(results)} VMs succeeded.[/bold]")
+        failed = any(result["status"] != "done" for result in results)
+    except Exception as e:
+        handle_error(e)
+    if failed:
+        raise typer.Exit(code=1)
+
+@app.command("exec")
+def exec_command(vm_pattern: str = typer.Argument(..., help="Name or glob pattern (e.g. 'web-*') of the running VMs."),
+                 command: List[str] = typer.Argument(..., help="The command to run, after `--`."),
+                 state: List[str] = AGENT_STATE_OPTION, timeout: float = AGENT_TIMEOUT_OPTION,
+                 shell: bool = typer.Option(False, "--shell", help="Run the command with /bin/sh -c, so it can use pipes and globs (quote the script as one argument)."),
+                 parallelism: int = PARALLELISM_OPTION, output: str = OUTPUT_OPTION):
+    """
+    Run a command in many VMs at once through the guest agent, e.g. `vmctl exec 'web-*' -- uname -a`.
+    The output of each VM is printed, prefixed by its name, as soon as its command exits.
+    """
+    from wrapper.agent import print_exec_result
+    run_agent_command(vm_pattern, state, output,
+                      lambda api, names, on_result: api.agent_api.exec(names, command, timeout, parallelism, shell, on_result),
+                      print_exec_result)
+
+@app.command()
+def fetch(vm_pattern: str = typer.Argument(..., help="Name or glob pattern (e.g. 'web-*') of the running VMs."),
+          path: str = typer.Argument(..., help="Path of the file in the guests."),
+          dest: str = typer.Option(".", "--dest", "-d", help="Local directory the files are copied to, as <dest>/<vm name>/<file name>."),
+          state: List[str] = AGENT_STATE_OPTION, timeout: float = AGENT_TIMEOUT_OPTION,
+          parallelism: int = PARALLELISM_OPTION, output: str = OUTPUT_OPTION):
+    """
+    Copy a file out of many VMs at once through the guest agent.
+    """
+    from wrapper.agent import print_fetch_result
+    run_agent_command(vm_pattern, state, output,
+                      lambda api, names, on_result: api.agent_api.fetch(names, path, dest, timeout, parallelism, on_result),
+                      print_fetch_result)
+
+# vmctl snapshot create|list|revert|delete
+snapshot_app = typer.Typer(no_args_is_help=True, help="Create, list, revert and delete snapshots of VMs.")
+app.add_typer(snapshot_app, name="snapshot")
+
+def run_snapshot_command(action: str, vm_names: List[str], all_vms: bool, state: List[str], output: str, func):
+    failed = False
+    try:
+        check_output_format(output)
+        names = get_api().vm_api.resolve_vms(vm_names, all_vms, state)
+        results = func(names)
+        if output != "table":
+            write_records(results, output)
+        else:
+            get_api().snapshot_api.print_snapshot_results(action, results)
+        failed = any(result["status"] == "failed" for result in results)
+    except Exception as e:
+        handle_error(e)
+    if failed:
+        raise typer.Exit(code=1)
+
+@snapshot_app.command("create")
+def snapshot_create(vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION,
+                    name: str = typer.Option(None, "--name", "-n", help="Name of the snapshot. Defaults to vmctl-<date>-<time>."),
+                    description: str = typer.Option(None, "--description", help="Description of the snapshot."),
+                    disk_only: bool = typer.Option(False, "--disk-only", help="Take external disk-only snapshots, which do not save memory and are fast."),
+                    consistent: bool = typer.Option(False, "--consistent", help="Pause all the VMs, snapshot them in parallel, then resume them all."),
+                    parallelism: int = PARALLELISM_OPTION, output: str = OUTPUT_OPTION):
+    """
+    Snapshot VMs, reporting how long each VM took.
+    """
+    run_snapshot_command("create", vm_names, all_vms, state, output,
+                         lambda names: get_api().snapshot_api.create(names, name, disk_only, consistent, parallelism, description))
+
+@snapshot_app.command("list")
+def snapshot_list(vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION,
+                  parallelism: int = PARALLELISM_OPTION, output: str = OUTPUT_OPTION):
+    """
+    List the snapshots of VMs.
+    """
+    try:
+        check_output_format(output)
+        names = get_api().vm_api.resolve_vms(vm_names, all_vms, state)
+        if output != "table":
+            write_records(get_api().snapshot_api.get_snapshots(names, parallelism), output)
+        else:
+            get_api().snapshot_api.list_snapshots(names, parallelism)
+    except Exception as e:
+        handle_error(e)
+
+@snapshot_app.command("revert")
+def snapshot_revert(name: str = typer.Argument(..., help="Name of the snapshot."), vm_names: List[str] = VM_NAMES_ARGUMENT,
+                    all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION, parallelism: int = PARALLELISM_OPTION,
+                    output: str = OUTPUT_OPTION):
+    """
+    Revert VMs to a snapshot.
+    """
+    run_snapshot_command("revert", vm_names, all_vms, state, output,
+                         lambda names: get_api().snapshot_api.revert(names, name, parallelism))
+
+@snapshot_app.command("delete")
+def snapshot_delete(name: str = typer.Argument(..., help="Name of the snapshot."), vm_names: List[str] = VM_NAMES_ARGUMENT,
+                    all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION, parallelism: int = PARALLELISM_OPTION,
+                    output: str = OUTPUT_OPTION):
+    """
+    Delete a snapshot of VMs.
+    """
+    run_snapshot_command("delete", vm_names, all_vms, state, output,
+                         lambda names: get_api().snapshot_api.delete(names, name, parallelism))
+
+# vmctl mem stats|set|ksm|balance
+mem_app = typer.Typer(no_args_is_help=True, help="Read and set the memory of running VMs, tune KSM and balance memory between VMs.")
+app.add_typer(mem_app, name="mem")
+
+@mem_app.command("stats")
+def mem_stats(vm_names: List[str] = typer.Argument(None, help="Only show these VMs. Defaults to every running VM.", show_default=False),
+              output: str = OUTPUT_OPTION):
+    """
+    Show the balloon and guest memory stats of running VMs, read with one bulk call.
+    """
+    try:
+        check_output_format(output)
+        if output != "table":
+            write_records(get_api().memory_api.get_memory_stats(vm_names), output)
+        else:
+            get_api().memory_api.memory_stats(vm_names)
+    except Exception as e:
+        handle_error(e)
+
+@mem_app.command("set")
+def mem_set(memory: int = typer.Argument(..., help="Balloon target in MiB, at most the VMs' maximum memory."),
+            vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION,
+            config: bool = typer.Option(False, "--config", help="Also keep the target when the VMs are restarted (required for shut off VMs)."),
+            parallelism: int = PARALLELISM_OPTION, output: str = OUTPUT_OPTION):
+    """
+    Set the balloon target of VMs at runtime.
+    """
+    failed = False
+    try:
+        check_output_format(output)
+        names = get_api().vm_api.resolve_vms(vm_names, all_vms, state)
+        results = get_api().memory_api.set_memory(names, memory, config, parallelism)
+        if output != "table":
+            write_records(results, output)
+        else:
+            get_api().memory_api.print_memory_results(results)
+        failed = any(result["status"] == "failed" for result in results)
+    except Exception as e:
+        handle_error(e)
+    if failed:
+        raise typer.Exit(code=1)
+
+@mem_app.command("ksm")
+def mem_ksm(pages_to_scan: int = typer.Option(None, "--pages-to-scan", help="Pages KSM scans before it sleeps."),
+            sleep_ms: int = typer.Option(None, "--sleep-ms", help="Milliseconds KSM sleeps between scans."),
+            merge_across_nodes: bool = typer.Option(None, "--merge-across-nodes/--no-merge-across-nodes", help="Merge pages of different NUMA nodes."),
+            output: str = OUTPUT_OPTION):
+    """
+    Show the host's kernel samepage merging (KSM) counters and the memory it saves, and tune it.
+    """
+    try:
+        check_output_format(output)
+        get_api().memory_api.set_ksm(pages_to_scan, sleep_ms, merge_across_nodes)
+        if output != "table":
+            write_records([get_api().memory_api.get_ksm()], output)
+        else:
+            get_api().memory_api.ksm()
+    except Exception as e:
+        handle_error(e)
+
+@mem_app.command("balance")
+def mem_balance(interval: float = typer.Option(10.0, "--interval", "-i", help="Seconds between ticks."),
+                count: int = typer.Option(None, "--count", "-n", help="Number of ticks. Defaults to running until interrupted."),
+                dry_run: bool = typer.Option(False, "--dry-run", help="Only show what would change."),
+                record: str = typer.Option(None, "--record", help="Append every tick's stats to this file, to replay them later."),
+                replay: str = typer.Option(None, "--replay", help="Run the balancer over stats recorded with --record, without a host."),
+                output: str = OUTPUT_OPTION):
+    """
+    Move memory from idle VMs to VMs under pressure with their balloons, in a control loop with hysteresis.
+    """
+    try:
+        check_output_format(output)
+        if replay:
+            from utils.balancer import format_change, load_trace, replay as replay_trace
+            changes = replay_trace(load_trace(replay))
+            if output != "table":
+                write_records(changes, output)
+            else:
+                for change in changes:
+                    print(format_change(change))
+            return
+        # changes are printed as they happen, which the daemon cannot do
+        api = get_direct_api()
+        if output == "ndjson":
+            api.memory_api.balance(interval, count, dry_run, record, on_tick=lambda now, changes: write_records(changes, output))
+        elif output != "table":
+            write_records(api.memory_api.balance(interval, count, dry_run, record, on_tick=lambda now, changes: None), output)
+        else:
+            api.memory_api.balance(interval, count, dry_run, record)
+    except Exception as e:
+        handle_error(e)
+
+# vmctl qos profiles|apply|show
+qos_app = typer.Typer(no_args_is_help=True, help="Throttle the disk and network I/O of VMs with QoS profiles.")
+app.add_typer(qos_app, name="qos")
+
+@qos_app.command("profiles")
+def qos_profiles(output: str = OUTPUT_OPTION):
+    """
+    List the QoS profiles, the built-in ones and those of the configuration file.
+    """
+    try:
+        check_output_format(output)
+        # profiles are read from the configuration, no connection is needed
+        from utils.qos import get_profiles
+        profiles = get_profiles()
+        if output != "table":
+            write_records([{"name": name, **profile} for name, profile in sorted(profiles.items())], output)
+        else:
+            from wrapper.qos import list_profiles
+            list_profiles(profiles)
+    except Exception as e:
+        handle_error(e)
+
+@qos_app.command("apply")
+def qos_apply(profile: str = typer.Argument(..., help="Name of the QoS profile."),
+              vm_names: List[str] = VM_NAMES_ARGUMENT, all_vms: bool = ALL_VMS_OPTION, state: List[str] = STATE_OPTION,
+              config: bool = typer.Option(False, "--config", help="Also keep the limits when the VMs are restarted (required for shut off VMs)."),
+              parallelism: int = PARALLELISM_OPTION, output: str = OUTPUT_OPTION):
+    """
+    Apply a QoS profile to the disks and network interfaces of VMs, live.
+    """
+    failed = False
+    try:
+        check_output_format(output)
+        names = get_api().vm_api.resolve_vms(vm_names, all_vms, state)
+        results = get_api().qos_api.apply(names, profile, config, parallelism)
+        if output != "table":
+            write_records(results, output)
+        else:
+            get_api().qos_api.print_apply_results(results)
+        failed = any(result["status"] == "failed" for result in results)
+    except Exception as e:
+        handle_error(e)
+    if failed:
+        raise typer.Exit(code=1)
+
+@qos_app.command("show")
+def qos_show(vm_names: List[str] = typer.Argument(None, help="Only show these VMs (names or glob patterns). Defaults to every VM.", show_default=False),
+             interval: float = typer.Option(1.0, "--interval", "-i", help="Seconds the throughput is measured over."),
+             parallelism: int = PARALLELISM_OPTION, output: str = OUTPUT_OPTION):
+    """
+    Show the I/O limits of VMs against the throughput they do, from two bulk stats reads.
+    """
+    try:
+        check_output_format(output)
+        names = get_api().vm_api.resolve_vms(vm_names, False, None) if vm_names else None
+        if output != "table":
+            from wrapper.qos import QOS_FIELDS
+            write_records(get_api().qos_api.get_qos(names, interval, parallelism), output, QOS_FIELDS)
+        else:
+            get_api().qos_api.show(names, interval, parallelism)
+    except Exception as e:
+        handle_error(e)
+
 if __name__ == "__main__":
     app()
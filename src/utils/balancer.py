@@ -0,0 +1,244 @@
+"""
+This module decides how to move memory between the VMs of a host with their balloons.
+
+BalloonBalancer is fed one sample of every VM's balloon stats per tick and returns the balloon targets to set.
+It knows nothing of libvirt, so it can be driven by the stats recorded with `vmctl mem balance --record`
+(see replay) as well as by a live host (wrapper.memory.MemoryApi.balance).
+
+A VM is under pressure when little of its memory is usable by the guest, or when it swaps in or takes many major
+faults, and idle when much of its memory is unused. Idle VMs are shrunk towards `target_free` only after they were
+idle for `settle_ticks` ticks in a row, and a VM is left alone for `cooldown_ticks` ticks after every change, so
+the balloons do not oscillate. The memory reclaimed in a tick, plus what the host has free above
+`host_reserve`, is handed to the VMs under pressure, the most pressured first. The settings are read from the
+"memory" section of the vmctl configuration file:
+
+    {
+        "memory": {
+            "low_free": 0.10,
+            "high_free": 0.35,
+            "target_free": 0.20,
+            "max_step": 512,
+            "min_change": 64,
+            "min_memory": 512,
+            "major_faults": 100,
+            "settle_ticks": 3,
+            "cooldown_ticks": 2,
+            "host_reserve": 1024
+        }
+    }
+
+The ratios are fractions of the memory available to the guest and the sizes are in MiB.
+"""
+import json
+import time
+from utils.config import load_config
+from utils.errors import VmctlError
+
+DEFAULT_BALANCER = {
+    "low_free": 0.10,
+    "high_free": 0.35,
+    "target_free": 0.20,
+    "max_step": 512,
+    "min_change": 64,
+    "min_memory": 512,
+    "major_faults": 100,
+    "settle_ticks": 3,
+    "cooldown_ticks": 2,
+    "host_reserve": 1024,
+}
+
+# the balloon stats a sample has, in KiB (swap_in) or counts (major_fault), as named by libvirt
+SAMPLE_KEYS = ["current", "maximum", "available", "usable", "unused", "swap_in", "major_fault"]
+
+def get_balancer_settings(settings=None):
+    """
+    Gets the balancer settings, from the configuration file unless they were given.
+
+    Args:
+        settings (dict, optional): The settings. Defaults to None, which reads them from the configuration file.
+
+    Raises:
+        VmctlError: If the watermarks are not 0 < low_free < target_free < high_free < 1.
+
+    Returns:
+        dict: The settings, with the defaults for anything not set.
+    """
+    if settings is None:
+        settings = load_config().get("memory", {})
+    settings = {**DEFAULT_BALANCER, **settings}
+    if not 0 < settings["low_free"] < settings["target_free"] < settings["high_free"] < 1:
+        raise VmctlError("The memory watermarks must satisfy 0 < low_free < target_free < high_free < 1.")
+    return settings
+
+
+class BalloonBalancer:
+    """
+    A control loop that reclaims memory from idle VMs and gives it to VMs under pressure, with hysteresis.
+    """
+
+    def __init__(self, settings=None):
+        """
+        Initializes the BalloonBalancer class.
+
+        Args:
+            settings (dict, optional): The settings (see DEFAULT_BALANCER). Defaults to None, which reads them from
+                                       the configuration file.
+        """
+        self.settings = get_balancer_settings(settings)
+        # vm name -> the previous sample, the number of ticks it was idle in a row and the ticks left to cool down
+        self.previous = {}
+        self.idle_ticks = {}
+        self.cooldown = {}
+
+    def decide(self, samples, host_free: int = None):
+        """
+        Runs one tick of the control loop.
+
+        Args:
+            samples (dict): The balloon stats of every running VM in KiB (see SAMPLE_KEYS), keyed by VM name.
+                            VMs without "available" and "usable" (the guest reports no stats) are left alone.
+            host_free (int, optional): The free memory of the host in KiB. Defaults to None, which only
+                                       redistributes the memory reclaimed from idle VMs.
+
+        Returns:
+            list: The balloon changes, dictionaries with the "name", "current" and "target" memory in KiB and
+                  the "reason" (idle or pressure) and "free" ratio of each VM to change.
+        """
+        settings = self.settings
+        max_step, min_change = settings["max_step"] * 1024, settings["min_change"] * 1024
+        idle, pressured = [], []
+
+        for name, sample in samples.items():
+            previous = self.previous.get(name, sample)
+            self.previous[name] = sample
+            cooling = self.cooldown.get(name, 0) > 0
+            if not sample.get("available") or sample.get("usable") is None:
+                continue
+
+            free = sample["usable"] / sample["available"]
+            used = sample["available"] - sample["usable"]
+            swapping = sample.get("swap_in", 0) > previous.get("swap_in", 0)
+            faulting = sample.get("major_fault", 0) - previous.get("major_fault", 0) > settings["major_faults"]
+            # the size that leaves the guest target_free of its memory free
+            wanted = int(used / (1 - settings["target_free"]))
+
+            if free < settings["low_free"] or swapping or faulting:
+                self.idle_ticks[name] = 0
+                if not cooling and sample["current"] < sample["maximum"]:
+                    pressured.append((free, name, sample, wanted))
+            elif free > settings["high_free"]:
+                self.idle_ticks[name] = self.idle_ticks.get(name, 0) + 1
+                if self.idle_ticks[name] >= settings["settle_ticks"] and not cooling:
+                    idle.append((free, name, sample, wanted))
+            else:
+                # in the dead band between the watermarks nothing changes
+                self.idle_ticks[name] = 0
+
+        for name in list(self.previous):
+            if name not in samples:
+                # the vm stopped or went away
+                for state in (self.previous, self.idle_ticks, self.cooldown):
+                    state.pop(name, None)
+
+        decisions = []
+        pool = max(0, (host_free or 0) - settings["host_reserve"] * 1024)
+        for free, name, sample, wanted in idle:
+            target = max(wanted, settings["min_memory"] * 1024, sample["current"] - max_step)
+            if sample["current"] - target >= min_change:
+                pool += sample["current"] - target
+                decisions.append(self._change(name, sample, target, "idle", free))
+
+        # the most pressured vms are served first
+        for free, name, sample, wanted in sorted(pressured, key=lambda item: item[0]):
+            grow = min(sample["maximum"] - sample["current"], max(wanted - sample["current"], min_change), max_step, pool)
+            if grow >= min_change:
+                pool -= grow
+                decisions.append(self._change(name, sample, sample["current"] + grow, "pressure", free))
+
+        changed = {decision["name"] for decision in decisions}
+        for name in self.cooldown:
+            if name not in changed:
+                self.cooldown[name] = max(0, self.cooldown[name] - 1)
+        return decisions
+
+    def _change(self, name: str, sample, target: int, reason: str, free: float):
+        """
+        Records a balloon change, which starts the VM's cooldown.
+
+        Returns:
+            dict: The change.
+        """
+        self.idle_ticks[name] = 0
+        self.cooldown[name] = self.settings["cooldown_ticks"]
+        return {"name": name, "current": sample["current"], "target": int(target), "reason": reason, "free": round(free, 3)}
+
+
+def format_change(change):
+    """
+    Formats a balloon change for display.
+
+    Args:
+        change (dict): The change, with the "time" of its tick and optionally the "status" of applying it.
+
+    Returns:
+        str: The change, with rich markup.
+    """
+    stamp = time.strftime("%H:%M:%S", time.localtime(change["time"]))
+    color = "green" if change["reason"] == "pressure" else "bright_yellow"
+    return (f"{stamp} [bold bright_cyan]{change['name']}[/bold bright_cyan]: {change['current'] // 1024} -> "
+            f"{change['target'] // 1024} MiB ([{color}]{change['reason']}[/{color}], {change['free']:.0%} free) "
+            f"{change.get('status', '')}").rstrip()
+
+
+def load_trace(path: str):
+    """
+    Loads the stats recorded with `vmctl mem balance --record`.
+
+    Args:
+        path (str): The path of the trace, one JSON object per line with the "time", "host_free" and "samples" of a tick.
+
+    Raises:
+        VmctlError: If the trace cannot be read.
+
+    Returns:
+        list: The ticks.
+    """
+    try:
+        with open(path) as trace_file:
+            return [json.loads(line) for line in trace_file if line.strip()]
+    except (OSError, ValueError) as e:
+        raise VmctlError(f"Error reading the trace '{path}': {e}")
+
+
+def replay(ticks, settings=None):
+    """
+    Runs a balancer over recorded ticks, as if the changes it decides were applied.
+
+    A change only shows up in the recorded stats if it was applied while recording, so the current memory of a VM
+    is carried over from the balancer's own decisions rather than read from the trace.
+
+    Args:
+        ticks (list): The ticks, as returned by load_trace.
+        settings (dict, optional): The balancer settings. Defaults to None, which reads them from the configuration file.
+
+    Returns:
+        list: The decisions of every tick, as returned by BalloonBalancer.decide, with the "time" of the tick.
+    """
+    balancer = BalloonBalancer(settings)
+    targets = {}
+    decisions = []
+    for tick in ticks:
+        samples = {}
+        for name, sample in tick["samples"].items():
+            sample = dict(sample)
+            if name in targets:
+                # the guest sees the memory the balloon gave or took as usable
+                sample["usable"] = max(0, sample.get("usable", 0) + targets[name] - sample["current"])
+                sample["available"] = sample.get("available", 0) + targets[name] - sample["current"]
+                sample["current"] = targets[name]
+            samples[name] = sample
+        changes = balancer.decide(samples, tick.get("host_free"))
+        for change in changes:
+            targets[change["name"]] = change["target"]
+            decisions.append(dict(change, time=tick.get("time")))
+    return decisions
@@ -0,0 +1,69 @@
+"""
+This module loads the vmctl configuration file.
+
+The configuration is a JSON file read from $VMCTL_CONFIG, or ~/.config/vmctl/config.json by default:
+
+    {
+        "hosts": {
+            "node1": "qemu+ssh://root@node1/system",
+            "node2": "qemu+ssh://root@node2/system"
+        }
+    }
+"""
+import json
+import os
+from utils.errors import VmctlError
+
+DEFAULT_CONFIG_PATH = os.path.join("~", ".config", "vmctl", "config.json")
+
+def load_config(path: str = None):
+    """
+    Loads the vmctl configuration file.
+
+    Args:
+        path (str, optional): The path of the configuration file. Defaults to $VMCTL_CONFIG or ~/.config/vmctl/config.json.
+
+    Raises:
+        VmctlError: If the file exists but is not valid JSON.
+
+    Returns:
+        dict: The configuration, or an empty dictionary if the file does not exist.
+    """
+    path = os.path.expanduser(path or os.environ.get("VMCTL_CONFIG") or DEFAULT_CONFIG_PATH)
+    try:
+        with open(path) as config_file:
+            config = json.load(config_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        raise VmctlError(f"Error reading the configuration file '{path}': {e}")
+
+    if not isinstance(config, dict):
+        raise VmctlError(f"The configuration file '{path}' must contain a JSON object.")
+    return config
+
+
+def resolve_hosts(config, selected, all_hosts: bool = False):
+    """
+    Resolves host names from the configuration (or plain libvirt URIs) to URIs.
+
+    Args:
+        config (dict): The vmctl configuration.
+        selected (list): Host names from the "hosts" section, or libvirt URIs.
+        all_hosts (bool, optional): Select every configured host. Defaults to False.
+
+    Raises:
+        VmctlError: If --all-hosts is used but no hosts are configured.
+
+    Returns:
+        dict: The selected hosts, mapping each host name to its URI.
+    """
+    configured = config.get("hosts", {})
+    if all_hosts:
+        if not configured:
+            raise VmctlError("No hosts are configured. Add a \"hosts\" section to the configuration file.")
+        return dict(configured)
+
+    # anything that is not a configured host name is used as a uri,
+    # so one-off hosts can be queried without editing the configuration
+    return {host: configured.get(host, host) for host in selected or []}
@@ -1,7 +1,10 @@
 """
 This module defines the custom exception classes and the centralized error handler for vmctl.
 """
-from rich import print
+from rich.console import Console
+
+# errors never mix with the output, which may be machine-readable (--output json)
+_stderr = Console(stderr=True)
 
 class VmctlError(Exception):
     """Base class for all vmctl errors."""
@@ -17,8 +20,12 @@ class LibvirtError(VmctlError):
         self.message = message
 
 def handle_error(e: Exception):
-    """Prints a user-friendly error message."""
+    """Prints a user-friendly error message and ends the command with exit status 1."""
+    # typer is only needed by the CLI, the wrappers import this module too
+    import typer
+
     if isinstance(e, VmctlError):
-        print(f"[bold red]Error:[/bold red] {e.message}")
+        _stderr.print(f"[bold red]Error:[/bold red] {e.message}")
     else:
-        print(f"[bold red]An unexpected error occurred:[/bold red] {e}")
\ No newline at end of file
+        _stderr.print(f"[bold red]An unexpected error occurred:[/bold red] {e}")
+    raise typer.Exit(code=1)
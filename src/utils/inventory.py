@@ -0,0 +1,288 @@
+"""
+This module provides vmctl's local inventory, a SQLite index of the VMs of every host vmctl has seen.
+
+Each VM is stored with its host, UUID, name, state, vCPU's, memory, disks and the tags read from its
+`<metadata>` element, and each host with the time it was last refreshed, so `vmctl list --cached` and
+`vmctl find` answer without asking libvirt and show how old the answer is. The index is refreshed by
+wrapper.inventory.InventoryApi.
+
+The inventory lives in $VMCTL_INVENTORY, the "path" of the "inventory" section of the configuration file,
+or ~/.cache/vmctl/inventory.db.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from utils.config import load_config
+from utils.errors import VmctlError
+
+DEFAULT_INVENTORY_PATH = "~/.cache/vmctl/inventory.db"
+
+# hosts refreshed longer ago than this (in seconds) are refreshed before being answered from
+DEFAULT_MAX_AGE = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    uri TEXT PRIMARY KEY,
+    hostname TEXT,
+    refreshed_at REAL
+);
+CREATE TABLE IF NOT EXISTS vms (
+    uri TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT,
+    vcpus INTEGER,
+    memory INTEGER,
+    disks TEXT,
+    tags TEXT,
+    PRIMARY KEY (uri, uuid)
+);
+CREATE INDEX IF NOT EXISTS vms_name ON vms (name);
+"""
+
+VM_FIELDS = ["host", "uri", "uuid", "name", "state", "vcpus", "memory", "disks", "tags", "age"]
+
+def get_inventory_settings():
+    """
+    Gets the path of the inventory and the maximum age of a host's entry.
+
+    Returns:
+        tuple: The path and the maximum age in seconds.
+    """
+    settings = load_config().get("inventory", {})
+    path = os.environ.get("VMCTL_INVENTORY") or settings.get("path") or DEFAULT_INVENTORY_PATH
+    return os.path.expanduser(path), float(settings.get("max_age", DEFAULT_MAX_AGE))
+
+
+class Inventory:
+    """
+    The SQLite store of the local inventory. It can be shared between threads.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        Initializes the Inventory class and creates the database if it does not exist.
+
+        Args:
+            path (str, optional): The path of the database. Defaults to the configured path.
+
+        Raises:
+            VmctlError: If the database cannot be opened.
+        """
+        self.path = path or get_inventory_settings()[0]
+        self.lock = threading.Lock()
+        try:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # the daemon writes the inventory from the event thread while commands read it
+            self.db = sqlite3.connect(self.path, timeout=10.0, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            raise VmctlError(f"Error opening the inventory '{self.path}': {e}")
+
+    def get_hosts(self):
+        """
+        Gets the hosts in the inventory.
+
+        Returns:
+            dict: The "hostname" and "refreshed_at" (a UNIX time) of each host, keyed by URI.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT uri, hostname, refreshed_at FROM hosts").fetchall()
+        return {uri: {"hostname": hostname, "refreshed_at": refreshed_at} for uri, hostname, refreshed_at in rows}
+
+    def get_age(self, uri: str):
+        """
+        Gets how long ago a host was refreshed.
+
+        Args:
+            uri (str): The libvirt URI of the host.
+
+        Returns:
+            float: The age in seconds, or None if the host was never refreshed.
+        """
+        host = self.get_hosts().get(uri)
+        if host is None or host["refreshed_at"] is None:
+            return None
+        return max(0.0, time.time() - host["refreshed_at"])
+
+    def get_vm_rows(self, uri: str):
+        """
+        Gets the stored VMs of a host, to compare them with libvirt.
+
+        Args:
+            uri (str): The libvirt URI of the host.
+
+        Returns:
+            dict: The "name", "state", "vcpus" and "memory" of each VM, and whether its disks and tags were "read",
+                  keyed by UUID.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT uuid, name, state, vcpus, memory, disks IS NOT NULL FROM vms WHERE uri = ?", (uri,)).fetchall()
+        return {
+            uuid: {"name": name, "state": state, "vcpus": vcpus, "memory": memory, "read": bool(read)}
+            for uuid, name, state, vcpus, memory, read in rows
+        }
+
+    def update_host(self, uri: str, hostname: str, vms, removed):
+        """
+        Stores the result of a refresh in a single transaction.
+
+        Args:
+            uri (str): The libvirt URI of the host.
+            hostname (str): The host name of the host.
+            vms (list): The VMs to insert or update, dictionaries with the "uuid", "name", "state", "vcpus" and
+                        "memory" of each VM, and its "disks" and "tags" when they were read, or None when reading
+                        them failed.
+            removed (list): The UUIDs of the VMs that no longer exist.
+        """
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO hosts (uri, hostname, refreshed_at) VALUES (?, ?, ?)", (uri, hostname, time.time()))
+            self.db.executemany("DELETE FROM vms WHERE uri = ? AND uuid = ?", [(uri, uuid) for uuid in removed])
+            for vm in vms:
+                # new VMs are stored without disks and tags until they are read
+                self.db.execute(
+                    "INSERT INTO vms (uri, uuid, name, state, vcpus, memory) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (uri, uuid) DO UPDATE SET name = excluded.name, state = excluded.state, "
+                    "vcpus = excluded.vcpus, memory = excluded.memory",
+                    (uri, vm["uuid"], vm["name"], vm["state"], vm["vcpus"], vm["memory"]),
+                )
+                if "disks" in vm:
+                    # NULL marks details that could not be read, so the next refresh reads them again
+                    self.db.execute("UPDATE vms SET disks = ?, tags = ? WHERE uri = ? AND uuid = ?",
+                                    (_to_json(vm["disks"]), _to_json(vm["tags"]), uri, vm["uuid"]))
+
+    def set_state(self, uri: str, uuid: str, state: str):
+        """
+        Updates the state of a VM, e.g. after a lifecycle event.
+
+        Args:
+            uri (str): The libvirt URI of the host.
+            uuid (str): The UUID of the VM.
+            state (str): The new state.
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE vms SET state = ? WHERE uri = ? AND uuid = ?", (state, uri, uuid))
+
+    def remove_vm(self, uri: str, uuid: str):
+        """
+        Removes a VM, e.g. after it was undefined.
+
+        Args:
+            uri (str): The libvirt URI of the host.
+            uuid (str): The UUID of the VM.
+        """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM vms WHERE uri = ? AND uuid = ?", (uri, uuid))
+
+    def get_vms(self, uris=None, states=None, pattern: str = None, tags=None):
+        """
+        Gets the VMs in the inventory.
+
+        Args:
+            uris (list, optional): Only include VMs of these hosts. Defaults to None, which includes every host.
+            states (list, optional): Only include VMs in one of these states. Defaults to None.
+            pattern (str, optional): Only include VMs whose name matches this glob pattern, or contains it if it has no
+                                     wildcards, or whose UUID starts with it. Case insensitive. Defaults to None.
+            tags (dict, optional): Only include VMs with all of these tags and values. Defaults to None.
+
+        Returns:
+            list: A list of dictionaries with the VM_FIELDS of each VM, ordered by host and name.
+                  "age" is how long ago the VM's host was refreshed, in seconds.
+        """
+        query = ("SELECT vms.uri, hosts.hostname, hosts.refreshed_at, uuid, name, state, vcpus, memory, disks, tags "
+                 "FROM vms LEFT JOIN hosts ON hosts.uri = vms.uri")
+        conditions, params = [], []
+        if uris is not None:
+            uris = list(uris)
+            conditions.append(f"vms.uri IN ({', '.join('?' * len(uris))})")
+            params.extend(uris)
+        if states:
+            conditions.append(f"state IN ({', '.join('?' * len(states))})")
+            params.extend(states)
+        if pattern:
+            # a pattern without wildcards matches anywhere in the name
+            glob = pattern.lower() if any(char in pattern for char in "*?[") else f"*{pattern.lower()}*"
+            conditions.append("(lower(name) GLOB ? OR lower(uuid) LIKE ?)")
+            params.extend([glob, f"{pattern.lower()}%"])
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY hosts.hostname, vms.uri, name"
+
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+
+        now = time.time()
+        vms = []
+        for uri, hostname, refreshed_at, uuid, name, state, vcpus, memory, disks, vm_tags in rows:
+            vm_tags = json.loads(vm_tags or "{}")
+            if tags and any(vm_tags.get(key) != value for key, value in tags.items()):
+                continue
+            vms.append({
+                "host": hostname or uri,
+                "uri": uri,
+                "uuid": uuid,
+                "name": name,
+                "state": state,
+                "vcpus": vcpus,
+                "memory": memory,
+                "disks": json.loads(disks or "[]"),
+                "tags": vm_tags,
+                "age": None if refreshed_at is None else round(max(0.0, now - refreshed_at), 1),
+            })
+        return vms
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        with self.lock:
+            self.db.close()
+
+
+def _to_json(value):
+    return None if value is None else json.dumps(value)
+
+
+def parse_tags(tags):
+    """
+    Parses tag filters given as key=value.
+
+    Args:
+        tags (list): The filters.
+
+    Raises:
+        VmctlError: If a filter is not key=value.
+
+    Returns:
+        dict: The values keyed by tag.
+    """
+    parsed = {}
+    for tag in tags or []:
+        key, separator, value = tag.partition("=")
+        if not separator or not key:
+            raise VmctlError(f"Invalid tag filter '{tag}'. Use key=value.")
+        parsed[key] = value
+    return parsed
+
+
+def format_age(age: float):
+    """
+    Formats the age of an inventory entry.
+
+    Args:
+        age (float): The age in seconds, or None if it was never refreshed.
+
+    Returns:
+        str: The age, e.g. "42s", "5m" or "3h".
+    """
+    if age is None:
+        return "never"
+    if age < 60:
+        return f"{age:.0f}s"
+    if age < 3600:
+        return f"{age / 60:.0f}m"
+    return f"{age / 3600:.0f}h"
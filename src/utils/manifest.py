@@ -0,0 +1,175 @@
+"""
+This module loads manifest files, which declare many virtual machines for `vmctl apply`.
+
+A manifest is a YAML or JSON file with a list of VMs, optional defaults shared by all of them,
+and optional named templates that VMs can start from:
+
+    defaults:
+      memory: 1024
+      vcpus: 1
+    templates:
+      db:
+        vcpus: 4
+        topology: {sockets: 1, cores: 2, threads: 2}
+        hugepages: true
+        disks:
+          - {source: "/var/lib/libvirt/images/{name}.qcow2"}
+          - {source: "/var/lib/libvirt/images/{name}-data.qcow2", bus: scsi}
+        interfaces:
+          - {network: default, model: virtio}
+          - {bridge: br0, model: virtio}
+    vms:
+      - name: web-{01..20}
+        disk: /var/lib/libvirt/images/{name}.qcow2
+      - name: db-{1..2}
+        template: db
+        memory: 4096
+
+Names can contain ranges ({01..20}) and alternatives ({a,b}), and "{name}" in a path is replaced by the VM's name.
+The disk, interface, topology, hugepages and numa options are described in utils.xml.DomainTemplate.
+"""
+import hashlib
+import itertools
+import json
+import os
+import re
+from utils.errors import VmctlError
+
+# the keys a vm can declare, anything else is most likely a typo
+SPEC_KEYS = ["name", "memory", "vcpus", "iso", "disk", "disks", "interfaces", "topology", "hugepages", "numa"]
+REQUIRED_KEYS = ["name", "memory", "vcpus"]
+
+# {01..20} or {a,b,c}
+NAME_PATTERN = re.compile(r"\{(?:(\d+)\.\.(\d+)|([^{}]*,[^{}]*))\}")
+
+def load_manifest(path: str):
+    """
+    Loads a manifest file and expands it into one spec per virtual machine.
+
+    Args:
+        path (str): The path of the manifest, a .yaml/.yml file or a JSON file.
+
+    Raises:
+        VmctlError: If the file cannot be read, is not valid, or declares a VM more than once.
+
+    Returns:
+        list: A list of specs, dictionaries with the "name", "memory", "vcpus" and "iso", "disk" or "disks" of each VM,
+              and any other option it declares.
+    """
+    try:
+        with open(os.path.expanduser(path)) as manifest_file:
+            if path.endswith((".yaml", ".yml")):
+                # yaml support is optional, json manifests work without it
+                try:
+                    import yaml
+                except ImportError:
+                    raise VmctlError("YAML manifests need PyYAML (pip install pyyaml), or use a JSON manifest.")
+                manifest = yaml.safe_load(manifest_file)
+            else:
+                manifest = json.load(manifest_file)
+    except VmctlError:
+        raise
+    except Exception as e:
+        raise VmctlError(f"Error reading the manifest '{path}': {e}")
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("vms"), list):
+        raise VmctlError(f"The manifest '{path}' must contain a \"vms\" list.")
+    defaults = manifest.get("defaults", {})
+    templates = manifest.get("templates", {})
+
+    specs = []
+    seen = set()
+    for entry in manifest["vms"]:
+        if not isinstance(entry, dict):
+            raise VmctlError(f"Every entry of \"vms\" must be a mapping, got: {entry!r}")
+        template = {}
+        if "template" in entry:
+            if entry["template"] not in templates:
+                raise VmctlError(f"The manifest entry '{entry.get('name')}' uses the unknown template '{entry['template']}'.")
+            template = templates[entry["template"]]
+        entry = {key: value for key, value in entry.items() if key != "template"}
+        for spec in expand_spec({**defaults, **template, **entry}):
+            if spec["name"] in seen:
+                raise VmctlError(f"VM '{spec['name']}' is declared more than once in the manifest.")
+            seen.add(spec["name"])
+            specs.append(spec)
+    return specs
+
+
+def expand_spec(entry):
+    """
+    Expands a manifest entry with a templated name into one spec per name.
+
+    Args:
+        entry (dict): The manifest entry, with the defaults applied.
+
+    Raises:
+        VmctlError: If the entry has unknown or missing keys, or invalid values.
+
+    Returns:
+        list: The specs.
+    """
+    unknown = [key for key in entry if key not in SPEC_KEYS]
+    if unknown:
+        raise VmctlError(f"Unknown keys in the manifest entry '{entry.get('name')}': {', '.join(unknown)}")
+    missing = [key for key in REQUIRED_KEYS if key not in entry]
+    if missing:
+        raise VmctlError(f"The manifest entry '{entry.get('name')}' is missing: {', '.join(missing)}")
+    if sum(1 for key in ["iso", "disk", "disks"] if entry.get(key)) != 1:
+        raise VmctlError(f"The manifest entry '{entry['name']}' needs exactly one of iso, disk or disks.")
+    if "disks" in entry and not all(isinstance(disk, dict) and disk.get("source") for disk in entry["disks"]):
+        raise VmctlError(f"Every disk of the manifest entry '{entry['name']}' needs a source path.")
+    for key in ["memory", "vcpus"]:
+        if not isinstance(entry[key], int) or isinstance(entry[key], bool) or entry[key] <= 0:
+            raise VmctlError(f"The {key} of the manifest entry '{entry['name']}' must be a positive integer.")
+
+    specs = []
+    for name in expand_name(str(entry["name"])):
+        spec = {key: entry[key] for key in SPEC_KEYS if entry.get(key) is not None}
+        spec["name"] = name
+        for key in ["iso", "disk"]:
+            if key in spec:
+                spec[key] = str(spec[key]).replace("{name}", name)
+        if "disks" in spec:
+            spec["disks"] = [dict(disk, source=str(disk["source"]).replace("{name}", name)) for disk in spec["disks"]]
+        specs.append(spec)
+    return specs
+
+
+def expand_name(template: str):
+    """
+    Expands the ranges and alternatives in a templated name.
+
+    Args:
+        template (str): The name, e.g. "web-{01..20}" or "{db,cache}-{1..2}".
+
+    Returns:
+        list: The names, e.g. ["web-01", ..., "web-20"]. Ranges keep the zero padding of their first number.
+    """
+    parts = []
+    position = 0
+    for match in NAME_PATTERN.finditer(template):
+        parts.append([template[position:match.start()]])
+        if match.group(3) is not None:
+            parts.append(match.group(3).split(","))
+        else:
+            first, last = match.group(1), match.group(2)
+            width = len(first) if first.startswith("0") else 0
+            step = 1 if int(last) >= int(first) else -1
+            parts.append([str(number).zfill(width) for number in range(int(first), int(last) + step, step)])
+        position = match.end()
+    parts.append([template[position:]])
+    return ["".join(combination) for combination in itertools.product(*parts)]
+
+
+def spec_hash(spec):
+    """
+    Hashes a spec, so an existing VM can be compared with its manifest entry without reading its whole configuration.
+
+    Args:
+        spec (dict): The spec.
+
+    Returns:
+        str: The SHA-256 of the spec's canonical JSON.
+    """
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,81 @@
+"""
+This module provides machine-readable output (JSON, NDJSON and CSV) for vmctl commands.
+
+These formats write plain typed values straight to stdout, without going through rich.
+"""
+import csv
+import json
+import sys
+from utils.errors import VmctlError
+
+# "table" is the rich rendering of every command, the default on a terminal
+OUTPUT_FORMATS = ["table", "json", "ndjson", "csv"]
+
+def default_output_format():
+    """
+    Gets the output format of commands run without --output.
+
+    Returns:
+        str: "table" when stdout is a terminal, otherwise "ndjson", so piped output can be parsed record by record.
+    """
+    return "table" if sys.stdout.isatty() else "ndjson"
+
+
+def check_output_format(output_format: str):
+    """
+    Checks that an output format is supported.
+
+    Args:
+        output_format (str): The output format.
+
+    Raises:
+        VmctlError: If the output format is not supported.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise VmctlError(f"Unsupported output format '{output_format}'. Use one of: {', '.join(OUTPUT_FORMATS)}.")
+
+
+def write_records(records, output_format: str, fields=None, file=None):
+    """
+    Writes records in a machine-readable format.
+
+    NDJSON and CSV records are written one at a time as they are produced, so `records` can be a generator.
+
+    Args:
+        records (iterable): The records (dictionaries) to write.
+        output_format (str): The output format (json, ndjson or csv).
+        fields (list, optional): The CSV columns. Defaults to None, which uses the keys of the first record.
+        file (file, optional): The file to write to. Defaults to sys.stdout.
+    """
+    file = file or sys.stdout
+    if output_format == "json":
+        json.dump(list(records), file, indent=2)
+        file.write("\n")
+    elif output_format == "ndjson":
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+            file.flush()
+    elif output_format == "csv":
+        writer = None
+        for record in records:
+            if writer is None:
+                writer = csv.DictWriter(file, fieldnames=fields or list(record), extrasaction="ignore")
+                writer.writeheader()
+            writer.writerow(record)
+            file.flush()
+    else:
+        raise VmctlError(f"Output format '{output_format}' cannot be written as records.")
+
+
+def strip_markup(text: str):
+    """
+    Removes rich markup (e.g. [bold]...[/bold]) from a message.
+
+    Args:
+        text (str): The message.
+
+    Returns:
+        str: The message as plain text.
+    """
+    from rich.text import Text
+    return Text.from_markup(text).plain
@@ -0,0 +1,69 @@
+"""
+This module provides a helper to run a function over many items using a bounded pool of worker threads.
+"""
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.errors import VmctlError
+
+def _call(func, item):
+    try:
+        return item, func(item), None
+    except Exception as e:
+        return item, None, e
+
+
+def _submit(executor, func, item):
+    # the calls run in the caller's context, e.g. the console a daemon request prints to
+    return executor.submit(contextvars.copy_context().run, _call, func, item)
+
+
+def run_parallel(func, items, parallelism: int = 8):
+    """
+    Runs a function for every item using at most `parallelism` worker threads.
+
+    A failure for one item does not stop the others, the exception is returned alongside the item instead.
+
+    Args:
+        func (callable): The function to call with each item.
+        items (list): The items to process.
+        parallelism (int, optional): The maximum number of concurrent calls. Defaults to 8.
+
+    Raises:
+        VmctlError: If parallelism is less than 1.
+
+    Returns:
+        list: A list of (item, result, error) tuples in the same order as `items`.
+              `error` is None when the call succeeded and `result` is None when it failed.
+    """
+    if parallelism < 1:
+        raise VmctlError("Parallelism must be at least 1.")
+
+    # libvirt releases the GIL while it waits on the daemon,
+    # so threads are enough to overlap the blocking calls
+    with ThreadPoolExecutor(max_workers=min(parallelism, max(len(items), 1))) as executor:
+        futures = [_submit(executor, func, item) for item in items]
+        return [future.result() for future in futures]
+
+
+def iter_parallel(func, items, parallelism: int = 8):
+    """
+    Like run_parallel, but yields each (item, result, error) tuple as soon as its call completes.
+
+    Args:
+        func (callable): The function to call with each item.
+        items (list): The items to process.
+        parallelism (int, optional): The maximum number of concurrent calls. Defaults to 8.
+
+    Raises:
+        VmctlError: If parallelism is less than 1.
+
+    Yields:
+        tuple: An (item, result, error) tuple, in completion order.
+    """
+    if parallelism < 1:
+        raise VmctlError("Parallelism must be at least 1.")
+
+    with ThreadPoolExecutor(max_workers=min(parallelism, max(len(items), 1))) as executor:
+        futures = [_submit(executor, func, item) for item in items]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,162 @@
+"""
+This module records where the time of a vmctl command goes: its phases (import, connect, command, render) and
+every libvirt call, with their count and latency.
+
+Profiling is off unless enable() is called. While it is off, phase() hands out one shared no-op context manager
+and the libvirt connection is not wrapped at all, so the cost is a function call and a None check.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from utils.errors import VmctlError
+
+# the profiler of this process, None while profiling is off
+_profiler = None
+
+_NO_PHASE = contextlib.nullcontext()
+
+def enable(origin: float = None):
+    """
+    Turns profiling on for the rest of the process. Calling it more than once has no effect.
+
+    Args:
+        origin (float, optional): The time the trace starts at (time.perf_counter), e.g. before the imports. Defaults to now.
+
+    Returns:
+        Profiler: The profiler.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(origin)
+    return _profiler
+
+
+def get_profiler():
+    """
+    Gets the profiler of this process.
+
+    Returns:
+        Profiler: The profiler, or None while profiling is off.
+    """
+    return _profiler
+
+
+def phase(name: str):
+    """
+    Times a phase of the command, e.g. `with phase("render"): ...`.
+
+    Args:
+        name (str): The name of the phase.
+
+    Returns:
+        contextlib.AbstractContextManager: The context manager timing the phase.
+    """
+    if _profiler is None:
+        return _NO_PHASE
+    return _profiler.phase(name)
+
+
+class Profiler:
+    """
+    Collects timed events, summarizes them and writes them as a Chrome trace.
+    """
+
+    def __init__(self, origin: float = None):
+        """
+        Initializes the Profiler class.
+
+        Args:
+            origin (float, optional): The time the trace starts at (time.perf_counter). Defaults to now.
+        """
+        self.origin = time.perf_counter() if origin is None else origin
+        # (name, category, start, end, thread id), appended from any thread
+        self.events = []
+
+    def record(self, name: str, category: str, start: float, end: float):
+        """
+        Records an event.
+
+        Args:
+            name (str): The name of the event, e.g. "virConnect.getAllDomainStats".
+            category (str): "phase" or "rpc".
+            start (float): The time the event started at (time.perf_counter).
+            end (float): The time the event ended at (time.perf_counter).
+        """
+        # list.append is atomic, no lock is needed on the hot path
+        self.events.append((name, category, start, end, threading.get_ident()))
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Times a phase of the command.
+
+        Args:
+            name (str): The name of the phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, "phase", start, time.perf_counter())
+
+    def summary(self):
+        """
+        Adds up the events by name.
+
+        Returns:
+            list: A list of dictionaries with the "name", "category", "count", "total_ms", "mean_ms" and "max_ms"
+                  of each event name, phases first, then the calls by total time.
+        """
+        totals = {}
+        for name, category, start, end, _ in list(self.events):
+            elapsed = (end - start) * 1000
+            total = totals.setdefault(name, {"name": name, "category": category, "count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            total["count"] += 1
+            total["total_ms"] += elapsed
+            total["max_ms"] = max(total["max_ms"], elapsed)
+        for total in totals.values():
+            total["mean_ms"] = total["total_ms"] / total["count"]
+        return sorted(totals.values(), key=lambda total: (total["category"] != "phase", -total["total_ms"]))
+
+    def print_summary(self, console):
+        """
+        Displays the summary in a table.
+
+        Args:
+            console (rich.console.Console): The console to print on, usually stderr so it never mixes with the output.
+        """
+        from rich.table import Table
+
+        table = Table(title="vmctl profile")
+        table.add_column("Phase / call", style="bold bright_cyan")
+        for header in ["Count", "Total (ms)", "Mean (ms)", "Max (ms)"]:
+            table.add_column(header, justify="right")
+        for total in self.summary():
+            name = total["name"] if total["category"] == "phase" else f"  {total['name']}"
+            table.add_row(name, str(total["count"]), f"{total['total_ms']:.2f}", f"{total['mean_ms']:.2f}", f"{total['max_ms']:.2f}")
+        console.print(table)
+
+    def write_trace(self, path: str):
+        """
+        Writes the events as Chrome trace JSON, which chrome://tracing and Perfetto open.
+
+        Args:
+            path (str): The path of the trace file.
+
+        Raises:
+            VmctlError: If the trace file cannot be written.
+        """
+        # reference: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+        pid = os.getpid()
+        trace_events = [
+            {"name": name, "cat": category, "ph": "X", "pid": pid, "tid": thread,
+             "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6}
+            for name, category, start, end, thread in list(self.events)
+        ]
+        try:
+            with open(path, "w") as trace_file:
+                json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+        except OSError as e:
+            raise VmctlError(f"Error writing the trace file '{path}': {e.strerror or e}")
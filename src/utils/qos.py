@@ -0,0 +1,261 @@
+"""
+This module defines the QoS profiles that throttle the disk and network I/O of VMs.
+
+A profile caps every disk of a VM with libvirt's iotune settings (IOPS and bytes per second, and bursts above
+them) and every network interface with its bandwidth settings (an average, peak and burst in each direction).
+Profiles are set when a VM is provisioned (utils.xml) or applied live to many VMs at once (wrapper.qos).
+Besides the built-in profiles (see DEFAULT_PROFILES), profiles are read from the "qos" section of the vmctl
+configuration file:
+
+    {
+        "qos": {
+            "db": {
+                "disk": {"total_iops_sec": 4000, "total_iops_sec_max": 8000, "total_iops_sec_max_length": 30,
+                         "total_bytes_sec": 209715200},
+                "net": {"inbound.average": 25600, "outbound.average": 25600, "outbound.peak": 51200, "outbound.burst": 10240}
+            }
+        }
+    }
+
+Disk limits apply to each disk, in IOPS or bytes per second, and a VM can go up to the *_max limits for
+*_max_length seconds. Network limits apply to each interface, in KiB/s (average and peak) and KiB (burst), and
+inbound is the traffic the guest receives. A limit that is not set (or 0) is removed when the profile is applied.
+"""
+import xml.etree.ElementTree as ET
+from utils.config import load_config
+from utils.errors import VmctlError
+
+# reference: https://libvirt.org/formatdomain.html#hard-drives-floppy-disks-cdroms (iotune)
+DISK_RATES = ["total_bytes_sec", "read_bytes_sec", "write_bytes_sec", "total_iops_sec", "read_iops_sec", "write_iops_sec"]
+DISK_LIMITS = (DISK_RATES + [f"{key}_max" for key in DISK_RATES] + [f"{key}_max_length" for key in DISK_RATES]
+               + ["size_iops_sec"])
+
+# reference: https://libvirt.org/formatnetwork.html#quality-of-service (bandwidth)
+NET_DIRECTIONS = ["inbound", "outbound"]
+NET_LIMITS = [f"{direction}.{key}" for direction in NET_DIRECTIONS for key in ["average", "peak", "burst"]]
+
+MIB = 1024 * 1024
+
+DEFAULT_PROFILES = {
+    # applying it removes every limit
+    "unlimited": {"disk": {}, "net": {}},
+    "bronze": {
+        "disk": {"total_iops_sec": 500, "total_bytes_sec": 50 * MIB},
+        "net": {"inbound.average": 12800, "outbound.average": 12800},
+    },
+    "silver": {
+        "disk": {"total_iops_sec": 2000, "total_iops_sec_max": 4000, "total_iops_sec_max_length": 60,
+                 "total_bytes_sec": 200 * MIB},
+        "net": {"inbound.average": 64000, "inbound.peak": 128000, "inbound.burst": 65536,
+                "outbound.average": 64000, "outbound.peak": 128000, "outbound.burst": 65536},
+    },
+    "gold": {
+        "disk": {"total_iops_sec": 8000, "total_iops_sec_max": 16000, "total_iops_sec_max_length": 60,
+                 "total_bytes_sec": 500 * MIB, "total_bytes_sec_max": 1000 * MIB, "total_bytes_sec_max_length": 60},
+        "net": {"inbound.average": 128000, "inbound.peak": 256000, "inbound.burst": 131072,
+                "outbound.average": 128000, "outbound.peak": 256000, "outbound.burst": 131072},
+    },
+}
+
+# the domain metadata that records the profile a VM was given
+QOS_NAMESPACE = "https://github.com/mohammednumaan/vmctl/qos"
+QOS_PREFIX = "vmctlqos"
+ET.register_namespace(QOS_PREFIX, QOS_NAMESPACE)
+
+def get_profiles(config=None):
+    """
+    Gets the QoS profiles, the built-in ones and those of the configuration file.
+
+    Args:
+        config (dict, optional): The vmctl configuration. Defaults to None, which reads the configuration file.
+
+    Raises:
+        VmctlError: If a profile is invalid.
+
+    Returns:
+        dict: The profiles, keyed by name. A configured profile replaces a built-in one of the same name.
+    """
+    if config is None:
+        config = load_config()
+    profiles = {**DEFAULT_PROFILES, **config.get("qos", {})}
+    return {name: check_profile(name, profile) for name, profile in profiles.items()}
+
+
+def get_profile(name: str, config=None):
+    """
+    Gets a QoS profile by name.
+
+    Args:
+        name (str): The name of the profile.
+        config (dict, optional): The vmctl configuration. Defaults to None, which reads the configuration file.
+
+    Raises:
+        VmctlError: If the profile does not exist or is invalid.
+
+    Returns:
+        dict: The profile.
+    """
+    profiles = get_profiles(config)
+    if name not in profiles:
+        raise VmctlError(f"Unknown QoS profile '{name}'. Use one of: {', '.join(sorted(profiles))}.")
+    return profiles[name]
+
+
+def check_profile(name: str, profile):
+    """
+    Checks that a QoS profile only sets known limits, to non-negative integers that libvirt accepts together.
+
+    Args:
+        name (str): The name of the profile.
+        profile (dict): The profile, with its "disk" and "net" limits.
+
+    Raises:
+        VmctlError: If the profile is invalid.
+
+    Returns:
+        dict: The profile, with empty "disk" and "net" limits if they were not set.
+    """
+    if not isinstance(profile, dict) or any(key not in ("disk", "net") for key in profile):
+        raise VmctlError(f"The QoS profile '{name}' must be a mapping with 'disk' and 'net' limits.")
+    profile = {"disk": profile.get("disk") or {}, "net": profile.get("net") or {}}
+    for kind, keys in (("disk", DISK_LIMITS), ("net", NET_LIMITS)):
+        unknown = [key for key in profile[kind] if key not in keys]
+        if unknown:
+            raise VmctlError(f"Unknown {kind} limits in the QoS profile '{name}': {', '.join(unknown)}")
+        for key, value in profile[kind].items():
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise VmctlError(f"The limit '{key}' of the QoS profile '{name}' must be a non-negative integer.")
+
+    disk, net = profile["disk"], profile["net"]
+    for kind in ("bytes", "iops"):
+        if disk.get(f"total_{kind}_sec") and (disk.get(f"read_{kind}_sec") or disk.get(f"write_{kind}_sec")):
+            raise VmctlError(f"The QoS profile '{name}' cannot cap total_{kind}_sec and read/write_{kind}_sec together.")
+    for key in DISK_RATES:
+        # a burst is on top of its rate, and lasts only as long as a burst is allowed
+        if disk.get(f"{key}_max") and not disk.get(key):
+            raise VmctlError(f"The QoS profile '{name}' sets {key}_max without {key}.")
+        if disk.get(f"{key}_max_length") and not disk.get(f"{key}_max"):
+            raise VmctlError(f"The QoS profile '{name}' sets {key}_max_length without {key}_max.")
+    for direction in NET_DIRECTIONS:
+        if (net.get(f"{direction}.peak") or net.get(f"{direction}.burst")) and not net.get(f"{direction}.average"):
+            raise VmctlError(f"The QoS profile '{name}' sets a {direction} peak or burst without an average.")
+    return profile
+
+
+def block_parameters(profile):
+    """
+    Gets the setBlockIoTune parameters that apply a profile to a disk.
+
+    Every rate and burst is sent, those the profile does not set as 0 to remove them, so a disk ends up with
+    exactly the profile's limits. Burst lengths are only sent when set, libvirt rejects them without a burst.
+
+    Args:
+        profile (dict): The profile.
+
+    Returns:
+        dict: The parameters.
+    """
+    disk = profile["disk"]
+    parameters = {key: disk.get(key, 0) for key in DISK_RATES + [f"{key}_max" for key in DISK_RATES]}
+    parameters.update({key: value for key, value in disk.items() if key.endswith("_max_length") or key == "size_iops_sec"})
+    return parameters
+
+
+def interface_parameters(profile):
+    """
+    Gets the setInterfaceParameters parameters that apply a profile to a network interface.
+
+    Args:
+        profile (dict): The profile.
+
+    Returns:
+        dict: The parameters, every limit the profile does not set as 0 to remove it.
+    """
+    return {key: profile["net"].get(key, 0) for key in NET_LIMITS}
+
+
+def iotune_element(profile):
+    """
+    Builds the `<iotune>` element of a disk.
+
+    Args:
+        profile (dict): The profile.
+
+    Returns:
+        xml.etree.ElementTree.Element: The element, or None if the profile sets no disk limits.
+    """
+    limits = [(key, profile["disk"][key]) for key in DISK_LIMITS if profile["disk"].get(key)]
+    if not limits:
+        return None
+    iotune = ET.Element("iotune")
+    for key, value in limits:
+        ET.SubElement(iotune, key).text = str(value)
+    return iotune
+
+
+def bandwidth_element(profile):
+    """
+    Builds the `<bandwidth>` element of a network interface.
+
+    Args:
+        profile (dict): The profile.
+
+    Returns:
+        xml.etree.ElementTree.Element: The element, or None if the profile sets no network limits.
+    """
+    bandwidth = ET.Element("bandwidth")
+    for direction in NET_DIRECTIONS:
+        attributes = {key.partition(".")[2]: str(value) for key, value in profile["net"].items()
+                      if key.startswith(f"{direction}.") and value}
+        if attributes:
+            ET.SubElement(bandwidth, direction, attributes)
+    return bandwidth if len(bandwidth) else None
+
+
+def qos_metadata(name: str):
+    """
+    Builds the metadata element that records the profile of a VM.
+
+    Args:
+        name (str): The name of the profile.
+
+    Returns:
+        xml.etree.ElementTree.Element: The element.
+    """
+    return ET.Element(f"{{{QOS_NAMESPACE}}}qos", {"profile": name})
+
+
+def read_limits(root):
+    """
+    Reads the QoS limits of a domain from its XML.
+
+    Args:
+        root (xml.etree.ElementTree.Element): The root element of the domain XML.
+
+    Returns:
+        dict: The "profile" recorded in the metadata (None if there is none), the "disks" (the iotune limits
+              keyed by target device) and the "interfaces" (the bandwidth limits keyed by target device, or MAC
+              address when the VM is not running).
+    """
+    limits = {"profile": None, "disks": {}, "interfaces": {}}
+    element = root.find(f"metadata/{{{QOS_NAMESPACE}}}qos")
+    if element is not None:
+        limits["profile"] = element.get("profile")
+
+    for disk in root.findall("devices/disk"):
+        target = disk.find("target")
+        if disk.get("device", "disk") != "disk" or target is None:
+            continue
+        iotune = disk.find("iotune")
+        limits["disks"][target.get("dev")] = {} if iotune is None else {
+            child.tag: int(child.text) for child in iotune if child.text and child.text.strip().isdigit()}
+
+    for interface in root.findall("devices/interface"):
+        target, mac = interface.find("target"), interface.find("mac")
+        device = target.get("dev") if target is not None else (mac.get("address") if mac is not None else None)
+        if device is None:
+            continue
+        limits["interfaces"][device] = {f"{element.tag}.{key}": int(value)
+                                        for element in interface.findall("bandwidth/*")
+                                        for key, value in element.attrib.items() if value.isdigit()}
+    return limits
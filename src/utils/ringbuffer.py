@@ -0,0 +1,75 @@
+"""
+This module provides a fixed-size ring buffer of numeric samples backed by a flat array.
+"""
+from array import array
+
+class RingBuffer:
+    """
+    A fixed-capacity buffer of samples, where each sample is a fixed number of floats.
+
+    All samples live in one preallocated array('d'), so memory use is constant no matter how long it runs.
+    """
+
+    def __init__(self, capacity: int, width: int):
+        """
+        Initializes the RingBuffer class.
+
+        Args:
+            capacity (int): The maximum number of samples kept, older samples are overwritten.
+            width (int): The number of values in each sample.
+        """
+        self.capacity = capacity
+        self.width = width
+        self.values = array("d", bytes(8 * capacity * width))
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, sample):
+        """
+        Adds a sample, overwriting the oldest one when the buffer is full.
+
+        Args:
+            sample (list): The values of the sample, exactly `width` of them.
+        """
+        index = (self.start + self.count) % self.capacity
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.count += 1
+        offset = index * self.width
+        self.values[offset:offset + self.width] = array("d", sample)
+
+    def get(self, position: int):
+        """
+        Gets a sample.
+
+        Args:
+            position (int): The position of the sample, 0 is the oldest and -1 the newest.
+
+        Raises:
+            IndexError: If there is no sample at that position.
+
+        Returns:
+            array: The values of the sample.
+        """
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError("ring buffer index out of range")
+        offset = ((self.start + position) % self.capacity) * self.width
+        return self.values[offset:offset + self.width]
+
+    def column(self, field: int):
+        """
+        Gets one value of every sample, from the oldest to the newest.
+
+        Args:
+            field (int): The index of the value within a sample.
+
+        Returns:
+            list: The values.
+        """
+        return [self.get(position)[field] for position in range(self.count)]
@@ -2,8 +2,9 @@
 This module provides a function to create and display a table using the rich library.
 """
 from rich.table import Table
-from rich.console import Console
+from rich import get_console
 from utils.errors import VmctlError
+from utils.profiling import phase
 
 def create_table(title, columns, rows):
     """
@@ -16,14 +17,14 @@ def create_table(title, columns, rows):
         rows (list): A list of lists, where each inner list represents a row.
     """
     try:
-        rich_table = Table(title=title)
-        for column in columns:
-            rich_table.add_column(column["header"], style=column.get("style", ""))
+        with phase("render"):
+            rich_table = Table(title=title)
+            for column in columns:
+                rich_table.add_column(column["header"], style=column.get("style", ""))
 
-        for row in rows:
-            rich_table.add_row(*row)
+            for row in rows:
+                rich_table.add_row(*row)
 
-        console = Console()
-        console.print(rich_table)
+            get_console().print(rich_table)
     except Exception as e:
         raise VmctlError(f"An unexpected error occurred while creating the table: {e}")
\ No newline at end of file
@@ -1,9 +1,37 @@
 """
-This module provides a function to create an XML configuration for a new virtual machine.
+This module builds the XML configuration of virtual machines.
+
+The structure of a domain (its disks, network interfaces, CPU topology, hugepages, NUMA placement and I/O limits) is built
+once with ElementTree and compiled into a template. Rendering a VM then only substitutes (and escapes) the fields
+that differ between VMs: its name, uuid, memory, vCPU's, disk paths and CPU pinning.
 """
+import copy
+import json
+import re
+import threading
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 from utils.errors import VmctlError
+from utils.qos import bandwidth_element, get_profile, iotune_element, qos_metadata
+
+# reference: https://libvirt.org/formatdomain.html
+
+# per vm fields are marked with slots while the template is built,
+# and the serialized template is split around them
+SLOT = "__vmctl_slot_{}__"
+SLOT_PATTERN = re.compile(r"__vmctl_slot_(\w+?)__")
+
+# the prefix of the target device names on each disk bus (vda, sda, hda, ...)
+DISK_TARGET_PREFIXES = {"virtio": "vd", "scsi": "sd", "sata": "sd", "usb": "sd", "ide": "hd"}
+DISK_KEYS = ["device", "format", "bus", "target", "source", "readonly"]
+INTERFACE_KEYS = ["network", "bridge", "model", "mac"]
+
+# compiled templates, keyed by their options
+_templates = {}
+_templates_lock = threading.Lock()
 
-def create_xml_config(vm_name: str, vm_memory: int, vm_vcpus: int, iso_path: str = None, disk_path: str = None):
+def create_xml_config(vm_name: str, vm_memory: int, vm_vcpus: int, iso_path: str = None, disk_path: str = None, placement=None,
+                      hugepages=False, qos: str = None):
     """
     Creates an XML configuration for a new virtual machine.
 
@@ -13,68 +41,323 @@ def create_xml_config(vm_name: str, vm_memory: int, vm_vcpus: int, iso_path: str
         vm_vcpus (int): The number of virtual CPUs for the virtual machine.
         iso_path (str, optional): The path to the ISO file for the virtual machine. Defaults to None.
         disk_path (str, optional): The path to the disk file for the virtual machine. Defaults to None.
+        placement (dict, optional): The NUMA node and CPUs to pin the VM to, from PlacementEngine.place. Defaults to None.
+        hugepages (bool | int, optional): Back the memory with hugepages, of this size in KiB if an int. Defaults to False.
+        qos (str, optional): The QoS profile that limits the disk and network I/O of the VM. Defaults to None.
 
     Raises:
-        VmctlError: If both or neither iso_path and disk_path are provided.
+        VmctlError: If both or neither iso_path and disk_path are provided, or the QoS profile does not exist.
 
     Returns:
         str: The XML configuration for the virtual machine.
     """
-    # i need to create a basic xml config for
-    # provisioning a new virtual machine
-    # reference: https://libvirt.org/formatdomain.html
-
     if not disk_path and not iso_path:
         raise VmctlError("Either disk_path or iso_path must be provided")
-    
 
     if iso_path and disk_path:
         raise VmctlError("Only one of disk_path or iso_path should be provided")
-    
-
-    if iso_path:
-        boot_device = "cdrom"
-        xml_device_config = f"""
-        <disk type='file' device='cdrom'>
-            <driver name='qemu' type='raw'/>
-            <source file='{iso_path}'/>
-            <target dev='hdc' bus='ide'/>
-            <readonly/>
-        </disk>
+
+    disk = cdrom_disk() if iso_path else {"device": "disk", "format": "qcow2", "bus": "virtio"}
+    template = get_template(disks=[disk], interfaces=[{"network": "default"}], hugepages=hugepages,
+                            qos=get_profile(qos) if qos else None)
+    return template.render(vm_name, vm_memory, vm_vcpus, sources=[iso_path or disk_path], placement=placement,
+                           metadata=qos_metadata(qos) if qos else None)
+
+
+def create_xml_from_spec(spec, uuid: str = None, metadata: ET.Element = None, placement=None):
+    """
+    Creates the XML configuration of a virtual machine declared in a manifest.
+
+    Args:
+        spec (dict): The spec of the VM, as returned by utils.manifest.load_manifest.
+        uuid (str, optional): The UUID of the domain. Defaults to None, which lets libvirt generate one.
+        metadata (xml.etree.ElementTree.Element, optional): An element stored in the domain's <metadata>. Defaults to None.
+        placement (dict, optional): The NUMA node and CPUs to pin the VM to, from PlacementEngine.place. Defaults to None.
+
+    Returns:
+        str: The XML configuration for the virtual machine.
+    """
+    if spec.get("iso"):
+        disks = [dict(cdrom_disk(), source=spec["iso"])]
+    elif spec.get("disk"):
+        disks = [{"device": "disk", "format": "qcow2", "bus": "virtio", "source": spec["disk"]}]
+    else:
+        disks = spec.get("disks", [])
+
+    # the disk paths differ between vms, everything else is shared
+    # by every vm with the same shape and compiled only once
+    template = get_template(
+        disks=[{key: value for key, value in disk.items() if key != "source"} for disk in disks],
+        interfaces=spec.get("interfaces", [{"network": "default"}]),
+        topology=spec.get("topology"),
+        hugepages=spec.get("hugepages", False),
+        numa=spec.get("numa"),
+    )
+    return template.render(spec["name"], spec["memory"], spec["vcpus"], uuid=uuid,
+                           sources=[disk.get("source") for disk in disks], metadata=metadata, placement=placement)
+
+
+def cdrom_disk():
+    """
+    Gets the options of the installation cdrom, which vmctl attaches as hdc.
+
+    Returns:
+        dict: The disk options.
+    """
+    return {"device": "cdrom", "format": "raw", "bus": "ide", "target": "hdc", "readonly": True}
+
+
+def get_template(**options):
+    """
+    Gets the compiled template for a domain structure, compiling it only the first time it is used.
+
+    Args:
+        **options: The options of DomainTemplate.
+
+    Returns:
+        DomainTemplate: The template.
+    """
+    key = json.dumps(options, sort_keys=True)
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is None:
+            template = DomainTemplate(**options)
+            _templates[key] = template
+        return template
+
+
+class DomainTemplate:
+    """
+    A compiled domain XML template.
+
+    The XML is built and serialized once, so rendering a VM is a single string join of the
+    template with its escaped per VM fields.
+    """
+
+    def __init__(self, disks=None, interfaces=None, topology=None, hugepages=False, numa=None, qos=None,
+                 arch: str = "x86_64", machine: str = "pc", emulator: str = "/usr/bin/qemu-system-x86_64"):
         """
+        Initializes the DomainTemplate class and compiles the template.
 
-    elif disk_path:
-        boot_device = "hd"
-        xml_device_config = f"""
-        <disk type='file' device='disk'>
-            <driver name='qemu' type='qcow2'/>
-            <source file='{disk_path}'/>
-            <target dev='vda' bus='virtio'/>
+        Args:
+            disks (list, optional): The disks, dictionaries with the "device" (disk or cdrom), "format" (qcow2 or raw), "bus",
+                                    and optionally "target", "readonly" and a default "source" path, where {name} is replaced
+                                    by the VM's name. The first disk is booted from. Defaults to None.
+            interfaces (list, optional): The network interfaces, dictionaries with a "network" or "bridge",
+                                         and optionally a "model" (e.g. virtio) and "mac". Defaults to None.
+            topology (dict, optional): The CPU "sockets", "cores" and "threads". Defaults to None.
+            hugepages (bool | int, optional): Back the memory with hugepages, of this size in KiB if an int. Defaults to False.
+            numa (dict, optional): The NUMA placement, with the host "nodeset" and "mode" (strict, preferred or interleave) of
+                                   the memory, the host "cpuset" the vCPU's run on, and guest "cells" (dictionaries with
+                                   "cpus" and "memory" in MiB). Defaults to None.
+            qos (dict, optional): The QoS profile whose limits are set on every disk and interface (see utils.qos).
+                                  Defaults to None.
+            arch (str, optional): The guest architecture. Defaults to "x86_64".
+            machine (str, optional): The machine type. Defaults to "pc".
+            emulator (str, optional): The path of the emulator. Defaults to "/usr/bin/qemu-system-x86_64".
 
-        </disk>
+        Raises:
+            VmctlError: If an option is invalid.
         """
+        self.disks = [self._check_keys("disk", disk, DISK_KEYS) for disk in disks or []]
+        self.interfaces = [self._check_keys("interface", interface, INTERFACE_KEYS) for interface in interfaces or []]
+        self.topology = topology
+        self.numa = numa or {}
+        self.qos = qos
+        self.literals, self.slots = self._compile(self._build(hugepages, arch, machine, emulator))
 
-    xml_string = f"""
-
-<domain type='kvm'>
-  <name>{vm_name}</name>
-    <memory unit='MiB'>{vm_memory}</memory>
-    <vcpu placement='static'>{vm_vcpus}</vcpu>
-    
-    <os>
-        <type arch="x86_64" machine="pc">hvm</type>
-        <boot dev="{boot_device}"/>
-    </os>
-    <devices>
-        <emulator>/usr/bin/qemu-system-x86_64</emulator>
-        {xml_device_config}
-        <interface type='network'>
-            <source network='default'/>
-        </interface>
-        <graphics type='vnc' port='-1' autoport='yes'/>
-    </devices>
-
-</domain>
-    """
+    def render(self, vm_name: str, vm_memory: int, vm_vcpus: int, uuid: str = None, sources=None, metadata: ET.Element = None,
+               placement=None):
+        """
+        Renders the XML configuration of a virtual machine.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            vm_memory (int): The amount of memory for the virtual machine in MiB.
+            vm_vcpus (int): The number of virtual CPUs for the virtual machine.
+            uuid (str, optional): The UUID of the domain. Defaults to None, which lets libvirt generate one.
+            sources (list, optional): The path of each disk. Defaults to None, which uses the template's paths.
+            metadata (xml.etree.ElementTree.Element, optional): An element stored in the domain's <metadata>. Defaults to None.
+            placement (dict, optional): The host NUMA "node" and the host "cpus" each vCPU is pinned to,
+                                        as returned by PlacementEngine.place. Defaults to None (no pinning).
+
+        Raises:
+            VmctlError: If the fields do not fit the template.
+
+        Returns:
+            str: The XML configuration for the virtual machine.
+        """
+        if self.topology and self.topology["sockets"] * self.topology["cores"] * self.topology["threads"] != vm_vcpus:
+            raise VmctlError(f"The CPU topology of VM '{vm_name}' does not add up to {vm_vcpus} vCPU's.")
+        cells = self.numa.get("cells")
+        if cells and sum(cell["memory"] for cell in cells) != vm_memory:
+            raise VmctlError(f"The NUMA cells of VM '{vm_name}' do not add up to {vm_memory} MiB of memory.")
+
+        sources = sources or [None] * len(self.disks)
+        if len(sources) != len(self.disks):
+            raise VmctlError(f"VM '{vm_name}' needs {len(self.disks)} disk paths, got {len(sources)}.")
+
+        values = {"name": escape(vm_name), "memory": str(int(vm_memory)), "vcpus": str(int(vm_vcpus)), "extra": "", "placement": ""}
+        if placement is not None:
+            if self.numa.get("nodeset") or self.numa.get("cpuset"):
+                raise VmctlError(f"VM '{vm_name}' already sets its NUMA placement, it cannot be placed automatically.")
+            if len(placement["cpus"]) != vm_vcpus:
+                raise VmctlError(f"VM '{vm_name}' has {vm_vcpus} vCPU's, but {len(placement['cpus'])} were placed.")
+            pins = "".join(f"<vcpupin vcpu=\"{vcpu}\" cpuset=\"{int(cpu)}\" />" for vcpu, cpu in enumerate(placement["cpus"]))
+            values["placement"] = (f"\n  <cputune>{pins}</cputune>"
+                                   f"\n  <numatune><memory mode=\"strict\" nodeset=\"{int(placement['node'])}\" /></numatune>")
+        if uuid is not None:
+            values["extra"] += f"\n  <uuid>{escape(uuid)}</uuid>"
+        if metadata is not None:
+            values["extra"] += f"\n  <metadata>{ET.tostring(metadata, encoding='unicode')}</metadata>"
+        for index, (disk, source) in enumerate(zip(self.disks, sources)):
+            source = source or disk.get("source")
+            if not source:
+                raise VmctlError(f"Disk {index} of VM '{vm_name}' has no path.")
+            values[f"source{index}"] = escape(source.replace("{name}", vm_name), {'"': "&quot;"})
+
+        parts = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            parts.append(values[slot])
+            parts.append(literal)
+        return "".join(parts)
+
+    def _build(self, hugepages, arch: str, machine: str, emulator: str):
+        """
+        Builds the domain element, with slots for the per VM fields.
+
+        Returns:
+            xml.etree.ElementTree.Element: The domain element.
+        """
+        domain = ET.Element("domain", {"type": "kvm"})
+        ET.SubElement(domain, "name").text = SLOT.format("name")
+        ET.SubElement(domain, "memory", {"unit": "MiB"}).text = SLOT.format("memory")
+        if hugepages:
+            backing = ET.SubElement(ET.SubElement(domain, "memoryBacking"), "hugepages")
+            if not isinstance(hugepages, bool):
+                ET.SubElement(backing, "page", {"size": str(int(hugepages)), "unit": "KiB"})
+
+        vcpu = ET.SubElement(domain, "vcpu", {"placement": "static"})
+        vcpu.text = SLOT.format("vcpus")
+        if self.numa.get("cpuset"):
+            vcpu.set("cpuset", str(self.numa["cpuset"]))
+        if self.numa.get("nodeset"):
+            numatune = ET.SubElement(domain, "numatune")
+            mode = self.numa.get("mode", "strict")
+            if mode not in ("strict", "preferred", "interleave"):
+                raise VmctlError(f"Unsupported NUMA memory mode '{mode}'.")
+            ET.SubElement(numatune, "memory", {"mode": mode, "nodeset": str(self.numa["nodeset"])})
+
+        os_element = ET.SubElement(domain, "os")
+        ET.SubElement(os_element, "type", {"arch": arch, "machine": machine}).text = "hvm"
+        if self.disks:
+            ET.SubElement(os_element, "boot", {"dev": "cdrom" if self.disks[0].get("device") == "cdrom" else "hd"})
+
+        if self.topology or self.numa.get("cells"):
+            cpu = ET.SubElement(domain, "cpu")
+            if self.topology:
+                try:
+                    ET.SubElement(cpu, "topology", {key: str(int(self.topology[key])) for key in ["sockets", "cores", "threads"]})
+                except (KeyError, TypeError, ValueError):
+                    raise VmctlError("The CPU topology needs integer sockets, cores and threads.")
+            if self.numa.get("cells"):
+                numa = ET.SubElement(cpu, "numa")
+                for index, cell in enumerate(self.numa["cells"]):
+                    try:
+                        ET.SubElement(numa, "cell", {"id": str(index), "cpus": str(cell["cpus"]), "memory": str(int(cell["memory"])), "unit": "MiB"})
+                    except (KeyError, TypeError, ValueError):
+                        raise VmctlError("Every NUMA cell needs its cpus and an integer memory.")
+
+        devices = ET.SubElement(domain, "devices")
+        ET.SubElement(devices, "emulator").text = emulator
+        iotune = iotune_element(self.qos) if self.qos else None
+        bandwidth = bandwidth_element(self.qos) if self.qos else None
+        targets = {}
+        for index, disk in enumerate(self.disks):
+            bus = disk.get("bus", "virtio")
+            if bus not in DISK_TARGET_PREFIXES:
+                raise VmctlError(f"Unsupported disk bus '{bus}'.")
+            element = ET.SubElement(devices, "disk", {"type": "file", "device": disk.get("device", "disk")})
+            ET.SubElement(element, "driver", {"name": "qemu", "type": disk.get("format", "qcow2")})
+            ET.SubElement(element, "source", {"file": SLOT.format(f"source{index}")})
+            ET.SubElement(element, "target", {"dev": disk.get("target") or self._next_target(bus, targets), "bus": bus})
+            if disk.get("readonly"):
+                ET.SubElement(element, "readonly")
+            elif iotune is not None:
+                # read-only media (the installation cdrom) is not throttled
+                element.append(copy.deepcopy(iotune))
 
-    return xml_string
\ No newline at end of file
+        for interface in self.interfaces:
+            if interface.get("bridge"):
+                element = ET.SubElement(devices, "interface", {"type": "bridge"})
+                ET.SubElement(element, "source", {"bridge": interface["bridge"]})
+            else:
+                element = ET.SubElement(devices, "interface", {"type": "network"})
+                ET.SubElement(element, "source", {"network": interface.get("network", "default")})
+            if interface.get("mac"):
+                ET.SubElement(element, "mac", {"address": interface["mac"]})
+            if interface.get("model"):
+                ET.SubElement(element, "model", {"type": interface["model"]})
+            if bandwidth is not None:
+                element.append(copy.deepcopy(bandwidth))
+
+        ET.SubElement(devices, "graphics", {"type": "vnc", "port": "-1", "autoport": "yes"})
+
+        ET.indent(domain)
+        # the optional uuid and metadata elements go right after the name,
+        # and the cpu pinning of a placed vm right after its vcpus
+        name = domain.find("name")
+        name.tail = SLOT.format("extra") + name.tail
+        vcpu.tail = SLOT.format("placement") + vcpu.tail
+        return domain
+
+    def _compile(self, domain: ET.Element):
+        """
+        Serializes the domain element and splits it around its slots.
+
+        Args:
+            domain (xml.etree.ElementTree.Element): The domain element.
+
+        Returns:
+            tuple: The literal parts of the XML and the slot between each of them.
+        """
+        pieces = SLOT_PATTERN.split(ET.tostring(domain, encoding="unicode"))
+        return pieces[0::2], pieces[1::2]
+
+    def _next_target(self, bus: str, targets):
+        """
+        Gets the next free target device name on a bus, e.g. vda, vdb.
+
+        Args:
+            bus (str): The disk bus.
+            targets (dict): The number of devices already on each prefix, updated in place.
+
+        Returns:
+            str: The target device name.
+        """
+        prefix = DISK_TARGET_PREFIXES[bus]
+        index = targets.get(prefix, 0)
+        targets[prefix] = index + 1
+        return prefix + "abcdefghijklmnopqrstuvwxyz"[index]
+
+    def _check_keys(self, kind: str, options, keys):
+        """
+        Checks that a disk or interface only uses known options.
+
+        Args:
+            kind (str): What the options describe (disk or interface).
+            options (dict): The options.
+            keys (list): The known options.
+
+        Raises:
+            VmctlError: If the options are not a dictionary or use an unknown option.
+
+        Returns:
+            dict: The options.
+        """
+        if not isinstance(options, dict):
+            raise VmctlError(f"Every {kind} must be a mapping, got: {options!r}")
+        unknown = [key for key in options if key not in keys]
+        if unknown:
+            raise VmctlError(f"Unknown {kind} options: {', '.join(unknown)}")
+        return options
@@ -0,0 +1,284 @@
+"""
+This module runs commands and reads files inside running VMs through the QEMU guest agent.
+
+Commands are sent to the agent (qemu-guest-agent, which has to run in the guest) as JSON through a transport.
+LibvirtAgentTransport sends them with libvirt's virDomainQemuAgentCommand. Any object with the same `command`
+method can be passed as the transport instead, e.g. a stub that answers like an agent would, so GuestAgentApi can be
+driven without a host or guests (see benchmarks/bench_agent.py).
+
+The agent only hands over the output of a command once it has exited, so the output of each VM arrives (and is
+reported) as a whole, as soon as that VM's command is done.
+reference: https://qemu-project.gitlab.io/qemu/interop/qemu-ga-ref.html
+"""
+import base64
+import json
+import math
+import os
+import shlex
+import threading
+import time
+from rich import print
+from rich.markup import escape
+from libvirt import libvirtError
+from libvirt_qemu import qemuAgentCommand
+from utils.errors import VmctlError, LibvirtError
+from utils.pool import iter_parallel
+
+# the seconds between guest-exec-status polls, growing so long commands are not polled needlessly
+POLL_INTERVALS = [0.05, 0.1, 0.2, 0.5, 1.0]
+
+# the bytes asked for per guest-file-read (the agent caps a read at 48 MiB)
+READ_CHUNK = 4 * 1024 * 1024
+
+class LibvirtAgentTransport:
+    """
+    Sends guest agent commands to VMs through libvirt.
+    """
+
+    def __init__(self, connection):
+        """
+        Initializes the LibvirtAgentTransport class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+        """
+        self.connection = connection
+        self._domains = {}
+        self._lock = threading.Lock()
+
+    def command(self, vm_name: str, execute: str, arguments=None, timeout: float = 5.0):
+        """
+        Sends a command to the guest agent of a VM and waits for its reply.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            execute (str): The agent command, e.g. "guest-exec".
+            arguments (dict, optional): The arguments of the command. Defaults to None.
+            timeout (float, optional): The seconds to wait for the reply. Defaults to 5.0.
+
+        Raises:
+            LibvirtError: If the command cannot be sent, e.g. the VM is not running or has no agent.
+            VmctlError: If the agent answers with an error.
+
+        Returns:
+            The "return" value of the reply.
+        """
+        payload = {"execute": execute}
+        if arguments:
+            payload["arguments"] = arguments
+        try:
+            with self._lock:
+                domain = self._domains.get(vm_name)
+                if domain is None:
+                    domain = self._domains[vm_name] = self.connection.lookupByName(vm_name)
+            # libvirt only takes whole seconds
+            reply = json.loads(qemuAgentCommand(domain, json.dumps(payload), max(1, math.ceil(timeout)), 0))
+        except libvirtError as e:
+            raise LibvirtError(f"Error talking to the guest agent of VM '{vm_name}': {e}")
+        if "error" in reply:
+            raise VmctlError(f"The guest agent of VM '{vm_name}' failed {execute}: {reply['error'].get('desc', reply['error'])}")
+        return reply.get("return")
+
+
+class GuestAgentApi:
+    """
+    A class for running commands and reading files in many VMs at once through their guest agents.
+    """
+
+    def __init__(self, connection, transport=None):
+        """
+        Initializes the GuestAgentApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+            transport (optional): The transport agent commands are sent with. Defaults to None, which sends
+                                  them through libvirt (LibvirtAgentTransport).
+        """
+        self.connection = connection
+        self.transport = transport or LibvirtAgentTransport(connection)
+
+    def exec(self, vm_names, command, timeout: float = 30.0, parallelism: int = 8, shell: bool = False,
+             on_result=None):
+        """
+        Runs a command in several VMs concurrently.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            command (list): The program and its arguments.
+            timeout (float, optional): The seconds each VM's command may take. Defaults to 30.0.
+            parallelism (int, optional): The maximum number of VMs acted on at the same time. Defaults to 8.
+            shell (bool, optional): Run the command with /bin/sh -c, so it can use pipes and globs. A single argument
+                                    is run as the script, several are quoted and joined. Defaults to False.
+            on_result (callable, optional): Called with the result of each VM as soon as its command is done.
+                                            Defaults to None.
+
+        Raises:
+            VmctlError: If there is no command or the timeout is not positive.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (done, failed or timeout), "exitcode", "stdout",
+                  "stderr", "seconds" and "message" of each VM, in the order the VMs finished.
+        """
+        if not command:
+            raise VmctlError("Provide the command to run after the VM names, e.g. `vmctl exec 'web-*' -- uptime`.")
+        if timeout <= 0:
+            raise VmctlError("The timeout must be a positive number of seconds.")
+        if shell:
+            # a single argument is the script itself, several are quoted so each stays one word
+            path, arguments = "/bin/sh", ["-c", command[0] if len(command) == 1 else shlex.join(command)]
+        else:
+            path, arguments = command[0], list(command[1:])
+
+        results = []
+        for vm_name, result, error in iter_parallel(lambda vm_name: self._exec_one(vm_name, path, arguments, timeout),
+                                                    vm_names, parallelism):
+            if error is not None:
+                result = {"name": vm_name, "status": "failed", "exitcode": None, "stdout": "", "stderr": "",
+                          "seconds": None, "message": error.message if isinstance(error, VmctlError) else str(error)}
+            results.append(result)
+            if on_result:
+                on_result(result)
+        return results
+
+    def fetch(self, vm_names, path: str, destination: str = ".", timeout: float = 30.0, parallelism: int = 8,
+              on_result=None):
+        """
+        Copies a file out of several VMs concurrently, to <destination>/<vm name>/<file name>.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            path (str): The path of the file in the guests.
+            destination (str, optional): The local directory to copy the files to. Defaults to ".".
+            timeout (float, optional): The seconds each VM's copy may take. Defaults to 30.0.
+            parallelism (int, optional): The maximum number of VMs acted on at the same time. Defaults to 8.
+            on_result (callable, optional): Called with the result of each VM as soon as its copy is done.
+                                            Defaults to None.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (done or failed), local "path", "bytes" and
+                  "message" of each VM, in the order the VMs finished.
+        """
+        results = []
+        for vm_name, result, error in iter_parallel(lambda vm_name: self._fetch_one(vm_name, path, destination, timeout),
+                                                    vm_names, parallelism):
+            if error is not None:
+                result = {"name": vm_name, "status": "failed", "path": None, "bytes": None,
+                          "message": error.message if isinstance(error, VmctlError) else str(error)}
+            results.append(result)
+            if on_result:
+                on_result(result)
+        return results
+
+    def _exec_one(self, vm_name: str, path: str, arguments, timeout: float):
+        """
+        Runs a command in a VM and waits for it to exit, at most `timeout` seconds.
+
+        Returns:
+            dict: The result.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        pid = self.transport.command(vm_name, "guest-exec", {"path": path, "arg": arguments, "capture-output": True},
+                                     timeout)["pid"]
+        polls = 0
+        while True:
+            status = self.transport.command(vm_name, "guest-exec-status", {"pid": pid}, max(deadline - time.monotonic(), 1))
+            if status.get("exited"):
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # the agent cannot stop a command, it keeps running in the guest
+                return {"name": vm_name, "status": "timeout", "exitcode": None, "stdout": "", "stderr": "",
+                        "seconds": round(time.monotonic() - start, 3),
+                        "message": f"Still running after {timeout:g}s (pid {pid} in the guest)."}
+            time.sleep(min(POLL_INTERVALS[min(polls, len(POLL_INTERVALS) - 1)], remaining))
+            polls += 1
+
+        exitcode = status.get("exitcode")
+        if exitcode is None and status.get("signal") is not None:
+            message = f"Killed by signal {status['signal']}."
+        else:
+            message = f"Exited with {exitcode}."
+        if status.get("out-truncated") or status.get("err-truncated"):
+            message += " The output was truncated by the agent."
+        return {
+            "name": vm_name,
+            "status": "done" if exitcode == 0 else "failed",
+            "exitcode": exitcode,
+            "stdout": self._decode(status.get("out-data")),
+            "stderr": self._decode(status.get("err-data")),
+            "seconds": round(time.monotonic() - start, 3),
+            "message": message,
+        }
+
+    def _fetch_one(self, vm_name: str, path: str, destination: str, timeout: float):
+        """
+        Copies a file out of a VM, in chunks.
+
+        Returns:
+            dict: The result.
+        """
+        deadline = time.monotonic() + timeout
+        target = os.path.join(destination, vm_name, os.path.basename(path.rstrip("/")) or "file")
+        handle = self.transport.command(vm_name, "guest-file-open", {"path": path, "mode": "r"}, timeout)
+        size = 0
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as local_file:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise VmctlError(f"Copying '{path}' out of VM '{vm_name}' took longer than {timeout:g}s.")
+                    chunk = self.transport.command(vm_name, "guest-file-read", {"handle": handle, "count": READ_CHUNK}, remaining)
+                    data = base64.b64decode(chunk.get("buf-b64", ""))
+                    local_file.write(data)
+                    size += len(data)
+                    if chunk.get("eof") or not data:
+                        break
+        except Exception:
+            # a partial copy is worse than none
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+        finally:
+            self.transport.command(vm_name, "guest-file-close", {"handle": handle}, 5)
+        return {"name": vm_name, "status": "done", "path": target, "bytes": size, "message": f"Copied {size} bytes to {target}."}
+
+    @staticmethod
+    def _decode(data):
+        """
+        Decodes the base64 output the agent returns.
+
+        Returns:
+            str: The output, with undecodable bytes replaced.
+        """
+        return base64.b64decode(data).decode("utf-8", "replace") if data else ""
+
+
+def print_exec_result(result):
+    """
+    Prints the output of a VM's command, every line prefixed by the VM's name, then how the command ended.
+
+    Args:
+        result (dict): The result, as returned by GuestAgentApi.exec.
+    """
+    # guest output is printed as it is, never as rich markup
+    name = escape(result["name"])
+    for line in result["stdout"].splitlines():
+        print(f"[bold bright_cyan]{name}[/bold bright_cyan] | {escape(line)}")
+    for line in result["stderr"].splitlines():
+        print(f"[bold bright_cyan]{name}[/bold bright_cyan] [red]|[/red] {escape(line)}")
+    color = {"done": "green", "failed": "red", "timeout": "bright_yellow"}[result["status"]]
+    seconds = "" if result["seconds"] is None else f" ({result['seconds']:.2f}s)"
+    print(f"[bold bright_cyan]{name}[/bold bright_cyan] [{color}]{result['status']}[/{color}]: {escape(result['message'])}{seconds}")
+
+
+def print_fetch_result(result):
+    """
+    Prints the result of copying a file out of a VM.
+
+    Args:
+        result (dict): The result, as returned by GuestAgentApi.fetch.
+    """
+    color = "green" if result["status"] == "done" else "red"
+    print(f"[bold bright_cyan]{escape(result['name'])}[/bold bright_cyan] [{color}]{result['status']}[/{color}]: {escape(result['message'])}")
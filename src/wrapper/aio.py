@@ -0,0 +1,348 @@
+"""
+This module provides an asyncio API for embedding vmctl in other programs.
+
+Unlike the CLI facing classes, it never prints: every call returns typed result objects. The blocking libvirt
+calls run in a bounded thread pool per connection, and libvirt's events are dispatched on the asyncio loop,
+so one process can drive many hosts and thousands of domains without blocking its loop.
+
+    async def main():
+        api = await AsyncLibVirtApi.open("qemu:///system")
+        try:
+            vms = await api.get_vms(["shutoff"])
+            results = await api.run_action("start", [vm.name for vm in vms], wait=True, timeout=60)
+            async for event in api.events(["web-*"]):
+                print(event.name, event.event, event.state)
+        finally:
+            await api.close()
+"""
+import asyncio
+import fnmatch
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+from utils.errors import VmctlError
+from utils.output import strip_markup
+from wrapper.events import EVENT_NAMES, EVENT_STATES, start_asyncio_event_loop
+from wrapper.libvirt import LibVirtApi
+from wrapper.vm import VMApi
+
+@dataclass(frozen=True)
+class VmSummary:
+    """A VM as returned by AsyncLibVirtApi.get_vms."""
+    id: Optional[int]
+    name: str
+    state: str
+
+
+@dataclass(frozen=True)
+class VmInfo:
+    """A VM as returned by AsyncLibVirtApi.get_vm_info. Memory is in KiB and the CPU time in ns."""
+    id: Optional[int]
+    name: str
+    state: str
+    memory: int
+    max_memory: int
+    vcpus: int
+    cpu_time: int
+
+
+@dataclass(frozen=True)
+class HostInfo:
+    """A host as returned by AsyncLibVirtApi.get_host_info. Memory is in MB."""
+    model: str
+    memory: int
+    cpus: int
+    mhz: int
+    numa_nodes: int
+    sockets: int
+    cores: int
+    threads: int
+
+
+@dataclass(frozen=True)
+class Capacity:
+    """The capacity of a host as returned by AsyncLibVirtApi.get_capacity. Memory is in MiB."""
+    memory_total: int
+    memory_limit: int
+    memory_defined: int
+    memory_running: int
+    memory_headroom: int
+    cpus: int
+    vcpu_limit: int
+    vcpus_defined: int
+    vcpus_running: int
+    vcpu_headroom: int
+
+
+@dataclass(frozen=True)
+class ActionResult:
+    """The outcome of a lifecycle action on one VM: status is done, skipped or failed."""
+    name: str
+    status: str
+    message: str
+
+
+@dataclass(frozen=True)
+class ApplyResult:
+    """The outcome of applying one VM of a manifest: status is created, updated, unchanged or failed."""
+    name: str
+    status: str
+    changes: str
+    message: str
+
+
+@dataclass(frozen=True)
+class CloneResult:
+    """The outcome of creating one clone: status is done or failed."""
+    name: str
+    status: str
+    uuid: str
+    message: str
+
+
+@dataclass(frozen=True)
+class DomainEvent:
+    """A lifecycle event of a VM. state is None when the event does not tell the new state (defined, undefined)."""
+    name: str
+    event: str
+    state: Optional[str]
+
+
+class AsyncLibVirtApi:
+    """
+    An asyncio wrapper around one libvirt connection.
+
+    Each instance owns a thread pool of `parallelism` workers that every blocking call goes through,
+    so a slow host only ever ties up its own workers. The batch calls (run_action, apply and clone) take one
+    of those workers and act on up to `batch_parallelism` VMs at a time from threads of their own, so with
+    batches in flight, up to `parallelism` x `batch_parallelism` libvirt calls can run at the same time.
+    """
+
+    def __init__(self, api: LibVirtApi, parallelism: int = 8, batch_parallelism: int = None):
+        """
+        Initializes the AsyncLibVirtApi class. Use AsyncLibVirtApi.open to connect.
+
+        Args:
+            api (LibVirtApi): The connection the calls are made on.
+            parallelism (int, optional): The maximum number of blocking calls running at the same time. Defaults to 8.
+            batch_parallelism (int, optional): The maximum number of VMs one batch call acts on at the same time.
+                                               Defaults to None, which is `parallelism`.
+
+        Raises:
+            VmctlError: If parallelism or batch_parallelism is less than 1.
+        """
+        batch_parallelism = parallelism if batch_parallelism is None else batch_parallelism
+        if parallelism < 1 or batch_parallelism < 1:
+            raise VmctlError("Parallelism must be at least 1.")
+        self.api = api
+        self.parallelism = parallelism
+        self.batch_parallelism = batch_parallelism
+        self.executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="vmctl-aio")
+
+    @classmethod
+    async def open(cls, uri: str = "qemu:///system", parallelism: int = 8, events: bool = True, max_staleness: float = 30.0,
+                   batch_parallelism: int = None):
+        """
+        Connects to libvirt without blocking the running loop.
+
+        Args:
+            uri (str, optional): The URI to connect to. Defaults to "qemu:///system".
+            parallelism (int, optional): The maximum number of blocking calls running at the same time. Defaults to 8.
+            events (bool, optional): Receive lifecycle events on the running loop, needed by events() and
+                                     run_action(wait=True). Defaults to True.
+            max_staleness (float, optional): The maximum age in seconds of a cached domain state. Defaults to 30.0.
+            batch_parallelism (int, optional): The maximum number of VMs one batch call acts on at the same time.
+                                               Defaults to None, which is `parallelism`.
+
+        Raises:
+            LibvirtError: If the connection cannot be opened.
+            VmctlError: If events are requested after libvirt's default event loop was registered, or parallelism
+                        or batch_parallelism is less than 1.
+
+        Returns:
+            AsyncLibVirtApi: The connected API.
+        """
+        loop = asyncio.get_running_loop()
+        if events:
+            # must happen before the connection is opened, LibVirtApi
+            # then leaves the registered implementation alone
+            start_asyncio_event_loop(loop)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vmctl-aio-connect")
+        try:
+            api = await loop.run_in_executor(executor, functools.partial(LibVirtApi, uri, events, max_staleness))
+        finally:
+            executor.shutdown(wait=False)
+        return cls(api, parallelism, batch_parallelism)
+
+    async def close(self):
+        """
+        Closes the connection and stops the thread pool.
+        """
+        try:
+            await self._call(self.api.close)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def get_hostname(self):
+        """
+        Gets the hostname of the host.
+
+        Returns:
+            str: The hostname.
+        """
+        return await self._call(self.api.host_api.get_hostname)
+
+    async def get_host_info(self):
+        """
+        Gets information about the host.
+
+        Returns:
+            HostInfo: The host's information.
+        """
+        return HostInfo(**await self._call(self.api.host_api.get_host_info))
+
+    async def get_capacity(self):
+        """
+        Gets the capacity of the host and the resources committed to its VMs.
+
+        Returns:
+            Capacity: The host's capacity.
+        """
+        return Capacity(**await self._call(self.api.capacity_api.get_capacity))
+
+    async def get_vms(self, states=None):
+        """
+        Gets every VM with one bulk call.
+
+        Args:
+            states (list, optional): Only include VMs in one of these states (running, paused, shutoff). Defaults to None.
+
+        Returns:
+            list: A list of VmSummary.
+        """
+        vms = await self._call(self.api.vm_api.get_vms, states)
+        return [VmSummary(**vm) for vm in vms]
+
+    async def get_vm_info(self, vm_name: str):
+        """
+        Gets information about a VM.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+
+        Returns:
+            VmInfo: The VM's information.
+        """
+        return VmInfo(**await self._call(self.api.vm_api.get_vm_info, vm_name))
+
+    async def resolve_vms(self, patterns, all_vms: bool = False, states=None):
+        """
+        Expands names and glob patterns into the names of existing VMs.
+
+        Args:
+            patterns (list): VM names or glob patterns.
+            all_vms (bool, optional): Select every VM. Defaults to False.
+            states (list, optional): Only select VMs in one of these states. Defaults to None.
+
+        Returns:
+            list: The names of the matching VMs.
+        """
+        return await self._call(self.api.vm_api.resolve_vms, patterns, all_vms, states)
+
+    async def run_action(self, action: str, vm_names, wait: bool = False, timeout: float = None, escalate: bool = False,
+                         force: bool = False):
+        """
+        Applies a lifecycle action to many VMs, at most `batch_parallelism` at the same time.
+
+        Args:
+            action (str): The lifecycle action (start, shutdown, destroy, suspend, resume or reboot).
+            vm_names (list): The names of the virtual machines.
+            wait (bool, optional): Wait until each VM reached the action's target state. Defaults to False.
+            timeout (float, optional): The maximum time to wait in seconds. Defaults to None (no limit).
+            escalate (bool, optional): Destroy VMs that did not shut down before the timeout. Defaults to False.
+            force (bool, optional): Start VMs even if they exceed the host's capacity. Defaults to False.
+
+        Returns:
+            list: A list of ActionResult, in the order of `vm_names`.
+        """
+        results = await self._call(self.api.vm_api.run_action, action, vm_names, self.batch_parallelism, wait, timeout, escalate, force)
+        return [ActionResult(result["name"], result["status"], strip_markup(result["message"])) for result in results]
+
+    async def apply(self, specs, dry_run: bool = False, placement: str = "none", force: bool = False):
+        """
+        Provisions the VMs declared in a manifest, at most `batch_parallelism` at the same time.
+
+        Args:
+            specs (list): The specs returned by utils.manifest.load_manifest.
+            dry_run (bool, optional): Only compute what would change. Defaults to False.
+            placement (str, optional): Pin the defined VMs to NUMA nodes with this strategy. Defaults to "none".
+            force (bool, optional): Define new VMs even if they exceed the host's capacity. Defaults to False.
+
+        Returns:
+            list: A list of ApplyResult.
+        """
+        results = await self._call(self.api.vm_api.apply, specs, self.batch_parallelism, dry_run, placement, force)
+        return [ApplyResult(result["name"], result["status"], result["changes"], strip_markup(result["message"])) for result in results]
+
+    async def clone(self, base_name: str, vm_names, pool_name: str = None, force: bool = False):
+        """
+        Creates thin clones of a shut off VM, at most `batch_parallelism` at the same time.
+
+        Args:
+            base_name (str): The name of the base virtual machine.
+            vm_names (list): The names of the clones.
+            pool_name (str, optional): The storage pool the overlays are created in. Defaults to None, the base disk's pool.
+            force (bool, optional): Define the clones even if they exceed the host's capacity. Defaults to False.
+
+        Returns:
+            list: A list of CloneResult.
+        """
+        results = await self._call(self.api.clone_api.clone, base_name, vm_names, self.batch_parallelism, pool_name, force)
+        return [CloneResult(**dict(result, message=strip_markup(result["message"]))) for result in results]
+
+    async def events(self, patterns=None):
+        """
+        Yields the lifecycle events of the connection's VMs as they happen, until the consumer stops iterating.
+
+        Args:
+            patterns (list, optional): Only yield events of VMs matching these names or glob patterns. Defaults to None.
+
+        Raises:
+            VmctlError: If the connection was opened without events.
+
+        Yields:
+            DomainEvent: An event.
+        """
+        feed = self.api.event_feed
+        if feed is None:
+            raise VmctlError("Events require a connection opened with events=True.")
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        # events are dispatched on the loop thread, call_soon_threadsafe
+        # keeps the queue safe even if a callback ever arrives from elsewhere
+        callback = lambda domain, event, detail: loop.call_soon_threadsafe(events.put_nowait, (domain.name(), event))
+        feed.subscribe(callback)
+        try:
+            while True:
+                vm_name, event = await events.get()
+                if patterns and not any(fnmatch.fnmatchcase(vm_name, pattern) for pattern in patterns):
+                    continue
+                state = EVENT_STATES.get(event)
+                yield DomainEvent(vm_name, EVENT_NAMES.get(event, "unknown"), None if state is None else VMApi._mapVmStateToString(state))
+        finally:
+            feed.unsubscribe(callback)
+
+    async def _call(self, func, *args):
+        """
+        Runs a blocking call in the connection's thread pool.
+
+        Args:
+            func (callable): The function.
+            *args: Its arguments.
+
+        Returns:
+            The function's return value.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
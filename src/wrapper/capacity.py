@@ -0,0 +1,302 @@
+"""
+This module accounts for the memory and vCPUs committed to VMs on a host, and refuses (or warns about)
+provisioning and starting VMs that would exceed the host's capacity.
+
+The limits are read from the "capacity" section of the vmctl configuration file:
+
+    {
+        "capacity": {
+            "cpu_overcommit": 4.0,
+            "memory_overcommit": 1.0,
+            "reserved_memory": 1024,
+            "admission": "refuse"
+        }
+    }
+
+The vCPU limit is the number of host CPUs times cpu_overcommit, and the memory limit is the host memory minus
+reserved_memory (MiB kept for the host itself) times memory_overcommit. "admission" is "refuse" or "warn".
+"""
+import threading
+import time
+from rich import get_console
+from rich.table import Table
+from libvirt import (
+    libvirtError,
+    VIR_DOMAIN_STATS_STATE,
+    VIR_DOMAIN_STATS_BALLOON,
+    VIR_DOMAIN_STATS_VCPU,
+)
+from utils.config import load_config
+from utils.errors import VmctlError, LibvirtError
+from wrapper.vm import VMApi
+
+DEFAULT_LIMITS = {"cpu_overcommit": 4.0, "memory_overcommit": 1.0, "reserved_memory": 1024, "admission": "refuse"}
+
+# the memory and vcpus of every domain, running or not, in one call
+# reference: https://libvirt.org/html/libvirt-libvirt-domain.html#virConnectGetAllDomainStats
+CAPACITY_STATS = VIR_DOMAIN_STATS_STATE | VIR_DOMAIN_STATS_BALLOON | VIR_DOMAIN_STATS_VCPU
+
+class CapacityApi:
+    """
+    A class for accounting for the capacity of a host and admitting new and starting VMs against it.
+
+    The committed resources are read with one bulk stats call and cached for `cache_ttl` seconds.
+    Admitted VMs are added to the cached figures right away, so a batch of VMs is admitted as a whole.
+    """
+
+    # the keys returned by get_capacity and their column headers, in display order
+    CAPACITY_KEYS = ["memory_total", "memory_limit", "memory_defined", "memory_running", "memory_headroom",
+                     "cpus", "vcpu_limit", "vcpus_defined", "vcpus_running", "vcpu_headroom"]
+    CAPACITY_HEADERS = ["Memory", "Mem limit", "Mem defined", "Mem running", "Mem headroom",
+                        "CPU's", "vCPU limit", "vCPU's defined", "vCPU's running", "vCPU headroom"]
+
+    def __init__(self, connection, limits=None, cache_ttl: float = 5.0):
+        """
+        Initializes the CapacityApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+            limits (dict, optional): The overcommit ratios, reserved memory and admission mode.
+                                     Defaults to None, which reads them from the configuration file.
+            cache_ttl (float, optional): How long the committed resources are reused in seconds. Defaults to 5.0.
+        """
+        self.connection = connection
+        self.limits = limits
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.snapshot_at = float("-inf")
+
+    def get_capacity(self):
+        """
+        Gets the capacity of the host and the resources committed to its VMs.
+
+        Returns:
+            dict: The host's "memory_total" (MiB) and "cpus", their limits ("memory_limit", "vcpu_limit"), the resources
+                  of every defined VM ("memory_defined", "vcpus_defined") and of the running ones ("memory_running",
+                  "vcpus_running"), and what is left for more VMs to start ("memory_headroom", "vcpu_headroom").
+        """
+        with self.lock:
+            snapshot = self._get_snapshot()
+            return self._summarize(snapshot)
+
+    def capacity(self):
+        """
+        Displays the capacity of the host in a table.
+        """
+        summary = self.get_capacity()
+        rich_table = Table(*self.CAPACITY_HEADERS, title="Host Capacity (memory in MiB)")
+        rich_table.add_row(*[self._format_value(key, summary[key]) for key in self.CAPACITY_KEYS])
+        get_console().print(rich_table)
+
+    def admit_new(self, vm_name: str, vm_memory: int, vm_vcpus: int, force: bool = False):
+        """
+        Admits a new VM against the resources committed to every defined VM.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            vm_memory (int): The memory of the VM in MiB.
+            vm_vcpus (int): The number of vCPUs of the VM.
+            force (bool, optional): Only warn when the limits would be exceeded. Defaults to False.
+
+        Raises:
+            VmctlError: If the VM would exceed the limits and admission is refused.
+
+        Returns:
+            str: A warning if the VM exceeds the limits, otherwise an empty string.
+        """
+        with self.lock:
+            snapshot = self._get_snapshot()
+            if vm_vcpus > snapshot["max_vcpus"]:
+                raise VmctlError(f"VM '{vm_name}' asks for {vm_vcpus} vCPU's, the host supports at most {snapshot['max_vcpus']}.")
+            summary = self._summarize(snapshot)
+            warning = self._check(vm_name, vm_memory, vm_vcpus, summary["memory_defined"], summary["vcpus_defined"], summary, force)
+            snapshot["domains"][vm_name] = {"memory": vm_memory, "vcpus": vm_vcpus, "active": False}
+            return warning
+
+    def admit_start(self, vm_name: str, force: bool = False):
+        """
+        Admits starting a VM against the resources committed to the running VMs.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            force (bool, optional): Only warn when the limits would be exceeded. Defaults to False.
+
+        Raises:
+            VmctlError: If the VM would exceed the limits and admission is refused.
+
+        Returns:
+            str: A warning if the VM exceeds the limits, otherwise an empty string.
+        """
+        with self.lock:
+            snapshot = self._get_snapshot()
+            if vm_name not in snapshot["domains"]:
+                # defined after the figures were cached
+                self.snapshot = None
+                snapshot = self._get_snapshot()
+            domain = snapshot["domains"].get(vm_name)
+            if domain is None or domain["active"]:
+                return ""
+            summary = self._summarize(snapshot)
+            warning = self._check(vm_name, domain["memory"], domain["vcpus"], summary["memory_running"], summary["vcpus_running"], summary, force)
+            domain["active"] = True
+            return warning
+
+    def release(self, vm_name: str):
+        """
+        Gives back the resources admitted for starting a VM that then failed to start.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+        """
+        with self.lock:
+            if self.snapshot is not None and vm_name in self.snapshot["domains"]:
+                self.snapshot["domains"][vm_name]["active"] = False
+
+    def release_new(self, vm_name: str):
+        """
+        Gives back the resources admitted for a new VM that then failed to be defined.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+        """
+        with self.lock:
+            if self.snapshot is not None:
+                self.snapshot["domains"].pop(vm_name, None)
+
+    def invalidate(self):
+        """
+        Drops the cached figures, e.g. after VMs were stopped, so they are read again on their next use.
+        """
+        with self.lock:
+            self.snapshot = None
+
+    def _get_snapshot(self):
+        """
+        Gets the cached host figures and the resources of every domain, reading them again once they are too old.
+        Must be called with the lock held.
+
+        Raises:
+            LibvirtError: If the figures cannot be read.
+
+        Returns:
+            dict: The host "memory" (MiB), "cpus" and "max_vcpus", and the "memory" (MiB), "vcpus" and "active"
+                  state of every domain, keyed by name under "domains".
+        """
+        if self.snapshot is not None and time.monotonic() - self.snapshot_at < self.cache_ttl:
+            return self.snapshot
+
+        try:
+            host_info = self.connection.getInfo()
+            max_vcpus = self.connection.getMaxVcpus(None)
+            domain_stats = self.connection.getAllDomainStats(CAPACITY_STATS)
+        except libvirtError as e:
+            raise LibvirtError(f"Error reading the host's capacity: {e}")
+
+        domains = {}
+        for domain, stats in domain_stats:
+            # a vm is committed to the most memory it can balloon up to
+            memory = stats.get("balloon.maximum", stats.get("balloon.current", 0))
+            domains[domain.name()] = {
+                "memory": memory // 1024,
+                "vcpus": stats.get("vcpu.current", stats.get("vcpu.maximum", 0)),
+                "active": VMApi._mapVmStateToString(stats.get("state.state")) in ("running", "paused"),
+            }
+        self.snapshot = {"memory": host_info[1], "cpus": host_info[2], "max_vcpus": max_vcpus, "domains": domains}
+        self.snapshot_at = time.monotonic()
+        return self.snapshot
+
+    def _summarize(self, snapshot):
+        """
+        Adds up the committed resources of a snapshot.
+
+        Args:
+            snapshot (dict): The snapshot returned by _get_snapshot.
+
+        Returns:
+            dict: The summary, as returned by get_capacity.
+        """
+        limits = self._get_limits()
+        domains = snapshot["domains"].values()
+        memory_limit = int((snapshot["memory"] - limits["reserved_memory"]) * limits["memory_overcommit"])
+        vcpu_limit = int(snapshot["cpus"] * limits["cpu_overcommit"])
+        memory_running = sum(domain["memory"] for domain in domains if domain["active"])
+        vcpus_running = sum(domain["vcpus"] for domain in domains if domain["active"])
+        return {
+            "memory_total": snapshot["memory"],
+            "memory_limit": memory_limit,
+            "memory_defined": sum(domain["memory"] for domain in domains),
+            "memory_running": memory_running,
+            "memory_headroom": memory_limit - memory_running,
+            "cpus": snapshot["cpus"],
+            "vcpu_limit": vcpu_limit,
+            "vcpus_defined": sum(domain["vcpus"] for domain in domains),
+            "vcpus_running": vcpus_running,
+            "vcpu_headroom": vcpu_limit - vcpus_running,
+        }
+
+    def _check(self, vm_name: str, vm_memory: int, vm_vcpus: int, memory_committed: int, vcpus_committed: int, summary, force: bool):
+        """
+        Checks that a VM fits within the limits on top of the committed resources.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            vm_memory (int): The memory of the VM in MiB.
+            vm_vcpus (int): The number of vCPUs of the VM.
+            memory_committed (int): The memory already committed in MiB.
+            vcpus_committed (int): The vCPUs already committed.
+            summary (dict): The summary returned by _summarize.
+            force (bool): Only warn when the limits would be exceeded.
+
+        Raises:
+            VmctlError: If the VM would exceed the limits and admission is refused.
+
+        Returns:
+            str: A warning if the VM exceeds the limits, otherwise an empty string.
+        """
+        problems = []
+        if memory_committed + vm_memory > summary["memory_limit"]:
+            problems.append(f"{memory_committed + vm_memory} MiB of memory (limit {summary['memory_limit']})")
+        if vcpus_committed + vm_vcpus > summary["vcpu_limit"]:
+            problems.append(f"{vcpus_committed + vm_vcpus} vCPU's (limit {summary['vcpu_limit']})")
+        if not problems:
+            return ""
+
+        message = f"VM '{vm_name}' would commit {' and '.join(problems)} on this host."
+        if force or self._get_limits()["admission"] == "warn":
+            return f"[bold bright_yellow]Warning:[/bold bright_yellow] {message}"
+        raise VmctlError(f"{message} Use --force to go ahead anyway.")
+
+    def _get_limits(self):
+        """
+        Gets the capacity limits, from the configuration file unless they were given.
+
+        Raises:
+            VmctlError: If the admission mode is not supported.
+
+        Returns:
+            dict: The limits, with the defaults for anything not set.
+        """
+        if self.limits is None:
+            self.limits = load_config().get("capacity", {})
+        limits = {**DEFAULT_LIMITS, **self.limits}
+        if limits["admission"] not in ("refuse", "warn"):
+            raise VmctlError(f"Unsupported admission mode '{limits['admission']}'. Use refuse or warn.")
+        return limits
+
+    @staticmethod
+    def _format_value(key: str, value: int):
+        """
+        Formats a capacity figure, with negative headroom in red.
+
+        Args:
+            key (str): The key of the figure.
+            value (int): The figure.
+
+        Returns:
+            str: The formatted figure.
+        """
+        if key.endswith("headroom"):
+            color = "red" if value < 0 else "green"
+            return f"[{color}]{value}[/{color}]"
+        return str(value)
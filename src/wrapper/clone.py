@@ -0,0 +1,279 @@
+"""
+This module provides thin clones of virtual machines, backed by qcow2 overlays of a base VM's disks.
+"""
+import uuid
+import xml.etree.ElementTree as ET
+from rich import print
+from libvirt import libvirtError, VIR_DOMAIN_XML_INACTIVE
+from utils.errors import VmctlError, LibvirtError
+from utils.pool import run_parallel
+from utils.table import create_table
+from wrapper.vm import APPLY_NAMESPACE
+
+# a clone does not copy the base image, each of its disks is a new qcow2 volume that only
+# stores what the clone writes and reads everything else from the base image.
+# reference: https://libvirt.org/formatstorage.html#storage-volume-xml
+
+class CloneApi:
+    """
+    A class for cloning virtual machines with copy-on-write overlays of their disks.
+    """
+
+    def __init__(self, connection, capacity=None):
+        """
+        Initializes the CloneApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+            capacity (CapacityApi, optional): The capacity accounting new clones are admitted against. Defaults to None (no checks).
+        """
+        self.connection = connection
+        self.capacity = capacity
+
+    def clone(self, base_name: str, vm_names, parallelism: int = 8, pool_name: str = None, force: bool = False):
+        """
+        Creates clones of a shut off VM, concurrently.
+
+        Every writable disk of the base VM gets a qcow2 overlay volume backed by it, in the base disk's storage pool
+        (or `pool_name`), and each clone is defined from the base VM's configuration with its own name, UUID and MACs.
+        A failure on one clone does not abort the others, and the volumes of a clone that failed are deleted.
+        Each clone is admitted against the host's capacity like any new VM, before its volumes are created.
+
+        Args:
+            base_name (str): The name of the base virtual machine.
+            vm_names (list): The names of the clones.
+            parallelism (int, optional): The maximum number of clones created at the same time. Defaults to 8.
+            pool_name (str, optional): The storage pool the overlays are created in. Defaults to None, the base disk's pool.
+            force (bool, optional): Define the clones even if they exceed the host's capacity. Defaults to False.
+
+        Raises:
+            VmctlError: If the base VM is running, or one of its disks is not a storage volume.
+            LibvirtError: If the base VM or its disks cannot be read.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (done or failed), "uuid" and "message" of each clone.
+        """
+        base_xml, disks = self._read_base(base_name, pool_name)
+
+        results = []
+        outcomes = run_parallel(lambda vm_name: self._clone_one(base_xml, disks, vm_name, force), vm_names, parallelism)
+        for vm_name, outcome, error in outcomes:
+            if error is not None:
+                message = error.message if isinstance(error, VmctlError) else str(error)
+                results.append({"name": vm_name, "status": "failed", "uuid": "", "message": message})
+            else:
+                results.append(outcome)
+        if self.capacity:
+            self.capacity.invalidate()
+        return results
+
+
+    def print_clone_results(self, base_name: str, results):
+        """
+        Displays the results of cloning a VM in a table.
+
+        Args:
+            base_name (str): The name of the base virtual machine.
+            results (list): The results returned by clone.
+        """
+        status_colors = {"done": "green", "failed": "red"}
+        columns = [
+            {"header": "VM name", "style": "bold bright_cyan"},
+            {"header": "Status"},
+            {"header": "UUID"},
+            {"header": "Message"},
+        ]
+        rows = []
+        for result in results:
+            color = status_colors[result["status"]]
+            rows.append([result["name"], f"[{color}]{result['status']}[/{color}]", result["uuid"], result["message"]])
+
+        failed = sum(1 for result in results if result["status"] == "failed")
+        create_table(f"Clone {base_name} to {len(results)} VMs ({failed} failed)", columns, rows)
+
+
+    def _read_base(self, base_name: str, pool_name: str = None):
+        """
+        Reads the configuration of the base VM and the storage volume behind each of its writable disks.
+
+        It runs once per clone command, so the clones themselves only create volumes and define domains.
+
+        Args:
+            base_name (str): The name of the base virtual machine.
+            pool_name (str, optional): The storage pool the overlays are created in. Defaults to None.
+
+        Raises:
+            VmctlError: If the base VM is running, or one of its disks is not a storage volume.
+            LibvirtError: If the base VM or its disks cannot be read.
+
+        Returns:
+            tuple: The base VM's inactive XML configuration, and a list of dictionaries with the "target", "path",
+                   "format", "capacity" and "pool" (libvirt.virStoragePool) of each writable disk.
+        """
+        try:
+            domain = self.connection.lookupByName(base_name)
+            # the base image must not change under its clones
+            if domain.isActive():
+                raise VmctlError(f"VM '{base_name}' is running, shut it down before cloning it.")
+            base_xml = domain.XMLDesc(VIR_DOMAIN_XML_INACTIVE)
+            target_pool = self.connection.storagePoolLookupByName(pool_name) if pool_name else None
+        except libvirtError as e:
+            raise LibvirtError(f"Error reading VM '{base_name}': {e}")
+
+        disks = []
+        for disk in ET.fromstring(base_xml).iter("disk"):
+            if not self._is_clonable_disk(disk):
+                continue
+            path = disk.find("source").get("file")
+            driver = disk.find("driver")
+            try:
+                volume = self.connection.storageVolLookupByPath(path)
+                disks.append({
+                    "target": disk.find("target").get("dev"),
+                    "path": path,
+                    "format": driver.get("type", "raw") if driver is not None else "raw",
+                    "capacity": volume.info()[1],
+                    "pool": target_pool or volume.storagePoolLookupByVolume(),
+                })
+            except libvirtError as e:
+                raise VmctlError(f"Disk '{path}' of VM '{base_name}' is not a volume of a storage pool: {e}")
+
+        if not disks:
+            raise VmctlError(f"VM '{base_name}' has no disk to clone.")
+        return base_xml, disks
+
+    def _clone_one(self, base_xml: str, disks, vm_name: str, force: bool = False):
+        """
+        Creates the overlay volumes of one clone and defines it.
+
+        Args:
+            base_xml (str): The base VM's inactive XML configuration.
+            disks (list): The writable disks of the base VM, as returned by _read_base.
+            vm_name (str): The name of the clone.
+            force (bool, optional): Define the clone even if it exceeds the host's capacity. Defaults to False.
+
+        Raises:
+            VmctlError: If the clone exceeds the host's capacity.
+            LibvirtError: If a volume cannot be created or the clone cannot be defined.
+
+        Returns:
+            dict: The result of the clone, as returned by clone.
+        """
+        # admitted before its volumes are created, so a refused clone leaves nothing behind
+        warning = self.capacity.admit_new(vm_name, *self._read_resources(base_xml), force) if self.capacity else ""
+        volumes = []
+        try:
+            overlays = {}
+            for disk in disks:
+                volume = disk["pool"].createXML(self._overlay_xml(vm_name, disk), 0)
+                volumes.append(volume)
+                overlays[disk["path"]] = volume.path()
+
+            vm_uuid = str(uuid.uuid4())
+            self.connection.defineXML(self._clone_xml(base_xml, vm_name, vm_uuid, overlays))
+            message = f"Defined with {len(volumes)} overlay disk{'s' if len(volumes) != 1 else ''}."
+            return {"name": vm_name, "status": "done", "uuid": vm_uuid, "message": message + (f" {warning}" if warning else "")}
+        except libvirtError as e:
+            # a half created clone would leave orphan volumes behind
+            for volume in volumes:
+                try:
+                    volume.delete(0)
+                except libvirtError:
+                    pass
+            # and what was admitted for it is given back, so the later clones are not refused because of it
+            if self.capacity:
+                self.capacity.release_new(vm_name)
+            raise LibvirtError(f"Error cloning VM '{vm_name}': {e}")
+
+    @staticmethod
+    def _read_resources(base_xml: str):
+        """
+        Reads the memory and vCPUs a clone of the base VM commits.
+
+        Args:
+            base_xml (str): The base VM's inactive XML configuration.
+
+        Returns:
+            tuple: The memory in MiB and the number of vCPUs.
+        """
+        domain = ET.fromstring(base_xml)
+        memory, vcpu = domain.find("memory"), domain.find("vcpu")
+        # libvirt always writes the memory in KiB
+        return (int(memory.text) // 1024 if memory is not None else 0), (int(vcpu.text) if vcpu is not None else 1)
+
+    def _overlay_xml(self, vm_name: str, disk):
+        """
+        Creates the XML of a qcow2 volume backed by a base disk.
+
+        Args:
+            vm_name (str): The name of the clone.
+            disk (dict): The base disk, as returned by _read_base.
+
+        Returns:
+            str: The volume XML.
+        """
+        volume = ET.Element("volume")
+        ET.SubElement(volume, "name").text = f"{vm_name}-{disk['target']}.qcow2"
+        ET.SubElement(volume, "capacity", {"unit": "bytes"}).text = str(disk["capacity"])
+        ET.SubElement(ET.SubElement(volume, "target"), "format", {"type": "qcow2"})
+        backing = ET.SubElement(volume, "backingStore")
+        ET.SubElement(backing, "path").text = disk["path"]
+        ET.SubElement(backing, "format", {"type": disk["format"]})
+        return ET.tostring(volume, encoding="unicode")
+
+    def _clone_xml(self, base_xml: str, vm_name: str, vm_uuid: str, overlays):
+        """
+        Creates the XML configuration of a clone from the base VM's configuration.
+
+        Args:
+            base_xml (str): The base VM's inactive XML configuration.
+            vm_name (str): The name of the clone.
+            vm_uuid (str): The UUID of the clone.
+            overlays (dict): The path of the overlay that replaces each base disk path.
+
+        Returns:
+            str: The XML configuration of the clone.
+        """
+        domain = ET.fromstring(base_xml)
+        domain.find("name").text = vm_name
+        uuid_element = domain.find("uuid")
+        if uuid_element is None:
+            uuid_element = ET.SubElement(domain, "uuid")
+        uuid_element.text = vm_uuid
+
+        for disk in domain.iter("disk"):
+            if self._is_clonable_disk(disk) and disk.find("source").get("file") in overlays:
+                disk.find("source").set("file", overlays[disk.find("source").get("file")])
+                driver = disk.find("driver")
+                if driver is None:
+                    driver = ET.SubElement(disk, "driver", {"name": "qemu"})
+                driver.set("type", "qcow2")
+
+        # every clone needs its own mac addresses and uefi variables. when none are set, libvirt
+        # generates the addresses and creates the variables from the firmware's template
+        for interface in domain.iter("interface"):
+            for mac in interface.findall("mac"):
+                interface.remove(mac)
+        nvram = domain.find("os/nvram")
+        if nvram is not None:
+            domain.find("os").remove(nvram)
+
+        # the clone was not created from a manifest, so vmctl apply must not consider it its own
+        metadata = domain.find("metadata")
+        if metadata is not None:
+            for element in metadata.findall(f"{{{APPLY_NAMESPACE}}}spec"):
+                metadata.remove(element)
+        return ET.tostring(domain, encoding="unicode")
+
+    def _is_clonable_disk(self, disk: ET.Element):
+        """
+        Checks whether a disk of the base VM gets an overlay: a writable file disk (not a cdrom or a shared disk).
+
+        Args:
+            disk (xml.etree.ElementTree.Element): The <disk> element.
+
+        Returns:
+            bool: True if the disk gets an overlay.
+        """
+        return (disk.get("type") == "file" and disk.get("device", "disk") == "disk" and disk.find("source") is not None
+                and disk.find("source").get("file") and disk.find("readonly") is None and disk.find("shareable") is None)
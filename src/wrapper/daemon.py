@@ -0,0 +1,328 @@
+"""
+This module provides the vmctl daemon, which keeps libvirt connections open and serves
+LibVirtApi operations over a Unix socket, and the thin client the CLI uses to talk to it.
+"""
+import contextvars
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import time
+import rich
+from rich.console import Console
+from wrapper.pool import ConnectionPool
+from utils.errors import VmctlError, LibvirtError
+from utils.profiling import get_profiler
+
+# every request and response is a single line of json,
+# which keeps the protocol trivial to read from both ends
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# the LibVirtApi attributes whose methods the daemon serves
+REMOTE_APIS = ("host_api", "vm_api", "clone_api", "capacity_api", "snapshot_api", "memory_api", "qos_api")
+
+# the console the output of the request being served is captured on, None outside of a request.
+# utils.pool hands it on to the worker threads of the request
+_request_console = contextvars.ContextVar("vmctl_request_console", default=None)
+
+
+def default_socket_path():
+    """
+    Gets the path of the daemon's Unix socket.
+
+    Returns:
+        str: The value of VMCTL_SOCKET if set, otherwise a per-user path in the runtime directory.
+    """
+    if os.environ.get("VMCTL_SOCKET"):
+        return os.environ["VMCTL_SOCKET"]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "vmctl.sock")
+    return f"/tmp/vmctl-{os.getuid()}.sock"
+
+
+def connect(uri: str):
+    """
+    Connects to the vmctl daemon if one is running, otherwise connects to libvirt directly.
+
+    Setting VMCTL_NO_DAEMON=1 always connects directly.
+
+    Args:
+        uri (str): The libvirt URI to use.
+
+    Returns:
+        DaemonClient | LibVirtApi: An object exposing the REMOTE_APIS (`host_api`, `vm_api`, ...).
+    """
+    if os.environ.get("VMCTL_NO_DAEMON") != "1":
+        client = DaemonClient(default_socket_path(), uri)
+        if client.ping():
+            return client
+    # imported here, so talking to the daemon never loads libvirt
+    from wrapper.libvirt import LibVirtApi
+    return LibVirtApi(uri)
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class DaemonClient:
+    """
+    A client that forwards LibVirtApi calls to the vmctl daemon.
+
+    It exposes the same REMOTE_APIS attributes (`host_api`, `vm_api`, ...) as LibVirtApi, so the CLI can use either.
+    """
+
+    def __init__(self, socket_path: str, uri: str):
+        """
+        Initializes the DaemonClient class.
+
+        Args:
+            socket_path (str): The path of the daemon's Unix socket.
+            uri (str): The libvirt URI the daemon should run the calls against.
+        """
+        self.socket_path = socket_path
+        self.uri = uri
+        for api in REMOTE_APIS:
+            setattr(self, api, _RemoteApi(self, api))
+
+    def ping(self):
+        """
+        Checks whether the daemon is running.
+
+        Returns:
+            bool: True if the daemon answered.
+        """
+        try:
+            return self._send({"method": "ping"}).get("result") == "pong"
+        except (OSError, ValueError):
+            return False
+
+    def call(self, api: str, method: str, *args, **kwargs):
+        """
+        Runs a method of one of the daemon's apis and prints whatever it printed.
+
+        Args:
+            api (str): The api the method belongs to (one of REMOTE_APIS).
+            method (str): The name of the method.
+
+        Raises:
+            VmctlError: If the daemon cannot be reached or the method failed.
+
+        Returns:
+            Any: The value returned by the method.
+        """
+        console = rich.get_console()
+        request = {
+            "uri": self.uri,
+            "api": api,
+            "method": method,
+            "args": args,
+            "kwargs": kwargs,
+            "terminal": console.is_terminal,
+            "width": console.width,
+        }
+        try:
+            response = self._send(request)
+        except (OSError, ValueError) as e:
+            raise VmctlError(f"Error communicating with the vmctl daemon: {e}")
+
+        if response.get("output"):
+            console.file.write(response["output"])
+            console.file.flush()
+        if response.get("error") is not None:
+            error_class = LibvirtError if response.get("error_type") == "LibvirtError" else VmctlError
+            raise error_class(response["error"])
+        return response.get("result")
+
+    def close(self):
+        """
+        Does nothing, the connections belong to the daemon.
+        """
+
+    def _send(self, request):
+        profiler = get_profiler()
+        if profiler is None:
+            return self._exchange(request)
+        start = time.perf_counter()
+        try:
+            return self._exchange(request)
+        finally:
+            name = f"daemon.{request['api']}.{request['method']}" if "api" in request else f"daemon.{request['method']}"
+            profiler.record(name, "rpc", start, time.perf_counter())
+
+    def _exchange(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+            client_socket.connect(self.socket_path)
+            client_socket.sendall(json.dumps(request).encode() + b"\n")
+            with client_socket.makefile("rb") as reader:
+                line = reader.readline(MAX_MESSAGE_SIZE)
+        if not line:
+            raise ValueError("the daemon closed the connection without answering")
+        return json.loads(line)
+
+
+class _RemoteApi:
+    """
+    Forwards method calls on one of the REMOTE_APIS to the daemon.
+    """
+
+    def __init__(self, client, api):
+        self._client = client
+        self._api = api
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self._client.call(self._api, method, *args, **kwargs)
+
+
+class _RequestConsole:
+    """
+    Stands in for rich's global console in the daemon, forwarding to the console of the request being served,
+    so requests print concurrently without their output mixing.
+    """
+
+    def __init__(self, default):
+        object.__setattr__(self, "_default", default)
+
+    def __getattr__(self, name):
+        return getattr(_request_console.get() or self._default, name)
+
+    def __setattr__(self, name, value):
+        setattr(_request_console.get() or self._default, name, value)
+
+
+def _install_request_console():
+    """
+    Makes rich.print and rich.get_console use the console of the request being served.
+    """
+    # both read the module's _console, rich has no public way to swap it per thread
+    if not isinstance(rich.get_console(), _RequestConsole):
+        rich._console = _RequestConsole(rich.get_console())
+
+
+class VmctlDaemon:
+    """
+    A daemon that keeps libvirt connections open and serves LibVirtApi calls over a Unix socket.
+    """
+
+    def __init__(self, socket_path: str, max_staleness: float = 30.0):
+        """
+        Initializes the VmctlDaemon class.
+
+        Args:
+            socket_path (str): The path of the Unix socket to listen on.
+            max_staleness (float, optional): The maximum age in seconds of a cached domain state. Defaults to 30.0.
+        """
+        self.socket_path = socket_path
+        self.max_staleness = max_staleness
+        self.pool = ConnectionPool(self._connect)
+        # the output of every call is captured on a console of its own,
+        # so a slow call never holds up the others
+        _install_request_console()
+
+    def _connect(self, uri: str):
+        """
+        Opens a connection of the daemon.
+
+        Args:
+            uri (str): The libvirt URI.
+
+        Returns:
+            LibVirtApi: The connection.
+        """
+        from wrapper.libvirt import LibVirtApi
+        # the daemon's connections receive lifecycle events, so the state
+        # checks of lifecycle commands are answered from the state cache
+        api = LibVirtApi(uri, events=True, max_staleness=self.max_staleness)
+        # and keep the states in the inventory current between refreshes
+        api.inventory_api.follow(api.event_feed)
+        return api
+
+    def serve_forever(self):
+        """
+        Listens on the socket and serves requests until interrupted.
+
+        Raises:
+            VmctlError: If another daemon is already listening on the socket.
+        """
+        self._remove_stale_socket()
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline(MAX_MESSAGE_SIZE)
+                if not line:
+                    return
+                try:
+                    response = daemon.handle_request(json.loads(line))
+                except ValueError as e:
+                    response = {"error": f"Invalid request: {e}", "error_type": "VmctlError"}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        # bind creates the socket file, so it must be created 0600 rather than chmod'ed
+        # afterwards, when another user could already have connected to it
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        finally:
+            os.umask(umask)
+        # stop the same way on SIGTERM (e.g. from systemd) as on ctrl+c
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(self.socket_path)
+            self.pool.close()
+
+    def handle_request(self, request):
+        """
+        Runs a single request.
+
+        Args:
+            request (dict): The decoded request.
+
+        Returns:
+            dict: The response, with the captured "output" and either a "result" or an "error".
+        """
+        if request.get("method") == "ping":
+            return {"result": "pong"}
+
+        api_name, method_name = request.get("api"), request.get("method", "")
+        if api_name not in REMOTE_APIS or method_name.startswith("_"):
+            return {"error": f"Unsupported call '{api_name}.{method_name}'.", "error_type": "VmctlError"}
+
+        buffer = io.StringIO()
+        token = _request_console.set(Console(file=buffer, force_terminal=request.get("terminal", False), width=request.get("width")))
+        try:
+            api = getattr(self.pool.get(request["uri"]), api_name)
+            method = getattr(api, method_name, None)
+            if method is None:
+                raise VmctlError(f"Unsupported call '{api_name}.{method_name}'.")
+            result = method(*request.get("args", []), **request.get("kwargs", {}))
+            return {"output": buffer.getvalue(), "result": result}
+        except VmctlError as e:
+            return {"output": buffer.getvalue(), "error": e.message, "error_type": type(e).__name__}
+        except Exception as e:
+            return {"output": buffer.getvalue(), "error": str(e), "error_type": type(e).__name__}
+        finally:
+            _request_console.reset(token)
+
+    def _remove_stale_socket(self):
+        """
+        Removes a socket file left behind by a daemon that is no longer running.
+
+        Raises:
+            VmctlError: If a daemon is still listening on the socket.
+        """
+        if not os.path.exists(self.socket_path):
+            return
+        if DaemonClient(self.socket_path, None).ping():
+            raise VmctlError(f"A vmctl daemon is already listening on {self.socket_path}.")
+        os.unlink(self.socket_path)
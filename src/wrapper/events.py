@@ -0,0 +1,336 @@
+"""
+This module provides libvirt domain lifecycle events and a domain state cache kept current by them.
+"""
+import threading
+import time
+import libvirt
+from utils.errors import VmctlError, LibvirtError
+
+# libvirt can only deliver events once an event loop implementation is registered,
+# and it has to be registered before opening the connections that need events.
+# reference: https://libvirt.org/html/libvirt-libvirt-event.html
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+# only one implementation can be registered per process, None until one is
+_event_loop_impl = None
+
+# reboots are reported through their own event id, they are passed to
+# subscribers like a lifecycle event with this made up event number
+REBOOT_EVENT = -1
+
+# the state a domain is in after each lifecycle event (VIR_DOMAIN_EVENT_*),
+# None means the event does not tell us the new state
+EVENT_STATES = {
+    libvirt.VIR_DOMAIN_EVENT_DEFINED: None,
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED: None,
+    libvirt.VIR_DOMAIN_EVENT_STARTED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: libvirt.VIR_DOMAIN_PAUSED,
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: libvirt.VIR_DOMAIN_SHUTOFF,
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: libvirt.VIR_DOMAIN_SHUTDOWN,
+    libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: libvirt.VIR_DOMAIN_PMSUSPENDED,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: libvirt.VIR_DOMAIN_CRASHED,
+}
+
+EVENT_NAMES = {
+    libvirt.VIR_DOMAIN_EVENT_DEFINED: "defined",
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED: "undefined",
+    libvirt.VIR_DOMAIN_EVENT_STARTED: "started",
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: "suspended",
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: "resumed",
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: "stopped",
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: "shutdown",
+    libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: "pmsuspended",
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: "crashed",
+    REBOOT_EVENT: "rebooted",
+}
+
+def start_event_loop():
+    """
+    Registers libvirt's default event loop and runs it in a background thread.
+
+    Calling it more than once, or after start_asyncio_event_loop, has no effect.
+    """
+    global _event_loop_thread, _event_loop_impl
+    with _event_loop_lock:
+        if _event_loop_impl is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        _event_loop_impl = "default"
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _event_loop_thread = threading.Thread(target=run, name="libvirt-events", daemon=True)
+        _event_loop_thread.start()
+
+
+def start_asyncio_event_loop(loop=None):
+    """
+    Registers an asyncio event loop as libvirt's event loop, so events are dispatched on it instead of a thread.
+
+    Calling it more than once has no effect.
+
+    Args:
+        loop (asyncio.AbstractEventLoop, optional): The loop. Defaults to None, the running loop.
+
+    Raises:
+        VmctlError: If libvirt's default event loop was registered already.
+    """
+    global _event_loop_impl
+    with _event_loop_lock:
+        if _event_loop_impl == "asyncio":
+            return
+        if _event_loop_impl is not None:
+            raise VmctlError("libvirt's default event loop is already registered, asyncio cannot replace it.")
+        # libvirtaio ships with libvirt-python, it is only imported by asyncio users
+        import libvirtaio
+        libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+        _event_loop_impl = "asyncio"
+
+
+class DomainEventFeed:
+    """
+    Receives the lifecycle and reboot events of every domain on a connection and passes them on to subscribers.
+    """
+
+    def __init__(self, connection):
+        """
+        Initializes the DomainEventFeed class and registers for lifecycle events.
+
+        Args:
+            connection (libvirt.virConnect): The connection object, opened after start_event_loop.
+        """
+        self.connection = connection
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.register()
+
+    def register(self):
+        """
+        Registers for the events on the connection, again after it was reopened (see wrapper.resilient).
+
+        Raises:
+            LibvirtError: If the registration fails.
+        """
+        try:
+            self.callback_ids = [
+                self.connection.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle_event, None),
+                self.connection.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, self._on_reboot_event, None),
+            ]
+        except libvirt.libvirtError as e:
+            raise LibvirtError(f"Error registering for domain events: {e}")
+
+    def subscribe(self, callback):
+        """
+        Adds a subscriber.
+
+        Args:
+            callback (callable): Called with (domain, event, detail) for every lifecycle event (VIR_DOMAIN_EVENT_*)
+                                 and reboot (REBOOT_EVENT).
+                                 It runs on the event loop thread, so it must return quickly.
+        """
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Removes a subscriber.
+
+        Args:
+            callback (callable): The callback passed to subscribe.
+        """
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def close(self):
+        """
+        Stops receiving events.
+        """
+        try:
+            for callback_id in self.callback_ids:
+                self.connection.domainEventDeregisterAny(callback_id)
+        except libvirt.libvirtError as e:
+            raise LibvirtError(f"Error deregistering domain events: {e}")
+
+    def _on_lifecycle_event(self, connection, domain, event, detail, opaque):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            callback(domain, event, detail)
+
+    def _on_reboot_event(self, connection, domain, opaque):
+        self._on_lifecycle_event(connection, domain, REBOOT_EVENT, 0, opaque)
+
+
+class StateWaiter:
+    """
+    Waits for many domains to reach a state, using lifecycle events instead of polling.
+
+    Every wait shares the feed's single event loop, so waiting on hundreds of domains costs no extra threads or RPCs.
+    """
+
+    def __init__(self, feed: DomainEventFeed):
+        """
+        Initializes the StateWaiter class and subscribes to the feed.
+
+        Args:
+            feed (DomainEventFeed): The event feed of the connection the domains belong to.
+        """
+        self.feed = feed
+        # vm name -> (target, event set once the target is reached)
+        self.pending = {}
+        self.lock = threading.Lock()
+        feed.subscribe(self._on_lifecycle_event)
+
+    def expect(self, vm_name: str, target: int):
+        """
+        Starts watching a domain. Call it before acting on the domain, so no event can be missed.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            target (int): The state to wait for (VIR_DOMAIN_*), or REBOOT_EVENT to wait for a reboot.
+        """
+        with self.lock:
+            self.pending[vm_name] = (target, threading.Event())
+
+    def forget(self, vm_name: str):
+        """
+        Stops watching a domain, e.g. because the action on it was not performed.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+        """
+        with self.lock:
+            self.pending.pop(vm_name, None)
+
+    def wait(self, vm_names, timeout: float = None):
+        """
+        Waits until every domain reached its target, or the timeout expires.
+
+        Args:
+            vm_names (list): The names of the virtual machines, each passed to expect before.
+            timeout (float, optional): The maximum time to wait in seconds, shared by all the domains. Defaults to None (no limit).
+
+        Returns:
+            dict: Whether each domain reached its target, keyed by VM name.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        reached = {}
+        for vm_name in vm_names:
+            with self.lock:
+                _, event = self.pending[vm_name]
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            reached[vm_name] = event.wait(remaining)
+        return reached
+
+    def close(self):
+        """
+        Stops receiving events.
+        """
+        self.feed.unsubscribe(self._on_lifecycle_event)
+
+    def _on_lifecycle_event(self, domain, event, detail):
+        with self.lock:
+            entry = self.pending.get(domain.name())
+        if entry is None:
+            return
+        target, reached = entry
+        if (target == REBOOT_EVENT and event == REBOOT_EVENT) or (target != REBOOT_EVENT and EVENT_STATES.get(event) == target):
+            reached.set()
+
+
+class DomainStateCache:
+    """
+    An in-process registry of domains and their states.
+
+    It is populated with a single bulk call and, when given an event feed, kept current by lifecycle
+    events. Entries older than `max_staleness` seconds are read again from libvirt before being used.
+    """
+
+    def __init__(self, connection, feed: DomainEventFeed = None, max_staleness: float = 30.0):
+        """
+        Initializes the DomainStateCache class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+            feed (DomainEventFeed, optional): The event feed that keeps the cache current. Defaults to None.
+            max_staleness (float, optional): The maximum age of an entry in seconds. Defaults to 30.0.
+        """
+        self.connection = connection
+        self.max_staleness = max_staleness
+        # vm name -> (domain, state, time the state was read)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.populated = False
+        if feed is not None:
+            feed.subscribe(self._on_lifecycle_event)
+
+    def populate(self):
+        """
+        Reads the state of every domain with a single getAllDomainStats call.
+        """
+        try:
+            domain_stats = self.connection.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        except libvirt.libvirtError as e:
+            raise LibvirtError(f"Error listing VMs: {e}")
+
+        now = time.monotonic()
+        with self.lock:
+            self.entries = {domain.name(): (domain, stats.get("state.state"), now) for domain, stats in domain_stats}
+            self.populated = True
+
+    def get(self, vm_name: str):
+        """
+        Gets a domain and its state, reading them from libvirt only if the cached entry is missing or stale.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+
+        Raises:
+            libvirt.libvirtError: If the domain cannot be looked up.
+
+        Returns:
+            tuple: The domain (libvirt.virDomain) and its state (VIR_DOMAIN_*).
+        """
+        with self.lock:
+            entry = self.entries.get(vm_name)
+        if entry is not None and time.monotonic() - entry[2] <= self.max_staleness:
+            return entry[0], entry[1]
+
+        domain = entry[0] if entry is not None else self.connection.lookupByName(vm_name)
+        state, _ = domain.state()
+        with self.lock:
+            self.entries[vm_name] = (domain, state, time.monotonic())
+        return domain, state
+
+    def invalidate(self, vm_name: str = None):
+        """
+        Marks an entry (or every entry) as stale, so it is read again on its next use.
+
+        Args:
+            vm_name (str, optional): The name of the virtual machine. Defaults to None, which invalidates every entry.
+        """
+        with self.lock:
+            names = [vm_name] if vm_name is not None else list(self.entries)
+            for name in names:
+                if name in self.entries:
+                    domain, state, _ = self.entries[name]
+                    self.entries[name] = (domain, state, float("-inf"))
+
+    def _on_lifecycle_event(self, domain, event, detail):
+        vm_name = domain.name()
+        with self.lock:
+            if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                self.entries.pop(vm_name, None)
+                return
+
+            state = EVENT_STATES.get(event)
+            if state is None:
+                # a newly defined domain starts out shut off, redefining
+                # an existing one does not change its state
+                entry = self.entries.get(vm_name)
+                state = entry[1] if entry is not None else libvirt.VIR_DOMAIN_SHUTOFF
+            self.entries[vm_name] = (domain, state, time.monotonic())
@@ -0,0 +1,228 @@
+"""
+This module provides an HTTP endpoint that exports host and VM metrics in the Prometheus text format.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from libvirt import libvirtError
+from rich import print
+from rich.console import Console
+from utils.errors import VmctlError, LibvirtError
+from wrapper.metrics import collect_domain_stats
+from wrapper.vm import VMApi
+
+# failed collections are reported here, the scrapes only see vmctl_up
+_stderr = Console(stderr=True)
+
+# reference: https://prometheus.io/docs/instrumenting/exposition_formats/
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# per device counters: (metric name, help, stats key suffix)
+BLOCK_COUNTERS = [
+    ("vmctl_domain_block_read_requests_total", "Number of read requests on a VM disk.", "rd.reqs"),
+    ("vmctl_domain_block_write_requests_total", "Number of write requests on a VM disk.", "wr.reqs"),
+    ("vmctl_domain_block_read_bytes_total", "Number of bytes read from a VM disk.", "rd.bytes"),
+    ("vmctl_domain_block_write_bytes_total", "Number of bytes written to a VM disk.", "wr.bytes"),
+]
+NET_COUNTERS = [
+    ("vmctl_domain_net_receive_bytes_total", "Number of bytes received on a VM interface.", "rx.bytes"),
+    ("vmctl_domain_net_transmit_bytes_total", "Number of bytes transmitted on a VM interface.", "tx.bytes"),
+]
+
+def format_metric(name: str, help_text: str, metric_type: str, samples):
+    """
+    Formats a metric in the Prometheus text format.
+
+    Args:
+        name (str): The metric name.
+        help_text (str): The description of the metric.
+        metric_type (str): The metric type (gauge or counter).
+        samples (list): A list of (labels dictionary, value) tuples.
+
+    Returns:
+        str: The formatted metric, or an empty string if there are no samples.
+    """
+    if not samples:
+        return ""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{_escape_label(str(label))}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: str):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsExporter:
+    """
+    Collects host and VM metrics for Prometheus.
+
+    Results are cached for `cache_ttl` seconds, concurrent scrapes share a single collection, and a scrape
+    never waits more than `scrape_timeout` seconds: when the collection takes longer, the last result is served.
+    """
+
+    def __init__(self, api, cache_ttl: float = 15.0, scrape_timeout: float = 5.0):
+        """
+        Initializes the MetricsExporter class.
+
+        Args:
+            api (LibVirtApi): The connection to export the metrics of.
+            cache_ttl (float, optional): How long a collection is reused in seconds, usually the scrape interval. Defaults to 15.0.
+            scrape_timeout (float, optional): The maximum time a scrape waits for a collection in seconds. Defaults to 5.0.
+        """
+        self.api = api
+        self.cache_ttl = cache_ttl
+        self.scrape_timeout = scrape_timeout
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.collecting = None
+        self.cached = None
+        self.cached_at = float("-inf")
+
+    def get_metrics(self):
+        """
+        Gets the metrics, collecting them again only when the cached ones are older than cache_ttl.
+
+        Returns:
+            str: The metrics in the Prometheus text format.
+        """
+        with self.lock:
+            if self.cached is not None and time.monotonic() - self.cached_at < self.cache_ttl:
+                return self.cached + self._format_status(up=True, timed_out=False)
+            if self.collecting is None:
+                self.collecting = self.executor.submit(self._collect_and_cache)
+            collecting = self.collecting
+
+        try:
+            return collecting.result(timeout=self.scrape_timeout) + self._format_status(up=True, timed_out=False)
+        except TimeoutError:
+            # the collection keeps running in the background
+            # and its result is served by a later scrape
+            return (self.cached or "") + self._format_status(up=self.cached is not None, timed_out=True)
+        except (libvirtError, LibvirtError) as e:
+            # anything else is a bug, which must not pass for a host that is down
+            _stderr.print(f"[bold red]Error collecting the metrics:[/bold red] {e.message if isinstance(e, LibvirtError) else e}")
+            return self._format_status(up=False, timed_out=False)
+
+    def collect(self):
+        """
+        Collects the metrics, with a single bulk stats call for all the VMs.
+
+        Returns:
+            str: The metrics in the Prometheus text format.
+        """
+        started_at = time.monotonic()
+        host_info = self.api.host_api.get_host_info()
+        max_vcpus = self.api.host_api.get_max_vCpus()
+        domain_stats = collect_domain_stats(self.api.connection)
+
+        parts = [
+            format_metric("vmctl_host_info", "Host model.", "gauge", [({"model": host_info["model"]}, 1)]),
+            format_metric("vmctl_host_memory_bytes", "Host memory.", "gauge", [({}, host_info["memory"] * 1024 * 1024)]),
+            format_metric("vmctl_host_cpus", "Number of host CPUs.", "gauge", [({}, host_info["cpus"])]),
+            format_metric("vmctl_host_cpu_mhz", "Host CPU frequency.", "gauge", [({}, host_info["mhz"])]),
+            format_metric("vmctl_host_numa_nodes", "Number of host NUMA nodes.", "gauge", [({}, host_info["numa_nodes"])]),
+            format_metric("vmctl_host_max_vcpus", "Maximum number of vCPUs per VM.", "gauge", [({}, max_vcpus)]),
+        ]
+
+        states, cpu, vcpus, memory, max_memory, rss = [], [], [], [], [], []
+        devices = {name: [] for name, _, _ in BLOCK_COUNTERS + NET_COUNTERS}
+        for domain, stats in domain_stats:
+            labels = {"domain": domain.name()}
+            states.append((dict(labels, state=VMApi._mapVmStateToString(stats.get("state.state"))), 1))
+            if "cpu.time" in stats:
+                cpu.append((labels, stats["cpu.time"] / 1e9))
+            if "vcpu.current" in stats:
+                vcpus.append((labels, stats["vcpu.current"]))
+            if "balloon.current" in stats:
+                memory.append((labels, stats["balloon.current"] * 1024))
+            if "balloon.maximum" in stats:
+                max_memory.append((labels, stats["balloon.maximum"] * 1024))
+            if "balloon.rss" in stats:
+                rss.append((labels, stats["balloon.rss"] * 1024))
+
+            for prefix, counters, label in [("block", BLOCK_COUNTERS, "device"), ("net", NET_COUNTERS, "interface")]:
+                for index in range(stats.get(f"{prefix}.count", 0)):
+                    device_labels = dict(labels, **{label: stats.get(f"{prefix}.{index}.name", str(index))})
+                    for name, _, key in counters:
+                        if f"{prefix}.{index}.{key}" in stats:
+                            devices[name].append((device_labels, stats[f"{prefix}.{index}.{key}"]))
+
+        parts += [
+            format_metric("vmctl_domain_state", "VM state, the state label is set to 1.", "gauge", states),
+            format_metric("vmctl_domain_cpu_seconds_total", "CPU time used by a VM.", "counter", cpu),
+            format_metric("vmctl_domain_vcpus", "Number of vCPUs of a VM.", "gauge", vcpus),
+            format_metric("vmctl_domain_memory_bytes", "Current (balloon) memory of a VM.", "gauge", memory),
+            format_metric("vmctl_domain_memory_max_bytes", "Maximum memory of a VM.", "gauge", max_memory),
+            format_metric("vmctl_domain_memory_rss_bytes", "Resident memory of a VM on the host.", "gauge", rss),
+        ]
+        parts += [format_metric(name, help_text, "counter", devices[name]) for name, help_text, _ in BLOCK_COUNTERS + NET_COUNTERS]
+        parts.append(format_metric("vmctl_collection_duration_seconds", "Time the collection took.", "gauge", [({}, round(time.monotonic() - started_at, 6))]))
+        return "".join(parts)
+
+    def serve_forever(self, address: str = "127.0.0.1", port: int = 9177):
+        """
+        Serves the metrics on http://address:port/metrics until interrupted.
+
+        Args:
+            address (str, optional): The address to listen on. Defaults to "127.0.0.1".
+            port (int, optional): The port to listen on. Defaults to 9177.
+        """
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.get_metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer((address, port), Handler)
+        except OSError as e:
+            raise VmctlError(f"Error listening on {address}:{port}: {e}")
+
+        print(f"Serving metrics on [bold bright_cyan]http://{address}:{server.server_address[1]}/metrics[/bold bright_cyan]")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.executor.shutdown(wait=False)
+
+    def _collect_and_cache(self):
+        try:
+            metrics = self.collect()
+            with self.lock:
+                self.cached = metrics
+                self.cached_at = time.monotonic()
+            return metrics
+        finally:
+            with self.lock:
+                self.collecting = None
+
+    def _format_status(self, up: bool, timed_out: bool):
+        """
+        Formats the metrics describing the scrape itself.
+
+        Args:
+            up (bool): Whether the served metrics come from a successful collection.
+            timed_out (bool): Whether the collection took longer than the scrape timeout.
+
+        Returns:
+            str: The status metrics in the Prometheus text format.
+        """
+        return (format_metric("vmctl_up", "Whether the served metrics come from a successful collection.", "gauge", [({}, int(up))]) +
+                format_metric("vmctl_scrape_timed_out", "Whether the collection took longer than the scrape timeout.", "gauge", [({}, int(timed_out))]))
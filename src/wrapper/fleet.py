@@ -0,0 +1,211 @@
+"""
+This module provides a class for querying several hypervisors at once and merging the results.
+"""
+import sys
+from rich import print
+from utils.pool import iter_parallel, run_parallel
+from utils.table import create_table
+from utils.errors import VmctlError
+from wrapper.capacity import CapacityApi
+from wrapper.host import HostApi
+from wrapper.vm import VMApi
+
+class FleetApi:
+    """
+    A class for fanning out queries to several hypervisors concurrently.
+    """
+
+    def __init__(self, hosts, pool, parallelism: int = 8):
+        """
+        Initializes the FleetApi class.
+
+        Args:
+            hosts (dict): The hosts to query, mapping each host name to its libvirt URI.
+            pool (ConnectionPool): The pool the connections to the hosts are taken from.
+            parallelism (int, optional): The maximum number of hosts queried at the same time. Defaults to 8.
+        """
+        self.hosts = hosts
+        self.pool = pool
+        self.parallelism = parallelism
+        # the hosts that could not be queried by the last iter_vms
+        self.errors = {}
+
+    def fan_out(self, func):
+        """
+        Calls a function with the connection of every host concurrently.
+
+        Args:
+            func (callable): Called with a connection (LibVirtApi or DaemonClient), returns the host's result.
+
+        Returns:
+            tuple: A dictionary of results keyed by host name, and a dictionary of error messages keyed by host name.
+        """
+        outcomes = run_parallel(lambda host: func(self.pool.get(self.hosts[host])), list(self.hosts), self.parallelism)
+
+        results, errors = {}, {}
+        for host, result, error in outcomes:
+            if error is not None:
+                errors[host] = error.message if isinstance(error, VmctlError) else str(error)
+            else:
+                results[host] = result
+        return results, errors
+
+    def get_vms(self, states=None):
+        """
+        Gets the VMs of every host.
+
+        Args:
+            states (list, optional): Only include VMs in one of these states (running, paused, shutoff). Defaults to None.
+
+        Returns:
+            tuple: A list of VM dictionaries with an added "host" key, and a dictionary of error messages keyed by host name.
+        """
+        results, errors = self.fan_out(lambda api: api.vm_api.get_vms(states))
+        vms = [{"host": host, **vm} for host in self.hosts if host in results for vm in results[host]]
+        return vms, errors
+
+    def iter_vms(self, states=None):
+        """
+        Like get_vms, but yields the VMs of each host as soon as that host answered.
+
+        The hosts that could not be queried are left in `errors` once the generator is exhausted.
+
+        Args:
+            states (list, optional): Only include VMs in one of these states (running, paused, shutoff). Defaults to None.
+
+        Yields:
+            dict: A VM dictionary with an added "host" key.
+        """
+        self.errors = {}
+        outcomes = iter_parallel(lambda host: self.pool.get(self.hosts[host]).vm_api.get_vms(states), list(self.hosts), self.parallelism)
+        for host, vms, error in outcomes:
+            if error is not None:
+                self.errors[host] = error.message if isinstance(error, VmctlError) else str(error)
+                continue
+            for vm in vms:
+                yield {"host": host, **vm}
+
+    def get_vm_info(self, vm_name):
+        """
+        Gets information about a virtual machine on every host it is defined on.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+
+        Raises:
+            VmctlError: If no host knows the VM.
+
+        Returns:
+            tuple: A list of VM info dictionaries with an added "host" key, and a dictionary of error messages
+                   keyed by host name, leaving out the hosts the VM was simply not found on.
+        """
+        results, errors = self.fan_out(lambda api: api.vm_api.get_vm_info(vm_name))
+        if not results:
+            raise VmctlError(f"VM '{vm_name}' was not found on any of the {len(self.hosts)} hosts.")
+
+        # a vm only lives on some of the hosts, so hosts that do not
+        # know it are not worth reporting when it was found elsewhere
+        errors = {host: error for host, error in errors.items() if "not found" not in error.lower()}
+        return [{"host": host, **vm} for host, vm in results.items()], errors
+
+    def get_host_info(self):
+        """
+        Gets information about every host.
+
+        Returns:
+            tuple: A list of host info dictionaries with an added "host" key, and a dictionary of error messages keyed by host name.
+        """
+        results, errors = self.fan_out(lambda api: api.host_api.get_host_info())
+        return [{"host": host, **info} for host, info in results.items()], errors
+
+    def get_capacity(self):
+        """
+        Gets the capacity of every host.
+
+        Returns:
+            tuple: A list of capacity dictionaries with an added "host" key, and a dictionary of error messages keyed by host name.
+        """
+        results, errors = self.fan_out(lambda api: api.capacity_api.get_capacity())
+        return [{"host": host, **capacity} for host, capacity in results.items()], errors
+
+    def list_vms(self, states=None):
+        """
+        Lists the VMs of every host in a single table.
+
+        Args:
+            states (list, optional): Only list VMs in one of these states (running, paused, shutoff). Defaults to None.
+        """
+        vms, errors = self.get_vms(states)
+        if vms:
+            columns = [
+                {"header": "Host", "style": "bold magenta"},
+                {"header": "VM ID", "style": "bold bright_yellow"},
+                {"header": "VM name", "style": "bold bright_cyan"},
+                {"header": "VM state"},
+            ]
+            rows = []
+            for vm in vms:
+                vm_id = "--" if vm["id"] is None else str(vm["id"])
+                color = VMApi._mapStateToColor(vm["state"])
+                rows.append([vm["host"], vm_id, vm["name"], f"[{color}]{vm['state']}[/{color}]"])
+            create_table(f"List of VMs on {len(self.hosts)} hosts", columns, rows)
+        elif not errors:
+            print("[bold bright_yellow]No VMs found[/bold bright_yellow]")
+        self.print_errors(errors)
+
+    def vm_info(self, vm_name):
+        """
+        Displays information about a virtual machine on every host it is defined on.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+        """
+        vms, errors = self.get_vm_info(vm_name)
+        columns = [
+            {"header": "Host", "style": "bold magenta"},
+            {"header": "VM ID"},
+            {"header": "VM name"},
+            {"header": "VM state"},
+            {"header": "VM current memory"},
+            {"header": "VM max memory"},
+            {"header": "VM number of vCPU's"},
+            {"header": "VM CPU time used"},
+        ]
+        rows = []
+        for vm in vms:
+            vm_id = "--" if vm["id"] is None else str(vm["id"])
+            rows.append([vm["host"], vm_id, vm_name, vm["state"], str(vm["memory"]), str(vm["max_memory"]), str(vm["vcpus"]), str(vm["cpu_time"])])
+        create_table(f"Virtual Machine [bold bright_cyan]{vm_name}[/bold bright_cyan] Info", columns, rows)
+        self.print_errors(errors)
+
+    def get_info(self):
+        """
+        Displays information about every host in a single table.
+        """
+        host_infos, errors = self.get_host_info()
+        if host_infos:
+            columns = [{"header": "Host", "style": "bold magenta"}] + [{"header": header} for header in HostApi.INFO_HEADERS]
+            rows = [[info["host"]] + [str(info[key]) for key in HostApi.INFO_KEYS] for info in host_infos]
+            create_table("Host Machine Info", columns, rows)
+        self.print_errors(errors)
+
+    def capacity(self):
+        """
+        Displays the capacity of every host in a single table.
+        """
+        capacities, errors = self.get_capacity()
+        if capacities:
+            columns = [{"header": "Host", "style": "bold magenta"}] + [{"header": header} for header in CapacityApi.CAPACITY_HEADERS]
+            rows = [[capacity["host"]] + [CapacityApi._format_value(key, capacity[key]) for key in CapacityApi.CAPACITY_KEYS] for capacity in capacities]
+            create_table("Host Capacity (memory in MiB)", columns, rows)
+        self.print_errors(errors)
+
+    def print_errors(self, errors):
+        """
+        Displays the hosts that could not be queried on stderr, so they never mix with machine-readable output.
+
+        Args:
+            errors (dict): Error messages keyed by host name.
+        """
+        for host, error in errors.items():
+            print(f"[bold red]Error:[/bold red] host [bold magenta]{host}[/bold magenta]: {error}", file=sys.stderr)
@@ -1,7 +1,7 @@
 """
 This module provides a class for interacting with the host machine's libvirt API.
 """
-from rich.console import Console
+from rich import get_console
 from rich.table import  Table
 from libvirt import libvirtError
 from utils.errors import LibvirtError
@@ -11,6 +11,10 @@ class HostApi:
     A class for interacting with the host machine's libvirt API.
     """
 
+    # the keys returned by get_host_info and their column headers, in display order
+    INFO_KEYS = ["model", "memory", "cpus", "mhz", "numa_nodes", "sockets", "cores", "threads"]
+    INFO_HEADERS = ["Model", "Memory Size (in MB)", "Number of CPU's", "MHz of CPU's", "Number of NUMA Nodes", "Number of CPU Sockets", "Number of CPU cores per Socket", "Number of CPU threads per core"]
+
     def __init__(self, connection):
         """
         Initializes the HostApi class.
@@ -19,7 +23,7 @@ class HostApi:
             connection (libvirt.virConnect): The connection object.
         """
         self.connection = connection
-        self.console = Console()
+        self.console = get_console()
 
     def get_hostname(self):
         """
@@ -45,19 +49,37 @@ class HostApi:
         except libvirtError as e:
             raise LibvirtError(f"Error getting maximum vCPUs: {e}")
     
-    def get_info(self):
+    def get_host_info(self):
         """
-        Gets information about the host machine and displays it in a table.
+        Gets information about the host machine.
+
+        Returns:
+            dict: The host's "model", "memory" (in MB), "cpus", "mhz", "numa_nodes", "sockets" (per NUMA node),
+                  "cores" (per socket) and "threads" (per core).
         """
         try:
             host_info = self.connection.getInfo()
-            rich_table = Table("Model", "Memory Size (in MB)", "Number of CPU's", "MHz of CPU's", "Number of NUMA Nodes", "Number of CPU Sockets", "Number of CPU cores per Socket", "Number of CPU threads per core", title="Host Machine Info")
-            
+
             # unpacking the array to retrieve all the info the libvirt API returned
             model, size, no_cpu, cpu_freq, no_numa_nodes, no_cpu_sockets_per_node, no_cores_per_socket, no_threads_per_core = host_info
-            rich_table.add_row(model, str(size), str(no_cpu), str(cpu_freq), 
-                    str(no_numa_nodes), str(no_cpu_sockets_per_node), str(no_cores_per_socket), 
-                    str(no_threads_per_core))
-            self.console.print(rich_table)
+            return {
+                "model": model,
+                "memory": size,
+                "cpus": no_cpu,
+                "mhz": cpu_freq,
+                "numa_nodes": no_numa_nodes,
+                "sockets": no_cpu_sockets_per_node,
+                "cores": no_cores_per_socket,
+                "threads": no_threads_per_core,
+            }
         except libvirtError as e:
-            raise LibvirtError(f"Error getting host information: {e}")
\ No newline at end of file
+            raise LibvirtError(f"Error getting host information: {e}")
+
+    def get_info(self):
+        """
+        Gets information about the host machine and displays it in a table.
+        """
+        host_info = self.get_host_info()
+        rich_table = Table(*self.INFO_HEADERS, title="Host Machine Info")
+        rich_table.add_row(*[str(host_info[key]) for key in self.INFO_KEYS])
+        self.console.print(rich_table)
@@ -0,0 +1,88 @@
+"""
+This module wraps libvirt objects so every method call on them is timed by the profiler.
+
+LibVirtApi only wraps its connection when profiling is on. The objects the connection returns (domains,
+snapshots, storage pools and volumes) are wrapped in turn, so their calls are counted as e.g. "virDomain.info".
+"""
+import time
+from utils.profiling import Profiler
+
+class Instrumented:
+    """
+    A proxy for a libvirt object that records the latency of its method calls.
+    """
+
+    __slots__ = ("_target", "_profiler", "_prefix")
+
+    def __init__(self, target, profiler: Profiler):
+        """
+        Initializes the Instrumented class.
+
+        Args:
+            target (object): The libvirt object (virConnect, virDomain, ...).
+            profiler (Profiler): The profiler the calls are recorded in.
+        """
+        self._target = target
+        self._profiler = profiler
+        self._prefix = type(target).__name__
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        # private attributes (e.g. _o, which libvirt reads from the objects
+        # passed to it) and plain values are handed out as they are
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        profiler, event = self._profiler, f"{self._prefix}.{name}"
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _wrap(attribute(*args, **kwargs), profiler)
+            finally:
+                profiler.record(event, "rpc", start, time.perf_counter())
+        return call
+
+    def __eq__(self, other):
+        return self._target == (other._target if isinstance(other, Instrumented) else other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def __repr__(self):
+        return f"Instrumented({self._target!r})"
+
+
+def instrument(connection, profiler: Profiler):
+    """
+    Wraps a libvirt connection so its calls, and those of the objects it returns, are recorded.
+
+    Args:
+        connection (libvirt.virConnect): The connection.
+        profiler (Profiler): The profiler the calls are recorded in.
+
+    Returns:
+        Instrumented: The wrapped connection.
+    """
+    return Instrumented(connection, profiler)
+
+
+def _wrap(value, profiler: Profiler):
+    """
+    Wraps the libvirt objects in a return value, including those in lists and tuples
+    (listAllDomains returns a list of domains, getAllDomainStats a list of (domain, stats) tuples).
+
+    Args:
+        value (object): The value returned by a libvirt call.
+        profiler (Profiler): The profiler the calls are recorded in.
+
+    Returns:
+        object: The value, with its libvirt objects wrapped.
+    """
+    if isinstance(value, list):
+        return [_wrap(item, profiler) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_wrap(item, profiler) for item in value)
+    if type(value).__module__ == "libvirt" and type(value).__name__.startswith("vir"):
+        return Instrumented(value, profiler)
+    return value
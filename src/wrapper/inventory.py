@@ -0,0 +1,231 @@
+"""
+This module keeps vmctl's local inventory (utils.inventory) in step with a libvirt host.
+
+A refresh is incremental: one getAllDomainStats call returns the UUID, name, state, vCPU's and memory of every
+domain, which is compared with what is stored. Only domains that are new, whose name, vCPU's or memory changed, or
+whose XML could not be read last time, have their XML read again for their disks and metadata tags, and domains
+that are gone are removed. In the daemon,
+lifecycle events also update the stored states as they happen (see InventoryApi.follow).
+"""
+import time
+import xml.etree.ElementTree as ET
+from rich import print
+from libvirt import (
+    libvirtError,
+    VIR_DOMAIN_EVENT_UNDEFINED,
+    VIR_DOMAIN_STATS_STATE,
+    VIR_DOMAIN_STATS_BALLOON,
+    VIR_DOMAIN_STATS_VCPU,
+)
+from utils.errors import LibvirtError
+from utils.inventory import Inventory, format_age
+from utils.pool import run_parallel
+from utils.qos import QOS_NAMESPACE
+from utils.table import create_table
+from wrapper.events import DomainEventFeed, EVENT_STATES
+from wrapper.vm import APPLY_NAMESPACE, VMApi
+
+INVENTORY_STATS = VIR_DOMAIN_STATS_STATE | VIR_DOMAIN_STATS_BALLOON | VIR_DOMAIN_STATS_VCPU
+
+class InventoryApi:
+    """
+    A class for refreshing the local inventory of a host.
+    """
+
+    def __init__(self, connection, uri: str, inventory: Inventory = None):
+        """
+        Initializes the InventoryApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+            uri (str): The libvirt URI of the host, its key in the inventory.
+            inventory (Inventory, optional): The inventory. Defaults to None, which opens the configured one on first use.
+        """
+        self.connection = connection
+        self.uri = uri
+        self.inventory = inventory
+
+    def follow(self, feed: DomainEventFeed):
+        """
+        Keeps the stored states current with the lifecycle events of the connection.
+
+        Only the daemon follows events, so other commands never create or write the inventory as a side effect.
+
+        Args:
+            feed (DomainEventFeed): The event feed of the connection.
+        """
+        feed.subscribe(self._on_lifecycle_event)
+
+    def refresh(self, full: bool = False, parallelism: int = 8):
+        """
+        Brings the host's entry in the inventory up to date.
+
+        Args:
+            full (bool, optional): Read the XML of every domain, not only of new or changed ones, e.g. to pick up
+                                   changed metadata tags. Defaults to False.
+            parallelism (int, optional): The maximum number of domain XMLs read at the same time. Defaults to 8.
+
+        Raises:
+            LibvirtError: If the domains cannot be listed.
+
+        Returns:
+            dict: The "uri", "host", "vms", "read" (XMLs read), "removed" and "seconds" of the refresh, and the
+                  "errors" of the XMLs that could not be read, keyed by VM name.
+        """
+        start = time.perf_counter()
+        try:
+            hostname = self.connection.getHostname()
+            domain_stats = self.connection.getAllDomainStats(INVENTORY_STATS)
+        except libvirtError as e:
+            raise LibvirtError(f"Error listing VMs: {e}")
+
+        inventory = self._get_inventory()
+        stored = inventory.get_vm_rows(self.uri)
+        vms, changed = [], []
+        for domain, stats in domain_stats:
+            vm = {
+                "uuid": domain.UUIDString(),
+                "name": domain.name(),
+                "state": VMApi._mapVmStateToString(stats.get("state.state")),
+                "vcpus": stats.get("vcpu.maximum", stats.get("vcpu.current")),
+                "memory": stats.get("balloon.maximum", 0) // 1024,
+            }
+            old = stored.get(vm["uuid"])
+            if (full or old is None or not old["read"]
+                    or (old["name"], old["vcpus"], old["memory"]) != (vm["name"], vm["vcpus"], vm["memory"])):
+                changed.append((domain, vm))
+            vms.append(vm)
+
+        # the xml is only read for the domains that need it, a few at a time
+        errors = {}
+        for (domain, vm), details, error in run_parallel(lambda item: self._read_details(item[0]), changed, parallelism):
+            if error is None:
+                vm.update(details)
+            else:
+                # stored as unread, so the next refresh tries again rather than keeping stale or empty details
+                vm.update(disks=None, tags=None)
+                errors[vm["name"]] = f"Error reading the XML: {error}"
+
+        seen = {vm["uuid"] for vm in vms}
+        removed = [uuid for uuid in stored if uuid not in seen]
+        inventory.update_host(self.uri, hostname, vms, removed)
+        return {
+            "uri": self.uri,
+            "host": hostname,
+            "vms": len(vms),
+            "read": len(changed),
+            "removed": len(removed),
+            "seconds": round(time.perf_counter() - start, 3),
+            "errors": errors,
+        }
+
+    def _get_inventory(self):
+        """
+        Gets the inventory, opening it on first use.
+
+        Returns:
+            Inventory: The inventory.
+        """
+        if self.inventory is None:
+            self.inventory = Inventory()
+        return self.inventory
+
+    def _read_details(self, domain):
+        """
+        Reads the disks and metadata tags of a domain from its XML.
+
+        Args:
+            domain (libvirt.virDomain): The domain.
+
+        Raises:
+            libvirt.libvirtError: If the XML cannot be read.
+
+        Returns:
+            dict: The "disks" (the "target" and "source" of each disk) and "tags" of the domain.
+        """
+        root = ET.fromstring(domain.XMLDesc(0))
+        disks = []
+        for disk in root.findall("devices/disk"):
+            target, source = disk.find("target"), disk.find("source")
+            disks.append({
+                "target": None if target is None else target.get("dev"),
+                "source": None if source is None else (source.get("file") or source.get("dev") or source.get("volume") or source.get("name")),
+            })
+        return {"disks": disks, "tags": self._read_tags(root.find("metadata"))}
+
+    @staticmethod
+    def _read_tags(metadata):
+        """
+        Reads the tags of a domain from its `<metadata>` element.
+
+        Every attribute and every element with text inside it becomes a tag named after it (without namespace), so
+        `<app:info xmlns:app="..." owner="alice"><team>db</team></app:info>` gives owner=alice and team=db.
+        The specs stored by `vmctl apply` and the profiles recorded by `vmctl qos apply` are skipped.
+
+        Args:
+            metadata (xml.etree.ElementTree.Element): The `<metadata>` element, or None.
+
+        Returns:
+            dict: The tags.
+        """
+        tags = {}
+        if metadata is None:
+            return tags
+        for element in metadata:
+            if element.tag in (f"{{{APPLY_NAMESPACE}}}spec", f"{{{QOS_NAMESPACE}}}qos"):
+                continue
+            for node in element.iter():
+                for key, value in node.attrib.items():
+                    tags[key.rpartition("}")[2]] = value
+                if len(node) == 0 and node.text and node.text.strip():
+                    tags[node.tag.rpartition("}")[2]] = node.text.strip()
+        return tags
+
+    def _on_lifecycle_event(self, domain, event, detail):
+        try:
+            if event == VIR_DOMAIN_EVENT_UNDEFINED:
+                self._get_inventory().remove_vm(self.uri, domain.UUIDString())
+            elif EVENT_STATES.get(event) is not None:
+                self._get_inventory().set_state(self.uri, domain.UUIDString(), VMApi._mapVmStateToString(EVENT_STATES[event]))
+        except Exception:
+            # new and redefined domains are picked up by the next refresh,
+            # and a failed write must never break the event thread
+            pass
+
+
+def list_cached_vms(vms, title: str):
+    """
+    Displays VMs from the inventory in a table, with the age of each host's entry.
+
+    Args:
+        vms (list): The VMs, as returned by Inventory.get_vms.
+        title (str): The title of the table.
+    """
+    if not vms:
+        print("[bold bright_yellow]No VMs found[/bold bright_yellow]")
+        return
+
+    columns = [
+        {"header": "Host", "style": "bold magenta"},
+        {"header": "VM name", "style": "bold bright_cyan"},
+        {"header": "VM state"},
+        {"header": "vCPU's"},
+        {"header": "Memory (MiB)"},
+        {"header": "Disks"},
+        {"header": "Tags"},
+        {"header": "Age"},
+    ]
+    rows = []
+    for vm in vms:
+        color = VMApi._mapStateToColor(vm["state"])
+        rows.append([
+            vm["host"],
+            vm["name"],
+            f"[{color}]{vm['state']}[/{color}]",
+            str(vm["vcpus"]),
+            str(vm["memory"]),
+            ", ".join(disk["target"] or "?" for disk in vm["disks"]),
+            ", ".join(f"{key}={value}" for key, value in sorted(vm["tags"].items())),
+            format_age(vm["age"]),
+        ])
+    create_table(title, columns, rows)
@@ -4,22 +4,68 @@ This module provides a wrapper around the libvirt API, making it easier to use.
 import libvirt
 from wrapper.host import HostApi
 from wrapper.vm import VMApi
+from wrapper.metrics import MetricsApi
+from wrapper.clone import CloneApi
+from wrapper.capacity import CapacityApi
+from wrapper.snapshot import SnapshotApi
+from wrapper.migrate import MigrationApi
+from wrapper.inventory import InventoryApi
+from wrapper.memory import MemoryApi
+from wrapper.qos import QosApi
+from wrapper.agent import GuestAgentApi
+from wrapper.events import DomainEventFeed, DomainStateCache, start_event_loop
+from wrapper.instrument import instrument
+from wrapper.resilient import ResilientConnection
 from utils.errors import LibvirtError
+from utils.profiling import get_profiler, phase
 import sys
 
 class LibVirtApi:
     """
     A wrapper class for the libvirt API.
     """
-    def __init__(self):
+    def __init__(self, uri: str = 'qemu:///system', events: bool = False, max_staleness: float = 30.0, retry=None):
         """
         Initializes the LibVirtApi class.
+
+        Args:
+            uri (str, optional): The URI to connect to. Defaults to 'qemu:///system'.
+            events (bool, optional): Receive domain lifecycle events and keep a domain state cache with them.
+                                     Meant for long running processes. Defaults to False.
+            max_staleness (float, optional): The maximum age in seconds of a cached domain state. Defaults to 30.0.
+            retry (dict, optional): The reconnect and retry settings (see wrapper.resilient). Defaults to None,
+                                    which reads them from the configuration file.
         """
-        self.connection = self._connect()
-        if self.connection is None:
-            raise LibvirtError("Failed to establish connection to libvirt.")
+        self.uri = uri
+        if events:
+            # the event loop has to exist before the connection is opened
+            start_event_loop()
+        # the connection is reopened if it is lost, e.g. when libvirtd restarts
+        with phase("connect"):
+            try:
+                self.connection = ResilientConnection(uri, self._connect, retry)
+            except libvirt.libvirtError as e:
+                raise LibvirtError(f"Error connecting to libvirt: {e}")
+
+        self.event_feed = None
+        self.state_cache = None
+        if events:
+            self.event_feed = DomainEventFeed(self.connection)
+            self.state_cache = DomainStateCache(self.connection, self.event_feed, max_staleness)
+            self.state_cache.populate()
+
         self.host_api = HostApi(self.connection)
-        self.vm_api = VMApi(self.connection)
+        self.capacity_api = CapacityApi(self.connection)
+        self.vm_api = VMApi(self.connection, self.state_cache, self.event_feed, self.capacity_api)
+        self.metrics_api = MetricsApi(self.connection)
+        self.clone_api = CloneApi(self.connection, self.capacity_api)
+        self.snapshot_api = SnapshotApi(self.connection)
+        self.migration_api = MigrationApi(self.connection)
+        self.memory_api = MemoryApi(self.connection)
+        self.qos_api = QosApi(self.connection)
+        self.agent_api = GuestAgentApi(self.connection)
+        self.inventory_api = InventoryApi(self.connection, uri)
+        self.connection.add_reconnect_listener(self._on_reconnect)
 
 
     def _connect(self, uri: str = 'qemu:///system'):
@@ -29,22 +75,39 @@ class LibVirtApi:
         Args:
             uri (str, optional): The URI to connect to. Defaults to 'qemu:///system'.
 
+        Raises:
+            libvirt.libvirtError: If the connection cannot be opened.
+
         Returns:
             libvirt.virConnect: The connection object.
         """
+        conn = libvirt.open(uri)
+        # without profiling the connection is used as it is, so it costs nothing
+        profiler = get_profiler()
+        return instrument(conn, profiler) if profiler is not None else conn
+
+    def _on_reconnect(self):
+        """
+        Brings what depends on the connection up to date after it was reopened.
+        """
+        self.capacity_api.invalidate()
         try:
-            conn = libvirt.open(uri)
-            if conn is None:
-                raise LibvirtError('Failed to open connection to local qemu.')
-            return conn
-        except libvirt.libvirtError as e:
-            raise LibvirtError(f"Error connecting to libvirt: {e}")
+            # the events registered on the old connection are gone, and so are those missed in between
+            if self.event_feed:
+                self.event_feed.register()
+            if self.state_cache:
+                self.state_cache.populate()
+        except LibvirtError:
+            # reconnect again on the next call, and try again
+            self.connection.closed = True
 
     def close(self):
         """
         Closes the connection to the libvirt daemon.
         """
         try:
+            if self.event_feed:
+                self.event_feed.close()
             if self.connection:
                 self.connection.close()
         except libvirt.libvirtError as e:
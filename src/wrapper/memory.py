@@ -0,0 +1,318 @@
+"""
+This module manages the memory of running VMs: their balloon stats and targets, the host's kernel samepage
+merging (KSM) and an auto-balancer that moves memory between VMs (see utils.balancer).
+
+The guest stats (available, usable, swap in, ...) come from the balloon driver, which only reports them once
+a stats period is set. `balance` sets one for the VMs that report none.
+"""
+import json
+import time
+from rich import print
+from libvirt import (
+    libvirtError,
+    VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE,
+    VIR_DOMAIN_AFFECT_CONFIG,
+    VIR_DOMAIN_AFFECT_LIVE,
+    VIR_DOMAIN_RUNNING,
+    VIR_DOMAIN_STATS_BALLOON,
+)
+from utils.balancer import BalloonBalancer, format_change
+from utils.errors import VmctlError, LibvirtError
+from utils.pool import run_parallel
+from utils.table import create_table
+
+# the columns of `vmctl mem stats`, the balloon stats in KiB shown in MiB
+MEMORY_KEYS = ["current", "maximum", "available", "usable", "unused", "rss", "swap_in", "swap_out"]
+MEMORY_HEADERS = ["Balloon", "Maximum", "Available", "Usable", "Unused", "RSS", "Swap in", "Swap out"]
+
+# the node memory parameters of KSM and their column headers
+# reference: https://libvirt.org/html/libvirt-libvirt-host.html#VIR_NODE_MEMORY_SHARED_FULL_SCANS
+KSM_KEYS = ["shm_pages_to_scan", "shm_sleep_millisecs", "shm_merge_across_nodes", "shm_pages_shared",
+            "shm_pages_sharing", "shm_pages_unshared", "shm_pages_volatile", "shm_full_scans"]
+KSM_HEADERS = ["Pages to scan", "Sleep (ms)", "Merge across nodes", "Pages shared", "Pages sharing",
+               "Pages unshared", "Pages volatile", "Full scans"]
+
+KSM_PAGE_SIZE = 4096
+
+class MemoryApi:
+    """
+    A class for reading and setting the memory of running VMs and balancing it between them.
+    """
+
+    STATUS_COLORS = {"done": "green", "failed": "red"}
+
+    def __init__(self, connection):
+        """
+        Initializes the MemoryApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+        """
+        self.connection = connection
+
+    def get_memory_stats(self, vm_names=None):
+        """
+        Gets the balloon stats of running VMs with one bulk call.
+
+        Args:
+            vm_names (list, optional): The names of the virtual machines. Defaults to None, every running VM.
+
+        Raises:
+            LibvirtError: If the stats cannot be read.
+
+        Returns:
+            list: A list of dictionaries with the "name" and the MEMORY_KEYS of each VM in MiB (None for the stats
+                  the guest does not report), and its "major_fault" and "minor_fault" counts.
+        """
+        records = []
+        for name, sample in self._read_samples(vm_names).items():
+            record = {"name": name}
+            for key in MEMORY_KEYS:
+                record[key] = None if sample.get(key) is None else sample[key] // 1024
+            record["major_fault"] = sample.get("major_fault")
+            record["minor_fault"] = sample.get("minor_fault")
+            records.append(record)
+        return records
+
+    def memory_stats(self, vm_names=None):
+        """
+        Displays the balloon stats of running VMs in a table.
+
+        Args:
+            vm_names (list, optional): The names of the virtual machines. Defaults to None, every running VM.
+        """
+        records = self.get_memory_stats(vm_names)
+        if not records:
+            print("[bold bright_yellow]No running VMs found[/bold bright_yellow]")
+            return
+
+        columns = [{"header": "VM name", "style": "bold bright_cyan"}] + [{"header": header} for header in MEMORY_HEADERS]
+        rows = [[record["name"]] + ["--" if record[key] is None else str(record[key]) for key in MEMORY_KEYS] for record in records]
+        create_table("Memory of running VMs (MiB)", columns, rows)
+        if any(record["available"] is None for record in records):
+            print("[bright_yellow]VMs without guest stats need a stats period, which `vmctl mem balance` sets.[/bright_yellow]")
+
+    def set_memory(self, vm_names, memory: int, config: bool = False, parallelism: int = 8):
+        """
+        Sets the balloon target of several VMs concurrently.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            memory (int): The balloon target in MiB, at most the VMs' maximum memory.
+            config (bool, optional): Also keep the target when the VMs are restarted. Defaults to False.
+            parallelism (int, optional): The maximum number of VMs acted on at the same time. Defaults to 8.
+
+        Raises:
+            VmctlError: If the memory is not positive.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (done or failed) and "message" of each VM.
+        """
+        if memory <= 0:
+            raise VmctlError("The memory must be a positive number of MiB.")
+
+        def set_one(vm_name):
+            domain = self.connection.lookupByName(vm_name)
+            # a shut off vm has no balloon, only its configuration can change
+            running = domain.state()[0] == VIR_DOMAIN_RUNNING
+            if not running and not config:
+                raise VmctlError(f"VM '{vm_name}' is not running. Use --config to change its configuration.")
+            flags = (VIR_DOMAIN_AFFECT_LIVE if running else 0) | (VIR_DOMAIN_AFFECT_CONFIG if config else 0)
+            domain.setMemoryFlags(memory * 1024, flags)
+
+        results = []
+        for vm_name, _, error in run_parallel(set_one, vm_names, parallelism):
+            if error is None:
+                results.append({"name": vm_name, "status": "done", "message": f"Balloon target set to {memory} MiB."})
+            else:
+                message = error.message if isinstance(error, VmctlError) else f"Error setting the memory of VM '{vm_name}': {error}"
+                results.append({"name": vm_name, "status": "failed", "message": message})
+        return results
+
+    def print_memory_results(self, results):
+        """
+        Displays the results of set_memory in a table.
+
+        Args:
+            results (list): The results returned by set_memory.
+        """
+        columns = [{"header": "VM name", "style": "bold bright_cyan"}, {"header": "Status"}, {"header": "Message"}]
+        rows = []
+        for result in results:
+            color = self.STATUS_COLORS[result["status"]]
+            rows.append([result["name"], f"[{color}]{result['status']}[/{color}]", result["message"]])
+        failed = sum(1 for result in results if result["status"] == "failed")
+        create_table(f"Set the memory of {len(results)} VMs ({failed} failed)", columns, rows)
+
+    def get_ksm(self):
+        """
+        Gets the host's kernel samepage merging parameters and counters.
+
+        Raises:
+            LibvirtError: If they cannot be read, e.g. the host has no KSM.
+
+        Returns:
+            dict: The KSM_KEYS that the host reports, and "saved" (the MiB saved by sharing pages).
+        """
+        try:
+            parameters = self.connection.getMemoryParameters(0)
+        except libvirtError as e:
+            raise LibvirtError(f"Error reading the KSM parameters: {e}")
+        ksm = {key: parameters.get(key) for key in KSM_KEYS}
+        ksm["saved"] = (ksm["shm_pages_sharing"] or 0) * KSM_PAGE_SIZE // (1024 * 1024)
+        return ksm
+
+    def set_ksm(self, pages_to_scan: int = None, sleep_millisecs: int = None, merge_across_nodes: bool = None):
+        """
+        Tunes the host's kernel samepage merging. Only the parameters given are changed.
+
+        Args:
+            pages_to_scan (int, optional): The pages to scan before KSM sleeps. Defaults to None.
+            sleep_millisecs (int, optional): The time KSM sleeps between scans in milliseconds. Defaults to None.
+            merge_across_nodes (bool, optional): Merge pages of different NUMA nodes. Defaults to None.
+
+        Raises:
+            LibvirtError: If the parameters cannot be set.
+        """
+        parameters = {"shm_pages_to_scan": pages_to_scan, "shm_sleep_millisecs": sleep_millisecs,
+                      "shm_merge_across_nodes": None if merge_across_nodes is None else int(merge_across_nodes)}
+        parameters = {key: value for key, value in parameters.items() if value is not None}
+        if not parameters:
+            return
+        try:
+            self.connection.setMemoryParameters(parameters, 0)
+        except libvirtError as e:
+            raise LibvirtError(f"Error setting the KSM parameters: {e}")
+
+    def ksm(self):
+        """
+        Displays the host's kernel samepage merging parameters and counters in a table.
+        """
+        ksm = self.get_ksm()
+        columns = [{"header": header} for header in KSM_HEADERS] + [{"header": "Saved (MiB)", "style": "bold green"}]
+        row = ["--" if ksm[key] is None else str(ksm[key]) for key in KSM_KEYS] + [str(ksm["saved"])]
+        create_table("Kernel samepage merging", columns, [row])
+
+    def balance(self, interval: float = 10.0, count: int = None, dry_run: bool = False, record: str = None,
+                settings=None, on_tick=None):
+        """
+        Runs the auto-balancer: every interval, reads the balloon stats of the running VMs and the host's free memory
+        with two calls, and sets the balloon targets the balancer decides on.
+
+        Args:
+            interval (float, optional): The seconds between ticks. Defaults to 10.0.
+            count (int, optional): The number of ticks. Defaults to None, which runs until interrupted (ctrl+c).
+            dry_run (bool, optional): Only show what would change. Defaults to False.
+            record (str, optional): Append every tick's stats to this file, for `vmctl mem balance --replay`.
+                                    Defaults to None.
+            settings (dict, optional): The balancer settings. Defaults to None, which reads them from the configuration file.
+            on_tick (callable, optional): Called with the time and the changes of every tick. Defaults to None,
+                                          which prints the changes.
+
+        Returns:
+            list: The changes of every tick, as returned by BalloonBalancer.decide, with the "time" and "status".
+        """
+        balancer = BalloonBalancer(settings)
+        on_tick = on_tick or self._print_changes
+        self._enable_stats(interval)
+
+        history = []
+        tick = 0
+        record_file = open(record, "a") if record else None
+        try:
+            while count is None or tick < count:
+                if tick:
+                    time.sleep(interval)
+                tick += 1
+                now = time.time()
+                samples = self._read_samples()
+                try:
+                    host_free = self.connection.getFreeMemory() // 1024
+                except libvirtError as e:
+                    raise LibvirtError(f"Error reading the free memory of the host: {e}")
+                if record_file:
+                    record_file.write(json.dumps({"time": now, "host_free": host_free, "samples": samples}) + "\n")
+                    record_file.flush()
+
+                changes = balancer.decide(samples, host_free)
+                for change in changes:
+                    change.update(time=now, status="dry run" if dry_run else self._apply_change(change))
+                history.extend(changes)
+                on_tick(now, changes)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if record_file:
+                record_file.close()
+        return history
+
+    def _apply_change(self, change):
+        """
+        Sets the balloon target of a change.
+
+        Returns:
+            str: "done", or "failed: <error>".
+        """
+        try:
+            self.connection.lookupByName(change["name"]).setMemoryFlags(change["target"], VIR_DOMAIN_AFFECT_LIVE)
+            return "done"
+        except libvirtError as e:
+            return f"failed: {e}"
+
+    @staticmethod
+    def _print_changes(now: float, changes):
+        """
+        Prints the changes of a balancer tick.
+
+        Args:
+            now (float): The time of the tick.
+            changes (list): The changes.
+        """
+        for change in changes:
+            print(format_change(dict(change, time=now)))
+
+    def _read_samples(self, vm_names=None):
+        """
+        Reads the balloon stats of running VMs with one bulk call.
+
+        Args:
+            vm_names (list, optional): The names of the virtual machines. Defaults to None, every running VM.
+
+        Raises:
+            LibvirtError: If the stats cannot be read.
+
+        Returns:
+            dict: The balloon stats of each VM in KiB (SAMPLE_KEYS and the other balloon stats), keyed by VM name.
+        """
+        # reference: https://libvirt.org/html/libvirt-libvirt-domain.html#virConnectGetAllDomainStats
+        try:
+            if vm_names:
+                domains = [self.connection.lookupByName(vm_name) for vm_name in vm_names]
+                domain_stats = self.connection.domainListGetStats(domains, VIR_DOMAIN_STATS_BALLOON)
+            else:
+                domain_stats = self.connection.getAllDomainStats(VIR_DOMAIN_STATS_BALLOON, VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        except libvirtError as e:
+            raise LibvirtError(f"Error reading the memory stats: {e}")
+
+        samples = {}
+        for domain, stats in domain_stats:
+            samples[domain.name()] = {key[len("balloon."):]: value for key, value in stats.items()
+                                      if key.startswith("balloon.") and key != "balloon.last-update"}
+        return samples
+
+    def _enable_stats(self, interval: float):
+        """
+        Sets a balloon stats period for the running VMs whose guests report no stats.
+
+        Args:
+            interval (float): The balancer's interval in seconds, which the period follows.
+        """
+        missing = [name for name, sample in self._read_samples().items() if any(key not in sample for key in ("available", "usable"))]
+        period = max(1, int(interval))
+
+        def enable(vm_name):
+            self.connection.lookupByName(vm_name).setMemoryStatsPeriod(period, VIR_DOMAIN_AFFECT_LIVE)
+
+        for vm_name, _, error in run_parallel(enable, missing):
+            if error is not None:
+                print(f"[bright_yellow]VM {vm_name} reports no guest memory stats: {error}[/bright_yellow]")
@@ -0,0 +1,285 @@
+"""
+This module provides a collector that samples the resource usage of every VM and computes per-interval rates.
+"""
+import time
+from rich import get_console, print
+from rich.live import Live
+from rich.table import Table
+from libvirt import (
+    libvirtError,
+    VIR_DOMAIN_STATS_STATE,
+    VIR_DOMAIN_STATS_CPU_TOTAL,
+    VIR_DOMAIN_STATS_BALLOON,
+    VIR_DOMAIN_STATS_VCPU,
+    VIR_DOMAIN_STATS_INTERFACE,
+    VIR_DOMAIN_STATS_BLOCK,
+)
+from utils.errors import VmctlError, LibvirtError
+from utils.ringbuffer import RingBuffer
+from wrapper.vm import VMApi
+
+# every stats group a sample needs, fetched for all domains in one call
+# reference: https://libvirt.org/html/libvirt-libvirt-domain.html#virConnectGetAllDomainStats
+SAMPLE_STATS = (VIR_DOMAIN_STATS_STATE | VIR_DOMAIN_STATS_CPU_TOTAL | VIR_DOMAIN_STATS_BALLOON |
+                VIR_DOMAIN_STATS_VCPU | VIR_DOMAIN_STATS_INTERFACE | VIR_DOMAIN_STATS_BLOCK)
+
+# the values stored for each sample, in order. everything but time,
+# vcpus and memory is a cumulative counter that rates are computed from
+SAMPLE_FIELDS = ["time", "cpu_time", "vcpus", "memory", "rd_reqs", "wr_reqs", "rd_bytes", "wr_bytes", "rx_bytes", "tx_bytes"]
+FIELD = {name: index for index, name in enumerate(SAMPLE_FIELDS)}
+
+# the columns `vmctl top` can be sorted by
+SORT_KEYS = ["name", "state", "cpu", "memory", "iops", "disk_read", "disk_write", "net_rx", "net_tx"]
+
+def collect_domain_stats(connection, stats: int = SAMPLE_STATS):
+    """
+    Gets the stats of every domain with a single getAllDomainStats call.
+
+    Args:
+        connection (libvirt.virConnect): The connection object.
+        stats (int, optional): The stats groups to fetch. Defaults to everything a sample needs.
+
+    Returns:
+        list: A list of (domain, stats dictionary) tuples.
+    """
+    try:
+        return connection.getAllDomainStats(stats)
+    except libvirtError as e:
+        raise LibvirtError(f"Error getting VM stats: {e}")
+
+
+def sample_from_stats(timestamp: float, stats):
+    """
+    Turns the stats of a domain into a sample with the values in SAMPLE_FIELDS.
+
+    Args:
+        timestamp (float): The time the stats were fetched at (time.monotonic()).
+        stats (dict): The stats returned by getAllDomainStats for the domain.
+
+    Returns:
+        list: The sample.
+    """
+    def device_total(prefix, count_key, suffix):
+        return sum(stats.get(f"{prefix}.{index}.{suffix}", 0) for index in range(stats.get(count_key, 0)))
+
+    return [
+        timestamp,
+        stats.get("cpu.time", 0),
+        stats.get("vcpu.current", 0),
+        # the resident set size is what the vm really uses on the host,
+        # the balloon size is the best we have when it is not reported
+        stats.get("balloon.rss", stats.get("balloon.current", 0)),
+        device_total("block", "block.count", "rd.reqs"),
+        device_total("block", "block.count", "wr.reqs"),
+        device_total("block", "block.count", "rd.bytes"),
+        device_total("block", "block.count", "wr.bytes"),
+        device_total("net", "net.count", "rx.bytes"),
+        device_total("net", "net.count", "tx.bytes"),
+    ]
+
+
+class MetricsCollector:
+    """
+    Samples the resource usage of every VM and keeps a bounded history of samples per VM.
+    """
+
+    def __init__(self, connection, history: int = 60):
+        """
+        Initializes the MetricsCollector class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+            history (int, optional): The number of samples kept per VM. Defaults to 60.
+        """
+        if history < 2:
+            raise VmctlError("At least 2 samples of history are needed to compute rates.")
+        self.connection = connection
+        self.history = history
+        # vm name -> RingBuffer of samples
+        self.samples = {}
+        self.states = {}
+
+    def sample(self):
+        """
+        Takes a sample of every VM with one bulk stats call.
+        """
+        domain_stats = collect_domain_stats(self.connection)
+        now = time.monotonic()
+
+        seen = set()
+        for domain, stats in domain_stats:
+            vm_name = domain.name()
+            seen.add(vm_name)
+            self.states[vm_name] = VMApi._mapVmStateToString(stats.get("state.state"))
+            if vm_name not in self.samples:
+                self.samples[vm_name] = RingBuffer(self.history, len(SAMPLE_FIELDS))
+            self.samples[vm_name].append(sample_from_stats(now, stats))
+
+        # forget vms that were undefined, so their history does not pile up
+        for vm_name in list(self.samples):
+            if vm_name not in seen:
+                del self.samples[vm_name]
+                del self.states[vm_name]
+
+    def rates(self):
+        """
+        Computes the usage of every VM over the last sampling interval.
+
+        Returns:
+            list: A list of dictionaries with the "name", "state", "vcpus", "memory" (KiB), "cpu" (% of one host CPU),
+                  "iops", "disk_read", "disk_write", "net_rx" and "net_tx" (bytes/s) of each VM.
+                  Rates are None until a VM has been sampled twice.
+        """
+        rates = []
+        for vm_name, buffer in self.samples.items():
+            newest = buffer.get(-1)
+            rate = {
+                "name": vm_name,
+                "state": self.states[vm_name],
+                "vcpus": int(newest[FIELD["vcpus"]]),
+                "memory": int(newest[FIELD["memory"]]),
+                "cpu": None, "iops": None, "disk_read": None, "disk_write": None, "net_rx": None, "net_tx": None,
+            }
+            if len(buffer) >= 2:
+                previous = buffer.get(-2)
+                elapsed = newest[FIELD["time"]] - previous[FIELD["time"]]
+
+                def per_second(*fields):
+                    # counters go back to zero when a vm is restarted
+                    delta = sum(newest[FIELD[field]] - previous[FIELD[field]] for field in fields)
+                    return max(delta, 0) / elapsed if elapsed > 0 else 0.0
+
+                rate.update({
+                    "cpu": per_second("cpu_time") / 1e9 * 100,
+                    "iops": per_second("rd_reqs", "wr_reqs"),
+                    "disk_read": per_second("rd_bytes"),
+                    "disk_write": per_second("wr_bytes"),
+                    "net_rx": per_second("rx_bytes"),
+                    "net_tx": per_second("tx_bytes"),
+                })
+            rates.append(rate)
+        return rates
+
+
+class MetricsApi:
+    """
+    A class for displaying the resource usage of virtual machines.
+    """
+
+    def __init__(self, connection):
+        """
+        Initializes the MetricsApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+        """
+        self.connection = connection
+
+    def top(self, interval: float = 2.0, sort_by: str = "cpu", history: int = 60):
+        """
+        Displays a live table of the resource usage of every VM, refreshed every interval, until interrupted.
+
+        Args:
+            interval (float, optional): The time between samples in seconds. Defaults to 2.0.
+            sort_by (str, optional): The column to sort by. Defaults to "cpu".
+            history (int, optional): The number of samples kept per VM. Defaults to 60.
+        """
+        self._check_sort_key(sort_by)
+        collector = MetricsCollector(self.connection, history)
+        collector.sample()
+        try:
+            with Live(self._build_table(collector.rates(), sort_by), console=get_console(), auto_refresh=False) as live:
+                while True:
+                    time.sleep(interval)
+                    collector.sample()
+                    live.update(self._build_table(collector.rates(), sort_by), refresh=True)
+        except KeyboardInterrupt:
+            pass
+
+    def stats(self, vm_names=None, interval: float = 1.0, count: int = 1, sort_by: str = "cpu"):
+        """
+        Displays the resource usage of VMs over one or more intervals.
+
+        Args:
+            vm_names (list, optional): Only show these VMs. Defaults to None, which shows every VM.
+            interval (float, optional): The time between samples in seconds. Defaults to 1.0.
+            count (int, optional): The number of intervals to report. Defaults to 1.
+            sort_by (str, optional): The column to sort by. Defaults to "cpu".
+        """
+        self._check_sort_key(sort_by)
+        collector = MetricsCollector(self.connection, 2)
+        collector.sample()
+        for _ in range(count):
+            time.sleep(interval)
+            collector.sample()
+            rates = [rate for rate in collector.rates() if not vm_names or rate["name"] in vm_names]
+            if not rates:
+                print("[bold bright_yellow]No VMs found[/bold bright_yellow]")
+                return
+            get_console().print(self._build_table(rates, sort_by))
+
+    def _build_table(self, rates, sort_by: str):
+        """
+        Builds the table of VM usage.
+
+        Args:
+            rates (list): The rates returned by MetricsCollector.rates.
+            sort_by (str): The column to sort by.
+
+        Returns:
+            rich.table.Table: The table.
+        """
+        # text columns sort alphabetically, numbers from the highest
+        if sort_by in ("name", "state"):
+            rates = sorted(rates, key=lambda rate: rate[sort_by])
+        else:
+            rates = sorted(rates, key=lambda rate: rate[sort_by] if rate[sort_by] is not None else -1, reverse=True)
+
+        table = Table(title=f"VM usage (sorted by {sort_by})")
+        table.add_column("VM name", style="bold bright_cyan")
+        table.add_column("VM state")
+        for header in ["vCPU's", "CPU %", "Memory", "IOPS", "Disk read/s", "Disk write/s", "Net rx/s", "Net tx/s"]:
+            table.add_column(header, justify="right")
+
+        for rate in rates:
+            color = VMApi._mapStateToColor(rate["state"])
+            table.add_row(
+                rate["name"],
+                f"[{color}]{rate['state']}[/{color}]",
+                str(rate["vcpus"]),
+                "--" if rate["cpu"] is None else f"{rate['cpu']:.1f}",
+                self._format_bytes(rate["memory"] * 1024),
+                "--" if rate["iops"] is None else f"{rate['iops']:.0f}",
+                *["--" if rate[key] is None else self._format_bytes(rate[key]) for key in ["disk_read", "disk_write", "net_rx", "net_tx"]],
+            )
+        return table
+
+    def _check_sort_key(self, sort_by: str):
+        """
+        Checks that a sort column exists.
+
+        Args:
+            sort_by (str): The column to sort by.
+
+        Raises:
+            VmctlError: If the column does not exist.
+        """
+        if sort_by not in SORT_KEYS:
+            raise VmctlError(f"Unsupported sort column '{sort_by}'. Use one of: {', '.join(SORT_KEYS)}.")
+
+    @staticmethod
+    def _format_bytes(size: float):
+        """
+        Formats a number of bytes with a binary unit.
+
+        Args:
+            size (float): The number of bytes.
+
+        Returns:
+            str: The formatted size, e.g. "1.5 MiB".
+        """
+        for unit in ["B", "KiB", "MiB", "GiB"]:
+            if abs(size) < 1024:
+                return f"{size:.1f} {unit}" if unit != "B" else f"{size:.0f} B"
+            size /= 1024
+        return f"{size:.1f} TiB"
@@ -0,0 +1,433 @@
+"""
+This module live migrates virtual machines to another host, with progress read from libvirt's job statistics.
+
+Migrations are peer-to-peer: the source libvirt daemon connects to the destination itself, vmctl only starts the
+migration and watches it. The defaults can be set in the "migration" section of the configuration file:
+
+    {
+        "migration": {
+            "max_concurrent": 2,
+            "bandwidth": 0
+        }
+    }
+
+"max_concurrent" is the number of migrations running at the same time, so a rebalance does not saturate the
+network, and "bandwidth" caps each migration in MiB/s (0 means no cap).
+"""
+import threading
+import time
+from rich import get_console
+from rich.live import Live
+from rich.table import Table
+from libvirt import (
+    libvirtError,
+    open as open_connection,
+    VIR_MIGRATE_LIVE,
+    VIR_MIGRATE_PEER2PEER,
+    VIR_MIGRATE_PERSIST_DEST,
+    VIR_MIGRATE_UNDEFINE_SOURCE,
+    VIR_MIGRATE_OFFLINE,
+    VIR_MIGRATE_AUTO_CONVERGE,
+    VIR_MIGRATE_POSTCOPY,
+    VIR_MIGRATE_PARAM_BANDWIDTH,
+)
+from utils.config import load_config
+from utils.errors import VmctlError, LibvirtError
+from utils.pool import run_parallel
+from utils.table import create_table
+from wrapper.capacity import CapacityApi
+from wrapper.metrics import MetricsApi
+
+DEFAULT_MIGRATION = {"max_concurrent": 2, "bandwidth": 0}
+
+# reference: https://libvirt.org/migration.html#peer-to-peer-migration
+MIGRATION_FLAGS = VIR_MIGRATE_PEER2PEER | VIR_MIGRATE_PERSIST_DEST | VIR_MIGRATE_UNDEFINE_SOURCE
+
+class MigrationApi:
+    """
+    A class for migrating virtual machines to another host.
+
+    It streams progress to a callback while migrations run, so it is used on a direct connection rather than
+    through the daemon.
+    """
+
+    STATUS_COLORS = {"queued": "dim", "migrating": "cyan", "postcopy": "magenta", "done": "green", "failed": "red"}
+
+    def __init__(self, connection):
+        """
+        Initializes the MigrationApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection to the source host.
+        """
+        self.connection = connection
+
+    def migrate(self, vm_names, dest_uri: str, max_concurrent: int = None, bandwidth: int = None, auto_converge: bool = False,
+                postcopy: bool = False, postcopy_after: float = None, force: bool = False, poll_interval: float = 0.5,
+                on_progress=None):
+        """
+        Migrates several VMs to another host, at most `max_concurrent` at the same time.
+
+        Before anything moves, every VM is checked against the destination: its name must be free there and it must
+        fit within the destination's capacity limits. Running VMs are migrated live, shut off VMs only move their
+        definition. A failure on one VM does not abort the others.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            dest_uri (str): The libvirt URI of the destination host, as seen from the source host.
+            max_concurrent (int, optional): The maximum number of migrations at the same time. Defaults to the configuration, or 2.
+            bandwidth (int, optional): The bandwidth cap of each migration in MiB/s, 0 for none. Defaults to the configuration, or 0.
+            auto_converge (bool, optional): Throttle the vCPUs of VMs that dirty memory faster than it is sent. Defaults to False.
+            postcopy (bool, optional): Switch to post-copy, so the VM runs on the destination while the rest of its
+                                       memory follows on demand. Defaults to False.
+            postcopy_after (float, optional): Switch to post-copy after this many seconds. Defaults to None, which switches
+                                              once the first pass over the memory is done.
+            force (bool, optional): Migrate VMs even if they exceed the destination's capacity. Defaults to False.
+            poll_interval (float, optional): The time between progress reads in seconds. Defaults to 0.5.
+            on_progress (callable, optional): Called with the progress of every VM (see MigrationProgress.get) after each read.
+                                              Defaults to None.
+
+        Raises:
+            VmctlError: If max_concurrent is less than 1.
+            LibvirtError: If the destination cannot be reached.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (done or failed), "seconds" and "message" of each VM.
+        """
+        settings = {**DEFAULT_MIGRATION, **load_config().get("migration", {})}
+        max_concurrent = settings["max_concurrent"] if max_concurrent is None else max_concurrent
+        bandwidth = settings["bandwidth"] if bandwidth is None else bandwidth
+        if max_concurrent < 1:
+            raise VmctlError("The number of concurrent migrations must be at least 1.")
+
+        # the progress belongs to this call, so calls sharing the api from several threads do not mix
+        progress = MigrationProgress(vm_names)
+        domains = self._preflight(progress, vm_names, dest_uri, force)
+
+        flags = MIGRATION_FLAGS
+        flags |= VIR_MIGRATE_AUTO_CONVERGE if auto_converge else 0
+        flags |= VIR_MIGRATE_POSTCOPY if postcopy else 0
+        params = {VIR_MIGRATE_PARAM_BANDWIDTH: bandwidth} if bandwidth else {}
+
+        # the migration calls block until they complete, the
+        # progress is read from another thread in the meantime
+        done = threading.Event()
+        poller = threading.Thread(target=self._poll, args=(progress, domains, done, poll_interval, postcopy, postcopy_after, on_progress),
+                                  name="vmctl-migrate-progress", daemon=True)
+        poller.start()
+        try:
+            outcomes = run_parallel(lambda vm_name: self._migrate_one(progress, domains[vm_name], dest_uri, params, flags),
+                                    list(domains), max_concurrent)
+        finally:
+            done.set()
+            poller.join()
+        # _migrate_one records libvirt errors itself, anything else would leave the vm migrating
+        for vm_name, _, error in outcomes:
+            if error is not None:
+                started_at = progress.started_at(vm_name)
+                progress.update(vm_name, status="failed", seconds=time.monotonic() - started_at if started_at else 0.0,
+                                message=f"Error migrating VM '{vm_name}': {error.message if isinstance(error, VmctlError) else error}")
+        if on_progress:
+            on_progress(progress.get())
+
+        return [{key: vm[key] for key in ("name", "status", "seconds", "message")} for vm in progress.get()]
+
+    def migrate_live(self, vm_names, dest_uri: str, **options):
+        """
+        Migrates several VMs like migrate, showing their progress in a live table, then the results.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            dest_uri (str): The libvirt URI of the destination host.
+            **options: The options of migrate.
+
+        Returns:
+            list: The results returned by migrate.
+        """
+        with Live(self._build_progress_table(dest_uri, MigrationProgress(vm_names).get()),
+                  console=get_console(), auto_refresh=False) as live:
+            results = self.migrate(vm_names, dest_uri, on_progress=lambda progress: live.update(self._build_progress_table(dest_uri, progress), refresh=True), **options)
+        self.print_migration_results(dest_uri, results)
+        return results
+
+    def print_migration_results(self, dest_uri: str, results):
+        """
+        Displays the results of migrating VMs in a table.
+
+        Args:
+            dest_uri (str): The libvirt URI of the destination host.
+            results (list): The results returned by migrate.
+        """
+        columns = [
+            {"header": "VM name", "style": "bold bright_cyan"},
+            {"header": "Status"},
+            {"header": "Time (s)"},
+            {"header": "Message"},
+        ]
+        rows = []
+        for result in results:
+            color = self.STATUS_COLORS[result["status"]]
+            rows.append([result["name"], f"[{color}]{result['status']}[/{color}]", f"{result['seconds']:.1f}", result["message"]])
+
+        failed = sum(1 for result in results if result["status"] == "failed")
+        create_table(f"Migrate {len(results)} VMs to {dest_uri} ({failed} failed)", columns, rows)
+
+    def _preflight(self, progress, vm_names, dest_uri: str, force: bool):
+        """
+        Looks up the VMs and checks that each of them can move to the destination, marking the others as failed.
+
+        Args:
+            progress (MigrationProgress): The progress of the migrations.
+            vm_names (list): The names of the virtual machines.
+            dest_uri (str): The libvirt URI of the destination host.
+            force (bool): Let VMs exceed the destination's capacity.
+
+        Raises:
+            LibvirtError: If the destination cannot be reached.
+
+        Returns:
+            dict: The domains (libvirt.virDomain) that passed, keyed by VM name.
+        """
+        try:
+            dest_connection = open_connection(dest_uri)
+        except libvirtError as e:
+            raise LibvirtError(f"Error connecting to the destination '{dest_uri}': {e}")
+
+        dest_capacity = CapacityApi(dest_connection)
+        domains = {}
+        try:
+            for vm_name in vm_names:
+                try:
+                    domain = self.connection.lookupByName(vm_name)
+                    _, max_memory, _, vcpus, _ = domain.info()
+                    try:
+                        dest_connection.lookupByName(vm_name)
+                        raise VmctlError(f"A VM named '{vm_name}' already exists on the destination.")
+                    except libvirtError:
+                        pass
+                    warning = dest_capacity.admit_new(vm_name, max_memory // 1024, vcpus, force)
+                    if warning:
+                        progress.update(vm_name, message=warning)
+                    domains[vm_name] = domain
+                except libvirtError as e:
+                    progress.update(vm_name, status="failed", message=f"Error reading VM '{vm_name}': {e}")
+                except VmctlError as e:
+                    progress.update(vm_name, status="failed", message=e.message)
+        finally:
+            dest_connection.close()
+        return domains
+
+    def _migrate_one(self, progress, domain, dest_uri: str, params, flags: int):
+        """
+        Migrates one VM and records its outcome.
+
+        Args:
+            progress (MigrationProgress): The progress of the migrations.
+            domain (libvirt.virDomain): The domain.
+            dest_uri (str): The libvirt URI of the destination host.
+            params (dict): The migration parameters (VIR_MIGRATE_PARAM_*).
+            flags (int): The migration flags (VIR_MIGRATE_*).
+        """
+        vm_name = domain.name()
+        started_at = time.monotonic()
+        try:
+            # a shut off vm has no memory to send, only its definition moves
+            if domain.isActive():
+                flags |= VIR_MIGRATE_LIVE
+            else:
+                flags = (flags | VIR_MIGRATE_OFFLINE) & ~(VIR_MIGRATE_AUTO_CONVERGE | VIR_MIGRATE_POSTCOPY)
+            progress.update(vm_name, status="migrating", started_at=started_at)
+            self._start_migration(domain, dest_uri, params, flags)
+            progress.update(vm_name, status="done", seconds=time.monotonic() - started_at, memory_remaining=0,
+                            message=f"Migrated in {time.monotonic() - started_at:.1f}s.")
+        except libvirtError as e:
+            progress.update(vm_name, status="failed", seconds=time.monotonic() - started_at, message=f"Error migrating VM '{vm_name}': {e}")
+
+    def _start_migration(self, domain, dest_uri: str, params, flags: int):
+        """
+        Runs a peer-to-peer migration, blocking until it completes.
+
+        Args:
+            domain (libvirt.virDomain): The domain.
+            dest_uri (str): The libvirt URI of the destination host.
+            params (dict): The migration parameters (VIR_MIGRATE_PARAM_*).
+            flags (int): The migration flags (VIR_MIGRATE_*).
+        """
+        domain.migrateToURI3(dest_uri, params, flags)
+
+    def _read_job_stats(self, domain):
+        """
+        Reads the statistics of a domain's running migration job.
+
+        Args:
+            domain (libvirt.virDomain): The domain.
+
+        Returns:
+            dict: The statistics (memory_total, memory_remaining, memory_bps, ...).
+        """
+        # reference: https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainGetJobStats
+        return domain.jobStats(0)
+
+    def _poll(self, progress, domains, done: threading.Event, poll_interval: float, postcopy: bool, postcopy_after: float, on_progress):
+        """
+        Reads the job statistics of the running migrations until they are all done.
+
+        Args:
+            progress (MigrationProgress): The progress of the migrations.
+            domains (dict): The domains being migrated, keyed by VM name.
+            done (threading.Event): Set once every migration completed.
+            poll_interval (float): The time between reads in seconds.
+            postcopy (bool): Switch the migrations to post-copy.
+            postcopy_after (float): Switch after this many seconds, or None after the first pass over the memory.
+            on_progress (callable): Called with the progress of every VM after each read.
+        """
+        while not done.wait(poll_interval):
+            for vm in progress.get():
+                if vm["status"] not in ("migrating", "postcopy"):
+                    continue
+                domain = domains[vm["name"]]
+                try:
+                    stats = self._read_job_stats(domain)
+                except libvirtError:
+                    # the job can finish between the status check and the read
+                    continue
+                vm = progress.update_from_stats(vm["name"], stats)
+                if vm is None:
+                    continue
+
+                switch = postcopy_after is not None and vm["seconds"] >= postcopy_after
+                switch = switch or (postcopy_after is None and vm["iteration"] > 1)
+                if postcopy and vm["status"] == "migrating" and switch:
+                    try:
+                        domain.migrateStartPostCopy(0)
+                        progress.update(vm["name"], status="postcopy")
+                    except libvirtError:
+                        pass
+            if on_progress:
+                on_progress(progress.get())
+
+    def _build_progress_table(self, dest_uri: str, progress):
+        """
+        Builds the live table of the migrations' progress.
+
+        Args:
+            dest_uri (str): The libvirt URI of the destination host.
+            progress (list): The progress returned by MigrationProgress.get.
+
+        Returns:
+            rich.table.Table: The table.
+        """
+        format_bytes = lambda size: "--" if size is None else MetricsApi._format_bytes(size)
+        table = Table(title=f"Migrating {len(progress)} VMs to {dest_uri}")
+        table.add_column("VM name", style="bold bright_cyan")
+        table.add_column("Status")
+        for header in ["Time (s)", "Remaining", "Total", "Sent/s", "Dirtied/s", "Pass", "Downtime (ms)"]:
+            table.add_column(header, justify="right")
+        table.add_column("Message")
+
+        for vm in progress:
+            color = self.STATUS_COLORS[vm["status"]]
+            table.add_row(
+                vm["name"],
+                f"[{color}]{vm['status']}[/{color}]",
+                f"{vm['seconds']:.1f}",
+                format_bytes(vm["memory_remaining"]),
+                format_bytes(vm["memory_total"]),
+                format_bytes(vm["memory_bps"]),
+                format_bytes(vm["dirty_rate"]),
+                str(vm["iteration"] or "--"),
+                "--" if vm["downtime_ms"] is None else f"{vm['downtime_ms']:.0f}",
+                vm["message"],
+            )
+        return table
+
+
+
+class MigrationProgress:
+    """
+    The progress of the migrations of one migrate call, written by its migration threads and its poller.
+    """
+
+    def __init__(self, vm_names):
+        """
+        Initializes the MigrationProgress class, with every VM queued.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+        """
+        self.vms = {vm_name: self._new_progress(vm_name) for vm_name in vm_names}
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Gets the progress of every VM.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (queued, migrating, postcopy, done or failed),
+                  "seconds" elapsed, "memory_total", "memory_remaining" (bytes), "memory_bps" (bytes/s sent), "dirty_rate"
+                  (bytes/s dirtied), "iteration" (passes over the memory), "downtime_ms" (estimated pause to send what
+                  remains, None until known) and "message" of each VM.
+        """
+        with self.lock:
+            return [dict(vm) for vm in self.vms.values()]
+
+    def started_at(self, vm_name: str):
+        """
+        Gets when the migration of a VM started.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+
+        Returns:
+            float: The time.monotonic() it started at, or None if it never started.
+        """
+        with self.lock:
+            return self.vms[vm_name]["started_at"]
+
+    def update(self, vm_name: str, **values):
+        """
+        Updates the progress of a VM.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            **values: The fields to set.
+        """
+        with self.lock:
+            self.vms[vm_name].update(values)
+
+    def update_from_stats(self, vm_name: str, stats):
+        """
+        Records the job statistics of a migration.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            stats (dict): The statistics returned by jobStats.
+
+        Returns:
+            dict: The progress of the VM, or None if its migration completed since the stats were read.
+        """
+        remaining = stats.get("memory_remaining", 0)
+        sent_rate = stats.get("memory_bps", 0)
+        # the dirty rate is reported in pages per second
+        dirty_rate = stats.get("memory_dirty_rate", 0) * stats.get("memory_page_size", 4096)
+        with self.lock:
+            current = self.vms[vm_name]
+            if current["status"] not in ("migrating", "postcopy"):
+                return None
+            current.update(
+                seconds=time.monotonic() - current["started_at"],
+                memory_total=stats.get("memory_total", 0),
+                memory_remaining=remaining,
+                memory_bps=sent_rate,
+                dirty_rate=dirty_rate,
+                iteration=stats.get("memory_iteration", 0),
+                # the vm is paused for as long as sending what is left takes
+                downtime_ms=remaining / sent_rate * 1000 if sent_rate else None,
+                message="Not converging, memory is dirtied faster than it is sent." if sent_rate and dirty_rate >= sent_rate else current["message"],
+            )
+            return dict(current)
+
+    @staticmethod
+    def _new_progress(vm_name: str):
+        return {"name": vm_name, "status": "queued", "seconds": 0.0, "started_at": None, "memory_total": None,
+                "memory_remaining": None, "memory_bps": None, "dirty_rate": None, "iteration": 0, "downtime_ms": None, "message": ""}
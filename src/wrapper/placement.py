@@ -0,0 +1,331 @@
+"""
+This module places new virtual machines on a NUMA node and a set of host CPUs.
+
+The placement engine reads the host's NUMA topology from its capabilities, the free memory of each node and the
+CPUs existing VMs are pinned to, then picks a node and a CPU for every vCPU of each new VM, so a VM's vCPUs and
+memory stay on one node.
+"""
+import threading
+import xml.etree.ElementTree as ET
+from libvirt import libvirtError
+from utils.errors import VmctlError, LibvirtError
+from utils.pool import run_parallel
+
+# none: leave the placement to the host scheduler (no pinning)
+# auto: the node with the most unpinned CPUs, so the vm gets CPUs of its own
+# pack: the fullest node the vm still fits on, keeping the other nodes free
+# spread: the node with the most free memory, one thread per core first
+PLACEMENT_STRATEGIES = ["none", "auto", "pack", "spread"]
+
+def parse_capabilities(capabilities_xml: str):
+    """
+    Reads the NUMA topology out of the host capabilities XML.
+
+    Args:
+        capabilities_xml (str): The XML returned by getCapabilities.
+
+    Raises:
+        VmctlError: If the XML has no NUMA topology.
+
+    Returns:
+        list: A list of dictionaries with the "id", "memory" (KiB) and "cpus" of each node. Each CPU is a dictionary
+              with its "id", "socket" and "core".
+    """
+    # reference: https://libvirt.org/formatcaps.html#host-capabilities
+    cells = ET.fromstring(capabilities_xml).findall("host/topology/cells/cell")
+    if not cells:
+        raise VmctlError("The host does not report its NUMA topology.")
+
+    nodes = []
+    for cell in cells:
+        memory = cell.find("memory")
+        nodes.append({
+            "id": int(cell.get("id")),
+            "memory": int(memory.text) if memory is not None else 0,
+            "cpus": [
+                {"id": int(cpu.get("id")), "socket": int(cpu.get("socket_id", 0)), "core": int(cpu.get("core_id", cpu.get("id")))}
+                for cpu in cell.findall("cpus/cpu")
+            ],
+        })
+    return nodes
+
+
+def parse_cpuset(cpuset: str):
+    """
+    Reads a libvirt cpuset (e.g. "0-3,^2,8").
+
+    Args:
+        cpuset (str): The cpuset.
+
+    Raises:
+        VmctlError: If the cpuset is not valid.
+
+    Returns:
+        set: The CPU ids.
+    """
+    cpus, excluded = set(), set()
+    try:
+        for part in cpuset.replace(" ", "").split(","):
+            if not part:
+                continue
+            target = excluded if part.startswith("^") else cpus
+            part = part.lstrip("^")
+            if "-" in part:
+                first, last = part.split("-")
+                target.update(range(int(first), int(last) + 1))
+            else:
+                target.add(int(part))
+    except ValueError:
+        raise VmctlError(f"Invalid cpuset '{cpuset}'.")
+    return cpus - excluded
+
+
+def format_cpuset(cpus):
+    """
+    Writes CPU ids as a libvirt cpuset, with ranges (e.g. "0-3,8").
+
+    Args:
+        cpus (iterable): The CPU ids.
+
+    Returns:
+        str: The cpuset.
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def read_pinned_cpus(domain_xml: str):
+    """
+    Reads the host CPUs a domain is pinned to.
+
+    Args:
+        domain_xml (str): The domain's XML configuration.
+
+    Returns:
+        list: The CPU ids, once for every vCPU pinned to each of them.
+    """
+    domain = ET.fromstring(domain_xml)
+    pins = domain.findall("cputune/vcpupin")
+    if pins:
+        return [cpu for pin in pins for cpu in parse_cpuset(pin.get("cpuset", ""))]
+    # without per vcpu pins, every vcpu floats over the domain's cpuset
+    vcpu = domain.find("vcpu")
+    if vcpu is not None and vcpu.get("cpuset"):
+        return list(parse_cpuset(vcpu.get("cpuset")))
+    return []
+
+
+def read_placement(domain_xml: str):
+    """
+    Reads where a domain is placed, to give its CPUs and memory back when it is placed again.
+
+    Args:
+        domain_xml (str): The domain's XML configuration.
+
+    Returns:
+        dict: The "node" its memory is bound to (None if it is not bound to a single node), the "cpus" its vCPUs
+              are pinned to (as read_pinned_cpus returns them) and its "memory" in MiB.
+    """
+    domain = ET.fromstring(domain_xml)
+    node = None
+    binding = domain.find("numatune/memory")
+    if binding is not None and binding.get("nodeset"):
+        nodes = parse_cpuset(binding.get("nodeset"))
+        node = nodes.pop() if len(nodes) == 1 else None
+    memory = domain.find("memory")
+    # libvirt always writes the memory in KiB
+    return {"node": node, "cpus": read_pinned_cpus(domain_xml), "memory": int(memory.text) // 1024 if memory is not None else 0}
+
+
+def load_placement_engine(connection, strategy: str, parallelism: int = 8):
+    """
+    Creates a placement engine from the current state of a host.
+
+    Args:
+        connection (libvirt.virConnect): The connection object.
+        strategy (str): The placement strategy (auto, pack or spread).
+        parallelism (int, optional): The maximum number of domain configurations read at the same time. Defaults to 8.
+
+    Raises:
+        LibvirtError: If the host's state cannot be read.
+
+    Returns:
+        PlacementEngine: The engine, or None for the "none" strategy.
+    """
+    check_placement_strategy(strategy)
+    if strategy == "none":
+        return None
+
+    try:
+        nodes = parse_capabilities(connection.getCapabilities())
+        free_memory = connection.getCellsFreeMemory(0, len(nodes))
+        domains = connection.listAllDomains(0)
+    except libvirtError as e:
+        raise LibvirtError(f"Error reading the host's NUMA topology: {e}")
+
+    pinned = []
+    for domain, domain_xml, error in run_parallel(lambda domain: domain.XMLDesc(0), domains, parallelism):
+        if error is not None:
+            # a domain undefined while we read it has no pinning left
+            continue
+        pinned += read_pinned_cpus(domain_xml)
+
+    # the free memory is reported in bytes, the topology in KiB
+    return PlacementEngine(nodes, {node["id"]: free // 1024 for node, free in zip(nodes, free_memory)}, pinned, strategy)
+
+
+def check_placement_strategy(strategy: str):
+    """
+    Checks that a placement strategy is supported.
+
+    Args:
+        strategy (str): The placement strategy.
+
+    Raises:
+        VmctlError: If the strategy is not supported.
+    """
+    if strategy not in PLACEMENT_STRATEGIES:
+        raise VmctlError(f"Unsupported placement '{strategy}'. Use one of: {', '.join(PLACEMENT_STRATEGIES)}.")
+
+
+class PlacementEngine:
+    """
+    Picks a NUMA node and host CPUs for new VMs.
+
+    Every placement is accounted for, so VMs placed one after the other by the same engine do not end up on the same CPUs.
+    """
+
+    def __init__(self, nodes, free_memory, pinned_cpus, strategy: str = "auto"):
+        """
+        Initializes the PlacementEngine class.
+
+        Args:
+            nodes (list): The NUMA nodes, as returned by parse_capabilities.
+            free_memory (dict): The free memory of each node in KiB, keyed by node id.
+            pinned_cpus (list): The CPU ids existing vCPUs are pinned to, once per vCPU.
+            strategy (str, optional): The placement strategy (auto, pack or spread). Defaults to "auto".
+
+        Raises:
+            VmctlError: If the strategy is not supported.
+        """
+        check_placement_strategy(strategy)
+        self.nodes = nodes
+        self.free_memory = dict(free_memory)
+        self.strategy = strategy
+        self.pin_counts = {cpu["id"]: 0 for node in nodes for cpu in node["cpus"]}
+        for cpu in pinned_cpus:
+            if cpu in self.pin_counts:
+                self.pin_counts[cpu] += 1
+        self.lock = threading.Lock()
+
+    def place(self, vm_vcpus: int, vm_memory: int):
+        """
+        Places a VM on a node and pins each of its vCPUs to a host CPU of that node.
+
+        Args:
+            vm_vcpus (int): The number of vCPUs of the VM.
+            vm_memory (int): The memory of the VM in MiB.
+
+        Raises:
+            VmctlError: If no node has enough CPUs and free memory for the VM.
+
+        Returns:
+            dict: The "node" id and the "cpus" the vCPUs are pinned to, in vCPU order.
+        """
+        with self.lock:
+            memory = vm_memory * 1024
+            candidates = [node for node in self.nodes if len(node["cpus"]) >= vm_vcpus and self.free_memory.get(node["id"], 0) >= memory]
+            if not candidates:
+                raise VmctlError(f"No NUMA node has {vm_vcpus} CPUs and {vm_memory} MiB of free memory.")
+
+            node = min(candidates, key=self._node_key(vm_vcpus))
+            cpus = sorted(node["cpus"], key=self._cpu_key(node))[:vm_vcpus]
+            placement = {"node": node["id"], "cpus": [cpu["id"] for cpu in cpus]}
+            self._account(placement, vm_memory, 1)
+            return placement
+
+    def reserve(self, placement, vm_memory: int = 0):
+        """
+        Accounts for a VM placed outside the engine, e.g. one whose new placement could not be defined.
+
+        Args:
+            placement (dict): The "node" (or None) and "cpus" of the VM.
+            vm_memory (int, optional): The memory of the VM in MiB, taken from its node. Defaults to 0.
+        """
+        with self.lock:
+            self._account(placement, vm_memory, 1)
+
+    def release(self, placement, vm_memory: int = 0):
+        """
+        Gives back the CPUs and memory of a VM that is no longer placed there, e.g. because its define failed
+        or it is being placed again.
+
+        Args:
+            placement (dict): The "node" (or None) and "cpus" of the VM, as returned by place or read_placement.
+            vm_memory (int, optional): The memory of the VM in MiB, given back to its node. Defaults to 0.
+        """
+        with self.lock:
+            self._account(placement, vm_memory, -1)
+
+    def _account(self, placement, vm_memory: int, sign: int):
+        """
+        Adds a placement to the pinned CPUs and free memory, or removes it. Must be called with the lock held.
+
+        Args:
+            placement (dict): The "node" (or None) and "cpus" of the VM.
+            vm_memory (int): The memory of the VM in MiB.
+            sign (int): 1 to add the placement, -1 to remove it.
+        """
+        for cpu in placement["cpus"]:
+            if cpu in self.pin_counts:
+                self.pin_counts[cpu] = max(0, self.pin_counts[cpu] + sign)
+        if placement["node"] in self.free_memory:
+            self.free_memory[placement["node"]] -= sign * vm_memory * 1024
+
+    def _node_key(self, vm_vcpus: int):
+        """
+        Gets the sort key of the nodes a VM fits on, the best node first.
+
+        Args:
+            vm_vcpus (int): The number of vCPUs of the VM.
+
+        Returns:
+            callable: The key function.
+        """
+        def unpinned(node):
+            return sum(1 for cpu in node["cpus"] if self.pin_counts[cpu["id"]] == 0)
+
+        if self.strategy == "pack":
+            # nodes where the vm still gets cpus of its own come first
+            return lambda node: (unpinned(node) < vm_vcpus, self.free_memory[node["id"]], node["id"])
+        if self.strategy == "spread":
+            return lambda node: (-self.free_memory[node["id"]], -unpinned(node), node["id"])
+        return lambda node: (unpinned(node) < vm_vcpus, -unpinned(node), -self.free_memory[node["id"]], node["id"])
+
+    def _cpu_key(self, node):
+        """
+        Gets the sort key of a node's CPUs, the best CPU first.
+
+        Args:
+            node (dict): The node.
+
+        Returns:
+            callable: The key function.
+        """
+        if self.strategy == "spread":
+            # the position of each cpu among its core's threads, so
+            # the first thread of every core is used before the second
+            thread = {}
+            seen = {}
+            for cpu in sorted(node["cpus"], key=lambda cpu: cpu["id"]):
+                core = (cpu["socket"], cpu["core"])
+                thread[cpu["id"]] = seen.get(core, 0)
+                seen[core] = thread[cpu["id"]] + 1
+            return lambda cpu: (self.pin_counts[cpu["id"]], thread[cpu["id"]], cpu["socket"], cpu["core"], cpu["id"])
+        # sibling threads next to each other, so a vm gets whole cores
+        return lambda cpu: (self.pin_counts[cpu["id"]], cpu["socket"], cpu["core"], cpu["id"])
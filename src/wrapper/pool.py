@@ -0,0 +1,59 @@
+"""
+This module provides a pool of libvirt connections keyed by URI.
+"""
+import threading
+
+class ConnectionPool:
+    """
+    A thread-safe pool that opens at most one connection per libvirt URI and reuses it.
+    """
+
+    def __init__(self, connect, connections=None):
+        """
+        Initializes the ConnectionPool class.
+
+        Args:
+            connect (callable): Opens a connection for a URI, e.g. LibVirtApi.
+            connections (dict, optional): Already open connections keyed by URI. Defaults to None.
+        """
+        self.connect = connect
+        self.connections = dict(connections or {})
+        self.lock = threading.Lock()
+        self.uri_locks = {}
+
+    def get(self, uri: str):
+        """
+        Gets the connection for a URI, connecting the first time it is used.
+
+        Connections to different URIs are opened concurrently, only callers asking
+        for the same URI wait for each other.
+
+        Args:
+            uri (str): The libvirt URI.
+
+        Returns:
+            object: The connection returned by `connect`.
+        """
+        with self.lock:
+            if uri in self.connections:
+                return self.connections[uri]
+            uri_lock = self.uri_locks.setdefault(uri, threading.Lock())
+
+        with uri_lock:
+            with self.lock:
+                if uri in self.connections:
+                    return self.connections[uri]
+            connection = self.connect(uri)
+            with self.lock:
+                self.connections[uri] = connection
+            return connection
+
+    def close(self):
+        """
+        Closes every connection in the pool.
+        """
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,342 @@
+"""
+This module applies QoS profiles (utils.qos) to VMs and reports their limits against the I/O they really do.
+
+A profile is applied to many VMs at once, a few at a time, with one setBlockIoTune call per disk and one
+setInterfaceParameters call per network interface. The observed throughput comes from two bulk stats calls an
+interval apart, so showing the limits of every VM costs two calls and one XML read per VM.
+"""
+import time
+import xml.etree.ElementTree as ET
+from rich import print
+from libvirt import (
+    libvirtError,
+    VIR_DOMAIN_AFFECT_CONFIG,
+    VIR_DOMAIN_AFFECT_LIVE,
+    VIR_DOMAIN_METADATA_ELEMENT,
+    VIR_DOMAIN_RUNNING,
+    VIR_DOMAIN_STATS_BLOCK,
+    VIR_DOMAIN_STATS_INTERFACE,
+    VIR_DOMAIN_STATS_STATE,
+    VIR_DOMAIN_XML_INACTIVE,
+)
+from utils.errors import VmctlError, LibvirtError
+from utils.pool import run_parallel
+from utils.qos import (
+    QOS_NAMESPACE,
+    QOS_PREFIX,
+    block_parameters,
+    get_profile,
+    interface_parameters,
+    read_limits,
+)
+from utils.table import create_table
+from wrapper.metrics import MetricsApi
+
+QOS_STATS = VIR_DOMAIN_STATS_STATE | VIR_DOMAIN_STATS_BLOCK | VIR_DOMAIN_STATS_INTERFACE
+
+# the fields of a `vmctl qos show` record. disks fill in the iops and bytes (read and written per second),
+# interfaces the in and out bytes per second, and "use" is the highest fraction of a limit in use.
+# a VM whose limits cannot be read gets a single record with only its name and the "error"
+QOS_FIELDS = ["name", "profile", "type", "device", "iops", "iops_limit", "bytes", "bytes_limit",
+              "in", "in_limit", "out", "out_limit", "use", "error"]
+
+class QosApi:
+    """
+    A class for throttling the disk and network I/O of virtual machines.
+    """
+
+    STATUS_COLORS = {"done": "green", "failed": "red"}
+
+    def __init__(self, connection):
+        """
+        Initializes the QosApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+        """
+        self.connection = connection
+
+    def apply(self, vm_names, profile_name: str, config: bool = False, parallelism: int = 8):
+        """
+        Applies a QoS profile to the disks and network interfaces of several VMs concurrently.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            profile_name (str): The name of the profile.
+            config (bool, optional): Also keep the limits when the VMs are restarted. Defaults to False.
+            parallelism (int, optional): The maximum number of VMs acted on at the same time. Defaults to 8.
+
+        Raises:
+            VmctlError: If the profile does not exist.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (done or failed) and "message" of each VM.
+        """
+        profile = get_profile(profile_name)
+        disk_parameters, net_parameters = block_parameters(profile), interface_parameters(profile)
+        # libvirt puts the element in QOS_NAMESPACE itself
+        metadata = ET.tostring(ET.Element("qos", {"profile": profile_name}), encoding="unicode")
+
+        def apply_one(vm_name):
+            domain = self.connection.lookupByName(vm_name)
+            # a shut off vm has no running devices, only its configuration can change
+            running = domain.state()[0] == VIR_DOMAIN_RUNNING
+            if not running and not config:
+                raise VmctlError(f"VM '{vm_name}' is not running. Use --config to change its configuration.")
+            flags = (VIR_DOMAIN_AFFECT_LIVE if running else 0) | (VIR_DOMAIN_AFFECT_CONFIG if config else 0)
+
+            # the mac address names an interface both live and in the configuration
+            root = ET.fromstring(domain.XMLDesc(0 if running else VIR_DOMAIN_XML_INACTIVE))
+            disks = [disk.find("target").get("dev") for disk in root.findall("devices/disk")
+                     if disk.get("device", "disk") == "disk" and disk.find("target") is not None]
+            macs = [mac.get("address") for mac in root.findall("devices/interface/mac")]
+            for disk in disks:
+                domain.setBlockIoTune(disk, disk_parameters, flags)
+            for mac in macs:
+                domain.setInterfaceParameters(mac, net_parameters, flags)
+            domain.setMetadata(VIR_DOMAIN_METADATA_ELEMENT, metadata, QOS_PREFIX, QOS_NAMESPACE, flags)
+            return len(disks), len(macs)
+
+        results = []
+        for vm_name, devices, error in run_parallel(apply_one, vm_names, parallelism):
+            if error is None:
+                results.append({"name": vm_name, "status": "done",
+                                "message": f"Profile {profile_name} applied to {devices[0]} disks and {devices[1]} interfaces."})
+            else:
+                message = error.message if isinstance(error, VmctlError) else f"Error applying the QoS profile to VM '{vm_name}': {error}"
+                results.append({"name": vm_name, "status": "failed", "message": message})
+        return results
+
+    def print_apply_results(self, results):
+        """
+        Displays the results of apply in a table.
+
+        Args:
+            results (list): The results returned by apply.
+        """
+        columns = [{"header": "VM name", "style": "bold bright_cyan"}, {"header": "Status"}, {"header": "Message"}]
+        rows = []
+        for result in results:
+            color = self.STATUS_COLORS[result["status"]]
+            rows.append([result["name"], f"[{color}]{result['status']}[/{color}]", result["message"]])
+        failed = sum(1 for result in results if result["status"] == "failed")
+        create_table(f"Applied a QoS profile to {len(results)} VMs ({failed} failed)", columns, rows)
+
+    def get_qos(self, vm_names=None, interval: float = 1.0, parallelism: int = 8):
+        """
+        Gets the I/O limits of VMs and the throughput they did over an interval.
+
+        Args:
+            vm_names (list, optional): The names of the virtual machines. Defaults to None, every VM.
+            interval (float, optional): The seconds between the two stats reads the throughput is computed from.
+                                        Defaults to 1.0.
+            parallelism (int, optional): The maximum number of domain XMLs read at the same time. Defaults to 8.
+
+        Raises:
+            LibvirtError: If the stats cannot be read.
+
+        Returns:
+            list: A record per disk and network interface (see QOS_FIELDS), and one with the "error" of each VM
+                  whose limits could not be read. Limits are None when not set and observed rates are None when the
+                  VM is not running. Bytes are per second.
+        """
+        domains, first = self._read_stats(vm_names)
+        start = time.monotonic()
+        time.sleep(interval)
+        _, second = self._read_stats(vm_names, domains)
+        elapsed = time.monotonic() - start
+
+        def read_one(domain):
+            return read_limits(ET.fromstring(domain.XMLDesc(0)))
+
+        records = []
+        for domain, limits, error in run_parallel(read_one, domains, parallelism):
+            vm_name = domain.name()
+            if error is not None:
+                # reported with the records, printing here would end up in the middle of the json or csv output
+                record = dict.fromkeys(QOS_FIELDS)
+                record.update(name=vm_name, error=f"Error reading the limits of VM {vm_name}: {error}")
+                records.append(record)
+                continue
+            rates = self._device_rates(first.get(vm_name, {}), second.get(vm_name, {}), elapsed)
+            for device, tune in limits["disks"].items():
+                records.append(self._disk_record(vm_name, limits["profile"], device, tune, rates.get(("block", device))))
+            for device, bandwidth in limits["interfaces"].items():
+                records.append(self._net_record(vm_name, limits["profile"], device, bandwidth, rates.get(("net", device))))
+        return records
+
+    def show(self, vm_names=None, interval: float = 1.0, parallelism: int = 8):
+        """
+        Displays the I/O limits of VMs against the throughput they did over an interval.
+
+        Args:
+            vm_names (list, optional): The names of the virtual machines. Defaults to None, every VM.
+            interval (float, optional): The seconds the throughput is measured over. Defaults to 1.0.
+            parallelism (int, optional): The maximum number of domain XMLs read at the same time. Defaults to 8.
+        """
+        records = self.get_qos(vm_names, interval, parallelism)
+        for record in records:
+            if record["error"] is not None:
+                print(f"[bright_yellow]{record['error']}[/bright_yellow]")
+        records = [record for record in records if record["error"] is None]
+        if not records:
+            print("[bold bright_yellow]No VMs found[/bold bright_yellow]")
+            return
+
+        def rate(value, limit, size=True):
+            observed = "--" if value is None else (MetricsApi._format_bytes(value) if size else f"{value:.0f}")
+            if limit is None:
+                return f"{observed} / [dim]none[/dim]"
+            return f"{observed} / {MetricsApi._format_bytes(limit) if size else limit}"
+
+        def use(record):
+            if record["use"] is None:
+                return "--"
+            color = "red" if record["use"] >= 0.9 else "bright_yellow" if record["use"] >= 0.6 else "green"
+            return f"[{color}]{record['use']:.0%}[/{color}]"
+
+        disks = [record for record in records if record["type"] == "disk"]
+        interfaces = [record for record in records if record["type"] == "net"]
+        if disks:
+            columns = [{"header": "VM name", "style": "bold bright_cyan"}, {"header": "Profile"}, {"header": "Disk"},
+                       {"header": "IOPS / limit"}, {"header": "Bytes/s / limit"},
+                       {"header": "Use"}]
+            rows = [[record["name"], record["profile"] or "--", record["device"],
+                     rate(record["iops"], record["iops_limit"], size=False), rate(record["bytes"], record["bytes_limit"]),
+                     use(record)] for record in disks]
+            create_table(f"Disk I/O limits (over {interval:g}s)", columns, rows)
+        if interfaces:
+            columns = [{"header": "VM name", "style": "bold bright_cyan"}, {"header": "Profile"}, {"header": "Interface"},
+                       {"header": "In/s / limit"}, {"header": "Out/s / limit"},
+                       {"header": "Use"}]
+            rows = [[record["name"], record["profile"] or "--", record["device"],
+                     rate(record["in"], record["in_limit"]), rate(record["out"], record["out_limit"]),
+                     use(record)] for record in interfaces]
+            create_table(f"Network limits (over {interval:g}s)", columns, rows)
+
+    def _read_stats(self, vm_names=None, domains=None):
+        """
+        Reads the block and interface stats of VMs with one bulk call.
+
+        Args:
+            vm_names (list, optional): The names of the virtual machines. Defaults to None, every VM.
+            domains (list, optional): The domains looked up by an earlier read. Defaults to None.
+
+        Raises:
+            LibvirtError: If the stats cannot be read.
+
+        Returns:
+            tuple: The domains, and the stats of each VM keyed by VM name.
+        """
+        # reference: https://libvirt.org/html/libvirt-libvirt-domain.html#virConnectGetAllDomainStats
+        try:
+            if vm_names:
+                domains = domains or [self.connection.lookupByName(vm_name) for vm_name in vm_names]
+                domain_stats = self.connection.domainListGetStats(domains, QOS_STATS)
+            else:
+                domain_stats = self.connection.getAllDomainStats(QOS_STATS)
+        except libvirtError as e:
+            raise LibvirtError(f"Error reading the I/O stats: {e}")
+        return [domain for domain, _ in domain_stats], {domain.name(): stats for domain, stats in domain_stats}
+
+    @staticmethod
+    def _device_rates(first, second, elapsed: float):
+        """
+        Computes the throughput of every disk and interface of a VM between two stats reads.
+
+        Args:
+            first (dict): The stats of the first read.
+            second (dict): The stats of the second read.
+            elapsed (float): The seconds between the reads.
+
+        Returns:
+            dict: The "reqs" (block only) and "read"/"write" or "rx"/"tx" bytes per second, keyed by
+                  ("block" or "net", device name). Empty when the VM is not running.
+        """
+        if second.get("state.state") != VIR_DOMAIN_RUNNING or elapsed <= 0:
+            return {}
+        counters = {"block": {"reqs": ("rd.reqs", "wr.reqs"), "read": ("rd.bytes",), "write": ("wr.bytes",)},
+                    "net": {"rx": ("rx.bytes",), "tx": ("tx.bytes",)}}
+        rates = {}
+        for group, fields in counters.items():
+            for index in range(second.get(f"{group}.count", 0)):
+                prefix = f"{group}.{index}"
+                name = second.get(f"{prefix}.name")
+                # devices are matched by name, the indexes can change when one is hot plugged
+                before = next((f"{group}.{old}" for old in range(first.get(f"{group}.count", 0))
+                               if first.get(f"{group}.{old}.name") == name), None)
+                if name is None or before is None:
+                    continue
+                rates[(group, name)] = {
+                    key: max(sum(second.get(f"{prefix}.{field}", 0) - first.get(f"{before}.{field}", 0) for field in keys), 0) / elapsed
+                    for key, keys in fields.items()
+                }
+        return rates
+
+    @staticmethod
+    def _disk_record(vm_name: str, profile: str, device: str, tune, rates):
+        """
+        Builds the `vmctl qos show` record of a disk. Separate read and write caps are added up.
+
+        Returns:
+            dict: The record.
+        """
+        def limit(kind):
+            total = tune.get(f"total_{kind}_sec") or (tune.get(f"read_{kind}_sec", 0) + tune.get(f"write_{kind}_sec", 0))
+            return total or None
+
+        record = dict.fromkeys(QOS_FIELDS)
+        record.update(name=vm_name, profile=profile, type="disk", device=device,
+                      iops_limit=limit("iops"), bytes_limit=limit("bytes"))
+        if rates is not None:
+            record.update(iops=round(rates["reqs"], 1), bytes=round(rates["read"] + rates["write"], 1))
+            record["use"] = QosApi._use([(record["iops"], record["iops_limit"]), (record["bytes"], record["bytes_limit"])])
+        return record
+
+    @staticmethod
+    def _net_record(vm_name: str, profile: str, device: str, bandwidth, rates):
+        """
+        Builds the `vmctl qos show` record of a network interface, with its limits in bytes per second.
+
+        Returns:
+            dict: The record.
+        """
+        record = dict.fromkeys(QOS_FIELDS)
+        record.update(name=vm_name, profile=profile, type="net", device=device,
+                      in_limit=bandwidth.get("inbound.average", 0) * 1024 or None,
+                      out_limit=bandwidth.get("outbound.average", 0) * 1024 or None)
+        if rates is not None:
+            record["in"], record["out"] = round(rates["rx"], 1), round(rates["tx"], 1)
+            record["use"] = QosApi._use([(record["in"], record["in_limit"]), (record["out"], record["out_limit"])])
+        return record
+
+    @staticmethod
+    def _use(pairs):
+        """
+        Gets the highest fraction of a limit in use.
+
+        Args:
+            pairs (list): (observed, limit) pairs, the limit None when not set.
+
+        Returns:
+            float: The fraction, or None if no limit is set.
+        """
+        fractions = [observed / limit for observed, limit in pairs if limit]
+        return round(max(fractions), 3) if fractions else None
+
+
+def list_profiles(profiles):
+    """
+    Displays QoS profiles in a table.
+
+    Args:
+        profiles (dict): The profiles, as returned by utils.qos.get_profiles.
+    """
+    columns = [{"header": "Profile", "style": "bold bright_cyan"}, {"header": "Disk limits (per disk)"},
+               {"header": "Network limits (per interface)"}]
+    rows = []
+    for name, profile in sorted(profiles.items()):
+        disk = [f"{key}={value}" for key, value in profile["disk"].items()]
+        net = [f"{key}={value}" for key, value in profile["net"].items()]
+        rows.append([name, "\n".join(disk) or "--", "\n".join(net) or "--"])
+    create_table("QoS profiles", columns, rows)
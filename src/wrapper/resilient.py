@@ -0,0 +1,359 @@
+"""
+This module keeps a libvirt connection usable when libvirtd restarts or the link to a remote host drops.
+
+LibVirtApi wraps its connection in a ResilientConnection, a proxy like wrapper.instrument.Instrumented. When a call
+fails because the connection is gone, the proxy opens a new one, and the domains it handed out are looked up
+again (by UUID) on the new connection the next time they are used. Calls that are safe to repeat (reads and
+setters of absolute values, see is_idempotent) are retried with jittered exponential backoff when the error is
+one that can go away (see classify). Anything else, e.g. starting or migrating a VM, is never repeated, because
+whether it happened before the connection dropped cannot be known. Its error is raised once the connection is back.
+
+The connection sends keepalive messages (setKeepAlive) and registers a close callback, so a dead connection is
+noticed, and replaced before the next call, even between calls. Both need an event loop, which long running
+commands (the daemon, watch) have. The settings are read from the "retry" section of the vmctl configuration file:
+
+    {
+        "retry": {
+            "attempts": 4,
+            "base_delay": 0.2,
+            "max_delay": 5.0,
+            "keepalive_interval": 5,
+            "keepalive_count": 3
+        }
+    }
+
+Delays are in seconds, and "attempts": 1 turns retries off.
+"""
+import random
+import threading
+import time
+import libvirt
+from utils.config import load_config
+from utils.errors import VmctlError
+from wrapper.instrument import Instrumented
+
+DEFAULT_RETRY = {
+    "attempts": 4,
+    "base_delay": 0.2,
+    "max_delay": 5.0,
+    "keepalive_interval": 5,
+    "keepalive_count": 3,
+}
+
+# errors that mean the connection itself is gone, a new one is opened before retrying
+# reference: https://libvirt.org/html/libvirt-virterror.html#virErrorNumber
+CONNECTION_ERRORS = {getattr(libvirt, name) for name in ("VIR_ERR_NO_CONNECT", "VIR_ERR_INVALID_CONN", "VIR_ERR_RPC",
+                                                         "VIR_ERR_AUTH_UNAVAILABLE") if hasattr(libvirt, name)}
+
+# VIR_ERR_SYSTEM_ERROR is any failed os call, e.g. a missing disk file or a denied permission. it only
+# means the connection is gone when it comes from the rpc layer (e.g. "End of file while reading data")
+SYSTEM_ERROR = getattr(libvirt, "VIR_ERR_SYSTEM_ERROR", None)
+CONNECTION_DOMAINS = {getattr(libvirt, name) for name in ("VIR_FROM_RPC", "VIR_FROM_REMOTE") if hasattr(libvirt, name)}
+
+# errors that can go away on their own, e.g. a domain that is busy with another job
+TRANSIENT_ERRORS = {getattr(libvirt, name) for name in ("VIR_ERR_OPERATION_TIMEOUT", "VIR_ERR_AGENT_UNRESPONSIVE",
+                                                        "VIR_ERR_RESOURCE_BUSY") if hasattr(libvirt, name)}
+
+# the calls that can be repeated without changing the outcome. besides these, every
+# get*, list*, lookup*, is*, has* and num* call only reads and can be repeated too
+IDEMPOTENT_PREFIXES = ("get", "list", "lookup", "is", "has", "num")
+IDEMPOTENT_METHODS = {
+    "info", "state", "name", "UUID", "UUIDString", "ID", "OSType", "XMLDesc", "metadata", "maxMemory", "maxVcpus",
+    "vcpus", "blockInfo", "blockStats", "blockStatsFlags", "blockIoTune", "interfaceStats", "interfaceParameters",
+    "memoryStats", "memoryParameters", "jobInfo", "jobStats", "schedulerParameters", "domainListGetStats",
+    "snapshotLookupByName", "snapshotCurrent", "hostname",
+    "setMemoryFlags", "setMemoryStatsPeriod", "setMemoryParameters", "setBlockIoTune", "setInterfaceParameters",
+    "setMetadata", "setSchedulerParameters", "setAutostart", "setKeepAlive",
+}
+
+def get_retry_settings(settings=None):
+    """
+    Gets the retry settings, from the configuration file unless they were given.
+
+    Args:
+        settings (dict, optional): The settings. Defaults to None, which reads them from the configuration file.
+
+    Raises:
+        VmctlError: If there is not at least one attempt.
+
+    Returns:
+        dict: The settings, with the defaults for anything not set.
+    """
+    if settings is None:
+        settings = load_config().get("retry", {})
+    settings = {**DEFAULT_RETRY, **settings}
+    if settings["attempts"] < 1:
+        raise VmctlError("The retry settings need at least 1 attempt.")
+    return settings
+
+
+def classify(error: libvirt.libvirtError, connection=None):
+    """
+    Classifies a libvirt error by whether trying again can help.
+
+    Args:
+        error (libvirt.libvirtError): The error.
+        connection (libvirt.virConnect, optional): The connection the call failed on, asked whether it is still
+                                                   alive when the error alone does not tell. Defaults to None.
+
+    Returns:
+        str: "connection" if the connection is gone, "transient" if the error can go away on its own,
+             None if trying again cannot help (e.g. the domain does not exist).
+    """
+    code = error.get_error_code()
+    if code in CONNECTION_ERRORS:
+        return "connection"
+    if code == SYSTEM_ERROR:
+        if error.get_error_domain() in CONNECTION_DOMAINS or not _is_alive(connection):
+            return "connection"
+        return None
+    if code in TRANSIENT_ERRORS:
+        return "transient"
+    return None
+
+
+def _is_alive(connection):
+    """
+    Checks whether a connection is still alive, assuming it is when there is no connection to ask.
+
+    Returns:
+        bool: Whether it is alive.
+    """
+    if connection is None:
+        return True
+    try:
+        return connection.isAlive() == 1
+    except libvirt.libvirtError:
+        return False
+
+
+def is_idempotent(method: str):
+    """
+    Checks whether a libvirt call can be repeated without changing the outcome.
+
+    Args:
+        method (str): The name of the method, e.g. "getAllDomainStats".
+
+    Returns:
+        bool: Whether it is safe to retry.
+    """
+    return method in IDEMPOTENT_METHODS or method.startswith(IDEMPOTENT_PREFIXES)
+
+
+def backoff(attempt: int, settings):
+    """
+    Gets the delay before a retry: exponential, capped, with full jitter so many clients do not retry in step.
+
+    Args:
+        attempt (int): The number of attempts made so far, from 1.
+        settings (dict): The retry settings.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    return random.uniform(0, min(settings["max_delay"], settings["base_delay"] * 2 ** (attempt - 1)))
+
+
+class ResilientConnection:
+    """
+    A proxy for a libvirt connection that reconnects when the connection is lost and retries idempotent calls.
+    """
+
+    def __init__(self, uri: str, open_connection, settings=None):
+        """
+        Initializes the ResilientConnection class and opens the connection.
+
+        Args:
+            uri (str): The libvirt URI.
+            open_connection (callable): Opens a connection for a URI (e.g. libvirt.open), raising libvirt.libvirtError
+                                        if it cannot.
+            settings (dict, optional): The retry settings (see DEFAULT_RETRY). Defaults to None, which reads them
+                                       from the configuration file.
+
+        Raises:
+            libvirt.libvirtError: If the connection cannot be opened.
+        """
+        self.uri = uri
+        self.open_connection = open_connection
+        self.settings = get_retry_settings(settings)
+        self.lock = threading.Lock()
+        # bumped on every reconnect, so domains know when to look themselves up again
+        self.generation = 0
+        self.reconnects = 0
+        self.listeners = []
+        self.closed = False
+        self.target = self._open()
+
+    def add_reconnect_listener(self, callback):
+        """
+        Adds a callback run after every reconnect, e.g. to register for events again.
+
+        Args:
+            callback (callable): Called without arguments.
+        """
+        self.listeners.append(callback)
+
+    def call(self, method: str, invoke):
+        """
+        Runs a libvirt call on the connection, reconnecting and retrying as the settings allow.
+
+        Args:
+            method (str): The name of the method, which decides if the call may be repeated.
+            invoke (callable): Makes the call, given the current connection.
+
+        Raises:
+            libvirt.libvirtError: If the call fails and cannot be retried, or every attempt failed.
+
+        Returns:
+            The value returned by the call, with its domains wrapped.
+        """
+        attempts = self.settings["attempts"] if is_idempotent(method) else 1
+        for attempt in range(1, attempts + 1):
+            generation = self.generation
+            try:
+                if self.closed:
+                    # the close callback saw the connection die since the last call
+                    self.reconnect(generation)
+                    generation = self.generation
+                return self._wrap(invoke(self.target))
+            except libvirt.libvirtError as e:
+                kind = classify(e, self.target)
+                if kind == "connection" or self.closed:
+                    try:
+                        self.reconnect(generation)
+                    except libvirt.libvirtError:
+                        # the host may still be coming back, the next attempt tries again
+                        if attempt == attempts:
+                            raise e
+                if kind is None or attempt == attempts:
+                    raise
+            time.sleep(backoff(attempt, self.settings))
+
+    def reconnect(self, generation: int):
+        """
+        Replaces the connection with a new one, unless another thread already did since `generation`.
+
+        Args:
+            generation (int): The generation the caller saw fail.
+
+        Raises:
+            libvirt.libvirtError: If the new connection cannot be opened.
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.target
+            self.target = self._open()
+            self.generation += 1
+            self.reconnects += 1
+            self.closed = False
+        try:
+            old.close()
+        except libvirt.libvirtError:
+            # it is gone already
+            pass
+        for callback in list(self.listeners):
+            callback()
+
+    def close(self):
+        """
+        Closes the connection. It is not reopened afterwards.
+        """
+        self.listeners.clear()
+        return self.target.close()
+
+    def _open(self):
+        """
+        Opens a connection, with keepalive and a close callback when the event loop allows.
+
+        Returns:
+            libvirt.virConnect: The connection.
+        """
+        connection = self.open_connection(self.uri)
+        try:
+            connection.setKeepAlive(self.settings["keepalive_interval"], self.settings["keepalive_count"])
+            connection.registerCloseCallback(self._on_close, None)
+        except (libvirt.libvirtError, AttributeError):
+            # without an event loop there is no keepalive, failed calls still reconnect
+            pass
+        return connection
+
+    def _on_close(self, connection, reason, opaque):
+        # runs on the event loop thread, the next call reconnects
+        self.closed = True
+
+    def _wrap(self, value):
+        """
+        Wraps the domains in a return value, including those in lists and tuples.
+
+        Returns:
+            object: The value, with its domains wrapped.
+        """
+        if isinstance(value, list):
+            return [self._wrap(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple(self._wrap(item) for item in value)
+        domain = value._target if isinstance(value, Instrumented) else value
+        if isinstance(domain, libvirt.virDomain):
+            return ResilientDomain(value, self)
+        return value
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self.call(name, lambda target: getattr(target, name)(*args, **kwargs))
+
+    def __repr__(self):
+        return f"ResilientConnection({self.uri!r})"
+
+
+class ResilientDomain:
+    """
+    A proxy for a domain of a ResilientConnection, which looks itself up again after a reconnect.
+    """
+
+    __slots__ = ("_target", "_connection", "_generation")
+
+    def __init__(self, target, connection: ResilientConnection):
+        """
+        Initializes the ResilientDomain class.
+
+        Args:
+            target (libvirt.virDomain): The domain.
+            connection (ResilientConnection): The connection it belongs to.
+        """
+        self._target = target
+        self._connection = connection
+        self._generation = connection.generation
+
+    def _current(self):
+        """
+        Gets the domain on the current connection.
+
+        Returns:
+            libvirt.virDomain: The domain.
+        """
+        if self._generation != self._connection.generation:
+            # a domain object keeps its uuid, reading it needs no connection
+            self._target = self._connection.target.lookupByUUIDString(self._target.UUIDString())
+            self._generation = self._connection.generation
+        return self._target
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            # libvirt reads _o from the domains passed to it
+            return getattr(self._current(), name)
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self._connection.call(name, lambda _: getattr(self._current(), name)(*args, **kwargs))
+
+    def __eq__(self, other):
+        return self._target == (other._target if isinstance(other, ResilientDomain) else other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def __repr__(self):
+        return f"ResilientDomain({self._target!r})"
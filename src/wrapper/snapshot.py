@@ -0,0 +1,384 @@
+"""
+This module provides snapshots of virtual machines, of one VM or of a group of VMs at (nearly) the same moment.
+"""
+import time
+import xml.etree.ElementTree as ET
+from rich import print
+from libvirt import (
+    libvirtError,
+    VIR_DOMAIN_RUNNING,
+    VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC,
+    VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY,
+)
+from utils.errors import VmctlError, LibvirtError
+from utils.pool import run_parallel
+from utils.table import create_table
+
+# internal snapshots (the default) save the disks and, for a running vm, its memory inside the qcow2 images.
+# external disk-only snapshots only switch each disk over to a new overlay file, which takes about the same
+# time whatever the size of the vm, because nothing is copied.
+# reference: https://libvirt.org/formatsnapshot.html
+
+class SnapshotApi:
+    """
+    A class for creating, listing, reverting and deleting snapshots of virtual machines.
+    """
+
+    STATUS_COLORS = {"done": "green", "failed": "red"}
+
+    def __init__(self, connection):
+        """
+        Initializes the SnapshotApi class.
+
+        Args:
+            connection (libvirt.virConnect): The connection object.
+        """
+        self.connection = connection
+
+    def create(self, vm_names, snapshot_name: str = None, disk_only: bool = False, consistent: bool = False,
+               parallelism: int = 8, description: str = None):
+        """
+        Snapshots several VMs concurrently.
+
+        With `consistent`, the running VMs are all paused first, then snapshotted, then all resumed, so the snapshots
+        are taken at the same moment as far as the guests can tell and the VMs are only paused for as long as the
+        slowest snapshot takes. If a VM cannot be paused, the VMs paused so far are resumed and none is snapshotted.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            snapshot_name (str, optional): The name of the snapshots. Defaults to None, a name made from the current time.
+            disk_only (bool, optional): Take external disk-only snapshots instead of internal ones. Defaults to False.
+            consistent (bool, optional): Pause all the VMs around the snapshots. Defaults to False.
+            parallelism (int, optional): The maximum number of VMs acted on at the same time. Defaults to 8.
+            description (str, optional): The description of the snapshots. Defaults to None.
+
+        Returns:
+            list: A list of dictionaries with the "name", "snapshot", "status" (done or failed), "message" and the time
+                  in milliseconds the VM took to "pause_ms", "snapshot_ms" and "resume_ms", and was "paused_ms" for.
+                  The timings of steps that did not happen are None.
+        """
+        snapshot_name = snapshot_name or time.strftime("vmctl-%Y%m%d-%H%M%S")
+        snapshot_xml = self._snapshot_xml(snapshot_name, description)
+        flags = VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY | VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC if disk_only else 0
+
+        results = {vm_name: self._new_result(vm_name, snapshot_name) for vm_name in vm_names}
+        domains = self._lookup(vm_names, results, parallelism)
+
+        paused = {}
+        if consistent:
+            paused = self._pause_all(domains, results, parallelism)
+            if paused is None:
+                return [results[vm_name] for vm_name in vm_names]
+
+        try:
+            outcomes = run_parallel(lambda vm_name: self._timed(lambda: domains[vm_name].snapshotCreateXML(snapshot_xml, flags)), domains, parallelism)
+            for vm_name, elapsed, error in outcomes:
+                if error is not None:
+                    self._fail(results[vm_name], f"Error creating snapshot of VM '{vm_name}': {error}")
+                else:
+                    results[vm_name].update(status="done", snapshot_ms=elapsed,
+                                            message=f"{'External disk-only' if disk_only else 'Internal'} snapshot created.")
+        finally:
+            # the vms must never stay paused, whatever happened to their snapshots
+            if paused:
+                self._resume_all(domains, paused, results, parallelism)
+        return [results[vm_name] for vm_name in vm_names]
+
+    def get_snapshots(self, vm_names, parallelism: int = 8):
+        """
+        Gets the snapshots of several VMs concurrently.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            parallelism (int, optional): The maximum number of VMs read at the same time. Defaults to 8.
+
+        Raises:
+            LibvirtError: If the snapshots of a VM cannot be read.
+
+        Returns:
+            list: A list of dictionaries with the "vm", "name", "created" time, "state" of the VM when it was taken,
+                  "type" (internal or external), "parent" snapshot and whether it is the "current" one.
+        """
+        snapshots = []
+        for vm_name, vm_snapshots, error in run_parallel(self._read_snapshots, vm_names, parallelism):
+            if error is not None:
+                raise error if isinstance(error, VmctlError) else LibvirtError(str(error))
+            snapshots += vm_snapshots
+        return snapshots
+
+    def list_snapshots(self, vm_names, parallelism: int = 8):
+        """
+        Lists the snapshots of several VMs in a table.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            parallelism (int, optional): The maximum number of VMs read at the same time. Defaults to 8.
+        """
+        snapshots = self.get_snapshots(vm_names, parallelism)
+        if not snapshots:
+            print("[bold bright_yellow]No snapshots found[/bold bright_yellow]")
+            return
+
+        columns = [
+            {"header": "VM name", "style": "bold bright_cyan"},
+            {"header": "Snapshot", "style": "bold"},
+            {"header": "Created"},
+            {"header": "VM state"},
+            {"header": "Type"},
+            {"header": "Parent"},
+            {"header": "Current"},
+        ]
+        rows = [[snapshot["vm"], snapshot["name"], snapshot["created"], snapshot["state"], snapshot["type"],
+                 snapshot["parent"] or "--", "[green]yes[/green]" if snapshot["current"] else ""] for snapshot in snapshots]
+        create_table(f"Snapshots of {len(vm_names)} VMs", columns, rows)
+
+    def revert(self, vm_names, snapshot_name: str, parallelism: int = 8):
+        """
+        Reverts several VMs to a snapshot concurrently.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            snapshot_name (str): The name of the snapshot.
+            parallelism (int, optional): The maximum number of VMs acted on at the same time. Defaults to 8.
+
+        Returns:
+            list: A list of dictionaries, as returned by create, with the revert's time in "snapshot_ms".
+        """
+        def revert_one(domain):
+            snapshot = domain.snapshotLookupByName(snapshot_name, 0)
+            domain.revertToSnapshot(snapshot, 0)
+
+        return self._run_on_snapshots(vm_names, snapshot_name, revert_one, "reverting to", "Reverted to the snapshot.", parallelism)
+
+    def delete(self, vm_names, snapshot_name: str, parallelism: int = 8):
+        """
+        Deletes a snapshot of several VMs concurrently.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            snapshot_name (str): The name of the snapshot.
+            parallelism (int, optional): The maximum number of VMs acted on at the same time. Defaults to 8.
+
+        Returns:
+            list: A list of dictionaries, as returned by create, with the deletion's time in "snapshot_ms".
+        """
+        def delete_one(domain):
+            domain.snapshotLookupByName(snapshot_name, 0).delete(0)
+
+        return self._run_on_snapshots(vm_names, snapshot_name, delete_one, "deleting", "Snapshot deleted.", parallelism)
+
+    def print_snapshot_results(self, action: str, results):
+        """
+        Displays the results of a snapshot command in a table, with the time each VM took at every step.
+
+        Args:
+            action (str): The snapshot command (create, revert or delete).
+            results (list): The results returned by create, revert or delete.
+        """
+        format_ms = lambda value: "--" if value is None else f"{value:.1f}"
+        # the pause and resume columns only mean something for consistent snapshots
+        timings = ["pause_ms", "snapshot_ms", "resume_ms", "paused_ms"]
+        if not any(result["pause_ms"] is not None for result in results):
+            timings = ["snapshot_ms"]
+        headers = {"pause_ms": "Pause (ms)", "snapshot_ms": f"{action.capitalize()} (ms)", "resume_ms": "Resume (ms)", "paused_ms": "Paused for (ms)"}
+
+        columns = [{"header": "VM name", "style": "bold bright_cyan"}, {"header": "Status"}]
+        columns += [{"header": headers[timing]} for timing in timings] + [{"header": "Message"}]
+        rows = []
+        for result in results:
+            color = self.STATUS_COLORS[result["status"]]
+            rows.append([result["name"], f"[{color}]{result['status']}[/{color}]"]
+                        + [format_ms(result[timing]) for timing in timings] + [result["message"]])
+
+        failed = sum(1 for result in results if result["status"] == "failed")
+        snapshot_name = results[0]["snapshot"] if results else ""
+        create_table(f"{action.capitalize()} snapshot {snapshot_name} of {len(results)} VMs ({failed} failed)", columns, rows)
+
+    def _run_on_snapshots(self, vm_names, snapshot_name: str, func, verb: str, message: str, parallelism: int):
+        """
+        Runs a function on the domain of several VMs concurrently and times it.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            snapshot_name (str): The name of the snapshot.
+            func (callable): Called with each domain.
+            verb (str): The verb used in error messages.
+            message (str): The message of the VMs the function succeeded for.
+            parallelism (int): The maximum number of VMs acted on at the same time.
+
+        Returns:
+            list: A list of dictionaries, as returned by create.
+        """
+        results = {vm_name: self._new_result(vm_name, snapshot_name) for vm_name in vm_names}
+        domains = self._lookup(vm_names, results, parallelism)
+        for vm_name, elapsed, error in run_parallel(lambda vm_name: self._timed(lambda: func(domains[vm_name])), domains, parallelism):
+            if error is not None:
+                self._fail(results[vm_name], f"Error {verb} snapshot '{snapshot_name}' of VM '{vm_name}': {error}")
+            else:
+                results[vm_name].update(status="done", snapshot_ms=elapsed, message=message)
+        return [results[vm_name] for vm_name in vm_names]
+
+    def _lookup(self, vm_names, results, parallelism: int):
+        """
+        Looks up several domains concurrently, marking the results of the ones that are not found as failed.
+
+        Args:
+            vm_names (list): The names of the virtual machines.
+            results (dict): The results keyed by VM name, updated in place.
+            parallelism (int): The maximum number of lookups at the same time.
+
+        Returns:
+            dict: The domains found (libvirt.virDomain), keyed by VM name.
+        """
+        domains = {}
+        for vm_name, domain, error in run_parallel(self.connection.lookupByName, vm_names, parallelism):
+            if error is not None:
+                self._fail(results[vm_name], f"Error looking up VM '{vm_name}': {error}")
+            else:
+                domains[vm_name] = domain
+        return domains
+
+    def _pause_all(self, domains, results, parallelism: int):
+        """
+        Pauses every running VM of a group concurrently.
+
+        Args:
+            domains (dict): The domains keyed by VM name.
+            results (dict): The results keyed by VM name, updated in place.
+            parallelism (int): The maximum number of VMs paused at the same time.
+
+        Returns:
+            dict: The time each paused VM was paused at (time.perf_counter), keyed by VM name,
+                  or None if a VM could not be paused and the group was resumed.
+        """
+        def pause(vm_name):
+            domain = domains[vm_name]
+            state, _ = domain.state()
+            if state != VIR_DOMAIN_RUNNING:
+                return None
+            elapsed = self._timed(domain.suspend)
+            return elapsed, time.perf_counter()
+
+        paused, failures = {}, []
+        for vm_name, outcome, error in run_parallel(pause, domains, parallelism):
+            if error is not None:
+                failures.append(vm_name)
+                self._fail(results[vm_name], f"Error pausing VM '{vm_name}': {error}")
+            elif outcome is not None:
+                results[vm_name]["pause_ms"], paused[vm_name] = outcome
+
+        if failures:
+            self._resume_all(domains, paused, results, parallelism)
+            for vm_name in domains:
+                if vm_name not in failures:
+                    # a vm that could not be resumed keeps its error after this one
+                    message = f"Not snapshotted, {', '.join(failures)} could not be paused. {results[vm_name]['message']}"
+                    self._fail(results[vm_name], message.rstrip())
+            return None
+        return paused
+
+    def _resume_all(self, domains, paused, results, parallelism: int):
+        """
+        Resumes the VMs of a group that were paused for their snapshots, concurrently.
+
+        Args:
+            domains (dict): The domains keyed by VM name.
+            paused (dict): The time each VM was paused at, keyed by VM name.
+            results (dict): The results keyed by VM name, updated in place.
+            parallelism (int): The maximum number of VMs resumed at the same time.
+        """
+        for vm_name, elapsed, error in run_parallel(lambda vm_name: self._timed(domains[vm_name].resume), paused, parallelism):
+            if error is not None:
+                self._fail(results[vm_name], f"Error resuming VM '{vm_name}', it is still paused: {error}")
+            else:
+                results[vm_name]["resume_ms"] = elapsed
+                results[vm_name]["paused_ms"] = (time.perf_counter() - paused[vm_name]) * 1000
+
+    def _read_snapshots(self, vm_name: str):
+        """
+        Reads the snapshots of a VM.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+
+        Raises:
+            LibvirtError: If the snapshots cannot be read.
+
+        Returns:
+            list: The snapshots, as returned by get_snapshots.
+        """
+        try:
+            domain = self.connection.lookupByName(vm_name)
+            snapshots = []
+            for snapshot in domain.listAllSnapshots(0):
+                snapshot_xml = ET.fromstring(snapshot.getXMLDesc(0))
+                external = any(disk.get("snapshot") == "external" for disk in snapshot_xml.findall("disks/disk"))
+                created = snapshot_xml.findtext("creationTime")
+                snapshots.append({
+                    "vm": vm_name,
+                    "name": snapshot.getName(),
+                    "created": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(created))) if created else "",
+                    "state": snapshot_xml.findtext("state", ""),
+                    "type": "external" if external else "internal",
+                    "parent": snapshot_xml.findtext("parent/name"),
+                    "current": bool(snapshot.isCurrent(0)),
+                })
+            return sorted(snapshots, key=lambda snapshot: snapshot["created"])
+        except libvirtError as e:
+            raise LibvirtError(f"Error listing snapshots of VM '{vm_name}': {e}")
+
+    def _snapshot_xml(self, snapshot_name: str, description: str = None):
+        """
+        Creates the XML of a snapshot.
+
+        Args:
+            snapshot_name (str): The name of the snapshot.
+            description (str, optional): The description of the snapshot. Defaults to None.
+
+        Returns:
+            str: The snapshot XML.
+        """
+        snapshot = ET.Element("domainsnapshot")
+        ET.SubElement(snapshot, "name").text = snapshot_name
+        if description:
+            ET.SubElement(snapshot, "description").text = description
+        return ET.tostring(snapshot, encoding="unicode")
+
+    def _new_result(self, vm_name: str, snapshot_name: str):
+        """
+        Creates the result of a VM, failed until the snapshot is done.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+            snapshot_name (str): The name of the snapshot.
+
+        Returns:
+            dict: The result, with the "name", "snapshot", "status", "message" and the timings in milliseconds.
+        """
+        return {"name": vm_name, "snapshot": snapshot_name, "status": "failed", "message": "",
+                "pause_ms": None, "snapshot_ms": None, "resume_ms": None, "paused_ms": None}
+
+    def _fail(self, result, message: str):
+        """
+        Marks the result of a VM as failed.
+
+        Args:
+            result (dict): The result, updated in place.
+            message (str): The reason it failed.
+        """
+        result["status"] = "failed"
+        result["message"] = message
+
+    def _timed(self, func):
+        """
+        Calls a function and measures how long it took.
+
+        Args:
+            func (callable): The function.
+
+        Returns:
+            float: The time the call took in milliseconds.
+        """
+        start = time.perf_counter()
+        func()
+        return (time.perf_counter() - start) * 1000
@@ -1,11 +1,37 @@
 """
 This module provides a class for interacting with virtual machines using the libvirt API.
 """
+import fnmatch
+import json
+import queue
+import time
+import xml.etree.ElementTree as ET
 from rich import print
+from utils.manifest import spec_hash
+from utils.pool import run_parallel
 from utils.table import create_table
-from utils.xml import create_xml_config
-from libvirt import libvirtError
+from utils.xml import create_xml_config, create_xml_from_spec
+from wrapper.placement import PlacementEngine, check_placement_strategy, format_cpuset, load_placement_engine, read_placement
+from libvirt import (
+    libvirtError,
+    VIR_DOMAIN_METADATA_ELEMENT,
+    VIR_DOMAIN_EVENT_UNDEFINED,
+    VIR_DOMAIN_RUNNING,
+    VIR_DOMAIN_PAUSED,
+    VIR_DOMAIN_SHUTOFF,
+    VIR_DOMAIN_STATS_STATE,
+    VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING,
+    VIR_CONNECT_GET_ALL_DOMAINS_STATS_PAUSED,
+    VIR_CONNECT_GET_ALL_DOMAINS_STATS_SHUTOFF,
+)
 from utils.errors import VmctlError, LibvirtError
+from wrapper.events import DomainEventFeed, DomainStateCache, StateWaiter, EVENT_NAMES, EVENT_STATES, REBOOT_EVENT
+
+# the spec a vm was applied from is kept in its <metadata>, so a later
+# apply can tell whether it changed without reading back the whole xml
+# reference: https://libvirt.org/formatdomain.html#general-metadata
+APPLY_NAMESPACE = "https://github.com/mohammednumaan/vmctl/apply"
+ET.register_namespace("vmctl", APPLY_NAMESPACE)
 
 # lifecycle management of guest domains
 # reference: https://libvirt-python.readthedocs.io/lifecycle-control/
@@ -14,17 +40,48 @@ class VMApi:
     """
     A class for interacting with virtual machines using the libvirt API.
     """
-    def __init__(self, connection):
+
+    # the state (or reboot) each lifecycle action is complete at, when waiting for it
+    WAIT_TARGETS = {
+        "start": VIR_DOMAIN_RUNNING,
+        "shutdown": VIR_DOMAIN_SHUTOFF,
+        "destroy": VIR_DOMAIN_SHUTOFF,
+        "suspend": VIR_DOMAIN_PAUSED,
+        "resume": VIR_DOMAIN_RUNNING,
+        "reboot": REBOOT_EVENT,
+    }
+
+    # maps each lifecycle action to the method that applies it
+    # and the verb used in its error messages
+    LIFECYCLE_ACTIONS = {
+        "start": ("_start", "starting"),
+        "shutdown": ("_shutdown", "shutting down"),
+        "destroy": ("_destroy", "destroying"),
+        "suspend": ("_suspend", "suspending"),
+        "resume": ("_resume", "resuming"),
+        "reboot": ("_reboot", "rebooting"),
+    }
+
+    APPLY_STATUS_COLORS = {"created": "green", "updated": "yellow", "unchanged": "dim", "failed": "red"}
+
+    def __init__(self, connection, state_cache: DomainStateCache = None, event_feed: DomainEventFeed = None, capacity=None):
         """
         Initializes the VMApi class.
 
         Args:
             connection (libvirt.virConnect): The connection object.
+            state_cache (DomainStateCache, optional): A cache used instead of looking up each VM's state. Defaults to None.
+            event_feed (DomainEventFeed, optional): The connection's lifecycle events, needed to wait for actions to complete. Defaults to None.
+            capacity (CapacityApi, optional): Admits new and starting VMs against the host's capacity. Defaults to None (no checks).
         """
         self.connection = connection
+        self.state_cache = state_cache
+        self.event_feed = event_feed
+        self.capacity = capacity
 
 
-    def provision_vm(self, vm_name: str, vm_memory: int, vm_vcpus: int, iso_path: str = None, disk_path: str = None):
+    def provision_vm(self, vm_name: str, vm_memory: int, vm_vcpus: int, iso_path: str = None, disk_path: str = None,
+                     placement: str = "none", force: bool = False, hugepages=False, qos: str = None):
         """
         Provisions a new virtual machine.
 
@@ -34,6 +91,11 @@ class VMApi:
             vm_vcpus (int): The number of virtual CPUs for the virtual machine.
             iso_path (str, optional): The path to the ISO file for the virtual machine. Defaults to None.
             disk_path (str, optional): The path to the disk file for the virtual machine. Defaults to None.
+            placement (str, optional): Pin the VM to a NUMA node with this strategy (none, auto, pack or spread). Defaults to "none".
+            force (bool, optional): Define the VM even if it exceeds the host's capacity. Defaults to False.
+            hugepages (bool | int, optional): Back the VM's memory with hugepages, of this size in KiB if an int.
+                                              Defaults to False.
+            qos (str, optional): The QoS profile that limits the VM's disk and network I/O. Defaults to None.
         """
         # to provision a vm in libvirt, we need to provide a xml file that defines the vm (size, os, disk path)
         # reference: https://libvirt-python.readthedocs.io/domain-config/
@@ -42,7 +104,10 @@ class VMApi:
         # this version of vmctl is going to provide usability over flexibility
         # hence, the user will not be able to provide a custom xml file
         try:
-            xml_config = create_xml_config(vm_name, vm_memory, vm_vcpus, iso_path, disk_path)
+            warning = self.capacity.admit_new(vm_name, vm_memory, vm_vcpus, force) if self.capacity else ""
+            engine = load_placement_engine(self.connection, placement)
+            vm_placement = engine.place(vm_vcpus, vm_memory) if engine else None
+            xml_config = create_xml_config(vm_name, vm_memory, vm_vcpus, iso_path, disk_path, vm_placement, hugepages, qos)
             if not xml_config:
                 return
 
@@ -50,93 +115,222 @@ class VMApi:
             if domain is None:
                 raise VmctlError("Failed to define a domain from the XML configuration.")
             print(f"Domain [bold bright_cyan]{domain.name()}[/bold bright_cyan] has been defined successfully.")
+            if warning:
+                print(warning)
+            if vm_placement:
+                print(self._describe_placement(vm_placement))
+            if qos:
+                print(f"Its disk and network I/O are limited by the QoS profile [bold]{qos}[/bold].")
             print("You can start the VM using the command: [green]vmctl start <vm_name>[/green]")
         except libvirtError as e:
             raise LibvirtError(f"Failed to define a domain from the XML configuration: {e}")
+        finally:
+            if self.capacity:
+                # the domain is in the next bulk read, or it was never defined
+                self.capacity.invalidate()
 
 
-    def list_vms(self):
+    def apply(self, specs, parallelism: int = 8, dry_run: bool = False, placement: str = "none", force: bool = False):
         """
-        Lists all virtual machines.
+        Provisions the virtual machines declared in a manifest concurrently.
+
+        VMs that do not exist are defined, VMs applied from a different spec are redefined (keeping their UUID),
+        and VMs applied from the same spec are left alone, so applying a manifest twice does nothing the second time.
+
+        Args:
+            specs (list): The specs returned by utils.manifest.load_manifest.
+            parallelism (int, optional): The maximum number of VMs defined at the same time. Defaults to 8.
+            dry_run (bool, optional): Only compute what would change. Defaults to False.
+            placement (str, optional): Pin the defined VMs to NUMA nodes with this strategy (none, auto, pack or spread).
+                                       Defaults to "none".
+            force (bool, optional): Define new VMs even if they exceed the host's capacity. Defaults to False.
+
+        Raises:
+            LibvirtError: If the existing VMs cannot be listed.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (created, updated, unchanged or failed),
+                  "changes" and "message" of each VM.
         """
+        check_placement_strategy(placement)
         try:
-            domains = self.connection.listAllDomains()
-            if not domains:
-                print("[bold bright_yellow]No VMs found[/bold bright_yellow]")
-                return
+            existing = {domain.name(): domain for domain in self.connection.listAllDomains(0)}
+        except libvirtError as e:
+            raise LibvirtError(f"Error listing VMs: {e}")
+        # one engine for the whole manifest, so the vms do not pile up on the same cpus
+        engine = load_placement_engine(self.connection, placement, parallelism) if not dry_run else None
+
+        results = []
+        outcomes = run_parallel(lambda spec: self._apply_spec(spec, existing.get(spec["name"]), dry_run, engine, force), specs, parallelism)
+        for spec, outcome, error in outcomes:
+            if error is not None:
+                message = error.message if isinstance(error, VmctlError) else str(error)
+                results.append({"name": spec["name"], "status": "failed", "changes": "", "message": message})
+            else:
+                results.append(outcome)
+        if self.capacity and not dry_run:
+            self.capacity.invalidate()
+        return results
 
-            columns = [
-                {"header": "VM ID", "style": "bold bright_yellow"},
-                {"header": "VM name", "style": "bold bright_cyan"},
-                {"header": "VM state"},
-            ]
-            rows = []
-            for domain in domains:
-                state, _ = domain.state()
-                vm_name = domain.name()
-                vm_id = "--" if domain.ID() == -1 else str(domain.ID())
 
-                mappedVmState = self._mapVmStateToString(state)
-                mappedVmColor = self._mapStateToColor(mappedVmState)
-                rows.append([vm_id, vm_name, f"[{mappedVmColor}]{mappedVmState}[/{mappedVmColor}]"])
+    def print_apply_results(self, results, dry_run: bool = False):
+        """
+        Displays the results of applying a manifest in a table.
+
+        Args:
+            results (list): The results returned by apply.
+            dry_run (bool, optional): Whether the results come from a dry run. Defaults to False.
+        """
+        if not results:
+            print("[bold bright_yellow]The manifest declares no VMs[/bold bright_yellow]")
+            return
+
+        columns = [
+            {"header": "VM name", "style": "bold bright_cyan"},
+            {"header": "Status"},
+            {"header": "Changes"},
+            {"header": "Message"},
+        ]
+        rows = []
+        counts = {status: 0 for status in self.APPLY_STATUS_COLORS}
+        for result in results:
+            color = self.APPLY_STATUS_COLORS[result["status"]]
+            counts[result["status"]] += 1
+            rows.append([result["name"], f"[{color}]{result['status']}[/{color}]", result["changes"], result["message"]])
+
+        summary = ", ".join(f"{count} {status}" for status, count in counts.items())
+        create_table(f"{'Plan' if dry_run else 'Apply'} {len(results)} VMs ({summary})", columns, rows)
+
+
+    def get_vms(self, states=None):
+        """
+        Gets the id, name and state of all virtual machines.
+
+        Args:
+            states (list, optional): Only include VMs in one of these states (running, paused, shutoff).
+                                     Defaults to None, which includes every VM.
+
+        Returns:
+            list: A list of dictionaries with the "id", "name" and "state" of each VM.
+        """
+        return list(self.iter_vms(states))
+
+    def iter_vms(self, states=None):
+        """
+        Like get_vms, but yields each VM as soon as it is processed.
+
+        Args:
+            states (list, optional): Only include VMs in one of these states (running, paused, shutoff).
+                                     Defaults to None, which includes every VM.
 
-            create_table("List of VMs", columns, rows)
+        Yields:
+            dict: The "id", "name" and "state" of a VM.
+        """
+        # a single getAllDomainStats call returns every domain together with its state,
+        # so the number of round trips stays the same no matter how many domains exist.
+        # name() and ID() are read from the domain object itself and never hit the daemon.
+        # reference: https://libvirt.org/html/libvirt-libvirt-domain.html#virConnectGetAllDomainStats
+        try:
+            flags = self._mapStateFiltersToFlags(states)
+            domain_stats = self.connection.getAllDomainStats(VIR_DOMAIN_STATS_STATE, flags)
         except libvirtError as e:
             raise LibvirtError(f"Error listing VMs: {e}")
 
-    def vm_info(self, vm_name):
+        for domain, stats in domain_stats:
+            vm_id = domain.ID()
+            yield {
+                "id": None if vm_id == -1 else vm_id,
+                "name": domain.name(),
+                "state": self._mapVmStateToString(stats.get("state.state")),
+            }
+
+    def list_vms(self, states=None):
+        """
+        Lists all virtual machines.
+
+        Args:
+            states (list, optional): Only list VMs in one of these states (running, paused, shutoff).
+                                     Defaults to None, which lists every VM.
+        """
+        vms = self.get_vms(states)
+        if not vms:
+            print("[bold bright_yellow]No VMs found[/bold bright_yellow]")
+            return
+
+        columns = [
+            {"header": "VM ID", "style": "bold bright_yellow"},
+            {"header": "VM name", "style": "bold bright_cyan"},
+            {"header": "VM state"},
+        ]
+        rows = []
+        for vm in vms:
+            vm_id = "--" if vm["id"] is None else str(vm["id"])
+            mappedVmColor = self._mapStateToColor(vm["state"])
+            rows.append([vm_id, vm["name"], f"[{mappedVmColor}]{vm['state']}[/{mappedVmColor}]"])
+
+        create_table("List of VMs", columns, rows)
+
+    def get_vm_info(self, vm_name):
         """
         Gets information about a virtual machine.
 
         Args:
             vm_name (str): The name of the virtual machine.
+
+        Returns:
+            dict: The "id", "name", "state", "memory" and "max_memory" (in KiB), "vcpus" and "cpu_time" (in ns) of the VM.
         """
         try:
             domain = self.connection.lookupByName(vm_name)
             state, max_mem, curr_mem, no_vcpu, cpu_time = domain.info()
 
-            vm_id = "--" if domain.ID() == -1 else str(domain.ID())
-            mappedVmState = self._mapVmStateToString(state)
-
-            title = f"Virtual Machine [bold bright_cyan]{vm_name}[/bold bright_cyan] Info"
-            columns = [
-                {"header": "VM ID"},
-                {"header": "VM name"},
-                {"header": "VM state"},
-                {"header": "VM current memory"},
-                {"header": "VM max memory"},
-                {"header": "VM number of vCPU's"},
-                {"header": "VM CPU time used"},
-            ]
-            rows = [[vm_id, vm_name, mappedVmState, str(max_mem), str(curr_mem), str(no_vcpu), str(cpu_time)]]
-            create_table(title, columns, rows)
+            vm_id = domain.ID()
+            return {
+                "id": None if vm_id == -1 else vm_id,
+                "name": vm_name,
+                "state": self._mapVmStateToString(state),
+                "memory": curr_mem,
+                "max_memory": max_mem,
+                "vcpus": no_vcpu,
+                "cpu_time": cpu_time,
+            }
         except libvirtError as e:
             raise LibvirtError(f"Error getting VM info for '{vm_name}': {e}")
 
+    def vm_info(self, vm_name):
+        """
+        Displays information about a virtual machine.
 
-    def start_vm(self, vm_name):
+        Args:
+            vm_name (str): The name of the virtual machine.
+        """
+        vm = self.get_vm_info(vm_name)
+        vm_id = "--" if vm["id"] is None else str(vm["id"])
+
+        title = f"Virtual Machine [bold bright_cyan]{vm_name}[/bold bright_cyan] Info"
+        columns = [
+            {"header": "VM ID"},
+            {"header": "VM name"},
+            {"header": "VM state"},
+            {"header": "VM current memory"},
+            {"header": "VM max memory"},
+            {"header": "VM number of vCPU's"},
+            {"header": "VM CPU time used"},
+        ]
+        rows = [[vm_id, vm_name, vm["state"], str(vm["memory"]), str(vm["max_memory"]), str(vm["vcpus"]), str(vm["cpu_time"])]]
+        create_table(title, columns, rows)
+
+
+    def start_vm(self, vm_name, force: bool = False):
         """
         Starts a virtual machine.
 
         Args:
             vm_name (str): The name of the virtual machine.
+            force (bool, optional): Start the VM even if it exceeds the host's capacity. Defaults to False.
         """
-        try:
-            domain = self.conection.lookupByName(vm_name)
-            state, _ = domain.state()
-            mapped_vm_state = self._mapVmStateToString(state)
-
-            if mapped_vm_state == "running":
-                print(f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is already in [green]running[/green] state.")
-            elif mapped_vm_state == "paused":
-                print(f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is [cyan]paused[/cyan]. Resume it instead of starting.")
-            elif mapped_vm_state == "suspended":
-                print(f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is [magenta]suspended[/magenta]. Resume it instead of starting.")
-            else:
-                domain.create()
-                print(f"Started VM [bold bright_cyan]{domain.name()}[/bold bright_cyan]. VM is now in [green]running[/green] state.")
-        except libvirtError as e:
-            raise LibvirtError(f"Error starting VM '{vm_name}': {e}")
+        _, message = self._run_lifecycle_action("start", vm_name, force=force)
+        print(message)
 
 
     def shutdown_vm(self, vm_name):
@@ -146,24 +340,8 @@ class VMApi:
         Args:
             vm_name (str): The name of the virtual machine.
         """
-        try:
-            domain = self.connection.lookupByName(vm_name)
-            state, _ = domain.state()
-            mapped_vm_state = self._mapVmStateToString(state)
-
-            if mapped_vm_state == "shutoff":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is already shut off.")
-            elif mapped_vm_state == "suspended":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is suspended. Resume it first.")
-            elif mapped_vm_state == "paused":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is paused. Resume it first.")
-            elif mapped_vm_state != "running":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is not running. Current state is [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}].")
-            else:
-                domain.shutdown()
-                print(f"[red]Shutting down[/red] VM [bold bright_cyan]{domain.name()}[/bold bright_cyan].")
-        except libvirtError as e:
-            raise LibvirtError(f"Error shutting down VM '{vm_name}': {e}")
+        _, message = self._run_lifecycle_action("shutdown", vm_name)
+        print(message)
 
 
     def destroy_vm(self, vm_name):
@@ -173,20 +351,8 @@ class VMApi:
         Args:
             vm_name (str): The name of the virtual machine.
         """
-        try:
-            domain = self.connection.lookupByName(vm_name)
-            state, _ = domain.state()
-            mapped_vm_state = self._mapVmStateToString(state)
-
-            if mapped_vm_state == "shutoff":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is already shut off.")
-            elif mapped_vm_state not in ["running", "paused", "blocked"]:
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] cannot be forcefully shut down from its current state: [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}].")
-            else:
-                domain.destroy()
-                print(f"[red]Forcefully[/red] shutting down VM [bold bright_cyan]{domain.name()}[/bold bright_cyan].")
-        except libvirtError as e:
-            raise LibvirtError(f"Error destroying VM '{vm_name}': {e}")
+        _, message = self._run_lifecycle_action("destroy", vm_name)
+        print(message)
 
 
     def suspend_vm(self, vm_name):
@@ -196,24 +362,8 @@ class VMApi:
         Args:
             vm_name (str): The name of the virtual machine.
         """
-        try:
-            domain = self.connection.lookupByName(vm_name)
-            state, _ = domain.state()
-            mapped_vm_state = self._mapVmStateToString(state)
-
-            if mapped_vm_state == "suspended":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is already suspended.")
-            elif mapped_vm_state == "paused":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is paused. Resume it first.")
-            elif mapped_vm_state == "shutoff":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is shut off. Start it first.")
-            elif mapped_vm_state != "running":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] cannot be suspended from its current state: [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}].")
-            else:
-                domain.suspend()
-                print(f"[bright_yellow]Suspending[/bright_yellow] VM [bold bright_cyan]{domain.name()}[/bold bright_cyan].")
-        except libvirtError as e:
-            raise LibvirtError(f"Error suspending VM '{vm_name}': {e}")
+        _, message = self._run_lifecycle_action("suspend", vm_name)
+        print(message)
 
 
     def resume_vm(self, vm_name):
@@ -223,51 +373,570 @@ class VMApi:
         Args:
             vm_name (str): The name of the virtual machine.
         """
+        _, message = self._run_lifecycle_action("resume", vm_name)
+        print(message)
+
+
+    def reboot_vm(self, vm_name):
+        """
+        Reboots a virtual machine.
+
+        Args:
+            vm_name (str): The name of the virtual machine.
+        """
+        _, message = self._run_lifecycle_action("reboot", vm_name)
+        print(message)
+
+
+    def watch(self, feed: DomainEventFeed, patterns=None):
+        """
+        Displays VM state transitions as they happen, until interrupted.
+
+        Args:
+            feed (DomainEventFeed): The event feed of this VMApi's connection.
+            patterns (list, optional): Only show VMs matching these names or glob patterns. Defaults to None.
+        """
+        states = {vm["name"]: vm["state"] for vm in self.get_vms()}
+        events = queue.Queue()
+        callback = lambda domain, event, detail: events.put((time.time(), domain.name(), event))
+        feed.subscribe(callback)
+        print(f"Watching [bold]{'all VMs' if not patterns else ', '.join(patterns)}[/bold]. Press [green]Ctrl+C[/green] to stop.")
+
         try:
-            domain = self.connection.lookupByName(vm_name)
-            state, _ = domain.state()
-            mapped_vm_state = self._mapVmStateToString(state)
-
-            if mapped_vm_state == "running":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is already running.")
-            elif mapped_vm_state == "shutoff":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is shut off. Start it first.")
-            elif mapped_vm_state not in ["paused", "suspended"]:
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] cannot be resumed from its current state: [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}].")
+            while True:
+                timestamp, vm_name, event = events.get()
+                if patterns and not any(fnmatch.fnmatchcase(vm_name, pattern) for pattern in patterns):
+                    continue
+
+                old_state = states.get(vm_name, "unknown")
+                new_state = EVENT_STATES.get(event)
+                new_state = old_state if new_state is None else self._mapVmStateToString(new_state)
+                if event == VIR_DOMAIN_EVENT_UNDEFINED:
+                    states.pop(vm_name, None)
+                else:
+                    states[vm_name] = new_state
+
+                old_color, new_color = self._mapStateToColor(old_state), self._mapStateToColor(new_state)
+                print(f"{time.strftime('%H:%M:%S', time.localtime(timestamp))}  VM [bold bright_cyan]{vm_name}[/bold bright_cyan] "
+                      f"[{old_color}]{old_state}[/{old_color}] -> [{new_color}]{new_state}[/{new_color}] ({EVENT_NAMES.get(event, 'unknown')})")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            feed.unsubscribe(callback)
+
+
+    def resolve_vms(self, patterns, all_vms: bool = False, states=None):
+        """
+        Resolves VM names and glob patterns (e.g. web-*) to a list of VM names.
+
+        Args:
+            patterns (list): The VM names or glob patterns.
+            all_vms (bool, optional): Select every VM instead of matching patterns. Defaults to False.
+            states (list, optional): Only select VMs in one of these states (running, paused, shutoff).
+                                     Defaults to None.
+
+        Raises:
+            VmctlError: If no VM names, patterns or --all were provided.
+
+        Returns:
+            list: The matching VM names, without duplicates, in the order they were matched.
+        """
+        patterns = patterns or []
+        if not patterns and not all_vms:
+            raise VmctlError("Provide at least one VM name or pattern, or use --all.")
+
+        # plain names can be used as they are, the domains only need
+        # to be listed (once) when there is something to match against
+        needs_listing = all_vms or states or any(self._isGlobPattern(pattern) for pattern in patterns)
+        listed_names = [vm["name"] for vm in self.get_vms(states)] if needs_listing else None
+
+        if all_vms:
+            return listed_names
+
+        vm_names = []
+        for pattern in patterns:
+            if self._isGlobPattern(pattern):
+                matches = fnmatch.filter(listed_names, pattern)
+            elif not states or pattern in listed_names:
+                # unknown names are kept so they are reported as failures
+                matches = [pattern]
+            else:
+                matches = []
+
+            for vm_name in matches:
+                if vm_name not in vm_names:
+                    vm_names.append(vm_name)
+        return vm_names
+
+
+    def run_action(self, action: str, vm_names, parallelism: int = 8, wait: bool = False, timeout: float = None, escalate: bool = False,
+                   force: bool = False):
+        """
+        Applies a lifecycle action to many virtual machines concurrently.
+
+        A failure on one VM does not abort the others, it is reported in its result instead.
+
+        Args:
+            action (str): The lifecycle action (start, shutdown, destroy, suspend, resume or reboot).
+            vm_names (list): The names of the virtual machines.
+            parallelism (int, optional): The maximum number of VMs acted on at the same time. Defaults to 8.
+            wait (bool, optional): Wait until each VM reached the action's target state. Defaults to False.
+            timeout (float, optional): The maximum time to wait in seconds. Defaults to None (no limit).
+            escalate (bool, optional): Destroy VMs that did not shut down before the timeout. Defaults to False.
+            force (bool, optional): Start VMs even if they exceed the host's capacity. Defaults to False.
+
+        Raises:
+            VmctlError: If the action is not supported, or waiting is requested without an event feed.
+
+        Returns:
+            list: A list of dictionaries with the "name", "status" (done, skipped or failed) and "message" of each VM.
+        """
+        if action not in self.LIFECYCLE_ACTIONS:
+            raise VmctlError(f"Unsupported action '{action}'.")
+        if wait and self.event_feed is None:
+            raise VmctlError("Waiting for VMs requires a connection that receives lifecycle events.")
+
+        # the states of all the vms are read with one bulk call up front,
+        # instead of a lookup and a state call for every single vm
+        state_cache = self.state_cache
+        if state_cache is None:
+            state_cache = DomainStateCache(self.connection)
+            state_cache.populate()
+
+        # every vm is watched before it is acted on, so its
+        # completion event cannot arrive before we listen for it
+        waiter = StateWaiter(self.event_feed) if wait else None
+        if waiter is not None:
+            for vm_name in vm_names:
+                waiter.expect(vm_name, self.WAIT_TARGETS[action])
+
+        try:
+            results = []
+            outcomes = run_parallel(lambda vm_name: self._run_lifecycle_action(action, vm_name, state_cache, force), vm_names, parallelism)
+            for vm_name, outcome, error in outcomes:
+                if error is not None:
+                    message = error.message if isinstance(error, VmctlError) else str(error)
+                    results.append({"name": vm_name, "status": "failed", "message": message})
+                else:
+                    performed, message = outcome
+                    results.append({"name": vm_name, "status": "done" if performed else "skipped", "message": message})
+
+            if waiter is not None:
+                self._wait_for_results(action, results, waiter, timeout, escalate, parallelism)
+            return results
+        finally:
+            if waiter is not None:
+                waiter.close()
+
+
+    def print_action_results(self, action: str, results):
+        """
+        Displays the results of a batch lifecycle action in a table.
+
+        Args:
+            action (str): The lifecycle action that was applied.
+            results (list): The results returned by run_action.
+        """
+        if not results:
+            print("[bold bright_yellow]No VMs matched[/bold bright_yellow]")
+            return
+
+        status_colors = {"done": "green", "skipped": "yellow", "failed": "red"}
+        columns = [
+            {"header": "VM name", "style": "bold bright_cyan"},
+            {"header": "Status"},
+            {"header": "Message"},
+        ]
+        rows = []
+        for result in results:
+            color = status_colors[result["status"]]
+            rows.append([result["name"], f"[{color}]{result['status']}[/{color}]", result["message"]])
+
+        failed = sum(1 for result in results if result["status"] == "failed")
+        create_table(f"{action.capitalize()} {len(results)} VMs ({failed} failed)", columns, rows)
+
+
+    def _wait_for_results(self, action: str, results, waiter: StateWaiter, timeout: float, escalate: bool, parallelism: int):
+        """
+        Waits for the VMs an action was performed on and updates their results.
+
+        Args:
+            action (str): The lifecycle action that was applied.
+            results (list): The results returned for each VM, updated in place.
+            waiter (StateWaiter): The waiter every VM was registered with.
+            timeout (float): The maximum time to wait in seconds, or None.
+            escalate (bool): Destroy VMs that did not shut down before the timeout.
+            parallelism (int): The maximum number of VMs destroyed at the same time.
+        """
+        performed = [result for result in results if result["status"] == "done"]
+        started_at = time.monotonic()
+        reached = waiter.wait([result["name"] for result in performed], timeout)
+        elapsed = time.monotonic() - started_at
+
+        timed_out = []
+        for result in performed:
+            if reached[result["name"]]:
+                result["message"] += f" Completed after {elapsed:.1f}s." if len(performed) == 1 else " Completed."
             else:
-                domain.resume()
-                print(f"[green]Resuming[/green] VM [bold bright_cyan]{domain.name()}[/bold bright_cyan].")
+                timed_out.append(result)
+
+        if escalate and action == "shutdown" and timed_out:
+            outcomes = run_parallel(lambda result: self._run_lifecycle_action("destroy", result["name"]), timed_out, parallelism)
+            for result, outcome, error in outcomes:
+                if error is None and outcome[0]:
+                    result["message"] = f"[red]Destroyed[/red] VM [bold bright_cyan]{result['name']}[/bold bright_cyan] after shutdown timed out."
+                    timed_out.remove(result)
+
+        for result in timed_out:
+            result["status"] = "failed"
+            result["message"] += f" Timed out after {timeout:g}s waiting for it to complete."
+
+    def _apply_spec(self, spec, domain, dry_run: bool, engine: PlacementEngine = None, force: bool = False):
+        """
+        Defines or redefines one virtual machine from its spec, if it changed.
+
+        Args:
+            spec (dict): The spec of the VM.
+            domain (libvirt.virDomain): The existing domain with the same name, or None.
+            dry_run (bool): Only compute what would change.
+            engine (PlacementEngine, optional): The engine that places the VM on a NUMA node. Defaults to None (no pinning).
+            force (bool, optional): Define the VM even if it exceeds the host's capacity. Defaults to False.
+
+        Raises:
+            VmctlError: If a VM with the same name exists but was not created by apply, or a new VM exceeds the host's capacity.
+
+        Returns:
+            dict: The result of the VM, as returned by apply.
+        """
+        vm_name = spec["name"]
+        try:
+            if domain is None:
+                changes = "+ " + ", ".join(f"{key}={value}" for key, value in spec.items() if key != "name")
+                message = "Would be defined."
+                if not dry_run:
+                    # admitted before it is placed, so a refused vm does not take up pinned cpus
+                    warning = self.capacity.admit_new(vm_name, spec["memory"], spec["vcpus"], force) if self.capacity else ""
+                    vm_placement = None
+                    try:
+                        vm_placement = engine.place(spec["vcpus"], spec["memory"]) if engine else None
+                        self.connection.defineXML(self._spec_xml(spec, placement=vm_placement))
+                    except (libvirtError, VmctlError):
+                        # the vm was not defined, what was set aside for it is given back,
+                        # so the later vms of the manifest are not refused because of it
+                        if vm_placement:
+                            engine.release(vm_placement, spec["memory"])
+                        if self.capacity:
+                            self.capacity.release_new(vm_name)
+                        raise
+                    message = "Defined." + (f" {self._describe_placement(vm_placement)}" if vm_placement else "")
+                    message += f" {warning}" if warning else ""
+                return {"name": vm_name, "status": "created", "changes": changes, "message": message}
+
+            applied_hash, applied = self._read_applied_spec(domain)
+            if applied is None:
+                raise VmctlError(f"VM '{vm_name}' already exists and was not created by vmctl apply.")
+            if applied_hash == spec_hash(spec):
+                return {"name": vm_name, "status": "unchanged", "changes": "", "message": "Up to date."}
+
+            changes = ", ".join(f"~ {key}: {applied.get(key, '-')} -> {spec.get(key, '-')}"
+                                for key in sorted(set(applied) | set(spec)) if applied.get(key) != spec.get(key))
+            if dry_run:
+                message = "Would be redefined."
+            else:
+                vm_placement = None
+                if engine:
+                    # the engine counted the vm's current pins (and memory, while it runs),
+                    # which it gives up for its new placement
+                    current = read_placement(domain.XMLDesc(0))
+                    current_memory = current["memory"] if domain.isActive() else 0
+                    engine.release(current, current_memory)
+                    try:
+                        vm_placement = engine.place(spec["vcpus"], spec["memory"])
+                    except VmctlError:
+                        engine.reserve(current, current_memory)
+                        raise
+                try:
+                    self.connection.defineXML(self._spec_xml(spec, domain.UUIDString(), vm_placement))
+                except libvirtError:
+                    if engine:
+                        # the vm keeps its current placement
+                        engine.release(vm_placement, spec["memory"])
+                        engine.reserve(current, current_memory)
+                    raise
+                # the new definition of a running vm only applies from its next boot
+                message = "Redefined, the changes apply from the next boot." if domain.isActive() else "Redefined."
+                message += f" {self._describe_placement(vm_placement)}" if vm_placement else ""
+            return {"name": vm_name, "status": "updated", "changes": changes, "message": message}
         except libvirtError as e:
-            raise LibvirtError(f"Error resuming VM '{vm_name}': {e}")
+            raise LibvirtError(f"Error defining VM '{vm_name}': {e}")
 
+    def _read_applied_spec(self, domain):
+        """
+        Reads the spec a domain was applied from, out of its metadata.
 
-    def reboot_vm(self, vm_name):
+        Args:
+            domain (libvirt.virDomain): The domain.
+
+        Returns:
+            tuple: The hash of the spec and the spec, or (None, None) if the domain was not created by apply.
         """
-        Reboots a virtual machine.
+        try:
+            element = ET.fromstring(domain.metadata(VIR_DOMAIN_METADATA_ELEMENT, APPLY_NAMESPACE, 0))
+            return element.get("hash"), json.loads(element.text)
+        except libvirtError:
+            # there is no metadata in our namespace
+            return None, None
+        except (ET.ParseError, TypeError, ValueError):
+            return None, None
+
+    def _spec_xml(self, spec, uuid: str = None, placement=None):
+        """
+        Creates the XML configuration of a virtual machine from its spec.
 
         Args:
+            spec (dict): The spec of the VM.
+            uuid (str, optional): The UUID of the existing domain being redefined. Defaults to None.
+            placement (dict, optional): The NUMA node and CPUs to pin the VM to. Defaults to None.
+
+        Returns:
+            str: The XML configuration, with the spec stored in its metadata.
+        """
+        applied = ET.Element(f"{{{APPLY_NAMESPACE}}}spec", {"hash": spec_hash(spec)})
+        applied.text = json.dumps(spec, sort_keys=True)
+        # redefining a domain under the same name needs its uuid,
+        # libvirt refuses a second domain with a new one
+        return create_xml_from_spec(spec, uuid, applied, placement)
+
+    def _describe_placement(self, placement):
+        """
+        Describes where a VM was placed.
+
+        Args:
+            placement (dict): The placement returned by PlacementEngine.place.
+
+        Returns:
+            str: The description.
+        """
+        return f"Pinned to NUMA node {placement['node']} (CPUs {format_cpuset(placement['cpus'])})."
+
+    def _run_lifecycle_action(self, action: str, vm_name: str, state_cache: DomainStateCache = None, force: bool = False):
+        """
+        Looks up a virtual machine and applies a lifecycle action to it.
+
+        Args:
+            action (str): The lifecycle action (start, shutdown, destroy, suspend, resume or reboot).
             vm_name (str): The name of the virtual machine.
+            state_cache (DomainStateCache, optional): The cache to read the VM's state from. Defaults to the VMApi's cache.
+            force (bool, optional): Start the VM even if it exceeds the host's capacity. Defaults to False.
+
+        Raises:
+            VmctlError: If starting the VM would exceed the host's capacity.
+
+        Returns:
+            tuple: Whether the action was performed and a message describing the outcome.
         """
+        method_name, verb = self.LIFECYCLE_ACTIONS[action]
+        state_cache = state_cache or self.state_cache
+        admitted = False
         try:
-            domain = self.connection.lookupByName(vm_name)
-            state, _ = domain.state()
-            mapped_vm_state = self._mapVmStateToString(state)
-
-            if mapped_vm_state == "shutoff":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is shut off. Start it first.")
-            elif mapped_vm_state == "suspended":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is suspended. Resume it first.")
-            elif mapped_vm_state == "paused":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] is paused. Resume it first.")
-            elif mapped_vm_state != "running":
-                print(f"VM [bold bright_cyan]{vm_name}[/bold bright_cyan] cannot be rebooted from its current state: [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}].")
+            if state_cache is not None:
+                domain, state = state_cache.get(vm_name)
             else:
-                domain.reboot()
-                print(f"[yellow]Rebooting[/yellow] VM [bold bright_cyan]{domain.name()}[/bold bright_cyan].")
+                domain = self.connection.lookupByName(vm_name)
+                state, _ = domain.state()
+
+            warning = ""
+            if action == "start" and self.capacity and self._mapVmStateToString(state) not in ("running", "paused", "suspended"):
+                warning = self.capacity.admit_start(vm_name, force)
+                admitted = True
+
+            performed, message = getattr(self, method_name)(domain, state)
+            if performed and state_cache is not None:
+                state_cache.invalidate(vm_name)
+            if performed and action != "start" and self.capacity:
+                # stopped vms give their resources back
+                self.capacity.invalidate()
+            return performed, f"{message} {warning}" if warning else message
         except libvirtError as e:
-            raise LibvirtError(f"Error rebooting VM '{vm_name}': {e}")
+            if admitted:
+                self.capacity.release(vm_name)
+            raise LibvirtError(f"Error {verb} VM '{vm_name}': {e}")
+
+    def _start(self, domain, state):
+        """
+        Starts a domain if its current state allows it.
+
+        Args:
+            domain (libvirt.virDomain): The domain.
+            state (int): The current state of the domain.
+
+        Returns:
+            tuple: Whether the domain was started and a message describing the outcome.
+        """
+        mapped_vm_state = self._mapVmStateToString(state)
+
+        if mapped_vm_state == "running":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is already in [green]running[/green] state."
+        elif mapped_vm_state == "paused":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is [cyan]paused[/cyan]. Resume it instead of starting."
+        elif mapped_vm_state == "suspended":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is [magenta]suspended[/magenta]. Resume it instead of starting."
+        domain.create()
+        return True, f"Started VM [bold bright_cyan]{domain.name()}[/bold bright_cyan]. VM is now in [green]running[/green] state."
+
+    def _shutdown(self, domain, state):
+        """
+        Shuts down a domain if its current state allows it.
+
+        Args:
+            domain (libvirt.virDomain): The domain.
+            state (int): The current state of the domain.
+
+        Returns:
+            tuple: Whether the domain was shut down and a message describing the outcome.
+        """
+        mapped_vm_state = self._mapVmStateToString(state)
+
+        if mapped_vm_state == "shutoff":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is already shut off."
+        elif mapped_vm_state == "suspended":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is suspended. Resume it first."
+        elif mapped_vm_state == "paused":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is paused. Resume it first."
+        elif mapped_vm_state != "running":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is not running. Current state is [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}]."
+        domain.shutdown()
+        return True, f"[red]Shutting down[/red] VM [bold bright_cyan]{domain.name()}[/bold bright_cyan]."
+
+    def _destroy(self, domain, state):
+        """
+        Destroys a domain if its current state allows it.
+
+        Args:
+            domain (libvirt.virDomain): The domain.
+            state (int): The current state of the domain.
+
+        Returns:
+            tuple: Whether the domain was destroyed and a message describing the outcome.
+        """
+        mapped_vm_state = self._mapVmStateToString(state)
+
+        if mapped_vm_state == "shutoff":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is already shut off."
+        elif mapped_vm_state not in ["running", "paused", "blocked"]:
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] cannot be forcefully shut down from its current state: [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}]."
+        domain.destroy()
+        return True, f"[red]Forcefully[/red] shutting down VM [bold bright_cyan]{domain.name()}[/bold bright_cyan]."
+
+    def _suspend(self, domain, state):
+        """
+        Suspends a domain if its current state allows it.
+
+        Args:
+            domain (libvirt.virDomain): The domain.
+            state (int): The current state of the domain.
+
+        Returns:
+            tuple: Whether the domain was suspended and a message describing the outcome.
+        """
+        mapped_vm_state = self._mapVmStateToString(state)
+
+        if mapped_vm_state == "suspended":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is already suspended."
+        elif mapped_vm_state == "paused":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is paused. Resume it first."
+        elif mapped_vm_state == "shutoff":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is shut off. Start it first."
+        elif mapped_vm_state != "running":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] cannot be suspended from its current state: [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}]."
+        domain.suspend()
+        return True, f"[bright_yellow]Suspending[/bright_yellow] VM [bold bright_cyan]{domain.name()}[/bold bright_cyan]."
+
+    def _resume(self, domain, state):
+        """
+        Resumes a domain if its current state allows it.
 
-    def _mapVmStateToString(self, vm_state):
+        Args:
+            domain (libvirt.virDomain): The domain.
+            state (int): The current state of the domain.
+
+        Returns:
+            tuple: Whether the domain was resumed and a message describing the outcome.
+        """
+        mapped_vm_state = self._mapVmStateToString(state)
+
+        if mapped_vm_state == "running":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is already running."
+        elif mapped_vm_state == "shutoff":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is shut off. Start it first."
+        elif mapped_vm_state not in ["paused", "suspended"]:
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] cannot be resumed from its current state: [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}]."
+        domain.resume()
+        return True, f"[green]Resuming[/green] VM [bold bright_cyan]{domain.name()}[/bold bright_cyan]."
+
+    def _reboot(self, domain, state):
+        """
+        Reboots a domain if its current state allows it.
+
+        Args:
+            domain (libvirt.virDomain): The domain.
+            state (int): The current state of the domain.
+
+        Returns:
+            tuple: Whether the domain was rebooted and a message describing the outcome.
+        """
+        mapped_vm_state = self._mapVmStateToString(state)
+
+        if mapped_vm_state == "shutoff":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is shut off. Start it first."
+        elif mapped_vm_state == "suspended":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is suspended. Resume it first."
+        elif mapped_vm_state == "paused":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] is paused. Resume it first."
+        elif mapped_vm_state != "running":
+            return False, f"VM [bold bright_cyan]{domain.name()}[/bold bright_cyan] cannot be rebooted from its current state: [{self._mapStateToColor(mapped_vm_state)}]{mapped_vm_state}[/{self._mapStateToColor(mapped_vm_state)}]."
+        domain.reboot()
+        return True, f"[yellow]Rebooting[/yellow] VM [bold bright_cyan]{domain.name()}[/bold bright_cyan]."
+
+    def _isGlobPattern(self, pattern):
+        """
+        Checks whether a VM name is a glob pattern.
+
+        Args:
+            pattern (str): The VM name or pattern.
+
+        Returns:
+            bool: True if the name contains glob characters.
+        """
+        return any(char in pattern for char in "*?[")
+
+    def _mapStateFiltersToFlags(self, states):
+        """
+        Maps a list of VM state filters to libvirt's domain listing flags.
+
+        Args:
+            states (list): The VM states to filter on (running, paused, shutoff).
+
+        Raises:
+            VmctlError: If an unsupported state is provided.
+
+        Returns:
+            int: The flags to pass to getAllDomainStats.
+        """
+        flag_mapping = {
+            "running": VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING,
+            "paused": VIR_CONNECT_GET_ALL_DOMAINS_STATS_PAUSED,
+            "shutoff": VIR_CONNECT_GET_ALL_DOMAINS_STATS_SHUTOFF,
+        }
+        flags = 0
+        for state in states or []:
+            if state not in flag_mapping:
+                raise VmctlError(f"Unsupported state filter '{state}'. Use one of: {', '.join(flag_mapping)}.")
+            flags |= flag_mapping[state]
+        return flags
+
+    @staticmethod
+    def _mapVmStateToString(vm_state):
         """
         Maps a VM state to a string.
 
@@ -290,7 +959,8 @@ class VMApi:
         return string_mapping.get(vm_state, "unknown")
 
 
-    def _mapStateToColor(self, vm_state_string):
+    @staticmethod
+    def _mapStateToColor(vm_state_string):
         """
         Maps a VM state string to a color.
 
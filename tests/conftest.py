@@ -0,0 +1,5 @@
+import os
+import sys
+
+# vmctl is not installed as a package, its modules are imported from src like main.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
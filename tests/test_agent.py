@@ -0,0 +1,151 @@
+import base64
+import os
+import threading
+import pytest
+
+pytest.importorskip("libvirt")
+
+from utils.errors import VmctlError
+from wrapper.agent import GuestAgentApi
+
+
+def encode(text: str):
+    return base64.b64encode(text.encode()).decode()
+
+
+class StubTransport:
+    """Answers guest agent commands from scripted replies, and records every command sent."""
+
+    def __init__(self, status=None, chunks=None):
+        # vm name -> the guest-exec-status replies, the last one repeated, and the guest-file-read replies in order
+        self.status = status or {}
+        self.chunks = chunks or {}
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def command(self, vm_name, execute, arguments=None, timeout=5.0):
+        with self.lock:
+            self.sent.append((vm_name, execute, arguments))
+        if execute == "guest-exec":
+            return {"pid": 1000}
+        if execute == "guest-exec-status":
+            replies = self.status[vm_name]
+            return replies.pop(0) if len(replies) > 1 else replies[0]
+        if execute == "guest-file-open":
+            return 7
+        if execute == "guest-file-read":
+            chunk = self.chunks[vm_name].pop(0)
+            if isinstance(chunk, Exception):
+                raise chunk
+            return chunk
+        if execute == "guest-file-close":
+            return {}
+        raise ValueError(f"The stub does not answer {execute}.")
+
+    def executed(self, vm_name):
+        return [arguments for name, execute, arguments in self.sent if name == vm_name and execute == "guest-exec"]
+
+
+def by_name(results):
+    return {result["name"]: result for result in results}
+
+
+def test_exec_reports_exit_codes():
+    transport = StubTransport({
+        "ok": [{"exited": False}, {"exited": True, "exitcode": 0, "out-data": encode("up 3 days\n")}],
+        "bad": [{"exited": True, "exitcode": 2, "err-data": encode("no such file\n")}],
+        "killed": [{"exited": True, "signal": 9}],
+    })
+    results = by_name(GuestAgentApi(None, transport).exec(["ok", "bad", "killed"], ["uptime"], timeout=5))
+
+    assert results["ok"]["status"] == "done" and results["ok"]["exitcode"] == 0
+    assert results["ok"]["stdout"] == "up 3 days\n"
+    assert results["bad"]["status"] == "failed" and results["bad"]["exitcode"] == 2
+    assert results["bad"]["stderr"] == "no such file\n"
+    assert results["bad"]["message"] == "Exited with 2."
+    assert results["killed"]["status"] == "failed" and results["killed"]["exitcode"] is None
+    assert results["killed"]["message"] == "Killed by signal 9."
+
+
+def test_exec_times_out_on_commands_that_keep_running():
+    transport = StubTransport({"slow": [{"exited": False}], "fast": [{"exited": True, "exitcode": 0}]})
+    results = by_name(GuestAgentApi(None, transport).exec(["slow", "fast"], ["sleep", "60"], timeout=0.2))
+
+    assert results["slow"]["status"] == "timeout"
+    assert results["slow"]["exitcode"] is None
+    assert results["slow"]["seconds"] >= 0.2
+    assert "pid 1000" in results["slow"]["message"]
+    assert results["fast"]["status"] == "done"
+
+
+def test_exec_reports_truncated_output():
+    transport = StubTransport({"chatty": [{"exited": True, "exitcode": 0, "out-data": encode("a" * 16),
+                                           "out-truncated": True}]})
+    result = GuestAgentApi(None, transport).exec(["chatty"], ["yes"])[0]
+
+    assert result["status"] == "done"
+    assert result["stdout"] == "a" * 16
+    assert result["message"] == "Exited with 0. The output was truncated by the agent."
+
+
+def test_exec_agent_errors_fail_only_that_vm():
+    class BrokenTransport(StubTransport):
+        def command(self, vm_name, execute, arguments=None, timeout=5.0):
+            if vm_name == "no-agent":
+                raise VmctlError("The guest agent of VM 'no-agent' is not connected.")
+            return super().command(vm_name, execute, arguments, timeout)
+
+    transport = BrokenTransport({"web": [{"exited": True, "exitcode": 0}]})
+    results = by_name(GuestAgentApi(None, transport).exec(["web", "no-agent"], ["true"]))
+
+    assert results["web"]["status"] == "done"
+    assert results["no-agent"]["status"] == "failed"
+    assert results["no-agent"]["message"] == "The guest agent of VM 'no-agent' is not connected."
+
+
+@pytest.mark.parametrize("command, script", [
+    (["ls /var/log | wc -l"], "ls /var/log | wc -l"),
+    (["echo", "two words", "it's"], "echo 'two words' 'it'\"'\"'s'"),
+])
+def test_exec_shell_keeps_arguments_whole(command, script):
+    transport = StubTransport({"web": [{"exited": True, "exitcode": 0}]})
+    GuestAgentApi(None, transport).exec(["web"], command, shell=True)
+
+    assert transport.executed("web") == [{"path": "/bin/sh", "arg": ["-c", script], "capture-output": True}]
+
+
+def test_exec_without_shell_passes_arguments_as_they_are():
+    transport = StubTransport({"web": [{"exited": True, "exitcode": 0}]})
+    GuestAgentApi(None, transport).exec(["web"], ["echo", "two words"])
+
+    assert transport.executed("web") == [{"path": "echo", "arg": ["two words"], "capture-output": True}]
+
+
+@pytest.mark.parametrize("command, timeout", [([], 5), (["true"], 0)])
+def test_exec_rejects_bad_arguments(command, timeout):
+    with pytest.raises(VmctlError):
+        GuestAgentApi(None, StubTransport()).exec(["web"], command, timeout=timeout)
+
+
+def test_fetch_copies_the_file(tmp_path):
+    transport = StubTransport(chunks={"web": [{"buf-b64": encode("hello "), "eof": False},
+                                              {"buf-b64": encode("world"), "eof": True}]})
+    result = GuestAgentApi(None, transport).fetch(["web"], "/etc/motd", str(tmp_path))[0]
+
+    target = tmp_path / "web" / "motd"
+    assert result["status"] == "done" and result["bytes"] == 11
+    assert result["path"] == str(target)
+    assert target.read_text() == "hello world"
+    assert ("web", "guest-file-close", {"handle": 7}) in transport.sent
+
+
+def test_fetch_removes_partial_copies_and_closes_the_file(tmp_path):
+    transport = StubTransport(chunks={"web": [{"buf-b64": encode("hello "), "eof": False},
+                                              VmctlError("The guest agent of VM 'web' failed guest-file-read: I/O error")]})
+    result = GuestAgentApi(None, transport).fetch(["web"], "/var/log/syslog", str(tmp_path))[0]
+
+    assert result["status"] == "failed"
+    assert "I/O error" in result["message"]
+    assert not os.path.exists(tmp_path / "web" / "syslog")
+    # the handle is closed in the guest even though the copy failed
+    assert transport.sent[-1] == ("web", "guest-file-close", {"handle": 7})
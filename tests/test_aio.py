@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from utils.errors import VmctlError
+from wrapper.aio import ActionResult, ApplyResult, AsyncLibVirtApi, CloneResult, DomainEvent, HostInfo, VmInfo, VmSummary
+
+WARNING = "[bold bright_yellow]Warning:[/bold bright_yellow] VM 'web-1' would commit 2048 MiB of memory on this host."
+
+
+class FakeHostApi:
+    def get_host_info(self):
+        return {"model": "x86_64", "memory": 16384, "cpus": 8, "mhz": 2000, "numa_nodes": 1, "sockets": 1, "cores": 4, "threads": 2}
+
+
+class FakeVmApi:
+    def __init__(self):
+        self.parallelism = []
+
+    def get_vms(self, states=None):
+        vms = [{"id": 1, "name": "web-1", "state": "running"}, {"id": None, "name": "db-1", "state": "shutoff"}]
+        return [vm for vm in vms if not states or vm["state"] in states]
+
+    def get_vm_info(self, vm_name):
+        if vm_name != "web-1":
+            raise VmctlError(f"VM '{vm_name}' not found.")
+        return {"id": 1, "name": vm_name, "state": "running", "memory": 1048576, "max_memory": 2097152, "vcpus": 2, "cpu_time": 5}
+
+    def run_action(self, action, vm_names, parallelism, wait, timeout, escalate, force):
+        self.parallelism.append(parallelism)
+        return [{"name": vm_name, "status": "done", "message": f"[green]{action}ed[/green] {WARNING}"} for vm_name in vm_names]
+
+    def apply(self, specs, parallelism, dry_run, placement, force):
+        self.parallelism.append(parallelism)
+        return [{"name": spec["name"], "status": "created", "changes": "+ memory=1024", "message": f"Defined. {WARNING}"} for spec in specs]
+
+
+class FakeCloneApi:
+    def __init__(self):
+        self.parallelism = []
+
+    def clone(self, base_name, vm_names, parallelism, pool_name, force):
+        self.parallelism.append(parallelism)
+        return [{"name": vm_name, "status": "done", "uuid": "uuid", "message": f"Defined with 1 overlay disk. {WARNING}"} for vm_name in vm_names]
+
+
+class FakeDomain:
+    def __init__(self, name):
+        self.domain_name = name
+
+    def name(self):
+        return self.domain_name
+
+
+class FakeFeed:
+    """Stands in for a DomainEventFeed, emitting events on demand."""
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def emit(self, vm_name, event):
+        for callback in list(self.subscribers):
+            callback(FakeDomain(vm_name), event, 0)
+
+
+class FakeApi:
+    """Stands in for a LibVirtApi."""
+
+    def __init__(self, events=True):
+        self.host_api = FakeHostApi()
+        self.vm_api = FakeVmApi()
+        self.clone_api = FakeCloneApi()
+        self.event_feed = FakeFeed() if events else None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_calls_return_typed_results():
+    async def main():
+        api = AsyncLibVirtApi(FakeApi(), parallelism=2)
+        try:
+            return await api.get_host_info(), await api.get_vms(["running"]), await api.get_vm_info("web-1")
+        finally:
+            await api.close()
+
+    host, vms, info = run(main())
+    assert host == HostInfo("x86_64", 16384, 8, 2000, 1, 1, 4, 2)
+    assert vms == [VmSummary(1, "web-1", "running")]
+    assert info == VmInfo(1, "web-1", "running", 1048576, 2097152, 2, 5)
+
+
+def test_errors_are_raised_in_the_caller():
+    async def main():
+        api = AsyncLibVirtApi(FakeApi())
+        try:
+            await api.get_vm_info("missing")
+        finally:
+            await api.close()
+
+    with pytest.raises(VmctlError, match="VM 'missing' not found."):
+        run(main())
+
+
+def test_batch_results_are_typed_and_free_of_markup():
+    fake = FakeApi()
+
+    async def main():
+        api = AsyncLibVirtApi(fake, parallelism=4, batch_parallelism=2)
+        try:
+            return (await api.run_action("start", ["web-1"]), await api.apply([{"name": "web-1"}]),
+                    await api.clone("base", ["web-2"]))
+        finally:
+            await api.close()
+
+    actions, applied, clones = run(main())
+    plain = "VM 'web-1' would commit 2048 MiB of memory on this host."
+    assert actions == [ActionResult("web-1", "done", f"started Warning: {plain}")]
+    assert applied == [ApplyResult("web-1", "created", "+ memory=1024", f"Defined. Warning: {plain}")]
+    assert clones == [CloneResult("web-2", "done", "uuid", f"Defined with 1 overlay disk. Warning: {plain}")]
+    # the batches fan out with their own width, not the size of the thread pool
+    assert fake.vm_api.parallelism == [2, 2] and fake.clone_api.parallelism == [2]
+    assert fake.closed
+
+
+def test_batch_parallelism_defaults_to_the_parallelism():
+    assert AsyncLibVirtApi(FakeApi(), parallelism=3).batch_parallelism == 3
+    for options in ({"parallelism": 0}, {"batch_parallelism": 0}):
+        with pytest.raises(VmctlError, match="at least 1"):
+            AsyncLibVirtApi(FakeApi(), **options)
+
+
+def test_events_are_filtered_and_unsubscribed():
+    fake = FakeApi()
+    feed = fake.event_feed
+
+    async def main():
+        api = AsyncLibVirtApi(fake)
+        received = []
+        events = api.events(["web-*"])
+
+        async def consume():
+            async for event in events:
+                received.append(event)
+                if len(received) == 2:
+                    break
+
+        consumer = asyncio.ensure_future(consume())
+        # let the consumer subscribe
+        while not feed.subscribers:
+            await asyncio.sleep(0)
+        feed.emit("db-1", libvirt.VIR_DOMAIN_EVENT_STARTED)
+        feed.emit("web-1", libvirt.VIR_DOMAIN_EVENT_STARTED)
+        # events may come from another thread too
+        thread = threading.Thread(target=feed.emit, args=("web-2", libvirt.VIR_DOMAIN_EVENT_UNDEFINED))
+        thread.start()
+        thread.join()
+        await asyncio.wait_for(consumer, 5)
+        await events.aclose()
+        await api.close()
+        return received
+
+    assert run(main()) == [DomainEvent("web-1", "started", "running"), DomainEvent("web-2", "undefined", None)]
+    # the consumer stopped iterating, so the feed no longer calls it
+    assert feed.subscribers == []
+
+
+def test_events_need_an_event_feed():
+    async def main():
+        api = AsyncLibVirtApi(FakeApi(events=False))
+        try:
+            async for _ in api.events():
+                pass
+        finally:
+            await api.close()
+
+    with pytest.raises(VmctlError, match="events=True"):
+        run(main())
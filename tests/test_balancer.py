@@ -0,0 +1,128 @@
+import os
+import pytest
+
+from utils.balancer import DEFAULT_BALANCER, BalloonBalancer, load_trace, replay
+
+TRACES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces")
+MIB = 1024
+
+
+def run(trace: str, host_free: int = None, **settings):
+    """Replays a recorded trace, optionally with another host_free (in MiB) for every tick."""
+    ticks = load_trace(os.path.join(TRACES, f"{trace}.ndjson"))
+    if host_free is not None:
+        for tick in ticks:
+            tick["host_free"] = host_free * MIB
+    return replay(ticks, settings)
+
+
+def steps(decisions, name: str):
+    return [(decision["target"] - decision["current"]) // MIB for decision in decisions if decision["name"] == name]
+
+
+def test_idle_vm_settles_then_cools_down():
+    decisions = run("idle")
+    settle, cooldown = DEFAULT_BALANCER["settle_ticks"], DEFAULT_BALANCER["cooldown_ticks"]
+    # shrunk only after settle_ticks idle ticks, then once every cooldown + settle period
+    times = [decision["time"] for decision in decisions]
+    assert times[0] == settle - 1
+    assert all(later - earlier == cooldown + 1 for earlier, later in zip(times, times[1:]))
+    assert all(decision["reason"] == "idle" for decision in decisions)
+
+
+@pytest.mark.parametrize("settle, cooldown", [(1, 0), (2, 4), (5, 1)])
+def test_hysteresis_follows_the_settings(settle, cooldown):
+    times = [decision["time"] for decision in run("idle", settle_ticks=settle, cooldown_ticks=cooldown)]
+    assert times[0] == settle - 1
+    gaps = {later - earlier for earlier, later in zip(times, times[1:])}
+    assert gaps == {max(settle, cooldown + 1)}
+
+
+def test_flapping_vm_is_left_alone():
+    # its free memory crosses high_free every other tick, it is never idle for settle_ticks in a row
+    assert run("flapping") == []
+
+
+def test_shrink_is_bounded_by_max_step():
+    assert steps(run("idle"), "web") == [-DEFAULT_BALANCER["max_step"]] * 4
+    assert set(steps(run("idle", max_step=128), "web")) == {-128}
+
+
+def test_shrink_stops_at_the_size_that_leaves_target_free():
+    decisions = run("idle", max_step=8192)
+    # 1 GiB used, so 1.25 GiB leaves 20% free, and nothing changes after that
+    assert len(decisions) == 1
+    assert decisions[0]["target"] == 1280 * MIB
+
+
+def test_shrink_stops_at_min_memory():
+    decisions = run("idle", min_memory=3584)
+    assert [decision["target"] for decision in decisions] == [3584 * MIB]
+    assert all(decision["target"] >= 3584 * MIB for decision in run("idle", min_memory=3584, max_step=8192))
+
+
+def test_pressure_grows_to_target_free():
+    decisions = run("pressure")
+    assert len(decisions) == 1
+    assert decisions[0]["reason"] == "pressure"
+    assert steps(decisions, "db") == [449]
+
+
+def test_pressure_growth_is_bounded_by_max_step_and_cools_down():
+    decisions = run("pressure", max_step=128)
+    assert set(steps(decisions, "db")) == {128}
+    # two steps take it out of pressure, the second after the cooldown
+    assert [decision["time"] for decision in decisions] == [0, 3]
+    assert all(decision["target"] <= 4096 * MIB for decision in decisions)
+
+
+def test_pressure_growth_keeps_the_host_reserve():
+    reserve = DEFAULT_BALANCER["host_reserve"]
+    assert set(steps(run("pressure", host_free=reserve + 100), "db")) == {100}
+    # less than min_change above the reserve is not worth a change
+    assert run("pressure", host_free=reserve + 32) == []
+    assert run("pressure", host_free=reserve) == []
+
+
+def test_idle_memory_goes_to_the_pressured_vm():
+    decisions = run("mixed")
+    reclaimed = granted = 0
+    for decision in decisions:
+        if decision["reason"] == "idle":
+            reclaimed += decision["current"] - decision["target"]
+        else:
+            granted += decision["target"] - decision["current"]
+        # without free host memory, only what was reclaimed can be handed out
+        assert granted <= reclaimed
+    assert granted > 0
+
+
+def reasons(decisions):
+    by_name = {}
+    for decision in decisions:
+        by_name.setdefault(decision["name"], []).append(decision["reason"])
+    return by_name
+
+
+@pytest.mark.parametrize("trace", ["idle", "pressure", "flapping", "mixed"])
+@pytest.mark.parametrize("max_step", [128, 512, 8192])
+def test_no_oscillation(trace, max_step):
+    for name, changes in reasons(run(trace, max_step=max_step)).items():
+        # a shrunk vm is never left under pressure, so it is never grown back, and the other way around
+        assert len(set(changes)) == 1, f"{name} went {' -> '.join(changes)}"
+
+
+def test_flapping_oscillates_without_hysteresis():
+    # the same trace, acted on every tick, is what settle_ticks and cooldown_ticks prevent
+    changes = reasons(run("flapping", settle_ticks=1, cooldown_ticks=0))["batch"]
+    assert set(changes) == {"idle", "pressure"}
+
+
+def test_stopped_vms_are_forgotten():
+    balancer = BalloonBalancer({"settle_ticks": 2})
+    sample = {"current": 4096 * MIB, "maximum": 4096 * MIB, "available": 4096 * MIB, "usable": 3072 * MIB}
+    assert balancer.decide({"web": sample}) == []
+    assert balancer.decide({}) == []
+    # the idle ticks start over after the vm is gone
+    assert balancer.decide({"web": sample}) == []
+    assert [decision["name"] for decision in balancer.decide({"web": sample})] == ["web"]
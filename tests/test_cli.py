@@ -0,0 +1,98 @@
+import json
+import pytest
+
+pytest.importorskip("libvirt")
+
+from typer.testing import CliRunner
+
+import main
+import wrapper.libvirt
+from utils import profiling
+from utils.errors import LibvirtError
+
+# every command that connects to libvirt, the ones that always connect directly first
+COMMANDS = [
+    ["watch"],
+    ["top"],
+    ["stats"],
+    ["exporter"],
+    ["start", "web-1", "--wait"],
+    ["migrate", "web-1", "--to", "qemu+ssh://node2/system"],
+    ["exec", "web-*", "--", "uptime"],
+    ["fetch", "web-*", "/etc/hostname"],
+    ["mem", "balance", "--count", "1"],
+    ["hostinfo"],
+    ["capacity"],
+    ["list"],
+    ["info", "web-1"],
+    ["provision", "web-1", "1024", "1", "--disk-path", "/images/web-1.qcow2"],
+    ["start", "web-1"],
+    ["shutdown", "web-1"],
+    ["destroy", "web-1"],
+    ["suspend", "web-1"],
+    ["resume", "web-1"],
+    ["reboot", "web-1"],
+    ["apply", "{manifest}"],
+    ["clone", "base", "web-{{1..2}}"],
+    ["snapshot", "create", "web-1"],
+    ["snapshot", "list", "web-1"],
+    ["mem", "stats"],
+    ["mem", "set", "1024", "web-1"],
+    ["mem", "ksm"],
+    ["qos", "apply", "bronze", "web-1"],
+    ["qos", "show"],
+]
+
+
+class UnreachableApi:
+    """Stands in for LibVirtApi on a host whose libvirtd is down."""
+
+    def __init__(self, uri, *args, **kwargs):
+        raise LibvirtError(f"Error connecting to '{uri}': libvirtd is unreachable")
+
+
+def unwrapped(output):
+    # rich wraps long lines at the width of the test run's terminal
+    return " ".join(output.split())
+
+
+@pytest.fixture
+def runner(monkeypatch, tmp_path):
+    monkeypatch.setenv("VMCTL_NO_DAEMON", "1")
+    monkeypatch.setenv("VMCTL_CONFIG", str(tmp_path / "config.json"))
+    monkeypatch.setenv("VMCTL_INVENTORY", str(tmp_path / "inventory.db"))
+    monkeypatch.setattr(wrapper.libvirt, "LibVirtApi", UnreachableApi)
+    return CliRunner()
+
+
+@pytest.mark.parametrize("command", COMMANDS, ids=" ".join)
+def test_commands_report_an_unreachable_host(runner, tmp_path, command):
+    manifest = tmp_path / "vms.json"
+    manifest.write_text(json.dumps({"vms": [{"name": "web-1", "memory": 1024, "vcpus": 1, "disk": "/images/web-1.qcow2"}]}))
+    command = [arg.format(manifest=manifest) for arg in command]
+
+    result = runner.invoke(main.app, command)
+
+    # a command that cannot even import what it uses would fail with a NameError or ImportError instead
+    assert result.exit_code == 1, result.output
+    assert "libvirtd is unreachable" in unwrapped(result.output)
+
+
+def test_find_answers_from_the_inventory_without_the_host(runner):
+    result = runner.invoke(main.app, ["find", "web"])
+    # the host is reported, and the search runs over what the inventory already knew
+    assert result.exit_code == 0, result.output
+    assert "libvirtd is unreachable" in unwrapped(result.output)
+
+
+def test_about_does_not_connect(runner):
+    result = runner.invoke(main.app, ["about"])
+    assert result.exit_code == 0
+
+
+def test_an_unwritable_trace_file_is_reported(runner, monkeypatch, tmp_path):
+    # main.py turns profiling on from sys.argv when it is imported, which happened before this test
+    monkeypatch.setattr(profiling, "_profiler", profiling.Profiler())
+    result = runner.invoke(main.app, ["--trace-file", str(tmp_path / "missing" / "trace.json"), "about"])
+    assert result.exit_code == 1
+    assert "Error writing the trace file" in unwrapped(result.output)
@@ -0,0 +1,180 @@
+import xml.etree.ElementTree as ET
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from utils.errors import VmctlError
+from wrapper.clone import CloneApi
+from wrapper.vm import APPLY_NAMESPACE
+
+BASE_XML = f"""
+<domain type="kvm">
+  <name>base</name>
+  <uuid>8d5e6d3a-7a4e-4c38-9b8e-1f0b5c1e2d3f</uuid>
+  <memory unit="KiB">2097152</memory>
+  <vcpu>2</vcpu>
+  <metadata><spec xmlns="{APPLY_NAMESPACE}">{{}}</spec></metadata>
+  <os><type>hvm</type><nvram>/var/lib/libvirt/qemu/nvram/base_VARS.fd</nvram></os>
+  <devices>
+    <disk type="file" device="disk"><driver name="qemu" type="raw"/><source file="/images/base.img"/><target dev="vda"/></disk>
+    <disk type="file" device="disk"><source file="/images/data.img"/><target dev="vdb"/></disk>
+    <disk type="file" device="disk"><source file="/images/shared.img"/><target dev="vdc"/><shareable/></disk>
+    <disk type="file" device="cdrom"><source file="/images/install.iso"/><target dev="hdc"/><readonly/></disk>
+    <interface type="network"><mac address="52:54:00:00:00:01"/><source network="default"/></interface>
+  </devices>
+</domain>
+"""
+
+TEST_VOLUME_XML = """
+<volume>
+  <name>golden.qcow2</name>
+  <capacity unit="MiB">64</capacity>
+  <target><format type="qcow2"/></target>
+</volume>
+"""
+
+TEST_DOMAIN_XML = """
+<domain type="test">
+  <name>golden</name>
+  <uuid>2c0f3b8e-51a4-4d0a-8f55-0e7a5d1c9b41</uuid>
+  <memory unit="KiB">131072</memory>
+  <vcpu>1</vcpu>
+  <os><type arch="x86_64">hvm</type></os>
+  <devices>
+    <disk type="file" device="disk"><driver name="qemu" type="qcow2"/><source file="{path}"/><target dev="vda"/></disk>
+    <interface type="network"><mac address="52:54:00:00:00:01"/><source network="default"/></interface>
+  </devices>
+</domain>
+"""
+
+
+def test_clone_xml_gets_its_own_identity_and_the_overlays():
+    overlays = {"/images/base.img": "/images/web-1-vda.qcow2", "/images/data.img": "/images/web-1-vdb.qcow2"}
+    domain = ET.fromstring(CloneApi(None)._clone_xml(BASE_XML, "web-1", "uuid-1", overlays))
+
+    assert domain.findtext("name") == "web-1"
+    assert domain.findtext("uuid") == "uuid-1"
+    disks = {disk.find("target").get("dev"): disk for disk in domain.iter("disk")}
+    assert disks["vda"].find("source").get("file") == "/images/web-1-vda.qcow2"
+    assert disks["vda"].find("driver").attrib == {"name": "qemu", "type": "qcow2"}
+    # a driver is added where the base disk had none
+    assert disks["vdb"].find("driver").get("type") == "qcow2"
+    # shared and read only disks are left pointing at the base
+    assert disks["vdc"].find("source").get("file") == "/images/shared.img"
+    assert disks["hdc"].find("source").get("file") == "/images/install.iso"
+    # libvirt generates new MACs and UEFI variables, and apply does not own the clone
+    assert domain.find("devices/interface/mac") is None
+    assert domain.find("devices/interface/source").get("network") == "default"
+    assert domain.find("os/nvram") is None
+    assert list(domain.find("metadata")) == []
+
+
+def test_clone_xml_adds_a_missing_uuid():
+    base = "<domain><name>base</name><devices/></domain>"
+    assert ET.fromstring(CloneApi(None)._clone_xml(base, "web-1", "uuid-1", {})).findtext("uuid") == "uuid-1"
+
+
+def test_overlay_xml_is_backed_by_the_base_disk():
+    disk = {"target": "vda", "path": "/images/base.img", "format": "raw", "capacity": 10 << 30}
+    volume = ET.fromstring(CloneApi(None)._overlay_xml("web-1", disk))
+
+    assert volume.findtext("name") == "web-1-vda.qcow2"
+    assert volume.find("capacity").get("unit") == "bytes" and volume.findtext("capacity") == str(10 << 30)
+    assert volume.find("target/format").get("type") == "qcow2"
+    assert volume.findtext("backingStore/path") == "/images/base.img"
+    # the backing store keeps the base disk's format, so qemu does not probe it
+    assert volume.find("backingStore/format").get("type") == "raw"
+
+
+def test_read_resources():
+    assert CloneApi._read_resources(BASE_XML) == (2048, 2)
+
+
+class FakeCapacity:
+    """Stands in for CapacityApi, with room for a number of new VMs."""
+
+    def __init__(self, room):
+        self.room = room
+        self.admitted = []
+        self.released = []
+        self.invalidated = 0
+
+    def admit_new(self, vm_name, vm_memory, vm_vcpus, force=False):
+        if len(self.admitted) >= self.room and not force:
+            raise VmctlError(f"VM '{vm_name}' would commit too much memory on this host. Use --force to go ahead anyway.")
+        self.admitted.append((vm_name, vm_memory, vm_vcpus))
+        return "" if len(self.admitted) <= self.room else f"[bold bright_yellow]Warning:[/bold bright_yellow] VM '{vm_name}' is over."
+
+    def release_new(self, vm_name):
+        self.released.append(vm_name)
+
+    def invalidate(self):
+        self.invalidated += 1
+
+
+@pytest.fixture
+def connection():
+    # the test driver keeps its state in memory until its last connection is closed
+    connection = libvirt.open("test:///default")
+    pool = connection.storagePoolLookupByName("default-pool")
+    volume = pool.createXML(TEST_VOLUME_XML, 0)
+    connection.defineXML(TEST_DOMAIN_XML.format(path=volume.path()))
+    yield connection
+    connection.close()
+
+
+def disk_sources(connection, vm_name):
+    domain = ET.fromstring(connection.lookupByName(vm_name).XMLDesc(0))
+    return [disk.find("source").get("file") for disk in domain.iter("disk")]
+
+
+def test_clone(connection):
+    results = CloneApi(connection).clone("golden", ["clone-1", "clone-2"], parallelism=2)
+
+    assert [(result["name"], result["status"], result["message"]) for result in results] == [
+        ("clone-1", "done", "Defined with 1 overlay disk."), ("clone-2", "done", "Defined with 1 overlay disk.")]
+    assert results[0]["uuid"] != results[1]["uuid"]
+    assert connection.lookupByName("clone-1").UUIDString() == results[0]["uuid"]
+    for vm_name in ("clone-1", "clone-2"):
+        [source] = disk_sources(connection, vm_name)
+        assert source == connection.storageVolLookupByPath(source).path()
+        assert source.endswith(f"{vm_name}-vda.qcow2")
+
+
+def test_clone_of_a_running_vm_is_refused(connection):
+    connection.lookupByName("golden").create()
+    with pytest.raises(VmctlError, match="is running, shut it down before cloning it"):
+        CloneApi(connection).clone("golden", ["clone-1"])
+
+
+def test_clones_are_admitted_against_the_capacity(connection):
+    capacity = FakeCapacity(room=1)
+    results = CloneApi(connection, capacity).clone("golden", ["clone-1", "clone-2"], parallelism=1)
+
+    assert [result["status"] for result in results] == ["done", "failed"]
+    assert "Use --force" in results[1]["message"]
+    assert capacity.admitted == [("clone-1", 128, 1)]
+    # the refused clone created no volume, and the figures are read again afterwards
+    with pytest.raises(libvirt.libvirtError):
+        connection.lookupByName("clone-2")
+    assert not any(name.startswith("clone-2") for name in connection.storagePoolLookupByName("default-pool").listVolumes())
+    assert capacity.invalidated == 1
+
+
+def test_forced_clones_carry_the_warning(connection):
+    capacity = FakeCapacity(room=0)
+    [result] = CloneApi(connection, capacity).clone("golden", ["clone-1"], force=True)
+    assert result["status"] == "done"
+    assert result["message"].startswith("Defined with 1 overlay disk. [bold bright_yellow]Warning:")
+
+
+def test_a_clone_that_cannot_be_defined_gives_its_admission_back(connection):
+    capacity = FakeCapacity(room=2)
+    # a domain of that name already exists with another UUID
+    results = CloneApi(connection, capacity).clone("golden", ["golden"])
+
+    assert results[0]["status"] == "failed"
+    assert results[0]["message"].startswith("Error cloning VM 'golden':")
+    assert capacity.released == ["golden"]
+    # and its overlay is deleted
+    assert "golden-vda.qcow2" not in connection.storagePoolLookupByName("default-pool").listVolumes()
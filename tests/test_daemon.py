@@ -0,0 +1,102 @@
+import os
+import socketserver
+import stat
+import threading
+import time
+import rich
+
+from utils.pool import run_parallel
+from wrapper.daemon import VmctlDaemon
+from wrapper.pool import ConnectionPool
+
+
+def test_socket_is_only_accessible_by_its_owner(monkeypatch, tmp_path):
+    socket_path = str(tmp_path / "vmctl.sock")
+    seen = {}
+    server_bind = socketserver.ThreadingUnixStreamServer.server_bind
+
+    def bind(server):
+        server_bind(server)
+        # what another user could find the moment the socket exists
+        seen["mode"] = stat.S_IMODE(os.stat(socket_path).st_mode)
+
+    monkeypatch.setattr(socketserver.ThreadingUnixStreamServer, "server_bind", bind)
+    monkeypatch.setattr(socketserver.ThreadingUnixStreamServer, "serve_forever", lambda server: None)
+    # leave the SIGTERM handling of the test run alone
+    monkeypatch.setattr("wrapper.daemon.signal.signal", lambda signum, handler: None)
+    umask = os.umask(0o022)
+    try:
+        VmctlDaemon(socket_path).serve_forever()
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
+
+    assert seen["mode"] & 0o077 == 0
+    assert not os.path.exists(socket_path)
+
+
+def test_ping():
+    assert VmctlDaemon("/nonexistent/vmctl.sock").handle_request({"method": "ping"}) == {"result": "pong"}
+
+
+def test_private_and_unknown_calls_are_refused():
+    daemon = VmctlDaemon("/nonexistent/vmctl.sock")
+    for request in ({"api": "vm_api", "method": "_lookup"}, {"api": "connection", "method": "close"}):
+        assert daemon.handle_request(request)["error_type"] == "VmctlError"
+
+
+class FakeVmApi:
+    """Stands in for the vm_api of a connection, with a call that takes a while."""
+
+    def __init__(self):
+        self.slow_started = threading.Event()
+
+    def slow(self):
+        rich.print("slow started")
+        self.slow_started.set()
+        time.sleep(0.5)
+        rich.print("slow done")
+
+    def fast(self):
+        rich.print("fast")
+        return "fast"
+
+    def fan_out(self, names):
+        run_parallel(lambda name: rich.print(f"worker {name}"), names, 2)
+
+
+class FakeApi:
+    def __init__(self):
+        self.vm_api = FakeVmApi()
+
+
+def daemon_with_fake_api():
+    daemon = VmctlDaemon("/nonexistent/vmctl.sock")
+    daemon.pool = ConnectionPool(None, {"test:///": FakeApi()})
+    return daemon
+
+
+def call(daemon, method, *args):
+    return daemon.handle_request({"uri": "test:///", "api": "vm_api", "method": method, "args": args})
+
+
+def test_a_slow_call_does_not_hold_up_the_others():
+    daemon = daemon_with_fake_api()
+    responses = {}
+    slow = threading.Thread(target=lambda: responses.update(slow=call(daemon, "slow")))
+    slow.start()
+    assert daemon.pool.get("test:///").vm_api.slow_started.wait(5)
+
+    start = time.monotonic()
+    responses["fast"] = call(daemon, "fast")
+    assert time.monotonic() - start < 0.2
+    slow.join()
+
+    # each call gets only what it printed itself
+    assert responses["fast"] == {"output": "fast\n", "result": "fast"}
+    assert responses["slow"]["output"] == "slow started\nslow done\n"
+
+
+def test_output_of_worker_threads_is_captured():
+    output = call(daemon_with_fake_api(), "fan_out", ["web-1", "web-2"])["output"]
+    assert sorted(output.splitlines()) == ["worker web-1", "worker web-2"]
@@ -0,0 +1,170 @@
+import threading
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from utils.errors import LibvirtError
+from wrapper.exporter import MetricsExporter, format_metric
+
+
+class FakeExporter(MetricsExporter):
+    """An exporter whose collections are counted and, while `gate` is cleared, block until it is set."""
+
+    def __init__(self, **options):
+        super().__init__(None, **options)
+        self.collections = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.failure = None
+
+    def collect(self):
+        self.collections += 1
+        self.gate.wait(5)
+        if self.failure:
+            raise self.failure
+        return f"collection {self.collections}\n"
+
+
+def status(metrics):
+    lines = dict(line.split() for line in metrics.splitlines() if line.startswith("vmctl_"))
+    return int(lines["vmctl_up"]), int(lines["vmctl_scrape_timed_out"])
+
+
+def wait_for_collection(exporter):
+    # the collection finishes in the background after a scrape gave up on it
+    collecting = exporter.collecting
+    if collecting is not None:
+        collecting.result(5)
+
+
+def test_collections_are_cached():
+    exporter = FakeExporter(cache_ttl=60)
+    first = exporter.get_metrics()
+
+    assert first.startswith("collection 1\n")
+    assert status(first) == (1, 0)
+    assert exporter.get_metrics() == first
+    assert exporter.collections == 1
+
+
+def test_collections_are_repeated_once_stale():
+    exporter = FakeExporter(cache_ttl=0)
+    exporter.get_metrics()
+    assert exporter.get_metrics().startswith("collection 2\n")
+
+
+def test_concurrent_scrapes_share_a_collection():
+    exporter = FakeExporter(cache_ttl=60)
+    exporter.gate.clear()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(exporter.get_metrics())) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    exporter.gate.set()
+    for thread in threads:
+        thread.join()
+
+    assert exporter.collections == 1
+    assert len(results) == 6 and all(result.startswith("collection 1\n") for result in results)
+
+
+def test_slow_first_collection_times_out():
+    exporter = FakeExporter(cache_ttl=60, scrape_timeout=0.05)
+    exporter.gate.clear()
+
+    metrics = exporter.get_metrics()
+    assert not metrics.startswith("collection")
+    assert status(metrics) == (0, 1)
+
+    # the collection went on, and a later scrape is served its result
+    exporter.gate.set()
+    wait_for_collection(exporter)
+    assert exporter.get_metrics().startswith("collection 1\n")
+    assert exporter.collections == 1
+
+
+def test_slow_collection_serves_the_last_result():
+    exporter = FakeExporter(cache_ttl=0, scrape_timeout=0.05)
+    exporter.get_metrics()
+    exporter.gate.clear()
+
+    metrics = exporter.get_metrics()
+    assert metrics.startswith("collection 1\n")
+    assert status(metrics) == (1, 1)
+    # a scrape while the collection is still running does not start another
+    exporter.get_metrics()
+    assert exporter.collections == 2
+    exporter.gate.set()
+    wait_for_collection(exporter)
+
+
+@pytest.mark.parametrize("failure", [LibvirtError("Error getting VM stats: connection lost"), libvirt.libvirtError("connection lost")])
+def test_failed_collections_are_reported_and_retried(capsys, failure):
+    exporter = FakeExporter(cache_ttl=60)
+    exporter.failure = failure
+
+    assert status(exporter.get_metrics()) == (0, 0)
+    assert "Error collecting the metrics:" in capsys.readouterr().err
+    exporter.failure = None
+    assert exporter.get_metrics().startswith("collection 2\n")
+
+
+def test_bugs_in_the_collection_are_not_reported_as_a_host_down():
+    exporter = FakeExporter(cache_ttl=60)
+    exporter.failure = KeyError("balloon.current")
+
+    with pytest.raises(KeyError):
+        exporter.get_metrics()
+
+
+def test_format_metric():
+    assert format_metric("vmctl_up", "Whether it is up.", "gauge", []) == ""
+    assert format_metric("vmctl_domain_vcpus", "Number of vCPUs of a VM.", "gauge", [({"domain": 'we"b\\1\n'}, 2), ({}, 3)]) == (
+        "# HELP vmctl_domain_vcpus Number of vCPUs of a VM.\n"
+        "# TYPE vmctl_domain_vcpus gauge\n"
+        'vmctl_domain_vcpus{domain="we\\"b\\\\1\\n"} 2\n'
+        "vmctl_domain_vcpus 3\n"
+    )
+
+
+class FakeHostApi:
+    def get_host_info(self):
+        return {"model": "x86_64", "memory": 16384, "cpus": 8, "mhz": 2000, "numa_nodes": 1}
+
+    def get_max_vCpus(self):
+        return 255
+
+
+class FakeDomain:
+    def __init__(self, name):
+        self.domain_name = name
+
+    def name(self):
+        return self.domain_name
+
+
+class FakeConnection:
+    def getAllDomainStats(self, stats):
+        return [(FakeDomain("web-1"), {"state.state": 1, "cpu.time": 2_500_000_000, "vcpu.current": 2,
+                                       "balloon.current": 1048576, "block.count": 1, "block.0.name": "vda",
+                                       "block.0.rd.bytes": 4096, "net.count": 1, "net.0.name": "vnet0",
+                                       "net.0.rx.bytes": 100})]
+
+
+class FakeApi:
+    host_api = FakeHostApi()
+    connection = FakeConnection()
+
+
+def test_collect():
+    metrics = MetricsExporter(FakeApi()).collect()
+
+    assert 'vmctl_host_info{model="x86_64"} 1\n' in metrics
+    assert "vmctl_host_memory_bytes 17179869184\n" in metrics
+    assert 'vmctl_domain_state{domain="web-1",state="running"} 1\n' in metrics
+    assert 'vmctl_domain_cpu_seconds_total{domain="web-1"} 2.5\n' in metrics
+    assert 'vmctl_domain_memory_bytes{domain="web-1"} 1073741824\n' in metrics
+    assert 'vmctl_domain_block_read_bytes_total{domain="web-1",device="vda"} 4096\n' in metrics
+    assert 'vmctl_domain_net_receive_bytes_total{domain="web-1",interface="vnet0"} 100\n' in metrics
+    # metrics without samples are left out
+    assert "vmctl_domain_memory_rss_bytes" not in metrics
@@ -0,0 +1,125 @@
+import threading
+import time
+import pytest
+
+pytest.importorskip("libvirt")
+
+from utils.errors import LibvirtError, VmctlError
+from wrapper.fleet import FleetApi
+from wrapper.pool import ConnectionPool
+
+HOSTS = {"node1": "qemu+ssh://node1/system", "node2": "qemu+ssh://node2/system", "node3": "qemu+ssh://node3/system"}
+
+
+class FakeVmApi:
+    def __init__(self, vms, error=None, delay=0.0):
+        self.vms = vms
+        self.error = error
+        self.delay = delay
+
+    def get_vms(self, states=None):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return [vm for vm in self.vms if not states or vm["state"] in states]
+
+    def get_vm_info(self, vm_name):
+        if self.error:
+            raise self.error
+        for vm in self.vms:
+            if vm["name"] == vm_name:
+                return dict(vm, memory=1024, max_memory=1024, vcpus=1, cpu_time=0)
+        raise VmctlError(f"VM '{vm_name}' not found.")
+
+
+class FakeApi:
+    """Stands in for a LibVirtApi, with only the vm_api the tests use."""
+
+    def __init__(self, uri, vm_api):
+        self.uri = uri
+        self.vm_api = vm_api
+
+
+def fleet(vm_apis, unreachable=(), parallelism=8):
+    def connect(uri):
+        if uri in unreachable:
+            raise LibvirtError(f"Error connecting to '{uri}': Connection refused")
+        return FakeApi(uri, vm_apis[uri])
+    return FleetApi(HOSTS, ConnectionPool(connect), parallelism)
+
+
+def vm(name, state="running", vm_id=1):
+    return {"id": vm_id, "name": name, "state": state}
+
+
+def test_fan_out_collects_results_and_errors():
+    api = fleet({
+        HOSTS["node1"]: FakeVmApi([vm("web-1")]),
+        HOSTS["node2"]: FakeVmApi([], error=LibvirtError("Error listing VMs: internal error")),
+        HOSTS["node3"]: FakeVmApi([], error=RuntimeError("unexpected")),
+    })
+
+    results, errors = api.fan_out(lambda api: api.uri)
+    assert results == HOSTS and errors == {}
+
+    results, errors = api.fan_out(lambda api: api.vm_api.get_vms())
+    assert results == {"node1": [vm("web-1")]}
+    # vmctl errors keep their message, anything else is turned into a string
+    assert errors == {"node2": "Error listing VMs: internal error", "node3": "unexpected"}
+
+
+def test_fan_out_reports_unreachable_hosts():
+    api = fleet({HOSTS["node1"]: FakeVmApi([vm("web-1")]), HOSTS["node2"]: FakeVmApi([vm("web-2")])},
+                unreachable=[HOSTS["node3"]])
+
+    vms, errors = api.get_vms()
+    assert [(vm["host"], vm["name"]) for vm in vms] == [("node1", "web-1"), ("node2", "web-2")]
+    assert errors == {"node3": "Error connecting to 'qemu+ssh://node3/system': Connection refused"}
+
+
+def test_fan_out_queries_hosts_concurrently():
+    api = fleet({uri: FakeVmApi([vm("web")], delay=0.2) for uri in HOSTS.values()})
+
+    start = time.monotonic()
+    vms, errors = api.get_vms()
+    assert time.monotonic() - start < 0.2 * len(HOSTS)
+    assert len(vms) == len(HOSTS) and not errors
+
+
+def test_fan_out_respects_the_parallelism():
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def query(api):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    fleet({uri: FakeVmApi([]) for uri in HOSTS.values()}, parallelism=2).fan_out(query)
+    assert peak[0] == 2
+
+
+def test_iter_vms_leaves_the_errors():
+    api = fleet({HOSTS["node1"]: FakeVmApi([vm("web-1"), vm("db-1", "shutoff", None)]),
+                 HOSTS["node2"]: FakeVmApi([], error=VmctlError("boom"))}, unreachable=[HOSTS["node3"]])
+
+    assert [vm["name"] for vm in api.iter_vms(["running"])] == ["web-1"]
+    assert sorted(api.errors) == ["node2", "node3"]
+    assert api.errors["node2"] == "boom"
+
+
+def test_get_vm_info_drops_hosts_the_vm_is_not_on():
+    api = fleet({HOSTS["node1"]: FakeVmApi([vm("web-1")]), HOSTS["node2"]: FakeVmApi([])},
+                unreachable=[HOSTS["node3"]])
+
+    vms, errors = api.get_vm_info("web-1")
+    assert [vm["host"] for vm in vms] == ["node1"]
+    assert list(errors) == ["node3"]
+
+
+def test_get_vm_info_of_an_unknown_vm():
+    api = fleet({uri: FakeVmApi([]) for uri in HOSTS.values()})
+    with pytest.raises(VmctlError, match="not found on any of the 3 hosts"):
+        api.get_vm_info("missing")
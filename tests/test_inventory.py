@@ -0,0 +1,99 @@
+import pytest
+
+from utils.errors import VmctlError
+from utils.inventory import Inventory, format_age, parse_tags
+
+URI = "qemu:///system"
+
+
+def vm(uuid, name, state="running", **details):
+    return dict({"uuid": uuid, "name": name, "state": state, "vcpus": 2, "memory": 1024}, **details)
+
+
+@pytest.fixture
+def inventory():
+    inventory = Inventory(":memory:")
+    yield inventory
+    inventory.close()
+
+
+def test_update_host_stores_the_vms(inventory):
+    inventory.update_host(URI, "node1", [
+        vm("u-1", "web-1", disks=[{"target": "vda", "source": "/images/web-1.qcow2"}], tags={"team": "web"}),
+        vm("u-2", "db-1", "shutoff"),
+    ], [])
+
+    assert inventory.get_hosts()[URI]["hostname"] == "node1"
+    assert inventory.get_age(URI) < 5
+    assert [(vm["host"], vm["name"], vm["disks"], vm["tags"]) for vm in inventory.get_vms()] == [
+        ("node1", "db-1", [], {}),
+        ("node1", "web-1", [{"target": "vda", "source": "/images/web-1.qcow2"}], {"team": "web"}),
+    ]
+
+
+def test_update_host_keeps_the_details_that_were_not_read_again(inventory):
+    inventory.update_host(URI, "node1", [vm("u-1", "web-1", disks=[{"target": "vda", "source": None}], tags={"a": "1"})], [])
+    inventory.update_host(URI, "node1", [vm("u-1", "web-1", "paused")], [])
+
+    [stored] = inventory.get_vms()
+    assert (stored["state"], stored["disks"], stored["tags"]) == ("paused", [{"target": "vda", "source": None}], {"a": "1"})
+
+
+def test_vms_are_marked_until_their_details_are_read(inventory):
+    inventory.update_host(URI, "node1", [vm("u-1", "web-1"), vm("u-2", "web-2", disks=[], tags={})], [])
+    assert {uuid: row["read"] for uuid, row in inventory.get_vm_rows(URI).items()} == {"u-1": False, "u-2": True}
+
+    # a failed read drops what was stored before
+    inventory.update_host(URI, "node1", [vm("u-2", "web-2", disks=None, tags=None)], [])
+    assert not inventory.get_vm_rows(URI)["u-2"]["read"]
+    assert inventory.get_vms(pattern="web-2")[0]["disks"] == []
+
+
+def test_removed_vms_and_states(inventory):
+    inventory.update_host(URI, "node1", [vm("u-1", "web-1"), vm("u-2", "web-2")], [])
+    inventory.update_host(URI, "node1", [], ["u-1"])
+    inventory.set_state(URI, "u-2", "shutoff")
+
+    assert [(vm["name"], vm["state"]) for vm in inventory.get_vms()] == [("web-2", "shutoff")]
+    inventory.remove_vm(URI, "u-2")
+    assert inventory.get_vms() == []
+
+
+def test_get_vms_filters(inventory):
+    inventory.update_host(URI, "node1", [
+        vm("abc-1", "web-1", disks=[], tags={"team": "web"}),
+        vm("def-2", "Web-2", "shutoff", disks=[], tags={"team": "web", "env": "prod"}),
+        vm("ghi-3", "db-1", disks=[], tags={"team": "db"}),
+    ], [])
+    inventory.update_host("qemu+ssh://node2/system", "node2", [vm("jkl-4", "web-3")], [])
+
+    def names(**filters):
+        return {vm["name"] for vm in inventory.get_vms(**filters)}
+
+    assert names(uris=[URI]) == {"db-1", "web-1", "Web-2"}
+    assert names(states=["shutoff"]) == {"Web-2"}
+    # names are matched case insensitively, as a substring without wildcards and as a glob with them
+    assert names(pattern="WEB") == {"web-1", "Web-2", "web-3"}
+    assert names(pattern="web-?") == {"web-1", "Web-2", "web-3"}
+    assert names(pattern="*-1") == {"db-1", "web-1"}
+    assert names(pattern="def") == {"Web-2"}
+    assert names(tags={"team": "web"}) == {"web-1", "Web-2"}
+    assert names(tags={"team": "web", "env": "prod"}) == {"Web-2"}
+    # ordered by host first
+    assert [vm["host"] for vm in inventory.get_vms()] == ["node1"] * 3 + ["node2"]
+
+
+def test_get_age_of_an_unknown_host(inventory):
+    assert inventory.get_age(URI) is None
+
+
+def test_parse_tags():
+    assert parse_tags(["team=web", "owner=a=b"]) == {"team": "web", "owner": "a=b"}
+    assert parse_tags(None) == {}
+    for tag in ("team", "=web"):
+        with pytest.raises(VmctlError, match="Use key=value"):
+            parse_tags([tag])
+
+
+def test_format_age():
+    assert [format_age(age) for age in (None, 42, 300, 7200)] == ["never", "42s", "5m", "2h"]
@@ -0,0 +1,131 @@
+import xml.etree.ElementTree as ET
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from utils.errors import LibvirtError
+from utils.inventory import Inventory
+from utils.qos import QOS_NAMESPACE
+from wrapper.inventory import InventoryApi
+from wrapper.vm import APPLY_NAMESPACE
+
+URI = "qemu:///system"
+
+DOMAIN_XML = """
+<domain>
+  <name>{name}</name>
+  <devices>
+    <disk><source file="/images/{name}.qcow2"/><target dev="vda"/></disk>
+    <disk><target dev="hdc"/></disk>
+  </devices>
+  <metadata>
+    <app:info xmlns:app="https://example.com/app" owner="alice"><app:team>db</app:team></app:info>
+  </metadata>
+</domain>
+"""
+
+
+class FakeDomain:
+    def __init__(self, uuid, name, vcpus=2, memory=1024):
+        self.uuid = uuid
+        self.domain_name = name
+        self.vcpus = vcpus
+        self.memory = memory
+        self.error = None
+        self.reads = 0
+
+    def UUIDString(self):
+        return self.uuid
+
+    def name(self):
+        return self.domain_name
+
+    def XMLDesc(self, flags):
+        self.reads += 1
+        if self.error:
+            raise libvirt.libvirtError(self.error)
+        return DOMAIN_XML.format(name=self.domain_name)
+
+
+class FakeConnection:
+    def __init__(self, domains):
+        self.domains = domains
+        self.error = None
+
+    def getHostname(self):
+        return "node1"
+
+    def getAllDomainStats(self, stats):
+        if self.error:
+            raise libvirt.libvirtError(self.error)
+        return [(domain, {"state.state": 1, "vcpu.maximum": domain.vcpus, "balloon.maximum": domain.memory * 1024})
+                for domain in self.domains]
+
+
+@pytest.fixture
+def inventory():
+    inventory = Inventory(":memory:")
+    yield inventory
+    inventory.close()
+
+
+def test_refresh_reads_new_and_changed_vms_only(inventory):
+    web, db = FakeDomain("u-1", "web-1"), FakeDomain("u-2", "db-1")
+    connection = FakeConnection([web, db])
+    api = InventoryApi(connection, URI, inventory)
+
+    summary = api.refresh()
+    assert (summary["host"], summary["vms"], summary["read"], summary["removed"], summary["errors"]) == ("node1", 2, 2, 0, {})
+    stored = {vm["name"]: vm for vm in inventory.get_vms()}
+    assert stored["web-1"]["disks"] == [{"target": "vda", "source": "/images/web-1.qcow2"}, {"target": "hdc", "source": None}]
+    assert stored["web-1"]["tags"] == {"owner": "alice", "team": "db"}
+    assert stored["web-1"]["memory"] == 1024
+
+    web.memory = 2048
+    connection.domains = [web]
+    summary = api.refresh()
+    assert (summary["read"], summary["removed"]) == (1, 1)
+    assert (web.reads, db.reads) == (2, 1)
+
+    assert api.refresh(full=True)["read"] == 1
+    assert web.reads == 3
+
+
+def test_vms_whose_xml_failed_are_read_again(inventory):
+    web = FakeDomain("u-1", "web-1")
+    api = InventoryApi(FakeConnection([web]), URI, inventory)
+    api.refresh()
+
+    web.error = "Domain not found"
+    web.vcpus = 4
+    summary = api.refresh()
+    assert summary["errors"] == {"web-1": "Error reading the XML: Domain not found"}
+    # the VM is still listed, without the details that are now out of date
+    [stored] = inventory.get_vms()
+    assert (stored["vcpus"], stored["disks"], stored["tags"]) == (4, [], {})
+
+    # and nothing changed since, but the next refresh reads it again
+    web.error = None
+    summary = api.refresh()
+    assert (summary["read"], summary["errors"]) == (1, {})
+    assert inventory.get_vms()[0]["tags"] == {"owner": "alice", "team": "db"}
+    assert api.refresh()["read"] == 0
+
+
+def test_refresh_reports_a_host_that_cannot_be_listed(inventory):
+    connection = FakeConnection([])
+    connection.error = "Connection reset"
+    with pytest.raises(LibvirtError, match="Error listing VMs: Connection reset"):
+        InventoryApi(connection, URI, inventory).refresh()
+
+
+def test_read_tags_skips_vmctl_metadata():
+    metadata = ET.fromstring(
+        "<metadata>"
+        f'<spec xmlns="{APPLY_NAMESPACE}">{{"memory": 1024}}</spec>'
+        f'<qos xmlns="{QOS_NAMESPACE}" profile="gold"/>'
+        '<a:tags xmlns:a="https://example.com/a"><a:env>prod</a:env><a:empty> </a:empty></a:tags>'
+        "</metadata>"
+    )
+    assert InventoryApi._read_tags(metadata) == {"env": "prod"}
+    assert InventoryApi._read_tags(None) == {}
@@ -0,0 +1,201 @@
+import threading
+import time
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+import wrapper.migrate
+from utils.errors import VmctlError
+from wrapper.migrate import MigrationApi, MigrationProgress
+
+SOURCE_URI = "qemu+ssh://source/system"
+DEST_URI = "qemu+ssh://dest/system"
+
+
+class FakeHost:
+    """A host whose domains are plain dictionaries, migrated by moving them to another FakeHost."""
+
+    def __init__(self, hosts, uri, memory=16384, cpus=8):
+        self.hosts = hosts
+        self.uri = uri
+        self.memory = memory
+        self.cpus = cpus
+        # vm name -> {"memory" (MiB), "vcpus", "active"}
+        self.domains = {}
+        # vm name -> the exception its migration raises
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.migrating = 0
+        self.max_migrating = 0
+        hosts[uri] = self
+
+    def define(self, name, memory=1024, vcpus=1, active=True):
+        self.domains[name] = {"memory": memory, "vcpus": vcpus, "active": active}
+
+
+class FakeConnection:
+    def __init__(self, host):
+        self.host = host
+        self.closed = False
+
+    def lookupByName(self, name):
+        if name not in self.host.domains:
+            raise libvirt.libvirtError(f"Domain not found: no domain with matching name '{name}'")
+        return FakeDomain(self.host, name)
+
+    def getInfo(self):
+        return ["x86_64", self.host.memory, self.host.cpus, 2000, 1, 1, self.host.cpus, 1]
+
+    def getMaxVcpus(self, type):
+        return 255
+
+    def getAllDomainStats(self, stats):
+        return [(FakeDomain(self.host, name), {"balloon.maximum": domain["memory"] * 1024, "vcpu.current": domain["vcpus"],
+                                               "state.state": 1 if domain["active"] else 5})
+                for name, domain in self.host.domains.items()]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDomain:
+    def __init__(self, host, name):
+        self.host = host
+        self.domain_name = name
+
+    def name(self):
+        return self.domain_name
+
+    def info(self):
+        domain = self.host.domains[self.domain_name]
+        return [1 if domain["active"] else 5, domain["memory"] * 1024, domain["memory"] * 1024, domain["vcpus"], 0]
+
+    def isActive(self):
+        return self.host.domains[self.domain_name]["active"]
+
+    def migrateToURI3(self, dest_uri, params, flags):
+        with self.host.lock:
+            self.host.migrating += 1
+            self.host.max_migrating = max(self.host.max_migrating, self.host.migrating)
+        try:
+            time.sleep(0.02)
+            if self.domain_name in self.host.failures:
+                raise self.host.failures[self.domain_name]
+            assert flags & libvirt.VIR_MIGRATE_PEER2PEER and flags & libvirt.VIR_MIGRATE_UNDEFINE_SOURCE
+            # the definition moves, and the vm keeps running on the destination if it was running here
+            domain = self.host.domains.pop(self.domain_name)
+            self.host.hosts[dest_uri].domains[self.domain_name] = domain
+        finally:
+            with self.host.lock:
+                self.host.migrating -= 1
+
+    def jobStats(self, flags):
+        raise libvirt.libvirtError("Requested operation is not valid: no job is active on the domain")
+
+
+@pytest.fixture
+def hosts(monkeypatch, tmp_path):
+    hosts = {}
+    FakeHost(hosts, SOURCE_URI)
+    FakeHost(hosts, DEST_URI)
+    monkeypatch.setenv("VMCTL_CONFIG", str(tmp_path / "config.json"))
+    # the source daemon would reach the destination itself, vmctl only opens it for the checks
+    monkeypatch.setattr(wrapper.migrate, "open_connection", lambda uri: FakeConnection(hosts[uri]))
+    return hosts
+
+
+def migrate(hosts, names, **options):
+    api = MigrationApi(FakeConnection(hosts[SOURCE_URI]))
+    return {result["name"]: result for result in api.migrate(names, DEST_URI, poll_interval=0.01, **options)}
+
+
+def test_migrates_between_hosts(hosts):
+    source, dest = hosts[SOURCE_URI], hosts[DEST_URI]
+    for index in range(4):
+        source.define(f"web-{index}", active=index % 2 == 0)
+
+    results = migrate(hosts, [f"web-{index}" for index in range(4)], max_concurrent=2)
+
+    assert {result["status"] for result in results.values()} == {"done"}
+    assert source.domains == {}
+    assert sorted(dest.domains) == ["web-0", "web-1", "web-2", "web-3"]
+    assert dest.domains["web-0"]["active"] and not dest.domains["web-1"]["active"]
+    assert 1 <= source.max_migrating <= 2
+
+
+def test_preflight_failures_do_not_stop_the_others(hosts):
+    source, dest = hosts[SOURCE_URI], hosts[DEST_URI]
+    source.define("web-1")
+    source.define("taken")
+    source.define("huge", memory=65536)
+    dest.define("taken")
+
+    results = migrate(hosts, ["web-1", "taken", "huge", "missing"])
+
+    assert results["web-1"]["status"] == "done"
+    assert results["taken"]["message"] == "A VM named 'taken' already exists on the destination."
+    assert "would commit" in results["huge"]["message"]
+    assert "Error reading VM 'missing'" in results["missing"]["message"]
+    assert [name for name, result in results.items() if result["status"] == "failed"] == ["taken", "huge", "missing"]
+    assert sorted(source.domains) == ["huge", "taken"]
+
+
+def test_failed_migrations_are_reported(hosts):
+    source, dest = hosts[SOURCE_URI], hosts[DEST_URI]
+    for name in ("web-1", "web-2", "web-3"):
+        source.define(name)
+    source.failures["web-2"] = libvirt.libvirtError("operation failed: migration out job: unexpectedly failed")
+    # not a libvirt error, _migrate_one lets it through to run_parallel
+    source.failures["web-3"] = RuntimeError("connection reset by peer")
+
+    results = migrate(hosts, ["web-1", "web-2", "web-3"])
+
+    assert results["web-1"]["status"] == "done"
+    assert results["web-2"]["status"] == "failed"
+    assert "unexpectedly failed" in results["web-2"]["message"]
+    assert results["web-3"]["status"] == "failed"
+    assert results["web-3"]["message"] == "Error migrating VM 'web-3': connection reset by peer"
+    assert sorted(source.domains) == ["web-2", "web-3"]
+    assert sorted(dest.domains) == ["web-1"]
+
+
+@pytest.mark.parametrize("max_concurrent", [0, -1])
+def test_max_concurrent_below_one_is_refused(hosts, max_concurrent):
+    hosts[SOURCE_URI].define("web-1")
+    with pytest.raises(VmctlError, match="at least 1"):
+        migrate(hosts, ["web-1"], max_concurrent=max_concurrent)
+    assert "web-1" in hosts[SOURCE_URI].domains
+
+
+def test_concurrent_calls_keep_their_own_progress(hosts):
+    source = hosts[SOURCE_URI]
+    for name in ("web-1", "web-2"):
+        source.define(name)
+    # one api, called from two threads
+    api = MigrationApi(FakeConnection(source))
+    results = {}
+
+    def run(name):
+        results[name] = api.migrate([name], DEST_URI, poll_interval=0.01)
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ("web-1", "web-2")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [(result["name"], result["status"]) for result in results["web-1"]] == [("web-1", "done")]
+    assert [(result["name"], result["status"]) for result in results["web-2"]] == [("web-2", "done")]
+
+
+def test_update_from_stats():
+    progress = MigrationProgress(["web-1"])
+    # a migration that has not started is left alone
+    assert progress.update_from_stats("web-1", {"memory_remaining": 100}) is None
+
+    progress.update("web-1", status="migrating", started_at=time.monotonic())
+    vm = progress.update_from_stats("web-1", {"memory_total": 4096, "memory_remaining": 2048, "memory_bps": 1024,
+                                              "memory_dirty_rate": 1, "memory_page_size": 4096, "memory_iteration": 3})
+    assert (vm["memory_remaining"], vm["dirty_rate"], vm["iteration"], vm["downtime_ms"]) == (2048, 4096, 3, 2000.0)
+    assert vm["message"] == "Not converging, memory is dirtied faster than it is sent."
+    assert progress.get()[0] == vm
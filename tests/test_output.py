@@ -0,0 +1,81 @@
+import io
+import json
+import pytest
+
+from utils.errors import VmctlError
+from utils.output import OUTPUT_FORMATS, check_output_format, default_output_format, strip_markup, write_records
+
+RECORDS = [{"name": "web-1", "state": "running", "vcpus": 2, "tags": None}, {"name": "db, 1", "state": "shut off", "vcpus": 4, "tags": None}]
+
+
+def written(records, output_format, fields=None):
+    file = io.StringIO()
+    write_records(records, output_format, fields, file)
+    return file.getvalue()
+
+
+def test_json():
+    output = written(iter(RECORDS), "json")
+    assert json.loads(output) == RECORDS
+    assert written([], "json") == "[]\n"
+
+
+def test_ndjson():
+    assert [json.loads(line) for line in written(RECORDS, "ndjson").splitlines()] == RECORDS
+    assert written([], "ndjson") == ""
+
+
+def test_csv():
+    assert written(RECORDS, "csv").splitlines() == ["name,state,vcpus,tags", "web-1,running,2,", '"db, 1",shut off,4,']
+    # the given fields pick and order the columns
+    assert written(RECORDS, "csv", ["vcpus", "name"]).splitlines() == ["vcpus,name", "2,web-1", '4,"db, 1"']
+    assert written([], "csv") == ""
+
+
+def test_records_are_streamed():
+    file = io.StringIO()
+    seen = []
+
+    def records():
+        for record in RECORDS:
+            yield record
+            # each record is out before the next one is produced
+            seen.append(file.getvalue().count("\n"))
+
+    write_records(records(), "ndjson", file=file)
+    assert seen == [1, 2]
+
+
+def test_table_is_not_a_record_format():
+    with pytest.raises(VmctlError, match="cannot be written as records"):
+        written(RECORDS, "table")
+
+
+def test_check_output_format():
+    for output_format in OUTPUT_FORMATS:
+        check_output_format(output_format)
+    with pytest.raises(VmctlError, match="Unsupported output format 'yaml'. Use one of: table, json, ndjson, csv."):
+        check_output_format("yaml")
+
+
+class FakeStdout(io.StringIO):
+    def __init__(self, tty):
+        super().__init__()
+        self.tty = tty
+
+    def isatty(self):
+        return self.tty
+
+
+def test_default_output_format(monkeypatch):
+    monkeypatch.setattr("sys.stdout", FakeStdout(tty=True))
+    assert default_output_format() == "table"
+    monkeypatch.setattr("sys.stdout", FakeStdout(tty=False))
+    assert default_output_format() == "ndjson"
+
+
+def test_strip_markup():
+    assert strip_markup("[bold bright_yellow]Warning:[/bold bright_yellow] VM [cyan]web-1[/cyan] is over.") == "Warning: VM web-1 is over."
+    assert strip_markup("no markup") == "no markup"
+    # escaped brackets are kept
+    assert strip_markup(r"list \[1]") == "list [1]"
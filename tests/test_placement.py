@@ -0,0 +1,177 @@
+import pytest
+
+pytest.importorskip("libvirt")
+
+from utils.errors import VmctlError
+from wrapper.placement import (
+    PlacementEngine,
+    format_cpuset,
+    parse_capabilities,
+    parse_cpuset,
+    read_placement,
+)
+
+GIB = 1024 * 1024
+
+# two nodes of 4 cores with 2 threads each, numbered like linux does: the
+# first thread of every core, then the second (cpu 0 and 8 share core 0)
+CAPABILITIES = """
+<capabilities>
+  <host>
+    <topology>
+      <cells num="2">
+        {cells}
+      </cells>
+    </topology>
+  </host>
+</capabilities>
+"""
+
+
+def cell(node):
+    cpus = "".join(f'<cpu id="{cpu}" socket_id="{node}" core_id="{cpu % 8}" />'
+                   for cpu in list(range(node * 4, node * 4 + 4)) + list(range(8 + node * 4, 12 + node * 4)))
+    return f'<cell id="{node}"><memory unit="KiB">{16 * GIB}</memory><cpus num="8">{cpus}</cpus></cell>'
+
+
+@pytest.fixture
+def nodes():
+    return parse_capabilities(CAPABILITIES.format(cells=cell(0) + cell(1)))
+
+
+def engine(nodes, strategy, free=(8, 8), pinned=()):
+    return PlacementEngine(nodes, {node: memory * GIB for node, memory in enumerate(free)}, list(pinned), strategy)
+
+
+@pytest.mark.parametrize("cpuset, cpus", [
+    ("0", {0}),
+    ("0-3", {0, 1, 2, 3}),
+    ("0-3,^2,8", {0, 1, 3, 8}),
+    ("0-7, ^4-5", {0, 1, 2, 3, 6, 7}),
+    ("1,,3", {1, 3}),
+    ("", set()),
+])
+def test_parse_cpuset(cpuset, cpus):
+    assert parse_cpuset(cpuset) == cpus
+
+
+@pytest.mark.parametrize("cpuset", ["a", "0-", "1-2-3", "^x"])
+def test_parse_invalid_cpusets(cpuset):
+    with pytest.raises(VmctlError):
+        parse_cpuset(cpuset)
+
+
+@pytest.mark.parametrize("cpus, cpuset", [
+    ([], ""),
+    ([3], "3"),
+    ([3, 0, 1, 2], "0-3"),
+    ([0, 1, 3, 8, 9, 10], "0-1,3,8-10"),
+    ({5, 7}, "5,7"),
+])
+def test_format_cpuset(cpus, cpuset):
+    assert format_cpuset(cpus) == cpuset
+    assert parse_cpuset(cpuset) == set(cpus)
+
+
+def test_parse_capabilities(nodes):
+    assert [node["id"] for node in nodes] == [0, 1]
+    assert nodes[0]["memory"] == 16 * GIB
+    assert [cpu["id"] for cpu in nodes[1]["cpus"]] == [4, 5, 6, 7, 12, 13, 14, 15]
+    assert nodes[0]["cpus"][4] == {"id": 8, "socket": 0, "core": 0}
+
+
+def test_parse_capabilities_without_topology():
+    with pytest.raises(VmctlError):
+        parse_capabilities("<capabilities><host /></capabilities>")
+
+
+def test_auto_gives_vms_cpus_of_their_own(nodes):
+    placer = engine(nodes, "auto", pinned=[0, 1, 2])
+    # node 1 has every cpu free
+    assert placer.place(2, 1024) == {"node": 1, "cpus": [4, 12]}
+    assert placer.place(4, 1024) == {"node": 1, "cpus": [5, 13, 6, 14]}
+    # node 0 has more unpinned cpus left now
+    assert placer.place(2, 1024)["node"] == 0
+
+
+def test_auto_whole_cores_first(nodes):
+    placement = engine(nodes, "auto").place(4, 1024)
+    # both threads of a core before the next core
+    assert placement == {"node": 0, "cpus": [0, 8, 1, 9]}
+
+
+def test_pack_fills_one_node_first(nodes):
+    placer = engine(nodes, "pack", free=(4, 8))
+    placements = [placer.place(2, 1024) for _ in range(4)]
+    assert {placement["node"] for placement in placements} == {0}
+    # no cpu of node 0 is shared until every one is used
+    assert len({cpu for placement in placements for cpu in placement["cpus"]}) == 8
+    # out of cpus of its own there, the vm moves to the next node
+    assert placer.place(2, 1024)["node"] == 1
+
+
+def test_pack_keeps_to_nodes_with_memory(nodes):
+    placer = engine(nodes, "pack", free=(1, 8))
+    assert placer.place(1, 512)["node"] == 0
+    assert placer.place(1, 1024)["node"] == 1
+
+
+def test_spread_balances_memory_and_uses_one_thread_per_core(nodes):
+    placer = engine(nodes, "spread")
+    first = placer.place(4, 2048)
+    second = placer.place(4, 2048)
+    assert first == {"node": 0, "cpus": [0, 1, 2, 3]}
+    assert second == {"node": 1, "cpus": [4, 5, 6, 7]}
+    # the second threads once every core has a vcpu
+    assert placer.place(2, 1024)["cpus"] == [8, 9]
+
+
+def test_place_accounts_for_memory(nodes):
+    placer = engine(nodes, "auto", free=(2, 2))
+    placer.place(1, 2048)
+    placer.place(1, 2048)
+    with pytest.raises(VmctlError):
+        placer.place(1, 2048)
+
+
+def test_place_needs_a_node_big_enough(nodes):
+    with pytest.raises(VmctlError):
+        engine(nodes, "auto").place(9, 1024)
+    with pytest.raises(VmctlError):
+        engine(nodes, "auto").place(1, 9 * 1024)
+
+
+def test_release_and_reserve(nodes):
+    placer = engine(nodes, "auto", free=(2, 0))
+    placement = placer.place(2, 2048)
+    assert placer.free_memory[0] == 0
+
+    placer.release(placement, 2048)
+    assert placer.free_memory[0] == 2 * GIB
+    assert all(count == 0 for count in placer.pin_counts.values())
+    # released again by mistake, the counts do not go negative
+    placer.release(placement)
+    assert all(count == 0 for count in placer.pin_counts.values())
+
+    placer.reserve(placement, 2048)
+    assert placer.free_memory[0] == 0
+    assert [placer.pin_counts[cpu] for cpu in placement["cpus"]] == [1, 1]
+
+
+def test_read_placement():
+    domain_xml = """
+    <domain>
+      <memory unit="KiB">2097152</memory>
+      <vcpu placement="static">2</vcpu>
+      <cputune><vcpupin vcpu="0" cpuset="4" /><vcpupin vcpu="1" cpuset="12" /></cputune>
+      <numatune><memory mode="strict" nodeset="1" /></numatune>
+    </domain>
+    """
+    assert read_placement(domain_xml) == {"node": 1, "cpus": [4, 12], "memory": 2048}
+    floating = '<domain><memory unit="KiB">1048576</memory><vcpu cpuset="0-1">2</vcpu></domain>'
+    assert read_placement(floating) == {"node": None, "cpus": [0, 1], "memory": 1024}
+
+
+def test_unknown_strategy(nodes):
+    with pytest.raises(VmctlError):
+        engine(nodes, "random")
@@ -0,0 +1,109 @@
+import threading
+import time
+import pytest
+
+from wrapper.pool import ConnectionPool
+
+
+class FakeApi:
+    def __init__(self, uri):
+        self.uri = uri
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Connector:
+    """Opens FakeApis, taking `delay` seconds each, and counts the connections opened per URI."""
+
+    def __init__(self, delay=0.0, failing=()):
+        self.delay = delay
+        self.failing = set(failing)
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def __call__(self, uri):
+        time.sleep(self.delay)
+        if uri in self.failing:
+            raise ConnectionError(f"cannot connect to {uri}")
+        with self.lock:
+            self.opened.append(uri)
+        return FakeApi(uri)
+
+
+def test_connections_are_reused():
+    connector = Connector()
+    pool = ConnectionPool(connector)
+
+    first = pool.get("qemu+ssh://node1/system")
+    assert pool.get("qemu+ssh://node1/system") is first
+    assert pool.get("qemu+ssh://node2/system") is not first
+    assert connector.opened == ["qemu+ssh://node1/system", "qemu+ssh://node2/system"]
+
+
+def test_given_connections_are_not_opened_again():
+    connector = Connector()
+    existing = FakeApi("qemu:///system")
+    pool = ConnectionPool(connector, {"qemu:///system": existing})
+
+    assert pool.get("qemu:///system") is existing
+    assert connector.opened == []
+
+
+def test_concurrent_callers_share_one_connection():
+    connector = Connector(delay=0.05)
+    pool = ConnectionPool(connector)
+    barrier = threading.Barrier(8)
+    got = []
+
+    def get():
+        barrier.wait()
+        got.append(pool.get("qemu+ssh://node1/system"))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert connector.opened == ["qemu+ssh://node1/system"]
+    assert len({id(api) for api in got}) == 1
+
+
+def test_different_uris_connect_concurrently():
+    connector = Connector(delay=0.2)
+    pool = ConnectionPool(connector)
+    uris = [f"qemu+ssh://node{index}/system" for index in range(4)]
+    threads = [threading.Thread(target=pool.get, args=(uri,)) for uri in uris]
+
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # one slow connection does not hold up the others
+    assert time.monotonic() - start < 0.2 * len(uris)
+    assert sorted(connector.opened) == uris
+
+
+def test_failed_connections_are_tried_again():
+    connector = Connector(failing=["qemu+ssh://node1/system"])
+    pool = ConnectionPool(connector)
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            pool.get("qemu+ssh://node1/system")
+    connector.failing.clear()
+    assert pool.get("qemu+ssh://node1/system").uri == "qemu+ssh://node1/system"
+
+
+def test_close_closes_every_connection():
+    pool = ConnectionPool(Connector())
+    apis = [pool.get(f"qemu+ssh://node{index}/system") for index in range(3)]
+
+    pool.close()
+    assert all(api.closed for api in apis)
+    # the pool can be used again afterwards
+    assert pool.get("qemu+ssh://node0/system") is not apis[0]
@@ -0,0 +1,25 @@
+import json
+import time
+import pytest
+
+from utils.errors import VmctlError
+from utils.profiling import Profiler
+
+
+def test_write_trace(tmp_path):
+    profiler = Profiler()
+    start = time.perf_counter()
+    profiler.record("vm_api.get_vms", "libvirt", start, start + 0.5)
+
+    profiler.write_trace(str(tmp_path / "trace.json"))
+
+    trace = json.loads((tmp_path / "trace.json").read_text())
+    [event] = trace["traceEvents"]
+    assert (event["name"], event["cat"], event["ph"]) == ("vm_api.get_vms", "libvirt", "X")
+    assert event["dur"] == pytest.approx(500000)
+
+
+def test_an_unwritable_trace_file_is_reported(tmp_path):
+    path = tmp_path / "missing" / "trace.json"
+    with pytest.raises(VmctlError, match=f"Error writing the trace file '{path}': No such file or directory"):
+        Profiler().write_trace(str(path))
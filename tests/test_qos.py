@@ -0,0 +1,109 @@
+import xml.etree.ElementTree as ET
+import pytest
+
+from utils.errors import VmctlError
+from utils.qos import (
+    DEFAULT_PROFILES,
+    QOS_NAMESPACE,
+    bandwidth_element,
+    block_parameters,
+    check_profile,
+    get_profile,
+    get_profiles,
+    interface_parameters,
+    iotune_element,
+    qos_metadata,
+    read_limits,
+)
+
+DB_PROFILE = {
+    "disk": {"total_iops_sec": 4000, "total_iops_sec_max": 8000, "total_iops_sec_max_length": 30},
+    "net": {"inbound.average": 25600, "outbound.average": 25600, "outbound.peak": 51200},
+}
+
+
+def test_configured_profiles_are_added_to_the_built_in_ones():
+    profiles = get_profiles({"qos": {"db": DB_PROFILE, "bronze": {"disk": {"total_iops_sec": 100}}}})
+
+    assert set(profiles) == set(DEFAULT_PROFILES) | {"db"}
+    assert profiles["db"] == DB_PROFILE
+    # a configured profile replaces the built-in one, and limits it does not set are empty
+    assert profiles["bronze"] == {"disk": {"total_iops_sec": 100}, "net": {}}
+    assert get_profile("gold", {}) == DEFAULT_PROFILES["gold"]
+
+
+def test_unknown_profile():
+    with pytest.raises(VmctlError, match="Unknown QoS profile 'platinum'. Use one of: bronze, gold, silver, unlimited."):
+        get_profile("platinum", {})
+
+
+@pytest.mark.parametrize("profile, message", [
+    ([], "must be a mapping"),
+    ({"cpu": {}}, "must be a mapping"),
+    ({"disk": {"iops": 1}}, "Unknown disk limits in the QoS profile 'bad': iops"),
+    ({"net": {"inbound.speed": 1}}, "Unknown net limits"),
+    ({"disk": {"total_iops_sec": -1}}, "must be a non-negative integer"),
+    ({"disk": {"total_iops_sec": 1.5}}, "must be a non-negative integer"),
+    ({"disk": {"total_iops_sec": True}}, "must be a non-negative integer"),
+    ({"disk": {"total_bytes_sec": 1, "read_bytes_sec": 1}}, "cannot cap total_bytes_sec and read/write_bytes_sec together"),
+    ({"disk": {"read_iops_sec_max": 10}}, "sets read_iops_sec_max without read_iops_sec"),
+    ({"disk": {"read_iops_sec": 5, "read_iops_sec_max_length": 10}}, "sets read_iops_sec_max_length without read_iops_sec_max"),
+    ({"net": {"outbound.burst": 10}}, "sets a outbound peak or burst without an average"),
+])
+def test_invalid_profiles(profile, message):
+    with pytest.raises(VmctlError, match=message):
+        check_profile("bad", profile)
+
+
+def test_block_parameters_remove_what_the_profile_does_not_set():
+    parameters = block_parameters(DB_PROFILE)
+
+    assert parameters["total_iops_sec"] == 4000 and parameters["total_iops_sec_max"] == 8000
+    assert parameters["total_iops_sec_max_length"] == 30
+    assert parameters["read_bytes_sec"] == 0 and parameters["write_iops_sec_max"] == 0
+    # burst lengths are only sent with a burst
+    assert "read_iops_sec_max_length" not in parameters
+    assert set(block_parameters(DEFAULT_PROFILES["unlimited"]).values()) == {0}
+
+
+def test_interface_parameters():
+    assert interface_parameters(DB_PROFILE) == {
+        "inbound.average": 25600, "inbound.peak": 0, "inbound.burst": 0,
+        "outbound.average": 25600, "outbound.peak": 51200, "outbound.burst": 0,
+    }
+
+
+def test_elements_round_trip_through_read_limits():
+    root = ET.fromstring(
+        "<domain><devices>"
+        '<disk type="file" device="disk"><target dev="vda"/></disk>'
+        '<disk type="file" device="cdrom"><target dev="hdc"/></disk>'
+        '<interface type="network"><mac address="52:54:00:00:00:01"/></interface>'
+        '<interface type="network"><mac address="52:54:00:00:00:02"/><target dev="vnet3"/></interface>'
+        "</devices><metadata/></domain>"
+    )
+    root.find("devices/disk").append(iotune_element(DB_PROFILE))
+    for interface in root.findall("devices/interface"):
+        interface.append(bandwidth_element(DB_PROFILE))
+    root.find("metadata").append(qos_metadata("db"))
+    # as libvirt hands it back
+    root = ET.fromstring(ET.tostring(root))
+
+    net = {"inbound.average": 25600, "outbound.average": 25600, "outbound.peak": 51200}
+    assert read_limits(root) == {
+        "profile": "db",
+        "disks": {"vda": DB_PROFILE["disk"]},
+        # interfaces are named by their target, or their MAC address when the VM is not running
+        "interfaces": {"52:54:00:00:00:01": net, "vnet3": net},
+    }
+
+
+def test_empty_profiles_build_no_elements():
+    assert iotune_element(DEFAULT_PROFILES["unlimited"]) is None
+    assert bandwidth_element(DEFAULT_PROFILES["unlimited"]) is None
+
+
+def test_read_limits_without_limits():
+    root = ET.fromstring('<domain><devices><disk device="disk"><target dev="vda"/></disk></devices></domain>')
+    assert read_limits(root) == {"profile": None, "disks": {"vda": {}}, "interfaces": {}}
+    assert qos_metadata("gold").tag == f"{{{QOS_NAMESPACE}}}qos"
@@ -0,0 +1,138 @@
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from utils.qos import DEFAULT_PROFILES, block_parameters, interface_parameters
+from wrapper.qos import QOS_FIELDS, QosApi
+
+DOMAIN_XML = """
+<domain>
+  <name>{name}</name>
+  <devices>
+    <disk type="file" device="disk"><target dev="vda"/><iotune><total_iops_sec>500</total_iops_sec></iotune></disk>
+    <disk type="file" device="cdrom"><target dev="hdc"/></disk>
+    <interface type="network"><mac address="52:54:00:00:00:01"/><target dev="vnet0"/>
+      <bandwidth><inbound average="100"/></bandwidth></interface>
+  </devices>
+</domain>
+"""
+
+
+class FakeDomain:
+    def __init__(self, name, state=None, error=None):
+        self.domain_name = name
+        self.domain_state = libvirt.VIR_DOMAIN_RUNNING if state is None else state
+        self.error = error
+        self.calls = []
+
+    def name(self):
+        return self.domain_name
+
+    def state(self):
+        return [self.domain_state, 0]
+
+    def XMLDesc(self, flags):
+        if self.error:
+            raise libvirt.libvirtError(self.error)
+        return DOMAIN_XML.format(name=self.domain_name)
+
+    def setBlockIoTune(self, disk, parameters, flags):
+        self.calls.append(("block", disk, parameters, flags))
+
+    def setInterfaceParameters(self, device, parameters, flags):
+        self.calls.append(("net", device, parameters, flags))
+
+    def setMetadata(self, kind, metadata, prefix, uri, flags):
+        self.calls.append(("metadata", metadata, flags))
+
+
+class FakeConnection:
+    def __init__(self, domains, stats=()):
+        self.domains = {domain.name(): domain for domain in domains}
+        # the stats returned by each bulk read, in turn
+        self.stats = list(stats)
+
+    def lookupByName(self, name):
+        if name not in self.domains:
+            raise libvirt.libvirtError(f"Domain not found: no domain with matching name '{name}'")
+        return self.domains[name]
+
+    def getAllDomainStats(self, stats):
+        reading = self.stats.pop(0)
+        return [(self.domains[name], reading.get(name, {})) for name in self.domains]
+
+
+def block_stats(reqs, read, write):
+    return {"block.count": 1, "block.0.name": "vda", "block.0.rd.reqs": reqs, "block.0.wr.reqs": 0,
+            "block.0.rd.bytes": read, "block.0.wr.bytes": write}
+
+
+def test_apply_sets_every_disk_and_interface():
+    running, shutoff = FakeDomain("web-1"), FakeDomain("web-2", libvirt.VIR_DOMAIN_SHUTOFF)
+    api = QosApi(FakeConnection([running, shutoff]))
+
+    results = api.apply(["web-1", "web-2", "web-3"], "bronze")
+    assert [(result["name"], result["status"]) for result in results] == [("web-1", "done"), ("web-2", "failed"), ("web-3", "failed")]
+    assert results[0]["message"] == "Profile bronze applied to 1 disks and 1 interfaces."
+    assert "is not running. Use --config" in results[1]["message"]
+    assert results[2]["message"].startswith("Error applying the QoS profile to VM 'web-3': Domain not found")
+
+    # the cdrom is left alone, and the interface is named by its MAC address
+    profile = DEFAULT_PROFILES["bronze"]
+    live = libvirt.VIR_DOMAIN_AFFECT_LIVE
+    assert running.calls[:2] == [("block", "vda", block_parameters(profile), live),
+                                 ("net", "52:54:00:00:00:01", interface_parameters(profile), live)]
+    assert running.calls[2][0] == "metadata" and 'profile="bronze"' in running.calls[2][1]
+
+
+def test_apply_to_the_configuration_of_a_shut_off_vm():
+    shutoff = FakeDomain("web-2", libvirt.VIR_DOMAIN_SHUTOFF)
+    [result] = QosApi(FakeConnection([shutoff])).apply(["web-2"], "gold", config=True)
+
+    assert result["status"] == "done"
+    assert {flags for *_, flags in shutoff.calls} == {libvirt.VIR_DOMAIN_AFFECT_CONFIG}
+
+
+def test_device_rates():
+    first = {"state.state": libvirt.VIR_DOMAIN_RUNNING, **block_stats(100, 1000, 0),
+             "net.count": 1, "net.0.name": "vnet0", "net.0.rx.bytes": 500, "net.0.tx.bytes": 100}
+    second = {"state.state": libvirt.VIR_DOMAIN_RUNNING, **block_stats(300, 3000, 1000),
+              "net.count": 2, "net.0.name": "vnet1", "net.0.rx.bytes": 50, "net.0.tx.bytes": 0,
+              "net.1.name": "vnet0", "net.1.rx.bytes": 900, "net.1.tx.bytes": 50}
+
+    rates = QosApi._device_rates(first, second, 2.0)
+    assert rates[("block", "vda")] == {"reqs": 100.0, "read": 1000.0, "write": 500.0}
+    # devices are matched by name, a hot plugged one has no rate yet and counters never go backwards
+    assert rates[("net", "vnet0")] == {"rx": 200.0, "tx": 0.0}
+    assert ("net", "vnet1") not in rates
+
+    stopped = dict(second, **{"state.state": libvirt.VIR_DOMAIN_SHUTOFF})
+    assert QosApi._device_rates(first, stopped, 2.0) == {}
+
+
+def test_records_add_up_limits_and_use():
+    disk = QosApi._disk_record("web-1", "db", "vda", {"read_iops_sec": 100, "write_iops_sec": 100, "total_bytes_sec": 1000},
+                               {"reqs": 50.0, "read": 900.0, "write": 0.0})
+    assert (disk["iops_limit"], disk["bytes_limit"], disk["iops"], disk["bytes"], disk["use"]) == (200, 1000, 50.0, 900.0, 0.9)
+
+    net = QosApi._net_record("web-1", None, "vnet0", {"outbound.average": 1}, {"rx": 10.0, "tx": 512.0})
+    assert (net["in_limit"], net["out_limit"], net["use"]) == (None, 1024, 0.5)
+
+    # no limits, or a VM that is not running
+    assert QosApi._disk_record("web-1", None, "vda", {}, {"reqs": 1.0, "read": 0.0, "write": 0.0})["use"] is None
+    assert QosApi._disk_record("web-1", None, "vda", {}, None)["iops"] is None
+
+
+def test_get_qos_returns_the_vms_whose_limits_cannot_be_read(capsys):
+    web, broken = FakeDomain("web-1"), FakeDomain("web-2", error="Domain not found")
+    stats = {"state.state": libvirt.VIR_DOMAIN_RUNNING, **block_stats(0, 0, 0)}
+    api = QosApi(FakeConnection([web, broken], [{"web-1": stats}, {"web-1": stats}]))
+
+    records = api.get_qos(interval=0)
+    assert [(record["name"], record["type"], record["device"]) for record in records] == [
+        ("web-1", "disk", "vda"), ("web-1", "net", "vnet0"), ("web-2", None, None)]
+    assert records[2]["error"] == "Error reading the limits of VM web-2: Domain not found"
+    assert all(set(record) == set(QOS_FIELDS) for record in records)
+    assert records[0]["iops_limit"] == 500 and records[1]["in_limit"] == 100 * 1024
+    # nothing is printed in the middle of json or csv output
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,240 @@
+import collections
+import threading
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from wrapper.resilient import ResilientConnection, classify, is_idempotent
+
+# no delay between retries
+SETTINGS = {"attempts": 3, "base_delay": 0, "max_delay": 0}
+
+
+class InjectedError(libvirt.libvirtError):
+    """A libvirt error with a chosen code and domain, raised without a failed libvirt call behind it."""
+
+    def __init__(self, code, domain=libvirt.VIR_FROM_NONE, message="injected"):
+        Exception.__init__(self, message)
+        self.err = (code, domain, message, libvirt.VIR_ERR_ERROR, None, None, None, -1, -1)
+
+    def get_error_code(self):
+        return self.err[0]
+
+    def get_error_domain(self):
+        return self.err[1]
+
+
+class FakeHost:
+    """Opens FakeConnections and fails their calls with the errors queued in `failures`."""
+
+    def __init__(self):
+        self.connections = []
+        self.failures = []
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def open(self, uri):
+        connection = FakeConnection(self)
+        self.connections.append(connection)
+        return connection
+
+
+class FakeConnection:
+    def __init__(self, host):
+        self.host = host
+        self.alive = True
+        self.closed = False
+
+    def call(self, method):
+        with self.host.lock:
+            self.host.calls[method] += 1
+            if not self.alive:
+                raise InjectedError(libvirt.VIR_ERR_INVALID_CONN)
+            if self.host.failures:
+                raise self.host.failures.pop(0)
+
+    def isAlive(self):
+        return 1 if self.alive else 0
+
+    def getInfo(self):
+        self.call("getInfo")
+        return ["x86_64", 16384, 8, 2000, 1, 1, 4, 2]
+
+    def lookupByName(self, name):
+        self.call("lookupByName")
+        return FakeDomain(self, name)
+
+    def lookupByUUIDString(self, uuid):
+        self.call("lookupByUUIDString")
+        return FakeDomain(self, uuid[len("uuid-"):])
+
+    def createXML(self, xml, flags=0):
+        self.call("createXML")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDomain(libvirt.virDomain):
+    # virDomain.__init__ wants a wrapped C object, the fake has none
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.domain_name = name
+
+    def name(self):
+        return self.domain_name
+
+    def UUIDString(self):
+        return f"uuid-{self.domain_name}"
+
+    def info(self):
+        self.connection.call("info")
+        return [1, 1024, 1024, 1, 0]
+
+    def suspend(self):
+        self.connection.call("suspend")
+
+
+@pytest.fixture
+def host():
+    return FakeHost()
+
+
+@pytest.fixture
+def connection(host):
+    return ResilientConnection("test:///fake", host.open, SETTINGS)
+
+
+def test_classify():
+    assert classify(InjectedError(libvirt.VIR_ERR_INVALID_CONN)) == "connection"
+    assert classify(InjectedError(libvirt.VIR_ERR_NO_CONNECT)) == "connection"
+    assert classify(InjectedError(libvirt.VIR_ERR_OPERATION_TIMEOUT)) == "transient"
+    assert classify(InjectedError(libvirt.VIR_ERR_NO_DOMAIN)) is None
+
+
+def test_classify_system_errors(host):
+    alive, dead = FakeConnection(host), FakeConnection(host)
+    dead.alive = False
+    missing_disk = InjectedError(libvirt.VIR_ERR_SYSTEM_ERROR, libvirt.VIR_FROM_STORAGE)
+    # an os error on a healthy connection is not a lost connection
+    assert classify(missing_disk) is None
+    assert classify(missing_disk, alive) is None
+    assert classify(missing_disk, dead) == "connection"
+    assert classify(InjectedError(libvirt.VIR_ERR_SYSTEM_ERROR, libvirt.VIR_FROM_RPC), alive) == "connection"
+    assert classify(InjectedError(libvirt.VIR_ERR_SYSTEM_ERROR, libvirt.VIR_FROM_REMOTE), alive) == "connection"
+
+
+@pytest.mark.parametrize("method", ["getAllDomainStats", "lookupByName", "listAllDomains", "isActive", "info",
+                                    "XMLDesc", "setMemoryFlags", "setBlockIoTune"])
+def test_idempotent_methods(method):
+    assert is_idempotent(method)
+
+
+@pytest.mark.parametrize("method", ["create", "createXML", "defineXML", "undefine", "suspend", "resume", "destroy",
+                                    "shutdown", "reboot", "migrate3", "snapshotCreateXML"])
+def test_non_idempotent_methods(method):
+    assert not is_idempotent(method)
+
+
+def test_reconnects_and_retries_idempotent_calls(host, connection):
+    listener = []
+    connection.add_reconnect_listener(lambda: listener.append(True))
+    host.connections[0].alive = False
+
+    assert connection.getInfo()[0] == "x86_64"
+    assert len(host.connections) == 2
+    assert host.connections[0].closed
+    assert connection.reconnects == 1 and connection.generation == 1
+    assert listener == [True]
+
+
+def test_domains_are_looked_up_again_after_a_reconnect(host, connection):
+    domain = connection.lookupByName("web-1")
+    host.connections[0].alive = False
+
+    assert domain.info()[0] == 1
+    assert host.calls["lookupByUUIDString"] == 1
+    assert domain._target.connection is host.connections[1]
+
+
+def test_transient_errors_are_retried(host, connection):
+    host.failures = [InjectedError(libvirt.VIR_ERR_OPERATION_TIMEOUT)] * 2
+
+    connection.getInfo()
+    assert host.calls["getInfo"] == 3
+    assert connection.reconnects == 0
+
+
+def test_retries_give_up_after_the_attempts(host, connection):
+    host.failures = [InjectedError(libvirt.VIR_ERR_OPERATION_TIMEOUT)] * 5
+
+    with pytest.raises(libvirt.libvirtError):
+        connection.getInfo()
+    assert host.calls["getInfo"] == SETTINGS["attempts"]
+
+
+def test_other_errors_are_not_retried(host, connection):
+    host.failures = [InjectedError(libvirt.VIR_ERR_SYSTEM_ERROR, libvirt.VIR_FROM_STORAGE)]
+
+    with pytest.raises(libvirt.libvirtError):
+        connection.getInfo()
+    assert host.calls["getInfo"] == 1
+    assert connection.reconnects == 0
+
+
+def test_non_idempotent_calls_never_repeat(host, connection):
+    domain = connection.lookupByName("web-1")
+    host.failures = [InjectedError(libvirt.VIR_ERR_OPERATION_TIMEOUT)]
+    with pytest.raises(libvirt.libvirtError):
+        domain.suspend()
+    assert host.calls["suspend"] == 1
+
+    # a lost connection is replaced, but the call that failed on it is not made again
+    host.connections[0].alive = False
+    with pytest.raises(libvirt.libvirtError):
+        connection.createXML("<domain/>")
+    assert host.calls["createXML"] == 1
+    assert connection.reconnects == 1
+
+    connection.createXML("<domain/>")
+    assert host.calls["createXML"] == 2
+
+
+def test_reconnect_once_per_generation(host, connection):
+    connection.reconnect(0)
+    # a caller that saw the same generation fail finds the connection replaced already
+    connection.reconnect(0)
+    assert connection.reconnects == 1
+    assert len(host.connections) == 2
+
+
+def test_concurrent_failures_reconnect_once(host, connection):
+    host.connections[0].alive = False
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def call():
+        barrier.wait()
+        try:
+            connection.getInfo()
+        except libvirt.libvirtError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert connection.reconnects == 1
+    assert len(host.connections) == 2
+
+
+def test_close_callback_reconnects_before_the_next_call(host, connection):
+    connection._on_close(host.connections[0], libvirt.VIR_CONNECT_CLOSE_REASON_EOF, None)
+    host.connections[0].alive = False
+
+    connection.getInfo()
+    assert host.calls["getInfo"] == 1
+    assert connection.reconnects == 1
@@ -0,0 +1,87 @@
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from wrapper.snapshot import SnapshotApi
+
+
+class FakeDomain:
+    """A running domain whose suspend, resume or snapshot fails if its name is in `failing`."""
+
+    def __init__(self, name, failing):
+        self.domain_name = name
+        self.failing = failing
+        self.running = True
+        self.snapshots = []
+
+    def call(self, method):
+        if (self.domain_name, method) in self.failing:
+            raise libvirt.libvirtError(f"{method} failed")
+
+    def state(self):
+        return (libvirt.VIR_DOMAIN_RUNNING if self.running else libvirt.VIR_DOMAIN_PAUSED), 0
+
+    def suspend(self):
+        self.call("suspend")
+        self.running = False
+
+    def resume(self):
+        self.call("resume")
+        self.running = True
+
+    def snapshotCreateXML(self, xml, flags):
+        self.call("snapshot")
+        self.snapshots.append(xml)
+
+
+class FakeConnection:
+    def __init__(self, names, failing=()):
+        self.domains = {name: FakeDomain(name, set(failing)) for name in names}
+
+    def lookupByName(self, name):
+        if name not in self.domains:
+            raise libvirt.libvirtError(f"Domain not found: no domain with matching name '{name}'")
+        return self.domains[name]
+
+
+def by_name(results):
+    return {result["name"]: result for result in results}
+
+
+def test_consistent_snapshots_resume_every_vm():
+    connection = FakeConnection(["db", "web"])
+    results = by_name(SnapshotApi(connection).create(["db", "web"], "nightly", consistent=True))
+
+    assert {result["status"] for result in results.values()} == {"done"}
+    assert all(domain.running and len(domain.snapshots) == 1 for domain in connection.domains.values())
+    assert all(result["paused_ms"] is not None for result in results.values())
+
+
+def test_a_vm_that_cannot_be_paused_cancels_the_group():
+    connection = FakeConnection(["db", "web", "cache"], failing=[("db", "suspend")])
+    results = by_name(SnapshotApi(connection).create(["db", "web", "cache"], "nightly", consistent=True))
+
+    assert results["db"]["message"] == "Error pausing VM 'db': suspend failed"
+    assert results["web"]["message"] == "Not snapshotted, db could not be paused."
+    assert {result["status"] for result in results.values()} == {"failed"}
+    assert all(domain.running and not domain.snapshots for domain in connection.domains.values())
+
+
+def test_a_vm_left_paused_keeps_its_resume_error():
+    connection = FakeConnection(["db", "web"], failing=[("db", "suspend"), ("web", "resume")])
+    result = by_name(SnapshotApi(connection).create(["db", "web"], "nightly", consistent=True))["web"]
+
+    assert result["status"] == "failed"
+    assert result["message"] == ("Not snapshotted, db could not be paused. "
+                                 "Error resuming VM 'web', it is still paused: resume failed")
+    assert not connection.domains["web"].running
+
+
+def test_failed_snapshots_still_resume():
+    connection = FakeConnection(["db", "web"], failing=[("web", "snapshot")])
+    results = by_name(SnapshotApi(connection).create(["db", "web", "gone"], "nightly", consistent=True))
+
+    assert results["db"]["status"] == "done"
+    assert results["web"]["message"] == "Error creating snapshot of VM 'web': snapshot failed"
+    assert results["gone"]["message"].startswith("Error looking up VM 'gone'")
+    assert all(domain.running for domain in connection.domains.values())
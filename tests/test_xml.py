@@ -0,0 +1,156 @@
+import xml.etree.ElementTree as ET
+import pytest
+
+from utils.errors import VmctlError
+from utils.xml import DomainTemplate, create_xml_config, create_xml_from_spec, get_template
+
+
+def disk(**options):
+    return dict({"device": "disk", "format": "qcow2", "bus": "virtio"}, **options)
+
+
+def test_render_fills_in_the_vm_fields():
+    template = DomainTemplate(disks=[disk(), disk(format="raw")], interfaces=[{"network": "default", "model": "virtio"}])
+    domain = ET.fromstring(template.render("web-1", 2048, 4, sources=["/var/lib/a.qcow2", "/var/lib/b.img"]))
+
+    assert domain.get("type") == "kvm"
+    assert domain.findtext("name") == "web-1"
+    assert domain.find("memory").get("unit") == "MiB" and domain.findtext("memory") == "2048"
+    assert domain.findtext("vcpu") == "4"
+    assert [element.get("file") for element in domain.findall("devices/disk/source")] == ["/var/lib/a.qcow2", "/var/lib/b.img"]
+    assert [element.get("dev") for element in domain.findall("devices/disk/target")] == ["vda", "vdb"]
+    assert [element.get("type") for element in domain.findall("devices/disk/driver")] == ["qcow2", "raw"]
+    assert domain.find("devices/interface/source").get("network") == "default"
+    assert domain.find("devices/interface/model").get("type") == "virtio"
+    assert domain.find("os/boot").get("dev") == "hd"
+    # nothing optional unless asked for
+    assert domain.find("uuid") is None and domain.find("metadata") is None and domain.find("cputune") is None
+
+
+def test_render_escapes_the_vm_fields():
+    template = DomainTemplate(disks=[disk()])
+    domain = ET.fromstring(template.render("a&b<c>", 512, 1, uuid="x\"y", sources=['/images/"quoted" & <odd>.qcow2']))
+
+    assert domain.findtext("name") == "a&b<c>"
+    assert domain.findtext("uuid") == "x\"y"
+    assert domain.find("devices/disk/source").get("file") == '/images/"quoted" & <odd>.qcow2'
+
+
+def test_render_does_not_leak_between_vms():
+    template = DomainTemplate(disks=[disk(source="/images/{name}.qcow2")])
+    first = template.render("web-1", 1024, 1, uuid="1111")
+    second = ET.fromstring(template.render("web-2", 2048, 2))
+
+    assert ET.fromstring(first).find("devices/disk/source").get("file") == "/images/web-1.qcow2"
+    assert second.find("devices/disk/source").get("file") == "/images/web-2.qcow2"
+    assert second.findtext("memory") == "2048" and second.find("uuid") is None
+
+
+def test_render_adds_uuid_and_metadata():
+    metadata = ET.Element("{https://example.com/vmctl}manifest", {"hash": "abc"})
+    domain = ET.fromstring(DomainTemplate(disks=[disk()]).render("web-1", 512, 1, uuid="6ba7b810", sources=["/a.qcow2"],
+                                                                 metadata=metadata))
+
+    assert domain.findtext("uuid") == "6ba7b810"
+    assert domain.find("metadata/{https://example.com/vmctl}manifest").get("hash") == "abc"
+    # both right after the name, where libvirt puts them
+    assert [child.tag for child in domain][:3] == ["name", "uuid", "metadata"]
+
+
+def test_render_pins_placed_vms():
+    domain = ET.fromstring(DomainTemplate(disks=[disk()]).render("web-1", 512, 2, sources=["/a.qcow2"],
+                                                                 placement={"node": 1, "cpus": [6, 14]}))
+
+    pins = [(pin.get("vcpu"), pin.get("cpuset")) for pin in domain.findall("cputune/vcpupin")]
+    assert pins == [("0", "6"), ("1", "14")]
+    assert domain.find("numatune/memory").attrib == {"mode": "strict", "nodeset": "1"}
+
+
+def test_template_options():
+    template = DomainTemplate(disks=[disk(), disk(bus="scsi"), disk(bus="scsi", target="sdq", readonly=True)],
+                              interfaces=[{"bridge": "br0", "mac": "52:54:00:00:00:01"}],
+                              topology={"sockets": 1, "cores": 2, "threads": 2}, hugepages=2048,
+                              numa={"nodeset": "0", "mode": "preferred", "cpuset": "0-3",
+                                    "cells": [{"cpus": "0-1", "memory": 512}, {"cpus": "2-3", "memory": 512}]})
+    domain = ET.fromstring(template.render("web-1", 1024, 4, sources=["/a", "/b", "/c"]))
+
+    assert [element.get("dev") for element in domain.findall("devices/disk/target")] == ["vda", "sda", "sdq"]
+    assert domain.find("devices/disk[3]/readonly") is not None
+    assert domain.find("devices/interface").get("type") == "bridge"
+    assert domain.find("devices/interface/mac").get("address") == "52:54:00:00:00:01"
+    assert domain.find("cpu/topology").attrib == {"sockets": "1", "cores": "2", "threads": "2"}
+    assert [cell.get("cpus") for cell in domain.findall("cpu/numa/cell")] == ["0-1", "2-3"]
+    assert domain.find("memoryBacking/hugepages/page").get("size") == "2048"
+    assert domain.find("vcpu").get("cpuset") == "0-3"
+    assert domain.find("numatune/memory").attrib == {"mode": "preferred", "nodeset": "0"}
+
+
+@pytest.mark.parametrize("options", [
+    {"disks": [disk(size=10)]},
+    {"disks": [disk(bus="floppy")]},
+    {"disks": ["/a.qcow2"]},
+    {"interfaces": [{"network": "default", "vlan": 5}]},
+    {"topology": {"sockets": 1, "cores": "two", "threads": 1}},
+    {"numa": {"nodeset": "0", "mode": "random"}},
+    {"numa": {"cells": [{"cpus": "0"}]}},
+])
+def test_invalid_templates(options):
+    with pytest.raises(VmctlError):
+        DomainTemplate(**options)
+
+
+@pytest.mark.parametrize("options, render", [
+    ({"disks": [disk()], "topology": {"sockets": 1, "cores": 2, "threads": 1}}, {"vm_vcpus": 4}),
+    ({"disks": [disk()], "numa": {"cells": [{"cpus": "0", "memory": 256}]}}, {}),
+    ({"disks": [disk(), disk()]}, {}),
+    ({"disks": [disk()]}, {"sources": [None]}),
+    ({"disks": [disk()]}, {"placement": {"node": 0, "cpus": [1]}}),
+    ({"disks": [disk()], "numa": {"nodeset": "0"}}, {"placement": {"node": 0, "cpus": [1, 2]}}),
+])
+def test_invalid_renders(options, render):
+    render = {"vm_name": "web-1", "vm_memory": 1024, "vm_vcpus": 2, "sources": ["/a.qcow2"], **render}
+    with pytest.raises(VmctlError):
+        DomainTemplate(**options).render(**render)
+
+
+def test_templates_are_compiled_once():
+    first = get_template(disks=[disk()], interfaces=[{"network": "default"}])
+    assert get_template(interfaces=[{"network": "default"}], disks=[disk()]) is first
+    assert get_template(disks=[disk(bus="scsi")], interfaces=[{"network": "default"}]) is not first
+
+
+def test_create_xml_from_spec_with_an_iso():
+    domain = ET.fromstring(create_xml_from_spec({"name": "installer", "memory": 1024, "vcpus": 1, "iso": "/isos/debian.iso"}))
+
+    assert domain.find("os/boot").get("dev") == "cdrom"
+    cdrom = domain.find("devices/disk")
+    assert cdrom.get("device") == "cdrom" and cdrom.find("readonly") is not None
+    assert cdrom.find("target").get("dev") == "hdc" and cdrom.find("source").get("file") == "/isos/debian.iso"
+    assert domain.find("devices/interface/source").get("network") == "default"
+
+
+def test_create_xml_from_spec_with_disks_and_placement():
+    spec = {
+        "name": "db-1", "memory": 4096, "vcpus": 2,
+        "disks": [disk(source="/images/{name}-root.qcow2"), disk(source="/images/{name}-data.qcow2")],
+        "interfaces": [{"bridge": "br0"}],
+        "topology": {"sockets": 1, "cores": 1, "threads": 2},
+    }
+    domain = ET.fromstring(create_xml_from_spec(spec, uuid="1234", placement={"node": 0, "cpus": [2, 3]}))
+
+    assert domain.findtext("name") == "db-1" and domain.findtext("uuid") == "1234"
+    assert [element.get("file") for element in domain.findall("devices/disk/source")] == \
+        ["/images/db-1-root.qcow2", "/images/db-1-data.qcow2"]
+    assert domain.find("devices/interface/source").get("bridge") == "br0"
+    assert [pin.get("cpuset") for pin in domain.findall("cputune/vcpupin")] == ["2", "3"]
+
+
+def test_create_xml_from_spec_matches_create_xml_config():
+    spec = {"name": "web-1", "memory": 1024, "vcpus": 2, "disk": "/images/web-1.qcow2"}
+    assert create_xml_from_spec(spec) == create_xml_config("web-1", 1024, 2, disk_path="/images/web-1.qcow2")
+
+
+@pytest.mark.parametrize("paths", [{}, {"iso_path": "/a.iso", "disk_path": "/a.qcow2"}])
+def test_create_xml_config_needs_one_path(paths):
+    with pytest.raises(VmctlError):
+        create_xml_config("web-1", 1024, 1, **paths)